@@ -0,0 +1,591 @@
+"""
+Batch Ingest Module
+
+This module unpacks a batch of images sent in one request, as multipart
+files or as a tar or zip archive, and hands them to batch tasks while the
+rest of the request is still arriving. Entries are parsed from the body as
+a stream and written to the upload directory one at a time, so neither the
+request nor the archive is held in memory or spooled to disk first. Every
+``BATCH_INGEST_SIZE`` images are handed to the dispatcher, which splits
+them into GPU batches.
+
+The items of a batch and the tasks processing them are kept in the task
+status store under the batch ID, so that every API process can report the
+progress of a batch.
+"""
+
+import hashlib
+import os
+import struct
+import tarfile
+import time
+import uuid
+import zlib
+from collections import Counter
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+from . import task_status
+from .cache import make_cache_key, result_cache
+from .storage import output_store, upload_store
+from .uploads import CHUNK_SIZE, MAX_UPLOAD_SIZE
+
+# Images handed to the dispatcher at a time while a batch is ingested
+BATCH_INGEST_SIZE = int(os.getenv("BATCH_INGEST_SIZE", 64))
+# Most images accepted in one batch; later entries are rejected
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100000))
+
+# Request content types mapped to the body formats they are parsed as
+BODY_FORMATS = {
+    "multipart/form-data": "multipart",
+    "application/x-tar": "tar",
+    "application/x-gtar": "tar",
+    "application/gzip": "tar",
+    "application/x-gzip": "tar",
+    "application/zip": "zip",
+    "application/x-zip-compressed": "zip",
+}
+
+
+class ArchiveError(ValueError):
+    """
+    Raised when a batch body is malformed or uses an unsupported feature.
+    """
+
+
+def body_format(content_type):
+    """
+    Return the format a batch body of a content type is parsed as.
+
+    Args:
+        content_type (str): The Content-Type header of the request.
+
+    Returns:
+        tuple: The format ('multipart', 'tar' or 'zip', or None if the
+        type is not supported) and the multipart boundary, or None.
+    """
+    media_type, options = parse_options_header(content_type or "")
+    return (BODY_FORMATS.get(media_type.decode("latin-1").lower()),
+            options.get(b"boundary"))
+
+
+class BatchIngest:
+    """
+    Writes the images of a batch to disk and dispatches them in groups.
+
+    Entries are pushed with ``begin``, ``write`` and ``end`` between
+    ``start`` and ``finish``, or read from a whole body with ``run``. An
+    image that was processed before is served from the result cache; the
+    others are collected into jobs, and every ``group_size`` items are
+    dispatched and saved to the store.
+
+    Attributes:
+        batch_id (str): The ID of the batch.
+        operation (str): 'decode' or 'encode'.
+        priority (int): Priority of the jobs.
+        total (int): Number of items so far, including rejected ones.
+        rejected (int): Number of entries that were not accepted.
+    """
+
+    def __init__(self, batch_id, operation, priority, dispatch, index=None,
+                 store=None, group_size=BATCH_INGEST_SIZE,
+                 max_items=BATCH_MAX_ITEMS, max_size=None):
+        """
+        Initialize the BatchIngest.
+
+        Args:
+            batch_id (str): The ID of the batch.
+            operation (str): 'decode' or 'encode'.
+            priority (int): Priority of the jobs.
+            dispatch (callable): Called with a list of jobs; returns the
+                task ID of each job.
+            index (callable): Called with the file ID and path of each
+                image, e.g. to add its header to the image index.
+            store (MemoryStatusStore or RedisStatusStore): Where the batch
+                is saved. Defaults to the shared task status store.
+            group_size (int): Items dispatched and saved at a time.
+            max_items (int): Most images accepted in the batch.
+            max_size (int): Largest accepted image in bytes. Defaults to
+                ``MAX_UPLOAD_SIZE``; 0 disables the limit.
+        """
+        self.batch_id = batch_id
+        self.operation = operation
+        self.priority = priority
+        self.dispatch = dispatch
+        self.index = index
+        self.store = store or task_status.status_store
+        self.group_size = group_size
+        self.max_items = max_items
+        self.max_size = MAX_UPLOAD_SIZE if max_size is None else max_size
+        self.total = 0
+        self.rejected = 0
+        self._groups = 0
+        self._items = []
+        self._jobs = []
+        self._current = None
+
+    def start(self):
+        """
+        Save the batch as being ingested.
+        """
+        self.store.update(self.batch_id, {
+            "kind": "batch", "state": "INGESTING",
+            "operation": self.operation, "priority": self.priority,
+            "created_at": time.time()})
+
+    def begin(self, name):
+        """
+        Start an entry of the batch.
+
+        Directories and hidden files, such as the resource forks of macOS
+        archives, are skipped.
+
+        Args:
+            name (str): The file name or archive path of the entry.
+        """
+        self._abort()
+        basename = os.path.basename(name.replace("\\", "/"))
+        if not basename or basename.startswith("."):
+            return
+        item = {"name": name}
+        self._current = {"item": item, "file": None, "size": 0,
+                         "digest": hashlib.sha256()}
+        if self.total >= self.max_items:
+            item["error"] = f"Batch exceeds {self.max_items} images"
+            return
+        file_id = str(uuid.uuid4())
+        path = upload_store.path(file_id, f"_{basename}", create=True)
+        item.update(file_id=file_id, input=path,
+                    output=output_store.path(
+                        file_id, f"_{basename}", create=True))
+        self._current["file"] = open(f"{path}.part", "wb")
+
+    def write(self, data):
+        """
+        Append data to the current entry.
+        """
+        current = self._current
+        if current is None or current["file"] is None:
+            return
+        current["size"] += len(data)
+        if self.max_size and current["size"] > self.max_size:
+            current["item"]["error"] = (
+                f"Image exceeds the limit of {self.max_size} bytes")
+            self._discard_file()
+            return
+        current["digest"].update(data)
+        current["file"].write(data)
+
+    def end(self):
+        """
+        Finish the current entry and queue its job.
+        """
+        current, self._current = self._current, None
+        if current is None:
+            return
+        item = current["item"]
+        self.total += 1
+        if "error" in item:
+            self.rejected += 1
+            item["state"] = "FAILURE"
+            self._items.append(item)
+            self._maybe_flush()
+            return
+
+        current["file"].close()
+        path = item["input"]
+        os.replace(f"{path}.part", path)
+        if self.index is not None:
+            self.index(item["file_id"], path)
+        cache_key = make_cache_key(
+            current["digest"].hexdigest(), self.operation)
+        if (result_cache.get(cache_key) is not None
+                and result_cache.materialize(cache_key, item["output"])):
+            output_store.register(item["output"])
+            item.update(state="SUCCESS", cached=True)
+        else:
+            self._jobs.append((item, {
+                "input_image": path,
+                "output_image": item["output"],
+                "operation": self.operation,
+                "cache_key": cache_key,
+                "file_id": item["file_id"],
+                "priority": self.priority,
+                "enqueued_at": time.time(),
+            }))
+        self._items.append(item)
+        self._maybe_flush()
+
+    def finish(self, error=None):
+        """
+        Dispatch the remaining items and mark the batch as ingested.
+
+        Args:
+            error (str): Why the body could not be read to its end; the
+                items read before are processed anyway.
+        """
+        self._abort()
+        self._flush()
+        fields = {"state": "INGESTED", "ingested_at": time.time(),
+                  "total": self.total, "rejected": self.rejected}
+        if error is not None:
+            fields["error"] = error
+        self.store.update(self.batch_id, fields)
+
+    def run(self, body, body_format, boundary=None):
+        """
+        Ingest every entry of a request body, between ``start`` and
+        ``finish``.
+
+        Args:
+            body (file): The body, as a buffered binary file.
+            body_format (str): 'multipart', 'tar' or 'zip'.
+            boundary (bytes): The boundary of a multipart body.
+
+        Raises:
+            ArchiveError: If the body is malformed; the entries read before
+                are dispatched.
+        """
+        self.start()
+        error = "The request ended before its body was read"
+        try:
+            if body_format == "multipart":
+                self._read_multipart(body, boundary)
+            elif body_format == "tar":
+                with tarfile.open(fileobj=body, mode="r|*") as archive:
+                    for member in archive:
+                        if member.isfile():
+                            self._copy(member.name,
+                                       archive.extractfile(member))
+            elif body_format == "zip":
+                for name, entry in iter_zip_entries(body):
+                    if not name.endswith("/"):
+                        self._copy(name, entry)
+            else:
+                raise ArchiveError(f"Unsupported body format {body_format}")
+            error = None
+        except (tarfile.TarError, zlib.error, EOFError,
+                FormParserError) as e:
+            error = f"Invalid {body_format} body: {e}"
+            raise ArchiveError(error) from e
+        except ArchiveError as e:
+            error = str(e)
+            raise
+        finally:
+            self.finish(error)
+
+    def _copy(self, name, entry):
+        self.begin(name)
+        while True:
+            data = entry.read(CHUNK_SIZE)
+            if not data:
+                break
+            self.write(data)
+        self.end()
+
+    def _read_multipart(self, body, boundary):
+        if not boundary:
+            raise ArchiveError("Multipart body without a boundary")
+        headers = {}
+        header = [b"", b""]
+        ended = []
+
+        def on_header_field(data, start, end):
+            header[0] += data[start:end]
+
+        def on_header_value(data, start, end):
+            header[1] += data[start:end]
+
+        def on_header_end():
+            headers[header[0].lower()] = header[1]
+            header[:] = [b"", b""]
+
+        def on_headers_finished():
+            # Form fields without a file name are ignored
+            _, options = parse_options_header(
+                headers.pop(b"content-disposition", b""))
+            headers.clear()
+            filename = options.get(b"filename")
+            if filename:
+                self.begin(filename.decode("utf-8", "replace"))
+
+        def on_part_data(data, start, end):
+            self.write(data[start:end])
+
+        parser = multipart.MultipartParser(boundary, {
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": self.end,
+            "on_end": lambda: ended.append(True),
+        })
+        while True:
+            data = body.read(CHUNK_SIZE)
+            if not data:
+                break
+            parser.write(data)
+        parser.finalize()
+        if not ended:
+            raise ArchiveError("Truncated multipart body")
+
+    def _maybe_flush(self):
+        if len(self._items) >= self.group_size:
+            self._flush()
+
+    def _flush(self):
+        """
+        Dispatch the queued jobs and save the items since the last flush.
+        """
+        if self._jobs:
+            task_ids = self.dispatch([job for _, job in self._jobs])
+            for (item, _), task_id in zip(self._jobs, task_ids):
+                item["task_id"] = task_id
+        if self._items:
+            self.store.update(self.batch_id, {
+                f"items-{self._groups:06d}": self._items,
+                "total": self.total})
+            self._groups += 1
+        self._items = []
+        self._jobs = []
+
+    def _abort(self):
+        # Drop an entry that was not ended, e.g. by a truncated body
+        if self._current is not None:
+            self._discard_file()
+            self._current = None
+
+    def _discard_file(self):
+        current = self._current
+        if current["file"] is not None:
+            current["file"].close()
+            try:
+                os.remove(current["file"].name)
+            except FileNotFoundError:
+                pass
+            current["file"] = None
+
+
+def batch_status(batch_id, store=None):
+    """
+    Return the progress of a batch and the state of each of its items.
+
+    Args:
+        batch_id (str): The ID of the batch.
+        store (MemoryStatusStore or RedisStatusStore): Where the batch is
+            kept. Defaults to the shared task status store.
+
+    Returns:
+        dict: The batch, or None if it is unknown. 'state' is INGESTING
+        while the request is read, RUNNING until every item is finished,
+        then SUCCESS, or FAILURE if any item failed. 'progress' counts the
+        items per state.
+    """
+    store = store or task_status.status_store
+    batch = store.get(batch_id)
+    if batch is None or batch.get("kind") != "batch":
+        return None
+    items = []
+    for name in sorted(name for name in batch if name.startswith("items-")):
+        items.extend(batch[name])
+
+    tasks = {}
+    for item in items:
+        task_id = item.get("task_id")
+        if task_id is not None:
+            if task_id not in tasks:
+                tasks[task_id] = store.get(task_id) or {}
+            item["state"] = tasks[task_id].get("state", "PENDING")
+            if tasks[task_id].get("error"):
+                item["error"] = tasks[task_id]["error"]
+    progress = Counter(item["state"] for item in items)
+    completed = sum(progress[state] for state in task_status.FINAL_STATES)
+
+    if batch["state"] == "INGESTING":
+        state = "INGESTING"
+    elif completed < len(items):
+        state = "RUNNING"
+    else:
+        state = "FAILURE" if progress["FAILURE"] else "SUCCESS"
+    return {
+        "batch_id": batch_id,
+        "state": state,
+        "operation": batch.get("operation"),
+        "total": len(items),
+        "completed": completed,
+        "failed": progress["FAILURE"],
+        "progress": dict(progress),
+        "created_at": batch.get("created_at"),
+        "ingested_at": batch.get("ingested_at"),
+        "error": batch.get("error"),
+        "items": items,
+    }
+
+
+# Signatures of the records that follow the entries of a zip archive
+_ZIP_TRAILERS = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07",
+                 b"PK\x05\x05")
+
+
+class _PushbackReader:
+    """
+    A binary file that data read too far can be pushed back onto.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.pending = b""
+
+    def read(self, size):
+        if not self.pending:
+            return self.raw.read(size)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        if len(data) < size:
+            data += self.raw.read(size - len(data))
+        return data
+
+    def read_exact(self, size):
+        data = self.read(size)
+        if len(data) < size:
+            raise ArchiveError("Truncated zip archive")
+        return data
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+
+class _ZipEntryReader:
+    """
+    Reads the data of one zip entry from the archive stream.
+
+    Stored and deflated entries are supported. A deflated entry whose size
+    is only given in the data descriptor after it is read until the end of
+    its deflate stream. The CRC and size are checked when the end of the
+    entry is reached.
+    """
+
+    def __init__(self, stream, flags, method, crc, compressed_size, size,
+                 zip64):
+        if flags & 0x1:
+            raise ArchiveError("Encrypted zip entries are not supported")
+        if method not in (0, 8):
+            raise ArchiveError(f"Unsupported zip compression method {method}")
+        self.stream = stream
+        self.has_descriptor = bool(flags & 0x8)
+        if method == 0 and self.has_descriptor:
+            raise ArchiveError(
+                "Stored zip entries without sizes are not supported")
+        self.zip64 = zip64
+        self.crc = crc
+        self.size = size
+        self.decompressor = zlib.decompressobj(-15) if method == 8 else None
+        self.remaining = None if self.has_descriptor else compressed_size
+        self.done = False
+        self._crc = 0
+        self._size = 0
+        if self.decompressor is None and not self.remaining:
+            self._finish()
+
+    def read(self, size=CHUNK_SIZE):
+        while not self.done:
+            data, end = self._next(size)
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += len(data)
+            if end:
+                self._finish()
+            if data:
+                return data
+        return b""
+
+    def _next(self, size):
+        if self.decompressor is None:
+            data = self.stream.read_exact(min(size, self.remaining))
+            self.remaining -= len(data)
+            return data, not self.remaining
+        compressed = self.decompressor.unconsumed_tail
+        if not compressed:
+            want = size if self.remaining is None else min(
+                size, self.remaining)
+            compressed = self.stream.read(want)
+            if not compressed:
+                raise ArchiveError("Truncated zip archive")
+            if self.remaining is not None:
+                self.remaining -= len(compressed)
+        data = self.decompressor.decompress(compressed, size)
+        if self.decompressor.eof:
+            self.stream.unread(self.decompressor.unused_data)
+            return data, True
+        return data, False
+
+    def _finish(self):
+        self.done = True
+        if self.has_descriptor:
+            signature = self.stream.read_exact(4)
+            if signature != b"PK\x07\x08":
+                self.stream.unread(signature)
+            layout = "<IQQ" if self.zip64 else "<III"
+            self.crc, _, self.size = struct.unpack(
+                layout, self.stream.read_exact(struct.calcsize(layout)))
+        if self._crc != self.crc or self._size != self.size:
+            raise ArchiveError("Corrupt zip entry: CRC or size mismatch")
+
+
+def iter_zip_entries(body):
+    """
+    Read the entries of a zip archive from a stream, in archive order.
+
+    Only the local headers that precede each entry are used; the central
+    directory at the end of the archive is not needed, so entries are
+    returned as they arrive.
+
+    Args:
+        body (file): The archive, as a binary file.
+
+    Yields:
+        tuple: The name of each entry and a reader of its data. The data
+        must be read before the next entry, or is skipped.
+
+    Raises:
+        ArchiveError: For malformed archives and encrypted entries, or
+            compression methods other than stored and deflate.
+    """
+    stream = _PushbackReader(body)
+    while True:
+        signature = stream.read(4)
+        if not signature or signature in _ZIP_TRAILERS:
+            return
+        if signature != b"PK\x03\x04":
+            raise ArchiveError("Invalid zip entry header")
+        (flags, method, crc, compressed_size, size, name_length,
+         extra_length) = struct.unpack("<2xHH4xIIIHH", stream.read_exact(26))
+        raw_name = stream.read_exact(name_length)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = stream.read_exact(extra_length)
+
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            tag, length = struct.unpack_from("<HH", extra, offset)
+            if tag == 0x0001:
+                zip64 = True
+                values = iter(struct.unpack_from(
+                    f"<{length // 8}Q", extra, offset + 4))
+                if size == 0xFFFFFFFF:
+                    size = next(values, size)
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = next(values, compressed_size)
+            offset += 4 + length
+
+        entry = _ZipEntryReader(stream, flags, method, crc, compressed_size,
+                                size, zip64)
+        yield name, entry
+        while entry.read():
+            pass
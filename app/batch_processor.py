@@ -3,96 +3,291 @@ Batch Processor Module
 
 This module handles the batch processing of image jobs using the nvJPEG2000 library.
 Jobs are processed in batches to optimize GPU usage.
+
+Within a batch, reading inputs, running the codec and writing outputs are
+pipelined: the input of the next job is prefetched and the output of the
+previous job is written while the current job is on the GPU.
 """
 
-from celery import Celery
-from .gpu_manager import gpu_manager
+from . import task_status
+from .gpu_manager import gpu_manager, GPUUnavailableError, GPU_WAIT_TIMEOUT
+from .cache import result_cache
+from .codec_pool import CPU_DEVICE, codec_pools
+from .metrics import observe_stage, time_codec, time_stage
+from .scheduler import scheduler
+from .tasks import (
+    celery, map_input, prefer_cpu, release_after, set_decode_window,
+    write_output,
+    GPU_RETRY_DELAY, GPU_MAX_RETRIES)
+import contextvars
+import logging
 import os
+import queue
+import threading
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Number of jobs buffered between pipeline stages
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", 2))
+
+# Marks the end of the jobs flowing through a pipeline queue
+_DONE = object()
+
 
-# Conditionally import the actual or mock nvJPEG2000 library based on the
-# environment variable
-if os.getenv("USE_MOCK_NVJPEG2000", "true").lower() == "true":
-    from .mock_nvjpeg2000 import *
-else:
-    import nvjpeg2000
+class BatchJobError(Exception):
+    """
+    Raised when jobs of a batch failed; the other jobs were processed.
+
+    Attributes:
+        errors (dict): Indexes of the failed jobs mapped to their errors.
+    """
 
-# Create a Celery instance for batch processing
-celery = Celery(
-    'batch_processor',
-    broker='redis://redis:6379/0',
-    backend='redis://redis:6379/0')
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or {}
 
 
-@celery.task
-def process_batch(jobs):
+@celery.task(bind=True, max_retries=GPU_MAX_RETRIES, track_status=True)
+def process_batch(self, jobs, priority=0, cost=None):
     """
     Process a batch of image jobs.
 
+    The task waits up to ``GPU_WAIT_TIMEOUT`` seconds for a GPU, with
+    higher-priority and shorter batches served first, and is retried if
+    none frees up. A batch expected to finish sooner on the CPU codec than
+    on a GPU, counting the wait for the GPU, is run on the CPU instead. The
+    codec time of each job annotated with its 'work' by the scheduler is
+    fed back into the cost model.
+
     Args:
         jobs (list): A list of job dictionaries, each containing 'input_image', 'output_image', and 'operation'.
+            An optional 'cache_key' stores the output in the result cache, and
+            optional 'reduce' and 'region' restrict decodes as for
+            ``process_image``.
+        priority (int): Priority of the batch (default is 0).
+        cost (float): Expected GPU seconds of the batch.
 
     Returns:
         list: A list of results for each job.
+
+    Raises:
+        BatchJobError: If any job failed, once the others are processed.
     """
-    gpu_id = gpu_manager.allocate_gpu()
+    if prefer_cpu(jobs):
+        return run_batch(self.request.id, jobs, CPU_DEVICE)
+
+    wait_start = perf_counter()
+    gpu_id = gpu_manager.allocate_gpu(
+        priority=priority, timeout=GPU_WAIT_TIMEOUT, cost=cost)
+    observe_stage("gpu_wait", perf_counter() - wait_start, "batch",
+                  "" if gpu_id is None else gpu_id)
     if gpu_id is None:
-        return "No GPU available. Please try again later."
+        raise self.retry(
+            exc=GPUUnavailableError("No GPU available"),
+            countdown=GPU_RETRY_DELAY)
 
     try:
-        results = []
-        for job in jobs:
-            input_image, output_image, operation = job['input_image'], job['output_image'], job['operation']
-            if operation == 'decode':
-                decode_image(input_image, output_image, gpu_id)
-            elif operation == 'encode':
-                encode_image(input_image, output_image, gpu_id)
-            results.append(f"Job {input_image} completed successfully")
-        return results
-    except Exception as e:
-        return str(e)
+        return run_batch(self.request.id, jobs, gpu_id)
     finally:
         gpu_manager.release_gpu(gpu_id)
 
 
-def decode_image(input_image, output_image, gpu_id):
+def run_batch(task_id, jobs, gpu_id):
     """
-    Decode a JPEG2000 image using the specified GPU.
+    Run a batch of jobs on a device and record the outcome of its task.
+
+    If jobs fail, the task records FAILURE with the error of each failed
+    job under 'job_errors', keyed by its output path, and the outputs of
+    the others.
+
+    Args:
+        task_id (str): ID of the task of the batch.
+        jobs (list): A list of job dictionaries, as for ``process_batch``.
+        gpu_id (int): The ID of the GPU to use, or ``CPU_DEVICE``.
+
+    Returns:
+        list: A list of results for each job.
+
+    Raises:
+        BatchJobError: If any job failed.
+    """
+    device = "the CPU" if gpu_id == CPU_DEVICE else f"GPU {gpu_id}"
+    try:
+        with task_status.report_outcome(
+                task_id, [job['output_image'] for job in jobs]):
+            results, timings = run_pipeline(jobs, gpu_id)
+    except BatchJobError as e:
+        task_status.record(
+            task_id, "FAILURE",
+            outputs=[job['output_image'] for index, job in enumerate(jobs)
+                     if index not in e.errors],
+            job_errors={jobs[index]['output_image']: str(error)
+                        for index, error in e.errors.items()})
+        raise
+    logger.info(
+        f"Batch of {len(jobs)} jobs on {device} took "
+        f"{timings['total']:.2f} seconds (read {timings['read']:.2f}, "
+        f"codec {timings['codec']:.2f}, write {timings['write']:.2f})")
+    return results
+
+
+def run_pipeline(jobs, gpu_id, depth=PIPELINE_DEPTH):
+    """
+    Run a batch of jobs through a read, codec and write pipeline.
+
+    A reader thread prefetches inputs and a writer thread writes outputs,
+    while the calling thread runs the codec. The stages are connected by
+    queues holding at most ``depth`` jobs, which caps the memory used by a
+    batch. A job failing in any stage is skipped by the later stages while
+    the other jobs go on, and the errors are raised together once all jobs
+    are done.
+
+    Args:
+        jobs (list): A list of job dictionaries, as for ``process_batch``.
+        gpu_id (int): The ID of the GPU to use, or ``CPU_DEVICE``.
+        depth (int): Number of jobs buffered between stages.
+
+    Returns:
+        tuple: The list of results for each job and a dict with the time in
+        seconds spent in the 'read', 'codec' and 'write' stages and the
+        'total' wall time.
+
+    Raises:
+        BatchJobError: If any job failed.
+    """
+    read_queue = queue.Queue(maxsize=depth)
+    write_queue = queue.Queue(maxsize=depth)
+    errors = {}
+    results = [None] * len(jobs)
+    timings = {"read": 0.0, "codec": 0.0, "write": 0.0}
+    start_time = perf_counter()
+
+    def fail(index, job, error):
+        logger.warning(f"Job {job['input_image']} of a batch failed: "
+                       f"{error}")
+        errors[index] = error
+        results[index] = f"Job {job['input_image']} failed: {error}"
+
+    def reader():
+        for index, job in enumerate(jobs):
+            stage_start = perf_counter()
+            try:
+                image_data = read_input(job['input_image'])
+            except Exception as e:
+                fail(index, job, e)
+                continue
+            timings["read"] += perf_counter() - stage_start
+            read_queue.put((index, job, image_data))
+        read_queue.put(_DONE)
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                break
+            index, job, output_data = item
+            stage_start = perf_counter()
+            try:
+                if output_data is not None:
+                    with time_stage("output_write", job['operation'], gpu_id):
+                        write_output(job['output_image'], output_data)
+                if job.get('cache_key'):
+                    result_cache.put(job['cache_key'], job['output_image'])
+            except Exception as e:
+                fail(index, job, e)
+                continue
+            timings["write"] += perf_counter() - stage_start
+            results[index] = f"Job {job['input_image']} completed successfully"
+
+    # The stages run in the trace context of the batch
+    threads = [threading.Thread(target=contextvars.copy_context().run,
+                                args=(stage,), daemon=True)
+               for stage in (reader, writer)]
+    for thread in threads:
+        thread.start()
+
+    # Failed jobs are dropped from the later stages; every stage still
+    # drains its queue, so every thread reaches the end marker.
+    while True:
+        item = read_queue.get()
+        if item is _DONE:
+            break
+        index, job, image_data = item
+        with release_after(image_data):
+            stage_start = perf_counter()
+            try:
+                output_data = process_data(
+                    job['operation'], image_data, gpu_id,
+                    job.get('reduce', 0), job.get('region'))
+            except Exception as e:
+                fail(index, job, e)
+                continue
+        codec_time = perf_counter() - stage_start
+        timings["codec"] += codec_time
+        scheduler.observe(job, codec_time, cpu=gpu_id == CPU_DEVICE)
+        write_queue.put((index, job, output_data))
+    write_queue.put(_DONE)
+
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BatchJobError(
+            f"{len(errors)} of {len(jobs)} jobs failed: "
+            + "; ".join(results[index] for index in sorted(errors)),
+            errors)
+    timings["total"] = perf_counter() - start_time
+    return results, timings
+
+
+def read_input(input_image):
+    """
+    Open an input image file and start reading it ahead of the codec.
 
     Args:
         input_image (str): Path to the input image file.
-        output_image (str): Path to the output image file.
-        gpu_id (int): The ID of the GPU to use.
+
+    Returns:
+        memoryview: The memory-mapped contents of the file.
     """
-    nvjpeg2k_handle = nvjpeg2kCreate()
-    nvjpeg2k_decode_state = nvjpeg2kDecodeStateCreate(nvjpeg2k_handle)
-    nvjpeg2k_stream = nvjpeg2kStreamCreate(nvjpeg2k_handle)
+    return map_input(input_image, prefetch=True)
 
-    with open(input_image, 'rb') as f:
-        image_data = f.read()
 
-    nvjpeg2kStreamParse(
-        nvjpeg2k_handle,
-        nvjpeg2k_stream,
-        image_data,
-        len(image_data))
+def process_data(operation, image_data, gpu_id, reduce=0, region=None):
+    """
+    Run the codec operation of a job on image data.
 
-    image_info = nvjpeg2kStreamGetImageInfo(nvjpeg2k_stream)
-    width, height, num_components = image_info.width, image_info.height, image_info.num_components
-    decoded_image = nvjpeg2kDecode(
-        nvjpeg2k_handle,
-        nvjpeg2k_decode_state,
-        nvjpeg2k_stream,
-        width,
-        height,
-        num_components,
-        gpu_id)
+    Args:
+        operation (str): Operation to perform ('decode' or 'encode').
+        image_data (memoryview): The input image data.
+        gpu_id (int): The ID of the GPU to use.
+        reduce (int): Resolution levels skipped by a decode.
+        region (tuple): (x, y, width, height) decoded, or None.
 
-    with open(output_image, 'wb') as f:
-        f.write(decoded_image)
+    Returns:
+        bytes: The processed image, or None for an unknown operation.
+    """
+    if operation == 'decode':
+        return decode_data(image_data, gpu_id, reduce, region)
+    elif operation == 'encode':
+        return encode_data(image_data, gpu_id)
+    return None
 
-    nvjpeg2kDecodeStateDestroy(nvjpeg2k_decode_state)
-    nvjpeg2kStreamDestroy(nvjpeg2k_stream)
-    nvjpeg2kDestroy(nvjpeg2k_handle)
+
+def decode_image(input_image, output_image, gpu_id, reduce=0, region=None):
+    """
+    Decode a JPEG2000 image using the specified GPU.
+
+    Args:
+        input_image (str): Path to the input image file.
+        output_image (str): Path to the output image file.
+        gpu_id (int): The ID of the GPU to use.
+        reduce (int): Resolution levels skipped by the decode.
+        region (tuple): (x, y, width, height) decoded, or None.
+    """
+    with release_after(read_input(input_image)) as image_data:
+        output_data = decode_data(image_data, gpu_id, reduce, region)
+    write_output(output_image, output_data)
 
 
 def encode_image(input_image, output_image, gpu_id):
@@ -104,28 +299,78 @@ def encode_image(input_image, output_image, gpu_id):
         output_image (str): Path to the output image file.
         gpu_id (int): The ID of the GPU to use.
     """
-    nvjpeg2k_handle = nvjpeg2kCreate()
-    nvjpeg2k_encode_state = nvjpeg2kEncodeStateCreate(nvjpeg2k_handle)
-    nvjpeg2k_stream = nvjpeg2kStreamCreate(nvjpeg2k_handle)
+    with release_after(read_input(input_image)) as image_data:
+        output_data = encode_data(image_data, gpu_id)
+    write_output(output_image, output_data)
+
+
+def decode_data(image_data, gpu_id, reduce=0, region=None):
+    """
+    Decode JPEG2000 image data using the specified GPU.
+
+    Only the tiles and resolution levels needed for ``reduce`` and
+    ``region`` are decoded; see ``set_decode_window``.
+
+    Args:
+        image_data (memoryview): The JPEG2000 codestream.
+        gpu_id (int): The ID of the GPU to use.
+        reduce (int): Resolution levels to skip.
+        region (tuple): (x, y, width, height) to decode, or None.
+
+    Returns:
+        bytes: The decoded image.
+    """
+    with codec_pools.checkout(gpu_id) as codec:
+        nvjpeg2k = codec.codec
+        with time_stage("parse", "decode", gpu_id):
+            nvjpeg2k.nvjpeg2kStreamParse(
+                codec.handle,
+                codec.stream,
+                image_data,
+                len(image_data))
+            image_info = nvjpeg2k.nvjpeg2kStreamGetImageInfo(
+                codec.stream)
 
-    with open(input_image, 'rb') as f:
-        image_data = f.read()
+        width, height = set_decode_window(codec, image_info, reduce, region)
+        num_components = image_info.num_components
+        with time_codec("decode", gpu_id, codec.backend, width * height):
+            return nvjpeg2k.nvjpeg2kDecode(
+                codec.handle,
+                codec.decode_state,
+                codec.stream,
+                width,
+                height,
+                num_components,
+                gpu_id,
+                codec.decode_params)
 
-    nvjpeg2kStreamParse(
-        nvjpeg2k_handle,
-        nvjpeg2k_stream,
-        image_data,
-        len(image_data))
 
-    encoded_image = nvjpeg2kEncode(
-        nvjpeg2k_handle,
-        nvjpeg2k_encode_state,
-        nvjpeg2k_stream,
-        gpu_id)
+def encode_data(image_data, gpu_id):
+    """
+    Encode image data to JPEG2000 format using the specified GPU.
 
-    with open(output_image, 'wb') as f:
-        f.write(encoded_image)
+    Args:
+        image_data (memoryview): The input image data.
+        gpu_id (int): The ID of the GPU to use.
+
+    Returns:
+        bytes: The JPEG2000 codestream.
+    """
+    with codec_pools.checkout(gpu_id) as codec:
+        nvjpeg2k = codec.codec
+        with time_stage("parse", "encode", gpu_id):
+            nvjpeg2k.nvjpeg2kStreamParse(
+                codec.handle,
+                codec.stream,
+                image_data,
+                len(image_data))
+            image_info = nvjpeg2k.nvjpeg2kStreamGetImageInfo(
+                codec.stream)
 
-    nvjpeg2kEncodeStateDestroy(nvjpeg2k_encode_state)
-    nvjpeg2kStreamDestroy(nvjpeg2k_stream)
-    nvjpeg2kDestroy(nvjpeg2k_handle)
+        with time_codec("encode", gpu_id, codec.backend,
+                        image_info.width * image_info.height):
+            return nvjpeg2k.nvjpeg2kEncode(
+                codec.handle,
+                codec.encode_state,
+                codec.stream,
+                gpu_id)
@@ -0,0 +1,153 @@
+"""
+Micro-Batching Module
+
+This module collects incoming image jobs per operation and flushes them to
+a batch task when either the batch is full or the oldest job has waited
+for the maximum linger time. Under bursty traffic this amortizes GPU
+allocation and codec setup over many images, while at low load a job is
+delayed by at most the linger time.
+"""
+
+import asyncio
+import logging
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Route uploads through the micro-batcher instead of process_image
+MICRO_BATCH_ENABLED = os.getenv(
+    "MICRO_BATCH_ENABLED", "false").lower() == "true"
+# Number of jobs that triggers an immediate flush
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 16))
+# Longest time in milliseconds a job waits for its batch to fill up
+BATCH_MAX_LINGER_MS = float(os.getenv("BATCH_MAX_LINGER_MS", 20))
+
+
+class MicroBatcher:
+    """
+    An asyncio aggregator that groups jobs into batches per operation.
+
+    Attributes:
+        dispatch (callable): Called from the thread pool with a list of jobs;
+            returns the ID of the task processing them, or a list with the
+            task ID of each job if they were split over several tasks.
+        max_batch_size (int): Number of jobs that triggers a flush.
+        max_linger (float): Seconds the first job of a batch may wait.
+        pending (dict): Operations mapped to their queued (job, future)
+            pairs.
+    """
+
+    def __init__(self, dispatch, max_batch_size=BATCH_MAX_SIZE,
+                 max_linger=BATCH_MAX_LINGER_MS / 1000):
+        """
+        Initialize the MicroBatcher.
+
+        Args:
+            dispatch (callable): Called with a list of jobs; returns the ID
+                of the task processing them, or a list with the task ID of
+                each job.
+            max_batch_size (int): Number of jobs that triggers a flush.
+            max_linger (float): Seconds the first job of a batch may wait.
+        """
+        self.dispatch = dispatch
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger
+        self.pending = {}
+        self._timers = {}
+        self._tasks = set()
+        self._batches = 0
+        self._jobs = 0
+        self._full_batches = 0
+
+    async def submit(self, job):
+        """
+        Queue a job and wait until its batch has been dispatched.
+
+        Args:
+            job (dict): A job dictionary with 'input_image', 'output_image'
+                and 'operation'.
+
+        Returns:
+            str: The ID of the task the job was dispatched with.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        operation = job["operation"]
+        batch = self.pending.setdefault(operation, [])
+        batch.append((job, future))
+
+        if len(batch) >= self.max_batch_size:
+            self._flush(operation)
+        elif len(batch) == 1:
+            self._timers[operation] = loop.call_later(
+                self.max_linger, self._flush, operation)
+        return await future
+
+    def stats(self):
+        """
+        Return batching statistics.
+
+        Returns:
+            dict: The number of batches and jobs dispatched, the mean batch
+            size, the fill ratio (mean size over ``max_batch_size``) and the
+            number of batches flushed because they were full.
+        """
+        mean_size = self._jobs / self._batches if self._batches else 0.0
+        return {
+            "batches": self._batches,
+            "jobs": self._jobs,
+            "mean_batch_size": mean_size,
+            "fill_ratio": mean_size / self.max_batch_size,
+            "full_batches": self._full_batches,
+        }
+
+    def _flush(self, operation):
+        """
+        Dispatch the pending batch of an operation.
+
+        Args:
+            operation (str): The operation whose batch is flushed.
+        """
+        timer = self._timers.pop(operation, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(operation, [])
+        if not batch:
+            return
+
+        self._batches += 1
+        self._jobs += len(batch)
+        if len(batch) >= self.max_batch_size:
+            self._full_batches += 1
+        BATCH_SIZE.observe(len(batch), operation=operation)
+        logger.debug(
+            f"Flushing {len(batch)} {operation} jobs "
+            f"({len(batch) / self.max_batch_size:.0%} full)")
+        task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch):
+        """
+        Hand a batch to the dispatch function and resolve its futures.
+
+        Args:
+            batch (list): The (job, future) pairs of the batch.
+        """
+        try:
+            task_id = await run_in_threadpool(
+                self.dispatch, [job for job, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            if isinstance(task_id, str):
+                task_id = [task_id] * len(batch)
+            for (_, future), job_task_id in zip(batch, task_id):
+                if not future.done():
+                    future.set_result(job_task_id)
@@ -0,0 +1,316 @@
+"""
+Result Cache Module
+
+This module implements a content-addressed cache of processed images.
+Results are keyed on the SHA-256 digest of the input together with the
+operation and codec parameters, stored in a bounded on-disk directory and
+tracked by a SQLite LRU index shared by all processes, so that lookups
+never touch Celery or a GPU.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Directory holding cached results
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache")
+# Upper bound on the total size of cached results in bytes
+RESULT_CACHE_MAX_BYTES = int(
+    os.getenv("RESULT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+
+# Name of the SQLite index database in the cache directory
+RESULT_CACHE_INDEX = "index.db"
+
+
+def make_cache_key(digest, operation, params=None):
+    """
+    Build the cache key for a processing request.
+
+    Args:
+        digest (str): SHA-256 hex digest of the input image.
+        operation (str): Operation to perform ('decode' or 'encode').
+        params (dict): Codec parameters that affect the output.
+
+    Returns:
+        str: A hex digest identifying the result.
+    """
+    description = json.dumps(
+        [digest, operation, params or {}], sort_keys=True,
+        separators=(",", ":"))
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    A bounded, content-addressed store of processed images.
+
+    The entries are indexed in a SQLite database in the cache directory,
+    shared by every process using the directory, so the size bound holds
+    for the cache as a whole however many API and worker processes write
+    to it.
+
+    Attributes:
+        root (str): Directory holding the cached results.
+        max_bytes (int): Upper bound on the total size of the cache.
+        lock (threading.Lock): A lock serializing access to the index.
+    """
+
+    def __init__(self, root=RESULT_CACHE_DIR,
+                 max_bytes=RESULT_CACHE_MAX_BYTES):
+        """
+        Initialize the ResultCache.
+
+        Args:
+            root (str): Directory holding the cached results.
+            max_bytes (int): Upper bound on the total size of the cache.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._connection = None
+
+    def path_for(self, key):
+        """
+        Return the on-disk path of a cache entry.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: Path of the cached result.
+        """
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        Look up a cached result and mark it as recently used.
+
+        Result files missing from the index, e.g. copied into the
+        directory, are adopted the first time they are looked up.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: Path of the cached result, or None on a miss.
+        """
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                found = connection.execute(
+                    "UPDATE entries SET used_at = ? WHERE key = ?",
+                    (time.time(), key)).rowcount
+        if found:
+            return self.path_for(key)
+
+        path = self.path_for(key)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        self._add(key, size)
+        return path
+
+    def put(self, key, source_path):
+        """
+        Store a processed image in the cache.
+
+        The file is hard-linked into the cache when possible and copied
+        otherwise. Least recently used entries are evicted until the cache
+        fits within ``max_bytes``.
+
+        Args:
+            key (str): The cache key.
+            source_path (str): Path of the processed image.
+
+        Returns:
+            str: Path of the cached result.
+        """
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        _link_or_copy(source_path, temp_path)
+        os.replace(temp_path, path)
+        self._add(key, os.path.getsize(path))
+        return path
+
+    def materialize(self, key, destination):
+        """
+        Make a cached result available at another path.
+
+        Args:
+            key (str): The cache key.
+            destination (str): Path the result should appear at.
+
+        Returns:
+            bool: True if the result was materialized, False if the entry
+            has been evicted in the meantime.
+        """
+        try:
+            _link_or_copy(self.path_for(key), destination)
+        except FileNotFoundError:
+            self.discard(key)
+            return False
+        return True
+
+    def discard(self, key):
+        """
+        Drop an entry from the index.
+
+        Args:
+            key (str): The cache key.
+        """
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM entries WHERE key = ?",
+                                   (key,))
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._connect().execute(
+                "SELECT 1 FROM entries WHERE key = ?",
+                (key,)).fetchone() is not None
+
+    @property
+    def total_bytes(self):
+        """
+        int: Total size of the indexed entries.
+        """
+        with self.lock:
+            return self._connect().execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def close(self):
+        """
+        Close the index database.
+        """
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _add(self, key, size):
+        """
+        Add or refresh an entry in the index, then evict least recently
+        used entries until the cache fits.
+
+        The eviction runs in a write transaction, so processes evicting
+        at the same time do not both remove entries for the same excess.
+
+        Args:
+            key (str): The cache key.
+            size (int): Size of the cached result in bytes.
+        """
+        evicted = []
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, size, used_at) "
+                    "VALUES (?, ?, ?)", (key, size, time.time()))
+                total, count = connection.execute(
+                    "SELECT COALESCE(SUM(size), 0), COUNT(*) "
+                    "FROM entries").fetchone()
+                rows = connection.execute(
+                    "SELECT key, size FROM entries WHERE key != ? "
+                    "ORDER BY used_at", (key,))
+                for old_key, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(old_key)
+                    total -= old_size
+                connection.executemany(
+                    "DELETE FROM entries WHERE key = ?",
+                    [(old_key,) for old_key in evicted])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        for old_key in evicted:
+            try:
+                os.remove(self.path_for(old_key))
+            except FileNotFoundError:
+                pass
+
+    def _connect(self):
+        """
+        Return the connection to the index, opening it on first use.
+
+        A new index is filled from the result files already in the
+        directory, least recently accessed first.
+
+        Must be called with the lock held.
+
+        Returns:
+            sqlite3.Connection: The database connection.
+        """
+        if self._connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            connection = sqlite3.connect(
+                os.path.join(self.root, RESULT_CACHE_INDEX), timeout=30,
+                isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("BEGIN IMMEDIATE")
+            created = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'entries'"
+            ).fetchone() is None
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, size INTEGER, used_at REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_used_at "
+                "ON entries (used_at)")
+            if created:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO entries (key, size, used_at) "
+                    "VALUES (?, ?, ?)", self._scan())
+            connection.execute("COMMIT")
+            self._connection = connection
+        return self._connection
+
+    def _scan(self):
+        """
+        List the result files in the cache directory.
+
+        Returns:
+            list: (key, size, access time) of each result file.
+        """
+        found = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                found.append((entry.name, stat.st_size, stat.st_atime))
+        return found
+
+
+def _link_or_copy(source, destination):
+    """
+    Hard-link a file, falling back to a copy across filesystems.
+
+    Args:
+        source (str): Path of the existing file.
+        destination (str): Path of the new file.
+    """
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        os.remove(destination)
+        os.link(source, destination)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+# Create a singleton ResultCache instance
+result_cache = ResultCache()
@@ -0,0 +1,46 @@
+"""
+Celery Application Module
+
+This module builds the Celery application of the API and the workers. Its
+settings are read once, when the application is first used, from
+``celeryconfig.py`` (or the module named by ``CELERY_CONFIG_MODULE``);
+``CELERY_BROKER_URL`` and ``CELERY_RESULT_BACKEND`` override the broker
+and result backend of the module.
+"""
+
+import os
+
+from celery import Celery
+from kombu import Queue
+
+from .priorities import PRIORITY_QUEUES, QUEUE_DEFAULT, route_by_priority
+
+# Module holding the Celery settings
+CELERY_CONFIG_MODULE = os.getenv("CELERY_CONFIG_MODULE", "celeryconfig")
+
+
+def create_celery(name="tasks", config=CELERY_CONFIG_MODULE):
+    """
+    Create the Celery application.
+
+    Nothing is imported or connected until the application is first used,
+    so creating it costs no more than importing Celery.
+
+    Args:
+        name (str): Name of the main module of the tasks.
+        config (str or object): The settings module, its dotted path, or
+            an object holding the settings as attributes.
+
+    Returns:
+        celery.Celery: The application.
+    """
+    celery = Celery(name, include=["app.batch_processor", "app.fast_path"])
+    celery.config_from_object(config)
+    # Route jobs to the queue of their priority tier; workers consume all
+    # tiers in weighted order
+    celery.conf.task_queues = [Queue(queue) for queue in PRIORITY_QUEUES]
+    celery.conf.task_default_queue = QUEUE_DEFAULT
+    celery.conf.task_routes = (route_by_priority,)
+    celery.conf.broker_transport_options = {
+        "queue_order_strategy": "app.priorities:WeightedCycle"}
+    return celery
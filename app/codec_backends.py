@@ -0,0 +1,139 @@
+"""
+Codec Backends Module
+
+This module keeps a registry of the JPEG2000 codec libraries the workers
+can run jobs with. A backend is a module exposing the nvJPEG2000 API, as
+``app.mock_nvjpeg2000`` does, and is only imported when it is first used,
+so that the API process and test collection never load a GPU library.
+Worker processes load the configured backend when they boot, before their
+first job.
+
+Bundled backends:
+    mock: The simulated library of ``app.mock_nvjpeg2000``.
+    nvjpeg2000: The nvJPEG2000 library, on the GPUs.
+    cpu: OpenJPEG through Pillow, on the CPU (see ``app.cpu_codec``).
+"""
+
+import importlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Run jobs with the mock library instead of nvJPEG2000
+USE_MOCK_NVJPEG2000 = (
+    os.getenv("USE_MOCK_NVJPEG2000", "true").lower() == "true")
+# Name of the backend jobs run with; defaults to 'mock' or 'nvjpeg2000'
+# following USE_MOCK_NVJPEG2000
+CODEC_BACKEND = os.getenv(
+    "CODEC_BACKEND", "mock" if USE_MOCK_NVJPEG2000 else "nvjpeg2000")
+# Name of the backend jobs run with on the CPU
+CPU_BACKEND = "cpu"
+
+
+class CodecRegistry:
+    """
+    The codec backends known to a process, imported on first use.
+
+    Attributes:
+        default (str): Name of the backend returned by ``get`` when no name
+            is given.
+        lock (threading.Lock): A lock guarding the loaded backends.
+        backends (dict): Backend names mapped to the module implementing
+            them.
+    """
+
+    def __init__(self, default=CODEC_BACKEND):
+        """
+        Initialize the CodecRegistry.
+
+        Args:
+            default (str): Name of the default backend.
+        """
+        self.default = default
+        self.lock = threading.Lock()
+        self.backends = {}
+        self._loaded = {}
+
+    def register(self, name, module):
+        """
+        Register a backend without importing it.
+
+        Args:
+            name (str): Name of the backend.
+            module (str): Dotted path of the module implementing it.
+        """
+        with self.lock:
+            self.backends[name] = module
+            self._loaded.pop(name, None)
+
+    def get(self, name=None):
+        """
+        Return a backend, importing it on first use.
+
+        Args:
+            name (str): Name of the backend; the default one if omitted.
+
+        Returns:
+            module: The module implementing the backend.
+
+        Raises:
+            ValueError: If no backend of that name is registered.
+            ImportError: If the library of the backend is not installed.
+        """
+        name = name or self.default
+        with self.lock:
+            if name not in self._loaded:
+                if name not in self.backends:
+                    raise ValueError(f"Unknown codec backend {name!r}")
+                self._loaded[name] = importlib.import_module(
+                    self.backends[name])
+                logger.info(f"Loaded codec backend {name}")
+            return self._loaded[name]
+
+    def loaded(self):
+        """
+        Return the names of the backends imported so far.
+
+        Returns:
+            list: The backend names, sorted.
+        """
+        with self.lock:
+            return sorted(self._loaded)
+
+    def available(self, name):
+        """
+        Tell whether a backend can run, loading it if needed.
+
+        A backend module may define ``available()`` to report whether the
+        library it wraps is usable.
+
+        Returns:
+            bool: False if the backend is unknown, fails to import or
+            reports it cannot run.
+        """
+        try:
+            backend = self.get(name)
+        except (ValueError, ImportError):
+            return False
+        check = getattr(backend, "available", None)
+        return check() if check is not None else True
+
+    def warm_up(self, names=None):
+        """
+        Import backends ahead of their first job.
+
+        Args:
+            names (list): Names of the backends; the default one if
+                omitted.
+        """
+        for name in names or [self.default]:
+            self.get(name)
+
+
+# Create a singleton CodecRegistry instance with the bundled backends
+codec_backends = CodecRegistry()
+codec_backends.register("mock", "app.mock_nvjpeg2000")
+codec_backends.register("nvjpeg2000", "nvjpeg2000")
+codec_backends.register(CPU_BACKEND, "app.cpu_codec")
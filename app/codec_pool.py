@@ -0,0 +1,260 @@
+"""
+Codec Pool Module
+
+This module keeps long-lived nvJPEG2000 handles, decode/encode states and
+streams per GPU. Creating these objects is the dominant per-image cost for
+small images, so they are owned by the worker process, checked out for the
+duration of a job and returned to the pool instead of being destroyed.
+
+Jobs run on the CPU codec check out contexts of the ``CPU_DEVICE`` pool,
+whose handle owns the codec processes.
+"""
+
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from .codec_backends import CPU_BACKEND, codec_backends
+
+# Device of the jobs run on the CPU codec, used in place of a GPU ID
+CPU_DEVICE = "cpu"
+
+
+class CodecContext:
+    """
+    The per-job codec objects checked out of a pool.
+
+    Decode and encode states and decode parameters are created on first
+    use, so a context that only ever decodes never allocates an encode state.
+
+    Attributes:
+        handle (nvjpeg2kHandle): The library handle of the owning GPU.
+        stream (nvjpeg2kStream): The codestream object.
+        gpu_id (int): The ID of the GPU the context belongs to.
+        backend (str): Name of the codec backend.
+    """
+
+    def __init__(self, codec, handle, gpu_id, backend=""):
+        """
+        Initialize the CodecContext.
+
+        Args:
+            codec (module): The nvJPEG2000 library module.
+            handle (nvjpeg2kHandle): The library handle of the owning GPU.
+            gpu_id (int): The ID of the GPU the context belongs to.
+            backend (str): Name of the codec backend.
+        """
+        self.codec = codec
+        self.handle = handle
+        self.gpu_id = gpu_id
+        self.backend = backend
+        self.stream = codec.nvjpeg2kStreamCreate(handle)
+        self._decode_state = None
+        self._encode_state = None
+        self._decode_params = None
+
+    @property
+    def decode_state(self):
+        """
+        nvjpeg2kDecodeState: The decode state, created on first use.
+        """
+        if self._decode_state is None:
+            self._decode_state = self.codec.nvjpeg2kDecodeStateCreate(
+                self.handle)
+        return self._decode_state
+
+    @property
+    def decode_params(self):
+        """
+        nvjpeg2kDecodeParams: The decode parameters, created on first use.
+        Jobs set the reduce factor and decode area before every decode.
+        """
+        if self._decode_params is None:
+            self._decode_params = self.codec.nvjpeg2kDecodeParamsCreate()
+        return self._decode_params
+
+    @property
+    def encode_state(self):
+        """
+        nvjpeg2kEncodeState: The encode state, created on first use.
+        """
+        if self._encode_state is None:
+            self._encode_state = self.codec.nvjpeg2kEncodeStateCreate(
+                self.handle)
+        return self._encode_state
+
+    def destroy(self):
+        """
+        Destroy the states, parameters and stream owned by the context.
+        """
+        if self._decode_state is not None:
+            self.codec.nvjpeg2kDecodeStateDestroy(self._decode_state)
+            self._decode_state = None
+        if self._encode_state is not None:
+            self.codec.nvjpeg2kEncodeStateDestroy(self._encode_state)
+            self._encode_state = None
+        if self._decode_params is not None:
+            self.codec.nvjpeg2kDecodeParamsDestroy(self._decode_params)
+            self._decode_params = None
+        self.codec.nvjpeg2kStreamDestroy(self.stream)
+
+
+class CodecPool:
+    """
+    A pool of codec contexts sharing one library handle on a single GPU.
+
+    Attributes:
+        gpu_id (int): The ID of the GPU the pool belongs to.
+        backend (str): Name of the codec backend.
+        lock (threading.Lock): A lock guarding the idle contexts.
+        idle (deque): Contexts that are ready to be checked out.
+        created (int): Number of contexts created by the pool.
+    """
+
+    def __init__(self, codec, gpu_id, backend=""):
+        """
+        Initialize the CodecPool.
+
+        Args:
+            codec (module): The nvJPEG2000 library module.
+            gpu_id (int): The ID of the GPU the pool belongs to.
+            backend (str): Name of the codec backend.
+        """
+        self.codec = codec
+        self.gpu_id = gpu_id
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.idle = deque()
+        self.created = 0
+        self.handle = None
+
+    def acquire(self):
+        """
+        Check out a context, creating one if none is idle.
+
+        Returns:
+            CodecContext: A context ready for a new job.
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            if self.handle is None:
+                self.handle = self.codec.nvjpeg2kCreate()
+            self.created += 1
+            return CodecContext(self.codec, self.handle, self.gpu_id,
+                                self.backend)
+
+    def release(self, context):
+        """
+        Return a context to the pool for reuse.
+
+        Args:
+            context (CodecContext): The context to return.
+        """
+        with self.lock:
+            self.idle.append(context)
+
+    def close(self):
+        """
+        Destroy all idle contexts and the library handle.
+        """
+        with self.lock:
+            while self.idle:
+                self.idle.pop().destroy()
+            if self.handle is not None:
+                self.codec.nvjpeg2kDestroy(self.handle)
+                self.handle = None
+
+
+class CodecPoolManager:
+    """
+    The per-GPU codec pools owned by a worker process, and the pool of
+    the CPU codec.
+
+    Attributes:
+        backend (str): Name of the codec backend of the GPU pools.
+        lock (threading.Lock): A lock guarding the pool dictionary.
+        pools (dict): GPU IDs, or ``CPU_DEVICE``, mapped to their CodecPool.
+    """
+
+    def __init__(self, codec=None, backend=None):
+        """
+        Initialize the CodecPoolManager.
+
+        Args:
+            codec (module): The nvJPEG2000 library module. The backend is
+                loaded on first use if not given.
+            backend (str): Name of the codec backend of the GPU pools; the
+                configured one by default.
+        """
+        self._codec = codec
+        self.backend = backend or codec_backends.default
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    @property
+    def codec(self):
+        """
+        module: The nvJPEG2000 library module, loaded on first use.
+        """
+        if self._codec is None:
+            self._codec = codec_backends.get(self.backend)
+        return self._codec
+
+    def pool(self, gpu_id):
+        """
+        Return the pool of a GPU, creating it on first use.
+
+        Args:
+            gpu_id (int): The ID of the GPU, or ``CPU_DEVICE`` for the CPU
+                codec.
+
+        Returns:
+            CodecPool: The pool of the GPU.
+        """
+        with self.lock:
+            if gpu_id not in self.pools:
+                if gpu_id == CPU_DEVICE:
+                    self.pools[gpu_id] = CodecPool(
+                        codec_backends.get(CPU_BACKEND), gpu_id, CPU_BACKEND)
+                else:
+                    self.pools[gpu_id] = CodecPool(
+                        self.codec, gpu_id, self.backend)
+            return self.pools[gpu_id]
+
+    @contextmanager
+    def checkout(self, gpu_id):
+        """
+        Check out a codec context for the duration of a job.
+
+        A context whose job raised is destroyed rather than reused, since
+        its states may be left in an undefined condition.
+
+        Args:
+            gpu_id (int): The ID of the GPU the job runs on.
+
+        Yields:
+            CodecContext: The checked out context.
+        """
+        pool = self.pool(gpu_id)
+        context = pool.acquire()
+        try:
+            yield context
+        except BaseException:
+            context.destroy()
+            raise
+        pool.release(context)
+
+    def close(self):
+        """
+        Tear down every pool. Called when the worker process shuts down.
+        """
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.close()
+
+
+# Create a singleton CodecPoolManager instance
+codec_pools = CodecPoolManager()
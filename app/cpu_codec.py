@@ -0,0 +1,266 @@
+"""
+CPU Codec Module
+
+This module is a codec backend that decodes and encodes JPEG2000 images on
+the CPU with OpenJPEG, through Pillow. Workers run jobs with it when their
+GPUs are all busy, and it makes the service usable on machines without a
+GPU. It exposes the same functions as the nvJPEG2000 library, like
+``app.mock_nvjpeg2000``, so jobs run with it unchanged.
+
+Decodes and encodes run in a pool of processes owned by the library
+handle, so that concurrent jobs use several cores and the worker process
+keeps its GIL. Only the header of an image is read in the calling process.
+Each of the ``CPU_CODEC_NODE_PROCESSES`` processes of a node running jobs
+gets its share of the cores, unless ``CPU_CODEC_WORKERS`` sets the size of
+every pool.
+
+Decoded images hold their samples interleaved, as Pillow stores them; a
+region is decoded at the reduced resolution and then cropped. Encodes
+write a lossless JP2 file from any image Pillow can read.
+"""
+
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .jp2 import InvalidHeaderError, parse_header
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+# Processes decoding and encoding images on the CPU in each worker process
+# (0 shares the cores of the node between its worker processes)
+CPU_CODEC_WORKERS = int(os.getenv("CPU_CODEC_WORKERS", 0))
+# Side of the square tiles of encoded images
+CPU_ENCODE_TILE_SIZE = int(os.getenv("CPU_ENCODE_TILE_SIZE", 1024))
+
+
+def available():
+    """
+    Tell whether Pillow with OpenJPEG support is installed.
+
+    Returns:
+        bool: Whether the CPU codec can run.
+    """
+    return Image is not None and features.check("jpg_2000")
+
+
+def pool_size():
+    """
+    Return the number of codec processes of a worker process.
+
+    Read when the pool is created, so that a Celery worker can publish its
+    concurrency in ``CPU_CODEC_NODE_PROCESSES`` before its processes start.
+
+    Returns:
+        int: ``CPU_CODEC_WORKERS`` if set, and otherwise the CPUs of the
+        node divided between the ``CPU_CODEC_NODE_PROCESSES`` processes
+        running jobs on it, at least 1.
+    """
+    if CPU_CODEC_WORKERS:
+        return CPU_CODEC_WORKERS
+    processes = int(os.getenv("CPU_CODEC_NODE_PROCESSES", 1)) or 1
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+class nvjpeg2kHandle:
+    """
+    The library handle, owning the pool of codec processes.
+    """
+
+    def __init__(self, workers=None):
+        if not available():
+            raise RuntimeError(
+                "The CPU codec needs Pillow built with OpenJPEG")
+        if workers is None:
+            workers = pool_size()
+        # Processes are spawned, as worker processes run threads that a
+        # forked child would inherit in an undefined state
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"))
+
+
+class nvjpeg2kDecodeState:
+    pass
+
+
+class nvjpeg2kEncodeState:
+    pass
+
+
+class nvjpeg2kStream:
+    def __init__(self):
+        self.data = b""
+        self.info = None
+        self.num_resolutions = 1
+
+
+class nvjpeg2kDecodeParams:
+    def __init__(self):
+        # (start_x, end_x, start_y, end_y); all zeros decodes the whole image
+        self.area = (0, 0, 0, 0)
+        self.reduce_factor = 0
+
+
+class ImageInfo:
+    def __init__(self, width, height, num_components, bit_depth=8,
+                 tile_width=None, tile_height=None):
+        self.width = width
+        self.height = height
+        self.num_components = num_components
+        self.bit_depth = bit_depth
+        self.tile_width = tile_width or width
+        self.tile_height = tile_height or height
+        self.num_tiles_x = -(-width // self.tile_width)
+        self.num_tiles_y = -(-height // self.tile_height)
+
+    @property
+    def sample_size(self):
+        return -(-self.bit_depth // 8)
+
+
+def nvjpeg2kCreate():
+    return nvjpeg2kHandle()
+
+
+def nvjpeg2kDecodeStateCreate(handle):
+    return nvjpeg2kDecodeState()
+
+
+def nvjpeg2kEncodeStateCreate(handle):
+    return nvjpeg2kEncodeState()
+
+
+def nvjpeg2kStreamCreate(handle):
+    return nvjpeg2kStream()
+
+
+def nvjpeg2kStreamParse(handle, stream, data, length):
+    """
+    Read the image information of a JPEG2000 codestream or, for encodes,
+    of any image Pillow can read.
+
+    The data is copied once, as it is sent to a codec process.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    stream.data = bytes(memoryview(data).cast("B")[:length])
+    try:
+        header = parse_header(io.BytesIO(stream.data))
+    except InvalidHeaderError:
+        try:
+            with Image.open(io.BytesIO(stream.data)) as image:
+                bands = len(image.getbands())
+                bit_depth = 16 if image.mode.startswith("I;16") else 8
+                stream.info = ImageInfo(*image.size, bands, bit_depth)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Unreadable image: {e}") from e
+        stream.num_resolutions = 1
+    else:
+        stream.info = ImageInfo(
+            header.width, header.height, header.num_components,
+            header.bit_depth, header.tile_width, header.tile_height)
+        stream.num_resolutions = header.decomposition_levels + 1
+
+
+def nvjpeg2kStreamGetImageInfo(stream):
+    return stream.info
+
+
+def nvjpeg2kStreamGetResolutionsInTile(stream, tile_id):
+    return stream.num_resolutions
+
+
+def nvjpeg2kDecodeParamsCreate():
+    return nvjpeg2kDecodeParams()
+
+
+def nvjpeg2kDecodeParamsSetDecodeArea(decode_params, start_x, end_x, start_y,
+                                      end_y):
+    decode_params.area = (start_x, end_x, start_y, end_y)
+
+
+def nvjpeg2kDecodeParamsSetReduceFactor(decode_params, reduce_factor):
+    decode_params.reduce_factor = reduce_factor
+
+
+def nvjpeg2kDecode(handle, decode_state, stream, width, height,
+                   num_components, gpu_id, decode_params=None):
+    info = stream.info
+    if decode_params is None:
+        decode_params = nvjpeg2kDecodeParams()
+    start_x, end_x, start_y, end_y = decode_params.area
+    if decode_params.area == (0, 0, 0, 0):
+        end_x, end_y = info.width, info.height
+    reduce_factor = decode_params.reduce_factor
+    if not 0 <= reduce_factor < stream.num_resolutions:
+        raise ValueError(f"Invalid reduce factor {reduce_factor}")
+
+    # The window on the reduced level, as in the JPEG2000 spec
+    def reduced(value):
+        return -(-value // (1 << reduce_factor))
+    box = (reduced(start_x), reduced(start_y), reduced(end_x), reduced(end_y))
+    if (width, height) != (box[2] - box[0], box[3] - box[1]):
+        raise ValueError(
+            f"Output size {width}x{height} does not match the decode "
+            f"window {box[2] - box[0]}x{box[3] - box[1]}")
+    return handle.executor.submit(
+        _decode, stream.data, reduce_factor, box).result()
+
+
+def nvjpeg2kEncode(handle, encode_state, stream, gpu_id):
+    return handle.executor.submit(
+        _encode, stream.data, CPU_ENCODE_TILE_SIZE).result()
+
+
+def nvjpeg2kDecodeStateDestroy(decode_state):
+    pass
+
+
+def nvjpeg2kEncodeStateDestroy(encode_state):
+    pass
+
+
+def nvjpeg2kStreamDestroy(stream):
+    stream.data = b""
+
+
+def nvjpeg2kDecodeParamsDestroy(decode_params):
+    pass
+
+
+def nvjpeg2kDestroy(handle):
+    handle.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _decode(data, reduce_factor, box):
+    """
+    Decode a codestream in a codec process.
+
+    Returns:
+        bytes: The interleaved samples of the window.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image.reduce = reduce_factor
+        image.load()
+        if box != (0, 0) + image.size:
+            return image.crop(box).tobytes()
+        return image.tobytes()
+
+
+def _encode(data, tile_size):
+    """
+    Encode an image as a lossless JP2 file in a codec process.
+
+    Returns:
+        bytes: The JP2 file.
+    """
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        image.save(output, "JPEG2000", irreversible=False,
+                   tile_size=(tile_size, tile_size), no_jp2=False)
+    return output.getvalue()
@@ -0,0 +1,358 @@
+"""
+Downloads Module
+
+This module serves output images with validators and byte ranges, so that
+a viewer refreshing an image revalidates it with a ``304`` instead of
+transferring it again, and an interrupted download of a large output is
+resumed where it stopped.
+
+Outputs are only ever replaced by renaming a new file into place, so the
+inode, size and modification time of a file identify its content and make
+a strong ETag without hashing it. The body is handed to the server with
+the ASGI ``zerocopysend`` or ``pathsend`` extensions when it offers them,
+which send the file with the kernel's ``sendfile``, or to a front proxy
+with ``SENDFILE_HEADER``; otherwise it is read in large chunks in the
+thread pool.
+"""
+
+import mimetypes
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse, Response
+
+# Seconds clients may keep an image requested by its version
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", 365 * 24 * 3600))
+# Header handing the transfer to a front proxy: 'X-Accel-Redirect' (nginx)
+# or 'X-Sendfile' (Apache, lighttpd). Empty serves files from the app.
+SENDFILE_HEADER = os.getenv("SENDFILE_HEADER", "")
+# Internal location the proxy serves the working directory under, for
+# X-Accel-Redirect
+SENDFILE_PREFIX = os.getenv("SENDFILE_PREFIX", "/protected/")
+# Most ranges served in one multipart response; more are served whole
+MAX_RANGES = int(os.getenv("MAX_RANGES", 100))
+# Bytes read per chunk when the server cannot send the file itself
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+
+
+class RangeNotSatisfiable(ValueError):
+    """
+    Raised when no requested range overlaps the file.
+    """
+
+
+def make_etag(stat_result):
+    """
+    Return the strong ETag of a file.
+
+    Args:
+        stat_result (os.stat_result): The status of the file.
+
+    Returns:
+        str: The quoted entity tag.
+    """
+    return (f'"{stat_result.st_ino:x}-{stat_result.st_size:x}'
+            f'-{stat_result.st_mtime_ns:x}"')
+
+
+def parse_http_date(value):
+    """
+    Parse an HTTP date.
+
+    Returns:
+        float: The timestamp, or None if the date is malformed.
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def etag_matches(header, etag, weak=True):
+    """
+    Tell whether an If-None-Match or If-Match header matches an ETag.
+
+    Args:
+        header (str): The comma-separated entity tags, or '*'.
+        etag (str): The quoted ETag of the file.
+        weak (bool): Compare weakly, ignoring the ``W/`` prefix, as
+            If-None-Match does.
+
+    Returns:
+        bool: Whether one of the tags matches.
+    """
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if weak and tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def is_not_modified(request_headers, etag, mtime):
+    """
+    Tell whether a conditional GET can be answered with ``304``.
+
+    If-Modified-Since is only considered without If-None-Match.
+
+    Args:
+        request_headers (Headers): The headers of the request.
+        etag (str): The ETag of the file.
+        mtime (float): The modification time of the file.
+
+    Returns:
+        bool: Whether the client's copy is current.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = parse_http_date(request_headers.get("if-modified-since"))
+    return since is not None and int(mtime) <= since
+
+
+def parse_ranges(header, size):
+    """
+    Parse a Range header.
+
+    Overlapping and adjacent ranges are merged, so a response never sends
+    the same bytes twice.
+
+    Args:
+        header (str): The Range header, e.g. 'bytes=0-99,-500'.
+        size (int): The size of the file.
+
+    Returns:
+        list: Sorted (start, end) byte ranges, ``end`` excluded, or None if
+        the header is malformed or asks for too many ranges, in which case
+        it is ignored and the whole file is served.
+
+    Raises:
+        RangeNotSatisfiable: If no range overlaps the file.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    if len(specs.split(",")) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        try:
+            if not dash:
+                return None
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                start, end = max(size - suffix, 0), size
+            else:
+                start = int(first)
+                end = int(last) + 1 if last else size
+                if start < 0 or (last and end <= start):
+                    return None
+        except ValueError:
+            return None
+        if start < min(end, size):
+            ranges.append((start, min(end, size)))
+    if not ranges:
+        raise RangeNotSatisfiable(header)
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FileDownload(Response):
+    """
+    A response serving a file with validators and byte ranges.
+
+    Answers conditional requests with ``304``, Range requests with ``206``
+    (one range) or a ``multipart/byteranges`` body (several), honouring
+    If-Range, and ``416`` when no range overlaps the file.
+
+    Attributes:
+        path (str): Path of the file.
+        stat_result (os.stat_result): Status of the file when the response
+            was created.
+        etag (str): The strong ETag of the file.
+    """
+
+    def __init__(self, path, stat_result=None, cache_control="no-cache",
+                 media_type=None):
+        """
+        Initialize the FileDownload.
+
+        Args:
+            path (str): Path of the file.
+            stat_result (os.stat_result): Status of the file; read when
+                omitted.
+            cache_control (str): The Cache-Control header.
+            media_type (str): The Content-Type; guessed from the path when
+                omitted.
+        """
+        self.path = path
+        self.cache_control = cache_control
+        self.media_type = (media_type or mimetypes.guess_type(path)[0]
+                           or "application/octet-stream")
+        self.status_code = 200
+        self.background = None
+        self._set_stat(stat_result or os.stat(path))
+
+    def _set_stat(self, stat_result):
+        self.stat_result = stat_result
+        self.etag = make_etag(stat_result)
+        self.raw_headers = MutableHeaders(headers={
+            "etag": self.etag,
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "cache-control": self.cache_control,
+            "accept-ranges": "bytes",
+        }).raw
+
+    async def __call__(self, scope, receive, send):
+        try:
+            f = await run_in_threadpool(open, self.path, "rb", buffering=0)
+        except FileNotFoundError:
+            response = PlainTextResponse("File not found", status_code=404)
+            await response(scope, receive, send)
+            return
+        try:
+            stat_result = os.fstat(f.fileno())
+            if stat_result.st_ino != self.stat_result.st_ino:
+                # The file was replaced since the response was created
+                self._set_stat(stat_result)
+            await self._respond(scope, send, f)
+        finally:
+            f.close()
+
+    async def _respond(self, scope, send, f):
+        request_headers = Headers(scope=scope)
+        headers = MutableHeaders(raw=list(self.raw_headers))
+        size = self.stat_result.st_size
+
+        if is_not_modified(request_headers, self.etag,
+                           self.stat_result.st_mtime):
+            await self._send_headers(send, 304, headers)
+            return
+        if SENDFILE_HEADER:
+            # The proxy serves the body and the ranges itself
+            headers["content-type"] = self.media_type
+            headers[SENDFILE_HEADER] = self._sendfile_location()
+            await self._send_headers(send, 200, headers)
+            return
+
+        ranges = None
+        if_range = request_headers.get("if-range")
+        if "range" in request_headers and (
+                if_range is None or self._if_range_matches(if_range)):
+            try:
+                ranges = parse_ranges(request_headers["range"], size)
+            except RangeNotSatisfiable:
+                headers["content-range"] = f"bytes */{size}"
+                await self._send_headers(send, 416, headers)
+                return
+
+        head = scope["method"].upper() == "HEAD"
+        if not ranges:
+            headers["content-type"] = self.media_type
+            headers["content-length"] = str(size)
+            await self._send_headers(send, 200, headers,
+                                     more_body=not head and size > 0)
+            if not head and size > 0:
+                await self._send_file(scope, send, f, [(0, size)])
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            headers["content-type"] = self.media_type
+            headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+            headers["content-length"] = str(end - start)
+            await self._send_headers(send, 206, headers, more_body=not head)
+            if not head:
+                await self._send_file(scope, send, f, ranges)
+        else:
+            boundary = uuid.uuid4().hex
+            parts = [
+                (f"--{boundary}\r\nContent-Type: {self.media_type}\r\n"
+                 f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+                 ).encode()
+                for start, end in ranges]
+            closing = f"\r\n--{boundary}--\r\n".encode()
+            headers["content-type"] = (
+                f"multipart/byteranges; boundary={boundary}")
+            headers["content-length"] = str(
+                sum(len(part) + end - start
+                    for part, (start, end) in zip(parts, ranges))
+                + 2 * (len(ranges) - 1) + len(closing))
+            await self._send_headers(send, 206, headers, more_body=not head)
+            if head:
+                return
+            for index, (part, byte_range) in enumerate(zip(parts, ranges)):
+                await send({"type": "http.response.body",
+                            "body": (b"\r\n" if index else b"") + part,
+                            "more_body": True})
+                await self._send_file(scope, send, f, [byte_range],
+                                      more_body=True)
+            await send({"type": "http.response.body", "body": closing,
+                        "more_body": False})
+
+    def _if_range_matches(self, if_range):
+        # If-Range takes a strong ETag or the exact Last-Modified date
+        if if_range.startswith('"'):
+            return if_range == self.etag
+        return parse_http_date(if_range) == int(self.stat_result.st_mtime)
+
+    def _sendfile_location(self):
+        if SENDFILE_HEADER.lower() == "x-accel-redirect":
+            return SENDFILE_PREFIX + os.path.relpath(self.path)
+        return os.path.abspath(self.path)
+
+    async def _send_headers(self, send, status, headers, more_body=False):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": headers.raw})
+        if not more_body:
+            await send({"type": "http.response.body", "body": b"",
+                        "more_body": False})
+
+    async def _send_file(self, scope, send, f, ranges, more_body=False):
+        """
+        Send byte ranges of the open file as the body.
+
+        Uses the server's ``zerocopysend`` extension, or ``pathsend`` for
+        the whole file, so that the kernel copies the file to the socket;
+        otherwise reads chunks with ``pread`` in the thread pool.
+        """
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            for index, (start, end) in enumerate(ranges):
+                await send({
+                    "type": "http.response.zerocopysend", "file": f,
+                    "offset": start, "count": end - start,
+                    "more_body": more_body or index < len(ranges) - 1})
+            return
+        if (not more_body and ranges == [(0, self.stat_result.st_size)]
+                and "http.response.pathsend" in extensions):
+            await send({"type": "http.response.pathsend",
+                        "path": os.path.abspath(self.path)})
+            return
+
+        fd = f.fileno()
+        for index, (start, end) in enumerate(ranges):
+            last_range = index == len(ranges) - 1
+            while start < end:
+                count = min(DOWNLOAD_CHUNK_SIZE, end - start)
+                chunk = await run_in_threadpool(os.pread, fd, count, start)
+                if not chunk:
+                    raise OSError(f"{self.path} was truncated")
+                start += len(chunk)
+                await send({
+                    "type": "http.response.body", "body": chunk,
+                    "more_body": more_body or not last_range or start < end})
@@ -0,0 +1,146 @@
+"""
+Fast Path Module
+
+This module processes small images without touching the filesystem. Their
+input and output are kept in the payload store instead of the upload and
+output directories, and the codec runs on the bytes. A job is either run
+by a worker, like any other task, or inline in the thread pool of the API
+process, which returns the result in the HTTP response.
+"""
+
+import logging
+from contextlib import contextmanager
+from time import perf_counter
+
+from . import task_status
+from .batch_processor import process_data
+from .codec_pool import CPU_DEVICE
+from .gpu_manager import gpu_manager, GPUUnavailableError, GPU_WAIT_TIMEOUT
+from .metrics import observe_stage
+from .payloads import payload_store
+from .scheduler import scheduler
+from .tasks import celery, prefer_cpu, GPU_MAX_RETRIES, GPU_RETRY_DELAY
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def acquire_device(job, priority=0, timeout=GPU_WAIT_TIMEOUT):
+    """
+    Hold the device a job runs on for the duration of a ``with`` block.
+
+    The job runs on the CPU codec if it is expected to finish there before
+    a GPU would, and waits for a GPU otherwise.
+
+    Args:
+        job (dict): The job, annotated with its 'operation', 'work' and
+            'cost'.
+        priority (int): Priority of the job.
+        timeout (float): Seconds to wait for a GPU.
+
+    Yields:
+        int or str: The ID of the GPU, ``CPU_DEVICE``, or None if no GPU
+        became available within the timeout.
+    """
+    if prefer_cpu([job]):
+        yield CPU_DEVICE
+        return
+    wait_start = perf_counter()
+    gpu_id = gpu_manager.allocate_gpu(
+        priority=priority, timeout=timeout, cost=job.get("cost"))
+    observe_stage("gpu_wait", perf_counter() - wait_start, job["operation"],
+                  "" if gpu_id is None else gpu_id)
+    try:
+        yield gpu_id
+    finally:
+        if gpu_id is not None:
+            gpu_manager.release_gpu(gpu_id)
+
+
+def run_codec(job, image_data, gpu_id):
+    """
+    Run the codec on an image, and feed its time back into the cost model.
+
+    Args:
+        job (dict): The job, annotated with its 'operation' and 'work'.
+        image_data (bytes): The input image.
+        gpu_id (int or str): The ID of the GPU, or ``CPU_DEVICE``.
+
+    Returns:
+        bytes: The processed image.
+    """
+    start_time = perf_counter()
+    result = process_data(job["operation"], image_data, gpu_id)
+    scheduler.observe(job, perf_counter() - start_time,
+                      cpu=gpu_id == CPU_DEVICE)
+    return result
+
+
+@celery.task(bind=True, max_retries=GPU_MAX_RETRIES, track_status=True)
+def process_payload(self, input_key, output_key, operation, priority=0,
+                    cost=None, work=None):
+    """
+    Process an image job whose input and output are kept in the payload
+    store.
+
+    The task waits for a device as ``process_image`` does, and is retried
+    if no GPU frees up. The input payload is removed once the output is
+    stored.
+
+    Args:
+        input_key (str): Key of the input image in the payload store.
+        output_key (str): Key the output image is stored under.
+        operation (str): Operation to perform ('decode' or 'encode').
+        priority (int): Priority of the job (default is 0).
+        cost (float): Expected GPU seconds of the job.
+        work (int): Decoded sample bytes of the job.
+
+    Returns:
+        str: Status message.
+
+    Raises:
+        ValueError: If the input payload has expired.
+        Exception: The error of the codec. FAILURE is recorded before
+            either is raised.
+    """
+    job = {"operation": operation, "work": work, "cost": cost}
+    with acquire_device(job, priority) as gpu_id:
+        if gpu_id is None:
+            raise self.retry(
+                exc=GPUUnavailableError("No GPU available"),
+                countdown=GPU_RETRY_DELAY)
+        with task_status.report_outcome(self.request.id, [output_key]):
+            image_data = payload_store.get(input_key)
+            if image_data is None:
+                raise ValueError(f"Payload {input_key} has expired")
+            payload_store.put(
+                output_key, run_codec(job, image_data, gpu_id))
+            payload_store.delete(input_key)
+    return f"Processed {input_key} in memory"
+
+
+def run_inline(operation, image_data, priority=0, cost=None, work=None):
+    """
+    Process an image in the calling process and return the result.
+
+    Called from the thread pool of the API process; it blocks until a
+    device is free.
+
+    Args:
+        operation (str): Operation to perform ('decode' or 'encode').
+        image_data (bytes): The input image.
+        priority (int): Priority of the job.
+        cost (float): Expected GPU seconds of the job.
+        work (int): Decoded sample bytes of the job.
+
+    Returns:
+        bytes: The processed image.
+
+    Raises:
+        GPUUnavailableError: If no GPU became available in time.
+    """
+    job = {"operation": operation, "work": work, "cost": cost}
+    with acquire_device(job, priority) as gpu_id:
+        if gpu_id is None:
+            raise GPUUnavailableError("No GPU available")
+        return run_codec(job, image_data, gpu_id)
@@ -2,72 +2,568 @@
 GPU Manager Module
 
 This module manages the allocation and deallocation of GPU resources.
-It also monitors the GPU usage continuously to ensure efficient utilization.
+Callers that find no free GPU wait in a queue ordered by job priority and
+expected duration, shortest first, with aging so that low-priority and
+long-running work cannot starve. GPU telemetry is sampled
+into ring buffers, and a free GPU is chosen by its recent utilization.
+
+A GPU is allocated by taking a lease on it (see the leases module), so the
+worker processes of a node share its devices instead of each assuming it
+owns all of them. Leases are renewed by a heartbeat thread while they are
+held, and the best job waiting in a process competes for released devices
+with those of the other processes.
 """
 
+import itertools
+import logging
+import os
 import threading
-from time import sleep
-import psutil
+import time
+from contextlib import contextmanager
+from time import monotonic
+from .leases import (
+    GPU_LEASE_BACKEND, GPU_LEASE_TTL, create_lease_backend, make_owner_id)
+from .telemetry import TelemetrySampler, create_backend
+
+logger = logging.getLogger(__name__)
+
+# Seconds a task waits for a GPU before it is retried
+GPU_WAIT_TIMEOUT = float(os.getenv("GPU_WAIT_TIMEOUT", 30))
+# Priority points a waiting job gains per second spent in the queue
+GPU_AGING_RATE = float(os.getenv("GPU_AGING_RATE", 0.1))
+# Priority points a job loses per second of expected GPU time
+GPU_COST_WEIGHT = float(os.getenv("GPU_COST_WEIGHT", 1.0))
+# Seconds of telemetry averaged when comparing GPU load
+GPU_USAGE_WINDOW = float(os.getenv("GPU_USAGE_WINDOW", 60))
+# Number of GPUs of the node; discovered from CUDA_VISIBLE_DEVICES or NVML
+# when unset
+GPU_COUNT = os.getenv("GPU_COUNT")
+# GPUs assumed when none can be discovered, e.g. with the stub telemetry
+DEFAULT_GPU_COUNT = 4
+# Seconds between two lease requests of a process waiting for a GPU that
+# another process holds
+GPU_LEASE_POLL_INTERVAL = float(os.getenv("GPU_LEASE_POLL_INTERVAL", 0.05))
+
+
+class GPUUnavailableError(Exception):
+    """
+    Raised when no GPU could be allocated within the timeout.
+    """
+
+
+def effective_priority(priority, waited, cost=0.0, aging_rate=GPU_AGING_RATE,
+                       cost_weight=GPU_COST_WEIGHT):
+    """
+    Return the priority a job is served by.
+
+    Jobs expected to run longer rank lower, so short jobs go first, and
+    every job gains priority while it waits.
+
+    Args:
+        priority (int): Priority of the job.
+        waited (float): Seconds the job has been waiting.
+        cost (float): Expected GPU seconds of the job.
+        aging_rate (float): Priority points gained per second of waiting.
+        cost_weight (float): Priority points lost per expected second.
+
+    Returns:
+        float: The effective priority; higher values are served first.
+    """
+    return priority + aging_rate * waited - cost_weight * cost
+
+
+def discover_gpus():
+    """
+    Return the number of GPUs of this node.
+
+    ``GPU_COUNT`` takes precedence, then the devices listed in
+    ``CUDA_VISIBLE_DEVICES``, then the devices NVML reports. Without NVML,
+    ``DEFAULT_GPU_COUNT`` GPUs are simulated.
+
+    Returns:
+        int: The number of GPUs.
+    """
+    if GPU_COUNT:
+        return int(GPU_COUNT)
+    visible = os.getenv("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        devices = [device for device in visible.split(",") if device.strip()]
+        # A negative index hides the devices from it onwards
+        for index, device in enumerate(devices):
+            if device.strip().startswith("-"):
+                return index
+        return len(devices)
+    backend = create_backend(DEFAULT_GPU_COUNT)
+    try:
+        return backend.device_count()
+    finally:
+        backend.close()
+
+
+class _Waiter:
+    """
+    A caller waiting in the GPU queue.
+
+    Attributes:
+        priority (int): Priority of the job; higher values are served first.
+        cost (float): Expected GPU seconds of the job.
+        enqueued_at (float): Monotonic time the caller started waiting.
+        score (float): Rank of the job among the waiters of all processes.
+        seq (int): Arrival order, used to break ties.
+        condition (threading.Condition): Signalled when a GPU is handed over.
+        gpu_id (int): The GPU handed to the waiter, or None.
+    """
+
+    def __init__(self, priority, enqueued_at, seq, lock, cost=0.0,
+                 score=0.0):
+        self.priority = priority
+        self.cost = cost
+        self.enqueued_at = enqueued_at
+        self.score = score
+        self.seq = seq
+        self.condition = threading.Condition(lock)
+        self.gpu_id = None
 
 
 class GPUManager:
     """
     A class to manage GPU resources.
 
+    The number of GPUs and the lease backend may be left to be discovered
+    and opened on first use, so that creating the manager does no I/O.
+
     Attributes:
         num_gpus (int): The total number of GPUs available.
         lock (threading.Lock): A lock to manage concurrent access to GPUs.
-        available_gpus (list): A list of available GPU IDs.
-        gpu_usage (list): A list to store the usage of each GPU.
+        leases: The lease backend shared with the other processes.
+        lease_ttl (float): Seconds a lease lasts unless renewed.
+        held (set): The IDs of the GPUs leased by this process.
+        waiters (list): Callers waiting for a GPU.
+        aging_rate (float): Priority points gained per second of waiting.
+        cost_weight (float): Priority points lost per expected GPU second.
     """
 
-    def __init__(self, num_gpus):
+    def __init__(self, num_gpus=None, aging_rate=GPU_AGING_RATE,
+                 telemetry=None, cost_weight=GPU_COST_WEIGHT, leases=None,
+                 lease_ttl=GPU_LEASE_TTL,
+                 poll_interval=GPU_LEASE_POLL_INTERVAL,
+                 lease_backend="memory"):
         """
         Initialize the GPUManager with the number of GPUs.
 
         Args:
-            num_gpus (int): The total number of GPUs.
+            num_gpus (int): The total number of GPUs. Discovered with
+                ``discover_gpus`` on first use if not given.
+            aging_rate (float): Priority points gained per second of waiting.
+            cost_weight (float): Priority points lost per expected GPU
+                second.
+            telemetry (TelemetrySampler): The GPU telemetry source. Created
+                from the configured backend on first use if not given.
+            leases: The lease backend. Created from ``lease_backend`` on
+                first use if not given.
+            lease_ttl (float): Seconds a lease lasts unless renewed.
+            poll_interval (float): Seconds between two lease requests while
+                other processes hold every GPU.
+            lease_backend (str): Name of the lease backend created when
+                ``leases`` is not given; 'memory' keeps the leases in this
+                process.
         """
-        self.num_gpus = num_gpus
+        self._num_gpus = num_gpus
         self.lock = threading.Lock()
-        self.available_gpus = list(range(num_gpus))
-        self.gpu_usage = [0] * num_gpus  # Track GPU usage
+        self._leases = leases
+        self.lease_backend = lease_backend
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.held = set()
+        self.waiters = []
+        self.aging_rate = aging_rate
+        self.cost_weight = cost_weight
+        self._telemetry = telemetry
+        self._seq = itertools.count()
+        self._allocations = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_cost = 0.0
+        self._busy_until = {}
+        self._released_at = {}
+        self._owner = None
+        self._owner_pid = None
+        self._heartbeat = None
+        self._stopped = threading.Event()
 
-    def allocate_gpu(self):
+    @property
+    def num_gpus(self):
         """
-        Allocate a GPU for a task.
+        int: The total number of GPUs, discovered on first use.
+        """
+        if self._num_gpus is None:
+            self._num_gpus = discover_gpus()
+        return self._num_gpus
+
+    @num_gpus.setter
+    def num_gpus(self, value):
+        self._num_gpus = value
+
+    @property
+    def leases(self):
+        """
+        The lease backend, created on first use.
+        """
+        if self._leases is None:
+            self._leases = create_lease_backend(self.lease_backend)
+        return self._leases
+
+    @property
+    def owner(self):
+        """
+        str: The lease owner ID of this process, renewed after a fork.
+        """
+        if self._owner_pid != os.getpid():
+            # A forked child inherits neither the leases nor the heartbeat
+            self._owner = make_owner_id()
+            self._owner_pid = os.getpid()
+            self.held = set()
+            self._heartbeat = None
+        return self._owner
+
+    @property
+    def available_gpus(self):
+        """
+        list: The IDs of the GPUs no process holds a lease on.
+        """
+        leased = self.leases.leases()
+        return [gpu_id for gpu_id in range(self.num_gpus)
+                if gpu_id not in leased]
+
+    def allocate_gpu(self, priority=0, timeout=None, cost=0.0):
+        """
+        Allocate a GPU for a task, waiting for one to become free.
+
+        Waiting callers are served in order of their ``effective_priority``:
+        their priority plus the aging bonus accumulated while queued, minus
+        a penalty for their expected GPU time. Ties are served first come,
+        first served. The best waiter of each process competes with those
+        of the other processes in the same order.
+
+        Args:
+            priority (int): Priority of the job; higher values are served
+                first.
+            timeout (float): Seconds to wait for a GPU. None waits
+                indefinitely and 0 returns immediately.
+            cost (float): Expected GPU seconds of the job.
 
         Returns:
-            int: The ID of the allocated GPU, or None if no GPU is available.
+            int: The ID of the allocated GPU, or None if no GPU became
+            available within the timeout.
         """
+        start = monotonic()
+        # Effective priorities age at the same rate, so jobs rank the same
+        # at any time by their effective priority at the epoch
+        score = effective_priority(priority, -time.time(), cost or 0.0,
+                                   self.aging_rate, self.cost_weight)
         with self.lock:
-            if self.available_gpus:
-                return self.available_gpus.pop(0)
-            return None
+            if not self.waiters:
+                gpu_id = self._lease_gpu(score)
+                if gpu_id is not None:
+                    self._record_wait(0.0, gpu_id, cost)
+                    return gpu_id
+            if timeout is not None and timeout <= 0:
+                self._timeouts += 1
+                return None
+
+            waiter = _Waiter(priority, start, next(self._seq), self.lock,
+                             cost or 0.0, score)
+            self.waiters.append(waiter)
+            deadline = None if timeout is None else start + timeout
+            while waiter.gpu_id is None:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                if waiter is self._next_waiter():
+                    # Devices released by other processes are polled for
+                    self.leases.set_waiting(self.owner, score, self.lease_ttl)
+                    waiter.gpu_id = self._lease_gpu(score)
+                    if waiter.gpu_id is not None:
+                        break
+                waiter.condition.wait(
+                    self.poll_interval if remaining is None
+                    else min(remaining, self.poll_interval))
+
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                self._update_waiting()
+            if waiter.gpu_id is None:
+                self._timeouts += 1
+                return None
+            self._record_wait(monotonic() - start, waiter.gpu_id, cost)
+            return waiter.gpu_id
 
     def release_gpu(self, gpu_id):
         """
         Release a GPU after a task is done.
 
+        If callers are waiting, the GPU is leased again at once for the one
+        with the highest effective priority, unless a job waiting in
+        another process ranks higher.
+
         Args:
             gpu_id (int): The ID of the GPU to release.
         """
         with self.lock:
-            self.available_gpus.append(gpu_id)
+            self.held.discard(gpu_id)
+            self._busy_until.pop(gpu_id, None)
+            self._released_at[gpu_id] = monotonic()
+            self.leases.release(self.owner, gpu_id)
+            if self.waiters:
+                waiter = self._next_waiter()
+                waiter.gpu_id = self._lease_gpu(waiter.score, [gpu_id])
+                if waiter.gpu_id is not None:
+                    self.waiters.remove(waiter)
+                    self._update_waiting()
+                waiter.condition.notify()
+
+    def close(self):
+        """
+        Stop the heartbeat and give up the leases of this process.
+        """
+        self._stopped.set()
+        if self._leases is None:
+            return
+        with self.lock:
+            for gpu_id in list(self.held):
+                self.leases.release(self.owner, gpu_id)
+            self.held.clear()
+            self.leases.clear_waiting(self.owner)
+
+    @contextmanager
+    def gpu(self, priority=0, timeout=GPU_WAIT_TIMEOUT, cost=0.0):
+        """
+        Hold a GPU for the duration of a ``with`` block.
+
+        Args:
+            priority (int): Priority of the job; higher values are served
+                first.
+            timeout (float): Seconds to wait for a GPU.
+            cost (float): Expected GPU seconds of the job.
+
+        Yields:
+            int: The ID of the allocated GPU.
+
+        Raises:
+            GPUUnavailableError: If no GPU became available in time.
+        """
+        gpu_id = self.allocate_gpu(
+            priority=priority, timeout=timeout, cost=cost)
+        if gpu_id is None:
+            raise GPUUnavailableError(
+                f"No GPU became available within {timeout} seconds")
+        try:
+            yield gpu_id
+        finally:
+            self.release_gpu(gpu_id)
+
+    def wait_stats(self):
+        """
+        Return statistics on the time callers spent waiting for a GPU.
+
+        Returns:
+            dict: Allocation and timeout counts, mean and maximum wait in
+            seconds, and the number of callers currently queued.
+        """
+        with self.lock:
+            return {
+                "allocations": self._allocations,
+                "timeouts": self._timeouts,
+                "mean_wait": (self._total_wait / self._allocations
+                              if self._allocations else 0.0),
+                "max_wait": self._max_wait,
+                "queued": len(self.waiters),
+                "held": len(self.held),
+            }
+
+    def expected_wait(self):
+        """
+        Return the seconds a job asking for a GPU now is expected to wait.
+
+        Zero if a GPU is free and no job of this process waits. Otherwise
+        the expected time left on the GPUs held by this process and the
+        expected time of the jobs waiting in it are spread over all GPUs;
+        a GPU held by another process counts for the mean expected time of
+        the jobs this process ran.
+
+        Returns:
+            float: The expected wait in seconds.
+        """
+        free = self.available_gpus
+        with self.lock:
+            if free and not self.waiters:
+                return 0.0
+            now = monotonic()
+            busy = sum(max(0.0, self._busy_until.get(gpu_id, now) - now)
+                       for gpu_id in self.held)
+            mean_cost = (self._total_cost / self._allocations
+                         if self._allocations else 0.0)
+            foreign = max(0, self.num_gpus - len(free) - len(self.held))
+            queued = sum(waiter.cost for waiter in self.waiters)
+            return (busy + foreign * mean_cost + queued) / max(
+                1, self.num_gpus)
+
+    @property
+    def telemetry(self):
+        """
+        TelemetrySampler: The GPU telemetry source, created on first use.
+        """
+        if self._telemetry is None:
+            self._telemetry = TelemetrySampler(create_backend(self.num_gpus))
+        return self._telemetry
+
+    @property
+    def gpu_usage(self):
+        """
+        list: The average utilization of each GPU over the last
+        ``GPU_USAGE_WINDOW`` seconds, 0 where nothing was sampled yet.
+        """
+        return [
+            self.telemetry.average(gpu_id, "utilization", GPU_USAGE_WINDOW)
+            or 0
+            for gpu_id in range(self.num_gpus)]
+
+    def start_monitoring(self):
+        """
+        Start sampling GPU telemetry in a background thread.
+        """
+        self.telemetry.start()
 
-    def monitor_gpu_usage(self):
+    def stop_monitoring(self):
         """
-        Continuously monitor the usage of each GPU.
+        Stop sampling GPU telemetry.
         """
-        while True:
-            for gpu_id in range(self.num_gpus):
-                # Simulated GPU usage monitoring
-                self.gpu_usage[gpu_id] = psutil.cpu_percent(interval=1)
-            sleep(5)  # Monitor every 5 seconds
+        if self._telemetry is not None:
+            self._telemetry.stop()
+
+    def _lease_gpu(self, score, candidates=None):
+        """
+        Lease a free GPU, preferring the one with the lowest recent
+        utilization.
+
+        Without telemetry samples the GPU that has been free the longest is
+        preferred. Must be called with the lock held.
 
+        Args:
+            score (float): Rank of the job the GPU is for.
+            candidates (list): The GPUs to choose from; all by default.
+
+        Returns:
+            int: The ID of the GPU, or None if none is free or a job
+            waiting in another process ranks higher.
+        """
+        if candidates is None:
+            candidates = sorted(
+                range(self.num_gpus),
+                key=lambda g: self._released_at.get(g, float("-inf")))
+            if self._telemetry is not None:
+                usage = {
+                    gpu_id: self._telemetry.average(
+                        gpu_id, "utilization", GPU_USAGE_WINDOW)
+                    for gpu_id in candidates}
+                candidates.sort(key=lambda g: usage[g] or 0)
+        gpu_id = self.leases.acquire(
+            self.owner, candidates, self.lease_ttl, score)
+        if gpu_id is not None:
+            self.held.add(gpu_id)
+            self._start_heartbeat()
+        return gpu_id
+
+    def _update_waiting(self):
+        """
+        Register the rank of the best waiter of this process, or remove
+        the registration if none is left.
+
+        Must be called with the lock held.
+        """
+        if self.waiters:
+            self.leases.set_waiting(
+                self.owner, self._next_waiter().score, self.lease_ttl)
+        else:
+            self.leases.clear_waiting(self.owner)
+
+    def _start_heartbeat(self):
+        """
+        Start the thread renewing the leases of this process, unless it is
+        running.
+
+        Must be called with the lock held.
+        """
+        if self._heartbeat is None or not self._heartbeat.is_alive():
+            self._stopped.clear()
+            self._heartbeat = threading.Thread(
+                target=self._renew_leases, name="gpu-lease-heartbeat",
+                daemon=True)
+            self._heartbeat.start()
+
+    def _renew_leases(self):
+        """
+        Renew the held leases every third of their TTL until stopped.
+        """
+        while not self._stopped.wait(self.lease_ttl / 3):
+            with self.lock:
+                held = set(self.held)
+                waiting = bool(self.waiters)
+            if not held and not waiting:
+                continue
+            try:
+                renewed = set(self.leases.renew(
+                    self.owner, held, self.lease_ttl))
+                if waiting:
+                    with self.lock:
+                        self._update_waiting()
+            except Exception as e:
+                logger.warning(f"Could not renew GPU leases: {e}")
+                continue
+            for gpu_id in held - renewed:
+                logger.warning(f"Lease of GPU {gpu_id} was lost")
+
+    def _next_waiter(self):
+        """
+        Return the waiter with the highest effective priority.
+
+        Must be called with the lock held.
+
+        Returns:
+            _Waiter: The waiter to serve next.
+        """
+        now = monotonic()
+        return max(
+            self.waiters,
+            key=lambda w: (
+                effective_priority(
+                    w.priority, now - w.enqueued_at, w.cost,
+                    self.aging_rate, self.cost_weight),
+                -w.seq))
+
+    def _record_wait(self, wait, gpu_id, cost=0.0):
+        """
+        Record the queue wait of a successful allocation.
+
+        Must be called with the lock held.
+
+        Args:
+            wait (float): Seconds the caller waited.
+            gpu_id (int): The allocated GPU.
+            cost (float): Expected GPU seconds of the job.
+        """
+        self._allocations += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._total_cost += cost or 0.0
+        self._busy_until[gpu_id] = monotonic() + (cost or 0.0)
 
-# Create a singleton GPUManager instance
-gpu_manager = GPUManager(num_gpus=4)
 
-# Start GPU usage monitoring in a separate thread
-threading.Thread(target=gpu_manager.monitor_gpu_usage, daemon=True).start()
+# Create a singleton GPUManager instance sharing the GPUs of the node with
+# the other processes; the GPUs are discovered and the lease backend opened
+# when a GPU is first allocated, and worker processes start its telemetry
+# sampling when they boot
+gpu_manager = GPUManager(lease_backend=GPU_LEASE_BACKEND)
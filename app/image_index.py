@@ -0,0 +1,137 @@
+"""
+Image Index Module
+
+This module keeps the header properties of uploaded images in a local
+SQLite database keyed by file ID. Headers are parsed once at upload time,
+so the API, the scheduler and the cache can look up image dimensions,
+tiling and resolution levels without reading the image or touching a GPU.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from .jp2 import ImageHeader
+
+# Path of the SQLite database of image headers
+IMAGE_INDEX_PATH = os.getenv("IMAGE_INDEX_PATH", "image_index.db")
+
+
+class ImageIndex:
+    """
+    A SQLite table of image headers keyed by file ID.
+
+    The database is opened on first use and shared by the threads of a
+    process; several processes may use the same file.
+
+    Attributes:
+        path (str): Path of the database file.
+        lock (threading.Lock): A lock serializing access to the connection.
+    """
+
+    def __init__(self, path=IMAGE_INDEX_PATH):
+        """
+        Initialize the ImageIndex.
+
+        Args:
+            path (str): Path of the database file.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    def put(self, file_id, header, path=None):
+        """
+        Store the header of an image, replacing any previous entry.
+
+        Args:
+            file_id (str): The ID of the file.
+            header (ImageHeader): The parsed header.
+            path (str): Path of the stored image.
+        """
+        columns = ", ".join(ImageHeader._fields)
+        placeholders = ", ".join("?" for _ in ImageHeader._fields)
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO images "
+                    f"(file_id, path, indexed_at, {columns}) "
+                    f"VALUES (?, ?, ?, {placeholders})",
+                    (file_id, path, time.time(), *header))
+
+    def get(self, file_id):
+        """
+        Look up the header of an image.
+
+        Args:
+            file_id (str): The ID of the file.
+
+        Returns:
+            ImageHeader: The stored header, or None if the file is not
+            indexed.
+        """
+        columns = ", ".join(ImageHeader._fields)
+        with self.lock:
+            row = self._connect().execute(
+                f"SELECT {columns} FROM images WHERE file_id = ?",
+                (file_id,)).fetchone()
+        if row is None:
+            return None
+        header = ImageHeader(*row)
+        return header._replace(signed=bool(header.signed))
+
+    def delete(self, file_id):
+        """
+        Remove the entry of an image, if any.
+
+        Args:
+            file_id (str): The ID of the file.
+        """
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "DELETE FROM images WHERE file_id = ?", (file_id,))
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self):
+        """
+        Return the connection, opening the database on first use.
+
+        Must be called with the lock held.
+
+        Returns:
+            sqlite3.Connection: The database connection.
+        """
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS images ("
+                    "file_id TEXT PRIMARY KEY, path TEXT, "
+                    "indexed_at REAL, width INTEGER, height INTEGER, "
+                    "num_components INTEGER, bit_depth INTEGER, "
+                    "signed INTEGER, tile_width INTEGER, "
+                    "tile_height INTEGER, num_tiles_x INTEGER, "
+                    "num_tiles_y INTEGER, decomposition_levels INTEGER)")
+            self._connection = connection
+        return self._connection
+
+
+# Create the singleton ImageIndex instance
+image_index = ImageIndex()
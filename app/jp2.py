@@ -0,0 +1,201 @@
+"""
+JPEG2000 Header Module
+
+This module reads the image properties of a JPEG2000 file from its header
+alone: the JP2 box structure is walked up to the contiguous codestream box,
+and the codestream main header is read up to the first tile-part. Image
+size and components come from the SIZ marker, the number of wavelet
+decomposition levels from the COD marker and its per-component COC
+overrides. Raw codestreams (.j2k) without JP2 boxes are supported too.
+
+Only a few hundred bytes are read, so images can be inspected without
+reading the whole file or touching a GPU.
+"""
+
+import struct
+from collections import namedtuple
+
+# Properties of an image read from its header
+ImageHeader = namedtuple(
+    "ImageHeader",
+    ["width", "height", "num_components", "bit_depth", "signed",
+     "tile_width", "tile_height", "num_tiles_x", "num_tiles_y",
+     "decomposition_levels"])
+
+JP2_SIGNATURE = b"\x00\x00\x00\x0cjP  \r\n\x87\n"
+
+# Codestream markers
+SOC = 0xFF4F
+SIZ = 0xFF51
+COD = 0xFF52
+COC = 0xFF53
+SOT = 0xFF90
+SOD = 0xFF93
+
+
+class InvalidHeaderError(ValueError):
+    """
+    Raised when a file is not a JPEG2000 image or its header is malformed.
+    """
+
+
+def parse_header(source):
+    """
+    Read the image properties from the header of a JPEG2000 file.
+
+    Args:
+        source (str or file): Path to the file, or a binary file object
+            positioned at the start of the file.
+
+    Returns:
+        ImageHeader: The image properties. ``bit_depth`` is the largest
+        component depth and ``decomposition_levels`` the smallest number of
+        levels of any component, i.e. the deepest reduction every component
+        supports.
+
+    Raises:
+        InvalidHeaderError: If the file is not a JP2 file or a JPEG2000
+            codestream, or its header is truncated or malformed.
+    """
+    if isinstance(source, (str, bytes)) or hasattr(source, "__fspath__"):
+        with open(source, "rb") as f:
+            return parse_header(f)
+
+    start = _read_exact(source, 12)
+    if start == JP2_SIGNATURE:
+        _find_codestream(source)
+    elif start[:2] == struct.pack(">H", SOC):
+        # A raw codestream; rewind to the marker after SOC
+        source.seek(-10, 1)
+    else:
+        raise InvalidHeaderError("Not a JPEG2000 file")
+    return _parse_main_header(source)
+
+
+def _find_codestream(f):
+    """
+    Skip JP2 boxes until the contiguous codestream box.
+
+    Args:
+        f (file): File positioned after the signature box.
+
+    Raises:
+        InvalidHeaderError: If the file has no codestream box.
+    """
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise InvalidHeaderError("No codestream box found")
+        length, box_type = struct.unpack(">I4s", header)
+        header_length = 8
+        if length == 1:
+            length = struct.unpack(">Q", _read_exact(f, 8))[0]
+            header_length = 16
+        if box_type == b"jp2c":
+            if _read_exact(f, 2) != struct.pack(">H", SOC):
+                raise InvalidHeaderError("Codestream does not start with SOC")
+            return
+        if length == 0:
+            raise InvalidHeaderError("No codestream box found")
+        if length < header_length:
+            raise InvalidHeaderError(f"Invalid length of box {box_type!r}")
+        f.seek(length - header_length, 1)
+
+
+def _parse_main_header(f):
+    """
+    Read the SIZ, COD and COC markers of a codestream main header.
+
+    Args:
+        f (file): File positioned after the SOC marker.
+
+    Returns:
+        ImageHeader: The image properties.
+    """
+    size = None
+    levels = None
+    component_levels = {}
+    while True:
+        marker, length = struct.unpack(">HH", _read_exact(f, 4))
+        if marker in (SOT, SOD):
+            break
+        if marker >> 8 != 0xFF or length < 2:
+            raise InvalidHeaderError(f"Invalid marker {marker:#06x}")
+        segment = _read_exact(f, length - 2)
+        if marker == SIZ:
+            size = _parse_siz(segment)
+        elif marker == COD:
+            if len(segment) < 6:
+                raise InvalidHeaderError("Truncated COD marker")
+            levels = segment[5]
+        elif marker == COC:
+            if size is None:
+                raise InvalidHeaderError("COC marker before SIZ")
+            index_size = 1 if size["num_components"] < 257 else 2
+            if len(segment) < index_size + 2:
+                raise InvalidHeaderError("Truncated COC marker")
+            component = int.from_bytes(segment[:index_size], "big")
+            component_levels[component] = segment[index_size + 1]
+
+    if size is None or levels is None:
+        raise InvalidHeaderError("Main header lacks SIZ or COD marker")
+    return ImageHeader(
+        width=size["width"],
+        height=size["height"],
+        num_components=size["num_components"],
+        bit_depth=size["bit_depth"],
+        signed=size["signed"],
+        tile_width=size["tile_width"],
+        tile_height=size["tile_height"],
+        num_tiles_x=size["num_tiles_x"],
+        num_tiles_y=size["num_tiles_y"],
+        decomposition_levels=min(
+            [levels] + list(component_levels.values())))
+
+
+def _parse_siz(segment):
+    """
+    Decode an SIZ marker segment.
+
+    Args:
+        segment (bytes): The segment after its length field.
+
+    Returns:
+        dict: Image and tile dimensions and component properties.
+    """
+    if len(segment) < 36:
+        raise InvalidHeaderError("Truncated SIZ marker")
+    (_, x_size, y_size, x_offset, y_offset, tile_width, tile_height,
+     tile_x_offset, tile_y_offset, num_components) = struct.unpack(
+        ">HIIIIIIIIH", segment[:36])
+    components = segment[36:36 + 3 * num_components]
+    if num_components == 0 or len(components) < 3 * num_components:
+        raise InvalidHeaderError("Truncated SIZ marker")
+    if (tile_width == 0 or tile_height == 0 or x_size <= x_offset
+            or y_size <= y_offset):
+        raise InvalidHeaderError("Invalid image or tile size")
+    depths = components[0::3]
+    return {
+        "width": x_size - x_offset,
+        "height": y_size - y_offset,
+        "num_components": num_components,
+        "bit_depth": max((depth & 0x7F) + 1 for depth in depths),
+        "signed": any(depth & 0x80 for depth in depths),
+        "tile_width": tile_width,
+        "tile_height": tile_height,
+        "num_tiles_x": -(-(x_size - tile_x_offset) // tile_width),
+        "num_tiles_y": -(-(y_size - tile_y_offset) // tile_height),
+    }
+
+
+def _read_exact(f, size):
+    """
+    Read exactly ``size`` bytes.
+
+    Raises:
+        InvalidHeaderError: If the file ends first.
+    """
+    data = f.read(size)
+    if len(data) < size:
+        raise InvalidHeaderError("Truncated JPEG2000 header")
+    return data
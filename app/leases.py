@@ -0,0 +1,409 @@
+"""
+GPU Leases Module
+
+This module keeps the leases that give a process the use of a GPU, so that
+the worker processes of a node never use the same device at once. A lease
+carries the ID of its owner process and expires unless the owner renews it,
+so the devices of a crashed worker are reclaimed after ``GPU_LEASE_TTL``
+seconds, or at once by the file backend, which sees that its process is
+gone. The Redis backend has no such check, as its owners may run in other
+containers whose PIDs this process cannot see; it relies on the TTL alone,
+which is kept short for that reason.
+
+Processes waiting for a device register the rank of their best waiting job,
+and a free device is only granted to a caller that no other waiting process
+outranks, so devices are shared fairly between processes.
+
+Backends:
+    redis: Keys with a TTL in Redis, shared by the processes and
+        containers of a node, which need not share a file system.
+    file: A JSON file locked with ``flock``, shared by the processes of a
+        host without Redis.
+    memory: Leases of a single process, for tests.
+"""
+
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Lease backend: 'memory', 'file' or 'redis'
+GPU_LEASE_BACKEND = os.getenv("GPU_LEASE_BACKEND", "redis")
+# Directory of the lease file of the file backend
+GPU_LEASE_DIR = os.getenv("GPU_LEASE_DIR", "gpu_leases")
+# Redis database of the redis backend
+GPU_LEASE_URL = os.getenv("GPU_LEASE_URL", "redis://redis:6379/1")
+# Seconds a lease lasts unless it is renewed; the devices of a crashed
+# worker are reclaimed after it by the redis backend
+GPU_LEASE_TTL = float(os.getenv("GPU_LEASE_TTL", 10))
+# Name of this node; leases are kept per node
+GPU_NODE_NAME = os.getenv("GPU_NODE_NAME", socket.gethostname())
+
+# A lease of a device
+Lease = namedtuple("Lease", ["gpu_id", "owner", "expires_at"])
+
+
+def make_owner_id(node=GPU_NODE_NAME):
+    """
+    Return a new owner ID for this process.
+
+    Returns:
+        str: 'node:pid:token'; the token tells apart processes that reuse
+        a PID.
+    """
+    return f"{node}:{os.getpid()}:{os.urandom(4).hex()}"
+
+
+def owner_alive(owner, node=GPU_NODE_NAME):
+    """
+    Tell whether the process of an owner ID may still be running.
+
+    Args:
+        owner (str): The owner ID.
+        node (str): The name of this node.
+
+    Returns:
+        bool: False only for owners on this node whose process is gone.
+    """
+    owner_node, _, pid = owner.rpartition(":")[0].rpartition(":")
+    if owner_node != node:
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+
+class _StateLeaseBackend:
+    """
+    Lease logic over a state dict, shared by the memory and file backends.
+
+    The state holds 'leases', mapping device IDs to [owner, expires_at],
+    and 'waiting', mapping owner IDs to [score, expires_at]. Subclasses
+    provide ``_state``, a context manager yielding the state under a lock
+    and saving it afterwards.
+    """
+
+    def acquire(self, owner, candidates, ttl=GPU_LEASE_TTL, score=None):
+        """
+        Lease the first free device of the candidates.
+
+        Args:
+            owner (str): The owner ID of the caller.
+            candidates (list): Device IDs in order of preference.
+            ttl (float): Seconds the lease lasts unless renewed.
+            score (float): Rank of the caller's job. No device is granted
+                while another process waits with a higher score.
+
+        Returns:
+            int: The leased device ID, or None.
+        """
+        now = time.time()
+        with self._state() as state:
+            waiting = state["waiting"]
+            for other, (other_score, expires_at) in list(waiting.items()):
+                if expires_at < now or not owner_alive(other):
+                    del waiting[other]
+                elif (other != owner and score is not None
+                        and other_score > score):
+                    return None
+            leases = state["leases"]
+            for gpu_id in candidates:
+                lease = leases.get(str(gpu_id))
+                if (lease is None or lease[1] < now
+                        or not owner_alive(lease[0])):
+                    leases[str(gpu_id)] = [owner, now + ttl]
+                    return gpu_id
+        return None
+
+    def release(self, owner, gpu_id):
+        """
+        Give up the lease of a device, if the owner still holds it.
+        """
+        with self._state() as state:
+            lease = state["leases"].get(str(gpu_id))
+            if lease is not None and lease[0] == owner:
+                del state["leases"][str(gpu_id)]
+
+    def renew(self, owner, gpu_ids, ttl=GPU_LEASE_TTL):
+        """
+        Extend the leases of an owner.
+
+        Returns:
+            list: The devices still leased by the owner.
+        """
+        now = time.time()
+        held = []
+        with self._state() as state:
+            for gpu_id in gpu_ids:
+                lease = state["leases"].get(str(gpu_id))
+                if lease is not None and lease[0] == owner:
+                    lease[1] = now + ttl
+                    held.append(gpu_id)
+        return held
+
+    def set_waiting(self, owner, score, ttl=GPU_LEASE_TTL):
+        """
+        Register the rank of the best job an owner is waiting with.
+        """
+        with self._state() as state:
+            state["waiting"][owner] = [score, time.time() + ttl]
+
+    def clear_waiting(self, owner):
+        """
+        Remove the registration of a waiting owner.
+        """
+        with self._state() as state:
+            state["waiting"].pop(owner, None)
+
+    def leases(self):
+        """
+        Return the unexpired leases.
+
+        Returns:
+            dict: Device IDs mapped to their Lease.
+        """
+        now = time.time()
+        with self._state() as state:
+            return {
+                int(gpu_id): Lease(int(gpu_id), owner, expires_at)
+                for gpu_id, (owner, expires_at) in state["leases"].items()
+                if expires_at >= now and owner_alive(owner)}
+
+
+class MemoryLeaseBackend(_StateLeaseBackend):
+    """
+    Leases kept in the memory of one process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {"leases": {}, "waiting": {}}
+
+    @contextmanager
+    def _state(self):
+        with self.lock:
+            yield self.state
+
+
+class FileLeaseBackend(_StateLeaseBackend):
+    """
+    Leases kept in a JSON file shared by the processes of a node.
+
+    Every operation reads and rewrites the file under an exclusive
+    ``flock``, which takes a few tens of microseconds.
+
+    Attributes:
+        path (str): Path of the lease file.
+    """
+
+    def __init__(self, directory=GPU_LEASE_DIR, node=GPU_NODE_NAME):
+        """
+        Initialize the FileLeaseBackend.
+
+        Args:
+            directory (str): Directory of the lease file.
+            node (str): The name of this node.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{node}.json")
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), "r+") as f:
+                    text = f.read()
+                    state = json.loads(text) if text else {}
+                    state.setdefault("leases", {})
+                    state.setdefault("waiting", {})
+                    yield state
+                    data = json.dumps(state)
+                    if data != text:
+                        f.seek(0)
+                        f.write(data)
+                        f.truncate()
+            finally:
+                os.close(fd)
+
+
+# Leases the first free device of KEYS[2..] to ARGV[1] unless a waiting
+# owner in the hash KEYS[1] outranks score ARGV[4]
+_ACQUIRE_SCRIPT = """
+local owner, ttl, now = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local score = tonumber(ARGV[4])
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+    local other_score, expires_at = string.match(
+        entries[i + 1], '^([^ ]+) ([^ ]+)$')
+    if tonumber(expires_at) < now then
+        redis.call('HDEL', KEYS[1], entries[i])
+    elseif score and entries[i] ~= owner
+            and tonumber(other_score) > score then
+        return -1
+    end
+end
+for i = 2, #KEYS do
+    if redis.call('SET', KEYS[i], owner, 'NX', 'PX', ttl) then
+        return i - 2
+    end
+end
+return -1
+"""
+
+# Extends the keys of KEYS still held by ARGV[1] and returns their indexes
+_RENEW_SCRIPT = """
+local held = {}
+for i = 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[1] then
+        redis.call('PEXPIRE', KEYS[i], ARGV[2])
+        table.insert(held, i - 1)
+    end
+end
+return held
+"""
+
+# Deletes KEYS[1] if ARGV[1] holds it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLeaseBackend:
+    """
+    Leases kept as Redis keys that expire after their TTL.
+
+    Each device of a node is a key holding the owner ID; waiting owners
+    are a hash of their score and expiry. Every operation is a single
+    atomic script.
+
+    Whether an owner is alive is not checked: the process IDs of owners in
+    other containers mean nothing here. The lease of a crashed owner is
+    reclaimed once its key expires, at most ``GPU_LEASE_TTL`` seconds
+    after the last renewal; live owners renew theirs every third of it.
+
+    Attributes:
+        client (redis.Redis): The Redis client.
+        prefix (str): Prefix of the keys of this node.
+    """
+
+    def __init__(self, url=GPU_LEASE_URL, node=GPU_NODE_NAME, client=None):
+        """
+        Initialize the RedisLeaseBackend.
+
+        Args:
+            url (str): URL of the Redis database.
+            node (str): The name of this node.
+            client (redis.Redis): A client to use instead of connecting to
+                ``url``.
+        """
+        if client is None:
+            # Imported here so processes without Redis never load it
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = f"gpu-lease:{node}"
+        self._acquire = self.client.register_script(_ACQUIRE_SCRIPT)
+        self._renew = self.client.register_script(_RENEW_SCRIPT)
+        self._release = self.client.register_script(_RELEASE_SCRIPT)
+
+    def _key(self, gpu_id):
+        return f"{self.prefix}:gpu:{gpu_id}"
+
+    def acquire(self, owner, candidates, ttl=GPU_LEASE_TTL, score=None):
+        """
+        Lease the first free device of the candidates; see
+        ``_StateLeaseBackend.acquire``.
+        """
+        candidates = list(candidates)
+        index = self._acquire(
+            keys=[f"{self.prefix}:waiting"]
+            + [self._key(gpu_id) for gpu_id in candidates],
+            args=[owner, int(ttl * 1000), time.time(),
+                  "" if score is None else score])
+        return None if index < 0 else candidates[index]
+
+    def release(self, owner, gpu_id):
+        """
+        Give up the lease of a device, if the owner still holds it.
+        """
+        self._release(keys=[self._key(gpu_id)], args=[owner])
+
+    def renew(self, owner, gpu_ids, ttl=GPU_LEASE_TTL):
+        """
+        Extend the leases of an owner.
+
+        Returns:
+            list: The devices still leased by the owner.
+        """
+        gpu_ids = list(gpu_ids)
+        if not gpu_ids:
+            return []
+        held = self._renew(
+            keys=[self._key(gpu_id) for gpu_id in gpu_ids],
+            args=[owner, int(ttl * 1000)])
+        return [gpu_ids[index] for index in held]
+
+    def set_waiting(self, owner, score, ttl=GPU_LEASE_TTL):
+        """
+        Register the rank of the best job an owner is waiting with.
+        """
+        self.client.hset(f"{self.prefix}:waiting", owner,
+                         f"{score!r} {time.time() + ttl!r}")
+
+    def clear_waiting(self, owner):
+        """
+        Remove the registration of a waiting owner.
+        """
+        self.client.hdel(f"{self.prefix}:waiting", owner)
+
+    def leases(self):
+        """
+        Return the unexpired leases.
+
+        Returns:
+            dict: Device IDs mapped to their Lease.
+        """
+        leases = {}
+        now = time.time()
+        for key in self.client.scan_iter(f"{self.prefix}:gpu:*"):
+            with self.client.pipeline() as pipe:
+                owner, ttl = pipe.get(key).pttl(key).execute()
+            if owner is not None and ttl > 0:
+                gpu_id = int(key.rsplit(b":", 1)[-1])
+                leases[gpu_id] = Lease(
+                    gpu_id, owner.decode(), now + ttl / 1000)
+        return leases
+
+
+def create_lease_backend(name=GPU_LEASE_BACKEND):
+    """
+    Create the configured lease backend.
+
+    Args:
+        name (str): 'memory', 'file' or 'redis'.
+
+    Returns:
+        MemoryLeaseBackend or FileLeaseBackend or RedisLeaseBackend: The
+        lease backend.
+    """
+    if name == "redis":
+        return RedisLeaseBackend()
+    if name == "file":
+        return FileLeaseBackend()
+    if name == "memory":
+        return MemoryLeaseBackend()
+    raise ValueError(f"Unknown GPU lease backend {name!r}")
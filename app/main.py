@@ -2,90 +2,764 @@
 Main module for FastAPI application.
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse
-from .tasks import process_image
-import shutil
+from fastapi import FastAPI, Request, HTTPException
+from celery.signals import after_task_publish
+from fastapi.responses import (
+    JSONResponse, PlainTextResponse, Response, StreamingResponse)
+from starlette.concurrency import run_in_threadpool
+from . import task_status
+from .batch_ingest import ArchiveError, BatchIngest, batch_status, body_format
+from .batch_processor import process_batch
+from .batching import MicroBatcher, MICRO_BATCH_ENABLED
+from .cache import make_cache_key, result_cache
+from .downloads import FileDownload, IMAGE_CACHE_MAX_AGE, make_etag
+from .fast_path import process_payload, run_inline
+from .gpu_manager import GPUUnavailableError
+from .image_index import image_index
+from .jp2 import InvalidHeaderError, parse_header
+from .metrics import registry, time_stage
+from .payloads import (
+    FAST_PATH_MAX_BYTES, input_key, output_key, payload_store)
+from .priorities import (
+    AdmissionController, MAX_PRIORITY, MIN_PRIORITY, broker_queue_depths,
+    queue_for_priority)
+from .scheduler import scheduler
+from .storage import output_store, sweeper, upload_store
+from .task_status import TASK_WAIT_MAX, describe, hub
+from .tracing import TraceMiddleware, tracer
+from .tasks import (
+    celery, process_image, process_image_array, GPU_RETRY_DELAY)
+from .uploads import (
+    BodyReader, CHUNK_SIZE, UploadLimitMiddleware, receive_upload)
+from contextlib import asynccontextmanager
+import io
+import json
 import os
+import time
 import uuid
 
-app = FastAPI()
 
-# Ensure the upload and output directories exist
-os.makedirs("uploads", exist_ok=True)
-os.makedirs("output", exist_ok=True)
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Sweep the storage areas while the application runs.
+    """
+    sweeper.start()
+    yield
+    sweeper.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(UploadLimitMiddleware, exempt=("/batches/",))
+app.add_middleware(TraceMiddleware)
+
+
+def dispatch_batch(jobs):
+    """
+    Submit the jobs collected by the micro-batcher.
+
+    The scheduler splits them into GPU batches by expected cost and memory,
+    and each batch is submitted as its own task.
+
+    Args:
+        jobs (list): The job dictionaries collected.
+
+    Returns:
+        list: The ID of the batch task of each job.
+    """
+    task_ids = {}
+    for batch in scheduler.plan(jobs):
+        task_id = process_batch.apply_async(
+            (batch["jobs"],),
+            {"priority": batch["priority"], "cost": batch["cost"]}).id
+        for job in batch["jobs"]:
+            task_ids[id(job)] = task_id
+    return [task_ids[id(job)] for job in jobs]
+
+
+def dispatch_slurm_array(jobs):
+    """
+    Submit a group of jobs collected for a Slurm job array.
+
+    Each job gets a task ID of its own, under which its array task records
+    its outcome.
+
+    Args:
+        jobs (list): The job dictionaries of the array.
+
+    Returns:
+        list: The task ID of each job.
+    """
+    for job in jobs:
+        job["task_id"] = str(uuid.uuid4())
+        task_status.record(job["task_id"], "QUEUED",
+                           outputs=[job["output_image"]])
+    priority = max(job.get("priority", 0) for job in jobs)
+    process_image_array.apply_async((jobs,), {"priority": priority})
+    return [job["task_id"] for job in jobs]
+
+
+# How uploads are submitted to Slurm: 'single' (one job per image) or
+# 'array' (coalesced into job arrays)
+SLURM_SUBMIT_MODE = os.getenv("SLURM_SUBMIT_MODE", "single")
+# Largest number of images per Slurm job array
+SLURM_ARRAY_MAX_SIZE = int(os.getenv("SLURM_ARRAY_MAX_SIZE", 1000))
+# Longest time in milliseconds an image waits for its job array to fill up
+SLURM_ARRAY_LINGER_MS = float(os.getenv("SLURM_ARRAY_LINGER_MS", 1000))
+
+# OpenAPI description of the multipart body parsed by ``receive_upload``
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["file"],
+            "properties": {"file": {"type": "string", "format": "binary"}},
+        }}},
+    },
+}
+
+# Refuses uploads while the queue of their priority tier is full
+admission = AdmissionController(lambda: broker_queue_depths(celery))
+after_task_publish.connect(admission.record_publish)
+
+# Collects uploads into batches when MICRO_BATCH_ENABLED is set
+micro_batcher = MicroBatcher(dispatch_batch)
+# Collects uploads into job arrays when SLURM_SUBMIT_MODE is 'array'
+slurm_batcher = MicroBatcher(
+    dispatch_slurm_array, max_batch_size=SLURM_ARRAY_MAX_SIZE,
+    max_linger=SLURM_ARRAY_LINGER_MS / 1000)
+
+
+def index_upload(file_id, path):
+    """
+    Add an uploaded image to the storage index and, if it is a JPEG2000
+    image, its parsed header to the image index.
+
+    Args:
+        file_id (str): The ID of the file.
+        path (str): Path of the uploaded image.
+
+    Returns:
+        ImageHeader: The header, or None if the file is not a JPEG2000
+        image.
+    """
+    upload_store.register(path)
+    try:
+        header = parse_header(path)
+    except InvalidHeaderError:
+        return None
+    image_index.put(file_id, header, path)
+    return header
+
+
+def materialize_result(cache_key, path):
+    """
+    Link a cached result to an output path and index it.
+
+    Returns:
+        bool: False if the result has been evicted from the cache.
+    """
+    if not result_cache.materialize(cache_key, path):
+        return False
+    output_store.register(path)
+    return True
 
 
-@app.post("/upload/")
-async def upload_file(file: UploadFile = File(...), operation: str = "decode"):
+async def admit(priority):
+    """
+    Check that a job of a priority may be queued.
+
+    Args:
+        priority (int): Priority of the job.
+
+    Raises:
+        HTTPException: 400 for a priority out of range, 429 with a
+            ``Retry-After`` header if the queue of its tier is full.
+    """
+    if not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        raise HTTPException(
+            status_code=400,
+            detail=f"priority must be between {MIN_PRIORITY} and "
+                   f"{MAX_PRIORITY}")
+    retry_after = await run_in_threadpool(
+        admission.check, queue_for_priority(priority))
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429, detail="Queue is full",
+            headers={"Retry-After": str(retry_after)})
+
+
+async def process_in_memory(file_id, upload, data, operation, priority,
+                            inline):
+    """
+    Process a small upload without writing it to disk.
+
+    The result cache is not consulted: it keeps results as files, which
+    the fast path exists to avoid, and decoding a small image costs about
+    as much as reading it back from the cache.
+
+    Args:
+        file_id (str): The ID of the file.
+        upload (UploadResult): The size and digest of the upload.
+        data (bytes): The uploaded image.
+        operation (str): The operation to perform ('decode' or 'encode').
+        priority (int): Priority of the job.
+        inline (bool): Process the image in this process and return it.
+
+    Returns:
+        dict or Response: The status message and file information, or the
+        processed image when ``inline`` is set.
+
+    Raises:
+        HTTPException: 503 with a ``Retry-After`` header if no GPU frees up
+            for an inline job.
+    """
+    job = {"operation": operation, "priority": priority}
+    with time_stage("header_parse", operation):
+        await run_in_threadpool(scheduler.annotate, job, data)
+
+    if inline:
+        try:
+            output = await run_in_threadpool(
+                run_inline, operation, data, priority, job["cost"],
+                job["work"])
+        except GPUUnavailableError as e:
+            raise HTTPException(
+                status_code=503, detail=str(e),
+                headers={"Retry-After": str(GPU_RETRY_DELAY)})
+        media_type = ("image/jp2" if operation == "encode"
+                      else "application/octet-stream")
+        return Response(output, media_type=media_type,
+                        headers={"X-File-Id": file_id})
+
+    with time_stage("enqueue", operation):
+        await run_in_threadpool(payload_store.put, input_key(file_id), data)
+        result = await run_in_threadpool(
+            process_payload.apply_async,
+            (input_key(file_id), output_key(file_id), operation),
+            {"cost": job["cost"], "work": job["work"],
+             "priority": priority})
+        task_id = result.id
+    try:
+        image = parse_header(io.BytesIO(data))._asdict()
+    except InvalidHeaderError:
+        image = None
+    return {
+        "status": "File uploaded successfully",
+        "task_id": task_id,
+        "file_id": file_id,
+        "size": upload.size,
+        "sha256": upload.sha256,
+        "image": image,
+        "cached": False,
+        "in_memory": True,
+    }
+
+
+@app.post("/upload/", openapi_extra=UPLOAD_REQUEST_BODY)
+async def upload_file(request: Request, operation: str = "decode",
+                      priority: int = 0, inline: bool = False):
     """
     Endpoint to upload an image file and process it.
 
+    The image is sent as the 'file' field of a ``multipart/form-data``
+    body, which is parsed, hashed and written to disk as it arrives.
+
+    The header of a JPEG2000 upload is parsed and stored in the image
+    index, and its properties are returned under 'image'.
+
+    Uploads of at most ``FAST_PATH_MAX_BYTES`` skip the disk: the image and
+    its output are kept in the payload store, and ``GET /images/{file_id}``
+    serves the output from there. With ``inline`` such an upload is
+    processed in the API process and the output is returned in the
+    response.
+
     Args:
-        file (UploadFile): The uploaded image file.
+        request (Request): The request carrying the image.
         operation (str): The operation to perform ('decode' or 'encode').
+        priority (int): Priority of the job, from -10 (backfill) to 10.
+            Jobs of priority ``HIGH_PRIORITY`` and above are queued ahead
+            of the default tier, negative ones behind it.
+        inline (bool): Return the processed image instead of a task ID.
 
     Returns:
-        dict: Status message and file information.
+        dict: Status message and file information, or a Response holding
+        the processed image for inline uploads.
+
+    Raises:
+        HTTPException: 400 for an invalid operation or priority or a
+            malformed body, 413 if the upload is larger than
+            ``MAX_UPLOAD_SIZE``, or than ``FAST_PATH_MAX_BYTES`` for an
+            inline upload, 415 if the body is not ``multipart/form-data``,
+            429 if the queue of the priority is full, 503 if no GPU frees
+            up for an inline upload.
     """
     if operation not in ["decode", "encode"]:
         raise HTTPException(status_code=400, detail="Invalid operation")
+    await admit(priority)
 
+    if inline and not FAST_PATH_MAX_BYTES:
+        raise HTTPException(
+            status_code=413, detail="Inline processing is disabled")
     file_id = str(uuid.uuid4())
-    input_image_path = f"uploads/{file_id}_{file.filename}"
-    output_image_path = f"output/{file_id}_{file.filename}"
 
-    # Save the uploaded file
-    with open(input_image_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    def upload_path(filename):
+        return upload_store.path(
+            file_id, f"_{os.path.basename(filename)}", create=True)
+
+    # Stream the uploaded file to disk, or keep a small one in memory
+    with time_stage("upload_receive", operation):
+        upload, data = await receive_upload(
+            request, upload_path,
+            max_size=FAST_PATH_MAX_BYTES if inline else None,
+            memory_size=FAST_PATH_MAX_BYTES)
+    if data is not None:
+        return await process_in_memory(
+            file_id, upload, data, operation, priority, inline)
+    input_image_path = upload.path
+    output_image_path = output_store.path(
+        file_id, f"_{os.path.basename(upload.filename)}", create=True)
+    with time_stage("header_parse", operation):
+        header = await run_in_threadpool(
+            index_upload, file_id, input_image_path)
+    image = None if header is None else header._asdict()
+
+    # Serve repeated requests for the same content from the result cache
+    cache_key = make_cache_key(upload.sha256, operation)
+    cached = await run_in_threadpool(result_cache.get, cache_key)
+    if cached is not None and await run_in_threadpool(
+            materialize_result, cache_key, output_image_path):
+        return {
+            "status": "File processed (cached)",
+            "task_id": None,
+            "file_id": file_id,
+            "size": upload.size,
+            "sha256": upload.sha256,
+            "image": image,
+            "cached": True,
+            "in_memory": False,
+        }
 
     # Submit the image processing job
-    result = process_image.apply_async(
-        (input_image_path, output_image_path, operation))
+    job = {
+        "input_image": input_image_path,
+        "output_image": output_image_path,
+        "operation": operation,
+        "cache_key": cache_key,
+        "file_id": file_id,
+        "priority": priority,
+        "enqueued_at": time.time(),
+    }
+    with time_stage("enqueue", operation):
+        if SLURM_SUBMIT_MODE == "array":
+            task_id = await slurm_batcher.submit(job)
+        elif MICRO_BATCH_ENABLED:
+            task_id = await micro_batcher.submit(job)
+        else:
+            await run_in_threadpool(scheduler.annotate, job)
+            result = await run_in_threadpool(
+                process_image.apply_async,
+                (input_image_path, output_image_path, operation),
+                {"cache_key": cache_key, "cost": job["cost"],
+                 "work": job["work"],
+                 "priority": priority})
+            task_id = result.id
+
+    return {
+        "status": "File uploaded successfully",
+        "task_id": task_id,
+        "file_id": file_id,
+        "size": upload.size,
+        "sha256": upload.sha256,
+        "image": image,
+        "cached": False,
+        "in_memory": False,
+    }
+
+
+@app.post("/batches/", status_code=202)
+async def submit_batch_upload(request: Request, operation: str = "decode",
+                              priority: int = 0):
+    """
+    Endpoint to upload many images in one request and process them.
+
+    The body is either ``multipart/form-data`` with any number of files, or
+    a tar (optionally compressed) or zip archive. Entries are unpacked as
+    the body arrives and submitted to batch tasks in groups, so the first
+    images are processed while the rest are still being uploaded.
+
+    Args:
+        request (Request): The request carrying the images.
+        operation (str): The operation to perform ('decode' or 'encode').
+        priority (int): Priority of the jobs, as for ``upload_file``.
+
+    Returns:
+        dict: The batch ID, whose progress ``GET /batches/{batch_id}``
+        reports, and the number of items and rejected entries.
+
+    Raises:
+        HTTPException: 400 for an invalid operation or priority, or a
+            malformed body (the entries read before it are processed), 415
+            for an unsupported content type, 429 if the queue of the
+            priority is full.
+    """
+    if operation not in ["decode", "encode"]:
+        raise HTTPException(status_code=400, detail="Invalid operation")
+    kind, boundary = body_format(request.headers.get("content-type"))
+    if kind is None:
+        raise HTTPException(
+            status_code=415,
+            detail="Send multipart/form-data, a tar or a zip archive")
+    await admit(priority)
+
+    batch_id = str(uuid.uuid4())
+    ingest = BatchIngest(batch_id, operation, priority, dispatch_batch,
+                         index=index_upload, store=hub.store)
+    body = io.BufferedReader(BodyReader(request), CHUNK_SIZE)
+    try:
+        await run_in_threadpool(ingest.run, body, kind, boundary)
+    except ArchiveError as e:
+        return JSONResponse(
+            {"detail": str(e), "batch_id": batch_id}, status_code=400)
+    return {
+        "status": "Batch submitted",
+        "batch_id": batch_id,
+        "items": ingest.total,
+        "rejected": ingest.rejected,
+    }
 
-    return {"status": "File uploaded successfully", "task_id": result.id, "file_id": file_id}
+
+@app.get("/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    """
+    Endpoint returning the progress of a batch and of each of its items.
+
+    Args:
+        batch_id (str): The ID of the batch.
+
+    Returns:
+        dict: The state of the batch, its item counts per state and its
+        items with their task, output path, state and error.
+
+    Raises:
+        HTTPException: 404 if the batch is unknown.
+    """
+    status = await run_in_threadpool(batch_status, batch_id, hub.store)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return status
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Endpoint exposing the pipeline latency histograms of all processes.
+
+    Returns:
+        PlainTextResponse: The metrics in the Prometheus text format.
+    """
+    text = await run_in_threadpool(registry.render)
+    return PlainTextResponse(
+        text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/tasks/{task_id}")
+async def get_task(task_id: str, wait: float = 0):
+    """
+    Endpoint returning the state of a task.
+
+    With ``wait`` the request is held until the task succeeds or fails or
+    ``wait`` seconds pass, whichever is first, so clients need not poll.
+
+    Args:
+        task_id (str): The ID of the task, as returned by an upload.
+        wait (float): Seconds to wait for the task to finish, at most
+            ``TASK_WAIT_MAX``.
+
+    Returns:
+        dict: The state, the times it was queued, started and finished,
+        the seconds spent queued and running, and the output paths.
+
+    Raises:
+        HTTPException: 400 for a negative wait, 404 if the task is unknown.
+    """
+    if wait < 0:
+        raise HTTPException(status_code=400, detail="Invalid wait")
+    if wait:
+        status = await hub.wait(task_id, min(wait, TASK_WAIT_MAX))
+    else:
+        status = await run_in_threadpool(hub.store.get, task_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return describe(task_id, status)
+
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """
+    Endpoint returning the spans recorded for a trace.
+
+    The ID of the trace of a request is in the ``traceparent`` header of
+    its response, and under 'trace_id' in the state of its task.
+
+    Args:
+        trace_id (str): The ID of the trace.
+
+    Returns:
+        dict: The trace ID and its spans, in order of their start.
+
+    Raises:
+        HTTPException: 404 if no span of the trace was recorded.
+    """
+    spans = await run_in_threadpool(tracer.exporter.trace, trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return {"trace_id": trace_id, "spans": spans}
+
+
+@app.get("/tasks/{task_id}/events")
+async def stream_task(task_id: str):
+    """
+    Endpoint streaming the state of a task as server-sent events.
+
+    A 'status' event carrying the same fields as ``GET /tasks/{task_id}``
+    is sent now and after every change, and the stream ends once the task
+    succeeds or fails. Comments are sent while nothing changes to keep the
+    connection open.
+
+    Args:
+        task_id (str): The ID of the task.
+
+    Returns:
+        StreamingResponse: The ``text/event-stream`` of states.
+
+    Raises:
+        HTTPException: 404 if the task is unknown.
+    """
+    if await run_in_threadpool(hub.store.get, task_id) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def events():
+        async for status in hub.stream(task_id):
+            if status is None:
+                yield ": keepalive\n\n"
+            else:
+                data = json.dumps(describe(task_id, status))
+                yield f"event: status\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def parse_region(region):
+    """
+    Parse a region query parameter.
+
+    Args:
+        region (str): 'x,y,w,h' in full-resolution pixels.
+
+    Returns:
+        tuple: The (x, y, width, height) integers.
+
+    Raises:
+        HTTPException: 400 if the region is malformed or empty.
+    """
+    try:
+        x, y, width, height = (int(value) for value in region.split(","))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="region must be x,y,w,h")
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        raise HTTPException(status_code=400, detail="Invalid region")
+    return x, y, width, height
+
+
+def variant_path(file_id, reduce, region):
+    """
+    Return the output path of a reduced-resolution or region decode.
+
+    The directory of the path is not created; the task decoding the
+    variant creates it when it writes the output.
+
+    Args:
+        file_id (str): The ID of the file.
+        reduce (int): Resolution levels skipped.
+        region (tuple): (x, y, width, height), or None.
+
+    Returns:
+        str: Path of the decoded variant.
+    """
+    suffix = f".reduce-{reduce}"
+    if region is not None:
+        suffix += ".region-" + "-".join(str(value) for value in region)
+    return output_store.path(file_id, suffix)
+
+
+def serve_output(file_path, version=None):
+    """
+    Serve an output image with validators and byte ranges.
+
+    An image requested without a version must be revalidated each time it
+    is used, since ``PUT /images/{file_id}`` replaces it under the same ID.
+    Requested by the version taken from its ETag, it can never change and
+    may be cached for ``IMAGE_CACHE_MAX_AGE`` seconds.
+
+    Args:
+        file_path (str): Path of the output image.
+        version (str): The ETag, without quotes, the client asks for.
+
+    Returns:
+        FileDownload: The response, or None if the image does not exist.
+
+    Raises:
+        HTTPException: 404 if the image is no longer at that version.
+    """
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    cache_control = "no-cache"
+    if version is not None:
+        if make_etag(stat_result).strip('"') != version:
+            raise HTTPException(status_code=404, detail="Version not found")
+        cache_control = f"max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+    return FileDownload(file_path, stat_result, cache_control)
 
 
 @app.get("/images/{file_id}")
-async def get_image(file_id: str):
+async def get_image(file_id: str, reduce: int = 0, region: str = None,
+                    version: str = None):
     """
     Endpoint to retrieve an image file.
 
+    With ``reduce`` or ``region`` the uploaded image is decoded again at a
+    lower resolution or for part of the image only, which skips the
+    resolution levels and tiles that are not needed. A variant that has
+    not been decoded yet is submitted and ``202`` is returned with the ID
+    of its task; requesting it again while the task runs returns the same
+    task, and once it is done serves the variant.
+
+    Images are served with an ETag and Last-Modified date, answer
+    conditional requests with ``304`` and Range requests with ``206``.
+    Outputs of uploads kept in memory are served whole from the payload
+    store. Their input is not kept on disk, so they have no variants.
+
     Args:
         file_id (str): The ID of the file to retrieve.
+        reduce (int): Resolution levels to skip; each halves the width and
+            height, so 3 returns a 1/8-scale preview.
+        region (str): 'x,y,w,h' area to decode, in full-resolution pixels.
+        version (str): The ETag of the image without quotes; the image is
+            then served with long-lived cache headers.
 
     Returns:
-        FileResponse: The requested image file.
+        FileDownload: The requested image file, or a JSONResponse with the
+        task ID while a variant is being decoded.
+
+    Raises:
+        HTTPException: 400 for invalid parameters or a region outside the
+            indexed image, 404 if the file does not exist or is no longer
+            at the requested version, or for a variant of an upload kept
+            in memory.
     """
-    file_path = f"output/{file_id}"
-    if not os.path.exists(file_path):
+    if reduce < 0:
+        raise HTTPException(status_code=400, detail="Invalid reduce level")
+    if region is not None:
+        region = parse_region(region)
+        header = await run_in_threadpool(image_index.get, file_id)
+        if header is not None and (region[0] >= header.width
+                                   or region[1] >= header.height):
+            raise HTTPException(
+                status_code=400, detail="Region is outside the image")
+
+    if not reduce and region is None:
+        file_path = output_store.find(file_id)
+        if file_path is None and FAST_PATH_MAX_BYTES:
+            data = await run_in_threadpool(
+                payload_store.get, output_key(file_id))
+            if data is not None:
+                return Response(data, media_type="application/octet-stream",
+                                headers={"Cache-Control": "no-cache"})
+        response = (None if file_path is None
+                    else serve_output(file_path, version))
+        if response is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        await run_in_threadpool(output_store.touch, file_path)
+        return response
+
+    file_path = variant_path(file_id, reduce, region)
+    response = serve_output(file_path, version)
+    if response is not None:
+        await run_in_threadpool(output_store.touch, file_path)
+        return response
+    input_image_path = upload_store.find(file_id)
+    if input_image_path is None:
+        if FAST_PATH_MAX_BYTES and await run_in_threadpool(
+                payload_store.get, output_key(file_id)) is not None:
+            raise HTTPException(
+                status_code=404,
+                detail="Variants of images kept in memory are not available")
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileResponse(file_path)
+    # Requests for a variant being decoded share its task
+    task_id = str(uuid.uuid4())
+    holder = await run_in_threadpool(task_status.claim, file_path, task_id)
+    if holder == task_id:
+        try:
+            await run_in_threadpool(
+                process_image.apply_async,
+                (input_image_path, file_path, "decode"),
+                {"reduce": reduce, "region": region}, task_id=task_id)
+        except Exception as e:
+            await run_in_threadpool(
+                task_status.record, task_id, "FAILURE", error=str(e))
+            raise
+    return JSONResponse(
+        {"status": "Decoding image", "task_id": holder}, status_code=202)
 
 
-@app.put("/images/{file_id}")
-async def update_image(file_id: str, file: UploadFile = File(...)):
+@app.put("/images/{file_id}", openapi_extra=UPLOAD_REQUEST_BODY)
+async def update_image(file_id: str, request: Request, priority: int = 0):
     """
     Endpoint to update an existing image file.
 
+    The decoded variants of the previous image are removed.
+
     Args:
         file_id (str): The ID of the file to update.
-        file (UploadFile): The new image file.
+        request (Request): The request carrying the new image, as for
+            ``upload_file``.
+        priority (int): Priority of the job, as for ``upload_file``.
 
     Returns:
         dict: Status message.
+
+    Raises:
+        HTTPException: 400 for an invalid priority or a malformed body, 413
+            if the upload is larger than ``MAX_UPLOAD_SIZE``, 415 if the
+            body is not ``multipart/form-data``, 429 if the queue of the
+            priority is full.
     """
-    input_image_path = f"uploads/{file_id}"
-    output_image_path = f"output/{file_id}"
+    await admit(priority)
+    input_image_path = (upload_store.find(file_id)
+                        or upload_store.path(file_id, create=True))
+    output_image_path = (output_store.find(file_id)
+                         or output_store.path(file_id, create=True))
 
-    # Save the new file
-    with open(input_image_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Stream the new file to disk
+    await receive_upload(request, lambda filename: input_image_path)
+    await run_in_threadpool(index_upload, file_id, input_image_path)
+    stale = [path for path in output_store.objects(file_id)
+             if path != output_image_path]
+    await run_in_threadpool(output_store.remove, stale)
 
     # Submit the image processing job
-    result = process_image.apply_async(
-        (input_image_path, output_image_path, "decode"))
+    result = await run_in_threadpool(
+        process_image.apply_async,
+        (input_image_path, output_image_path, "decode"),
+        {"priority": priority})
 
     return {"status": "File updated successfully", "task_id": result.id}
 
@@ -93,7 +767,8 @@ async def update_image(file_id: str, file: UploadFile = File(...)):
 @app.delete("/images/{file_id}")
 async def delete_image(file_id: str):
     """
-    Endpoint to delete an image file.
+    Endpoint to delete an image file, its output and its decoded
+    variants, or the payloads of an upload kept in memory.
 
     Args:
         file_id (str): The ID of the file to delete.
@@ -101,12 +776,11 @@ async def delete_image(file_id: str):
     Returns:
         dict: Status message.
     """
-    input_image_path = f"uploads/{file_id}"
-    output_image_path = f"output/{file_id}"
-
-    if os.path.exists(input_image_path):
-        os.remove(input_image_path)
-    if os.path.exists(output_image_path):
-        os.remove(output_image_path)
+    for store in (upload_store, output_store):
+        await run_in_threadpool(store.remove, store.objects(file_id))
+    if FAST_PATH_MAX_BYTES:
+        await run_in_threadpool(
+            payload_store.delete, input_key(file_id), output_key(file_id))
+    await run_in_threadpool(image_index.delete, file_id)
 
     return {"status": "File deleted successfully"}
@@ -0,0 +1,470 @@
+"""
+Metrics Module
+
+This module records latency histograms for each stage of the image
+pipeline and renders them in the Prometheus text exposition format.
+
+Every process (API workers and Celery worker children) keeps its own
+histograms in memory, and a background thread periodically writes a
+snapshot of them to ``METRICS_DIR``. The ``/metrics`` endpoint merges the
+snapshots of all processes, so the exposed histograms cover the whole
+deployment on a node. Snapshots of exited processes are removed once they
+have not been rewritten for ``METRICS_SNAPSHOT_TTL`` seconds.
+"""
+
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from time import monotonic, perf_counter, sleep, time
+
+from .tracing import tracer
+
+# Directory where processes share their metric snapshots ('' disables it)
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+# Seconds between two snapshots written by a process
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1))
+# Seconds after which a snapshot that was not rewritten is removed; live
+# processes rewrite theirs at least twice per period
+METRICS_SNAPSHOT_TTL = float(os.getenv("METRICS_SNAPSHOT_TTL", 3600))
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+# Upper bounds of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+# Upper bounds in megapixels per second of the codec throughput buckets
+THROUGHPUT_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+                      5000)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    A labelled histogram with cumulative buckets.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        labelnames (tuple): The names of the labels.
+        buckets (tuple): The upper bounds of the buckets.
+    """
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        """
+        Initialize the Histogram.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labelnames (tuple): The names of the labels.
+            buckets (tuple): The upper bounds of the buckets.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        """
+        Record an observation.
+
+        Args:
+            value (float): The observed value.
+            labels (dict): The label values; missing labels are empty.
+        """
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """
+        Return a JSON-serializable copy of the histogram.
+
+        Returns:
+            dict: The metric description and its series.
+        """
+        with self.lock:
+            series = [[list(key), list(counts), total, count]
+                      for key, (counts, total, count) in self._series.items()]
+        return {
+            "documentation": self.documentation,
+            "labelnames": list(self.labelnames),
+            "buckets": list(self.buckets),
+            "series": series,
+        }
+
+
+class Registry:
+    """
+    The histograms of a process and the snapshots shared between processes.
+
+    Attributes:
+        directory (str): Where snapshots are shared; '' keeps metrics local.
+        flush_interval (float): Seconds between two snapshots.
+        snapshot_ttl (float): Seconds after which a snapshot that was not
+            rewritten is removed.
+        histograms (dict): Metric names mapped to their Histogram.
+    """
+
+    def __init__(self, directory=METRICS_DIR,
+                 flush_interval=METRICS_FLUSH_INTERVAL,
+                 snapshot_ttl=METRICS_SNAPSHOT_TTL):
+        """
+        Initialize the Registry.
+
+        Args:
+            directory (str): Where snapshots are shared; '' keeps metrics
+                local to the process.
+            flush_interval (float): Seconds between two snapshots.
+            snapshot_ttl (float): Seconds after which a snapshot that was
+                not rewritten, e.g. of an exited process, is removed.
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_ttl = snapshot_ttl
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._flusher_pid = None
+        self._instance = None
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        """
+        Return the histogram of a name, creating it if needed.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labelnames (tuple): The names of the labels.
+            buckets (tuple): The upper bounds of the buckets.
+
+        Returns:
+            Histogram: The histogram.
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(
+                    name, documentation, labelnames, buckets)
+            return self.histograms[name]
+
+    def snapshot(self):
+        """
+        Return the snapshots of every histogram of this process.
+
+        Returns:
+            dict: Metric names mapped to their snapshots.
+        """
+        with self.lock:
+            histograms = list(self.histograms.values())
+        return {h.name: h.snapshot() for h in histograms}
+
+    def maybe_flush(self):
+        """
+        Mark the histograms as changed since the last snapshot.
+
+        The snapshot is written by a background thread within the flush
+        interval, so observations made on the event loop never wait for
+        the disk. The thread is started on the first call in each process.
+        """
+        if not self.directory:
+            return
+        self._dirty = True
+        pid = os.getpid()
+        if self._flusher_pid != pid:
+            with self.lock:
+                if self._flusher_pid != pid:
+                    self._flusher_pid = pid
+                    threading.Thread(target=self._run_flusher,
+                                     name="metrics-flush",
+                                     daemon=True).start()
+
+    def flush(self):
+        """
+        Write the snapshot of this process to the shared directory.
+        """
+        if not self.directory:
+            return
+        with self._flush_lock:
+            self._write_snapshot()
+
+    def _run_flusher(self):
+        """
+        Write a snapshot every flush interval in which the histograms
+        changed, and at least twice per ``snapshot_ttl`` so that the
+        snapshot of an idle process is not taken for a stale one.
+        """
+        last_write = monotonic()
+        while True:
+            sleep(self.flush_interval)
+            if (not self._dirty
+                    and monotonic() - last_write < self.snapshot_ttl / 2):
+                continue
+            self._dirty = False
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"Could not write the metrics snapshot: {e}")
+            last_write = monotonic()
+
+    def _write_snapshot(self):
+        """
+        Atomically write the snapshot file. Called with the flush lock held.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._snapshot_path()
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """
+        Merge the snapshots of all processes sharing the directory.
+
+        The live histograms of this process are used in place of its own
+        snapshot file. Snapshots, and files left by interrupted writes,
+        that were not rewritten for ``snapshot_ttl`` seconds are removed
+        instead, so the counts of exited processes are dropped.
+
+        Returns:
+            dict: Metric names mapped to merged snapshots.
+        """
+        snapshots = [self.snapshot()]
+        if self.directory and os.path.isdir(self.directory):
+            own_file = os.path.basename(self._snapshot_path())
+            expired = time() - self.snapshot_ttl
+            for entry in os.scandir(self.directory):
+                if entry.name == own_file or not entry.name.endswith(
+                        (".json", ".tmp")):
+                    continue
+                try:
+                    if entry.stat().st_mtime < expired:
+                        os.remove(entry.path)
+                        continue
+                    if not entry.name.endswith(".json"):
+                        continue
+                    with open(entry.path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        """
+        Render the merged metrics in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        return render_prometheus(self.collect())
+
+    def _snapshot_path(self):
+        """
+        Return the snapshot file of this process.
+
+        The name includes a random instance ID so that a restarted process
+        reusing a PID does not overwrite the counts of its predecessor.
+
+        Returns:
+            str: Path of the snapshot file.
+        """
+        if self._instance is None or self._instance[0] != os.getpid():
+            self._instance = (os.getpid(), uuid.uuid4().hex[:8])
+        pid, instance = self._instance
+        return os.path.join(self.directory, f"{pid}-{instance}.json")
+
+
+def merge_snapshots(snapshots):
+    """
+    Add up the series of several registry snapshots.
+
+    Args:
+        snapshots (list): Registry snapshots as returned by
+            ``Registry.snapshot``.
+
+    Returns:
+        dict: Metric names mapped to merged snapshots.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {
+                "documentation": metric["documentation"],
+                "labelnames": metric["labelnames"],
+                "buckets": metric["buckets"],
+                "series": {},
+            })
+            if metric["buckets"] != target["buckets"]:
+                continue
+            for labels, counts, total, count in metric["series"]:
+                key = tuple(labels)
+                if key not in target["series"]:
+                    target["series"][key] = [[0] * len(counts), 0.0, 0]
+                series = target["series"][key]
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+    for metric in merged.values():
+        metric["series"] = [[list(key), counts, total, count]
+                            for key, (counts, total, count)
+                            in sorted(metric["series"].items())]
+    return merged
+
+
+def render_prometheus(metrics):
+    """
+    Render histogram snapshots in the Prometheus text format.
+
+    Args:
+        metrics (dict): Metric names mapped to snapshots.
+
+    Returns:
+        str: The exposition text.
+    """
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append(f"# HELP {name} {metric['documentation']}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, counts, total, count in metric["series"]:
+            pairs = list(zip(metric["labelnames"], labels))
+            cumulative = 0
+            for bound, bucket_count in zip(metric["buckets"], counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(pairs + [("le", bound)])
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(pairs + [("le", "+Inf")])
+            lines.append(f"{name}_bucket{bucket_labels} {count}")
+            lines.append(f"{name}_sum{_format_labels(pairs)} {total}")
+            lines.append(f"{name}_count{_format_labels(pairs)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(pairs):
+    """
+    Format label pairs as a Prometheus label set.
+
+    Args:
+        pairs (list): (name, value) pairs.
+
+    Returns:
+        str: The label set, or '' if there are no labels.
+    """
+    if not pairs:
+        return ""
+    formatted = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace(
+            "\n", "\\n").replace('"', '\\"')
+        formatted.append(f'{name}="{value}"')
+    return "{" + ",".join(formatted) + "}"
+
+
+# Create the singleton Registry of this process
+registry = Registry()
+
+# Time spent in each stage of the image pipeline
+STAGE_SECONDS = registry.histogram(
+    "image_stage_duration_seconds",
+    "Time spent in each stage of the image processing pipeline.",
+    ("stage", "operation", "gpu"))
+# Number of jobs per dispatched batch
+BATCH_SIZE = registry.histogram(
+    "image_batch_size",
+    "Number of jobs in each batch flushed by a micro-batcher.",
+    ("operation",), buckets=BATCH_SIZE_BUCKETS)
+
+# Megapixels per second of each codec call, by backend
+CODEC_THROUGHPUT = registry.histogram(
+    "image_codec_throughput_megapixels_per_second",
+    "Pixels decoded or encoded per second by each codec call.",
+    ("backend", "operation"), buckets=THROUGHPUT_BUCKETS)
+
+
+def observe_stage(stage, seconds, operation="", gpu=""):
+    """
+    Record the duration of a pipeline stage, and within a trace a span
+    ending now.
+
+    Args:
+        stage (str): The stage, e.g. 'upload_receive', 'header_parse',
+            'queue_wait', 'gpu_wait', 'parse', 'decode', 'encode',
+            'output_write' or 'slurm_submit'.
+        seconds (float): The duration of the stage.
+        operation (str): The operation of the job.
+        gpu (int): The ID of the GPU the stage ran on.
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage, operation=operation, gpu=gpu)
+    tracer.record(stage, time() - seconds, operation=operation, gpu=gpu)
+    registry.maybe_flush()
+
+
+def observe_throughput(backend, operation, pixels, seconds):
+    """
+    Record the throughput of a codec call.
+
+    Args:
+        backend (str): Name of the codec backend, e.g. 'nvjpeg2000' or
+            'cpu'.
+        operation (str): 'decode' or 'encode'.
+        pixels (int): Pixels decoded or encoded.
+        seconds (float): Duration of the call.
+    """
+    if seconds > 0:
+        CODEC_THROUGHPUT.observe(pixels / seconds / 1e6, backend=backend,
+                                 operation=operation)
+        registry.maybe_flush()
+
+
+@contextmanager
+def time_codec(operation, gpu, backend, pixels):
+    """
+    Record the duration of a codec call in a ``with`` block as the
+    'decode' or 'encode' stage and, if it succeeds, its throughput.
+
+    Args:
+        operation (str): 'decode' or 'encode'.
+        gpu (int): The ID of the GPU the call runs on, or 'cpu'.
+        backend (str): Name of the codec backend.
+        pixels (int): Pixels decoded or encoded.
+    """
+    with time_stage(operation, operation, gpu):
+        start = perf_counter()
+        yield
+        observe_throughput(backend, operation, pixels, perf_counter() - start)
+
+
+@contextmanager
+def time_stage(stage, operation="", gpu=""):
+    """
+    Record the duration of a ``with`` block as a pipeline stage.
+
+    Args:
+        stage (str): The stage name.
+        operation (str): The operation of the job.
+        gpu (int): The ID of the GPU the stage runs on.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, perf_counter() - start, operation, gpu)
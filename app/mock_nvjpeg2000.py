@@ -3,8 +3,81 @@ Mock nvJPEG2000 Library
 
 This mock library simulates the behavior of the actual nvJPEG2000 library
 for local development without requiring a GPU.
+
+Create and destroy calls are counted in ``call_counts`` so that tests can
+assert how often handles, states and streams are set up.
+
+Images are tiled and carry several resolution levels like real codestreams.
+Parsed streams report the dimensions, tiling and resolution levels of the
+JPEG2000 header of their data; data that is not a JPEG2000 file is treated
+as a 1920x1080 image. Decodes honour the reduce factor and decode area of
+their parameters, and the tiles, resolution levels and pixels they process
+are added up in ``decode_counts``. Decoded images are as large as the raw
+pixels of their window, and encoded images as large as the raw pixels over
+``MOCK_COMPRESSION_RATIO``.
+
+Decodes and encodes run on simulated GPUs (see ``SimulatedDevices``) so
+that scheduling, batching and pooling can be load-tested without a GPU.
+Each call takes a fixed overhead plus its pixels over the throughput of its
+GPU, calls on one GPU run one after the other, and a call fails with
+``nvjpeg2kOutOfMemoryError`` when its buffers do not fit in the memory left
+on its GPU. With the default settings calls are instant and memory is
+unlimited. Devices are simulated per process.
 """
 
+import io
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from .jp2 import InvalidHeaderError, parse_header
+
+# Throughput of the simulated GPUs in megapixels per second, as one value
+# or a comma-separated value per GPU; 0 makes calls instant
+MOCK_GPU_MPIXELS_PER_SEC = os.getenv("MOCK_GPU_MPIXELS_PER_SEC", "0")
+# Seconds added to every decode and encode call
+MOCK_CALL_OVERHEAD = float(os.getenv("MOCK_CALL_OVERHEAD", 0))
+# Memory of each simulated GPU in bytes (0 is unlimited)
+MOCK_GPU_MEMORY = int(os.getenv("MOCK_GPU_MEMORY", 0))
+# Standard deviation of the call durations relative to their mean
+MOCK_JITTER = float(os.getenv("MOCK_JITTER", 0))
+# Seed of the jitter, so that runs can be repeated
+MOCK_SEED = os.getenv("MOCK_SEED")
+# Ratio of raw image size to encoded size
+MOCK_COMPRESSION_RATIO = float(os.getenv("MOCK_COMPRESSION_RATIO", 8))
+
+# Bytes of working memory per coefficient of the decoded tiles
+COEFFICIENT_SIZE = 4
+
+# Number of calls made to each counted function
+call_counts = Counter()
+# Tiles, resolution levels and output pixels processed by decodes
+decode_counts = Counter()
+
+
+def _counted(func):
+    """
+    Count the calls made to a mock library function.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        call_counts[func.__name__] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def reset_call_counts():
+    """
+    Reset the call and decode counters.
+    """
+    call_counts.clear()
+    decode_counts.clear()
+
 
 class nvjpeg2kHandle:
     pass
@@ -19,57 +92,348 @@ class nvjpeg2kEncodeState:
 
 
 class nvjpeg2kStream:
-    pass
-
-
+    def __init__(self):
+        self.info = ImageInfo()
+        self.num_resolutions = NUM_RESOLUTIONS
+
+
+class nvjpeg2kDecodeParams:
+    def __init__(self):
+        # (start_x, end_x, start_y, end_y); all zeros decodes the whole image
+        self.area = (0, 0, 0, 0)
+        self.reduce_factor = 0
+
+
+class nvjpeg2kOutOfMemoryError(MemoryError):
+    """
+    Raised when the buffers of a call do not fit in the memory of its GPU.
+    """
+
+
+class ImageInfo:
+    width = 1920
+    height = 1080
+    num_components = 3
+    bit_depth = 8
+    tile_width = 512
+    tile_height = 512
+    num_tiles_x = 4
+    num_tiles_y = 3
+
+    def __init__(self, header=None):
+        if header is not None:
+            for name in ("width", "height", "num_components", "bit_depth",
+                         "tile_width", "tile_height", "num_tiles_x",
+                         "num_tiles_y"):
+                setattr(self, name, getattr(header, name))
+
+    @property
+    def sample_size(self):
+        return -(-self.bit_depth // 8)
+
+
+# Resolution levels in every tile (5 wavelet decompositions)
+NUM_RESOLUTIONS = 6
+
+
+class SimulatedDevices:
+    """
+    Simulated GPUs with a throughput, a per-call overhead and memory.
+
+    Each call holds its buffers on its GPU while it waits for and runs on
+    the GPU, and runs alone on it for ``call_overhead`` plus its pixels
+    over the throughput of the GPU, scaled by a random jitter factor.
+
+    Attributes:
+        throughput (list): Megapixels per second of each GPU; GPUs past the
+            end of the list use its last value.
+        call_overhead (float): Seconds added to every call.
+        memory (int): Bytes of memory of each GPU, or 0 for unlimited.
+        jitter (float): Standard deviation of the jitter factor.
+        stats (dict): GPU IDs mapped to a Counter of their calls, busy
+            seconds, pixels, peak memory and out-of-memory errors.
+    """
+
+    def __init__(self, throughput=MOCK_GPU_MPIXELS_PER_SEC,
+                 call_overhead=MOCK_CALL_OVERHEAD, memory=MOCK_GPU_MEMORY,
+                 jitter=MOCK_JITTER, seed=MOCK_SEED):
+        """
+        Initialize the SimulatedDevices.
+
+        Args:
+            throughput (str or float or list): Megapixels per second, as a
+                number, a list or a comma-separated string of one per GPU.
+            call_overhead (float): Seconds added to every call.
+            memory (int): Bytes of memory of each GPU, or 0 for unlimited.
+            jitter (float): Standard deviation of the jitter factor.
+            seed (int): Seed of the jitter, or None for a random seed.
+        """
+        if isinstance(throughput, str):
+            throughput = [float(value) for value in throughput.split(",")]
+        elif not isinstance(throughput, (list, tuple)):
+            throughput = [float(throughput)]
+        self.throughput = list(throughput)
+        self.call_overhead = call_overhead
+        self.memory = memory
+        self.jitter = jitter
+        self.random = random.Random(None if seed is None else int(seed))
+        self.lock = threading.Lock()
+        self.allocated = Counter()
+        self.stats = {}
+        self._devices = {}
+
+    def _device(self, gpu_id):
+        """
+        Return the lock serializing the calls on a GPU.
+        """
+        with self.lock:
+            if gpu_id not in self._devices:
+                self._devices[gpu_id] = threading.Lock()
+                self.stats[gpu_id] = Counter()
+            return self._devices[gpu_id]
+
+    def duration(self, gpu_id, pixels):
+        """
+        Draw the duration of a call.
+
+        Args:
+            gpu_id (int): The ID of the GPU.
+            pixels (int): Pixels processed by the call.
+
+        Returns:
+            float: The duration in seconds.
+        """
+        throughput = self.throughput[min(gpu_id, len(self.throughput) - 1)]
+        seconds = self.call_overhead
+        if throughput > 0:
+            seconds += pixels / (throughput * 1e6)
+        if self.jitter and seconds:
+            with self.lock:
+                seconds *= max(0.0, self.random.gauss(1.0, self.jitter))
+        return seconds
+
+    @contextmanager
+    def allocate(self, gpu_id, size):
+        """
+        Hold buffers on a GPU.
+
+        Args:
+            gpu_id (int): The ID of the GPU.
+            size (int): Bytes allocated.
+
+        Raises:
+            nvjpeg2kOutOfMemoryError: If the GPU has less memory left.
+        """
+        self._device(gpu_id)
+        with self.lock:
+            stats = self.stats[gpu_id]
+            if self.memory and self.allocated[gpu_id] + size > self.memory:
+                stats["oom_errors"] += 1
+                raise nvjpeg2kOutOfMemoryError(
+                    f"GPU {gpu_id} cannot allocate {size} bytes: "
+                    f"{self.allocated[gpu_id]} of {self.memory} in use")
+            self.allocated[gpu_id] += size
+            stats["peak_memory"] = max(
+                stats["peak_memory"], self.allocated[gpu_id])
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.allocated[gpu_id] -= size
+
+    def run(self, gpu_id, pixels, memory):
+        """
+        Simulate a call on a GPU.
+
+        Args:
+            gpu_id (int): The ID of the GPU.
+            pixels (int): Pixels processed by the call.
+            memory (int): Bytes the call allocates on the GPU.
+        """
+        device = self._device(gpu_id)
+        with self.allocate(gpu_id, memory), device:
+            seconds = self.duration(gpu_id, pixels)
+            if seconds:
+                time.sleep(seconds)
+        with self.lock:
+            stats = self.stats[gpu_id]
+            stats["calls"] += 1
+            stats["busy_seconds"] += seconds
+            stats["pixels"] += pixels
+
+
+# The simulated GPUs of this process
+devices = SimulatedDevices()
+
+
+def configure_devices(**settings):
+    """
+    Replace the simulated GPUs, e.g. to load-test other hardware.
+
+    Args:
+        settings (dict): Arguments of ``SimulatedDevices``.
+
+    Returns:
+        SimulatedDevices: The new devices.
+    """
+    global devices
+    devices = SimulatedDevices(**settings)
+    return devices
+
+
+class _BufferReader:
+    """
+    A binary file over a buffer that does not copy it.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data).cast("B") if data else memoryview(b"")
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.position + size
+        chunk = self.data[self.position:end].tobytes()
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position,
+                io.SEEK_END: len(self.data)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+
+@_counted
 def nvjpeg2kCreate():
     return nvjpeg2kHandle()
 
 
+@_counted
 def nvjpeg2kDecodeStateCreate(handle):
     return nvjpeg2kDecodeState()
 
 
+@_counted
 def nvjpeg2kEncodeStateCreate(handle):
     return nvjpeg2kEncodeState()
 
 
+@_counted
 def nvjpeg2kStreamCreate(handle):
     return nvjpeg2kStream()
 
 
 def nvjpeg2kStreamParse(handle, stream, data, length):
-    pass
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        header = parse_header(_BufferReader(memoryview(data)[:length]))
+    except InvalidHeaderError:
+        stream.info = ImageInfo()
+        stream.num_resolutions = NUM_RESOLUTIONS
+    else:
+        stream.info = ImageInfo(header)
+        stream.num_resolutions = header.decomposition_levels + 1
 
 
 def nvjpeg2kStreamGetImageInfo(stream):
-    class ImageInfo:
-        width = 1920
-        height = 1080
-        num_components = 3
-    return ImageInfo()
+    return stream.info
+
+
+def nvjpeg2kStreamGetResolutionsInTile(stream, tile_id):
+    return stream.num_resolutions
+
+
+@_counted
+def nvjpeg2kDecodeParamsCreate():
+    return nvjpeg2kDecodeParams()
+
+
+def nvjpeg2kDecodeParamsSetDecodeArea(decode_params, start_x, end_x, start_y,
+                                      end_y):
+    decode_params.area = (start_x, end_x, start_y, end_y)
+
+
+def nvjpeg2kDecodeParamsSetReduceFactor(decode_params, reduce_factor):
+    decode_params.reduce_factor = reduce_factor
 
 
 def nvjpeg2kDecode(handle, decode_state, stream, width, height,
-                   num_components, gpu_id):
-    return b"decoded_image_data"
+                   num_components, gpu_id, decode_params=None):
+    info = nvjpeg2kStreamGetImageInfo(stream)
+    num_resolutions = stream.num_resolutions
+    if decode_params is None:
+        decode_params = nvjpeg2kDecodeParams()
+    start_x, end_x, start_y, end_y = decode_params.area
+    if decode_params.area == (0, 0, 0, 0):
+        end_x, end_y = info.width, info.height
+    reduce_factor = decode_params.reduce_factor
+    if not 0 <= reduce_factor < num_resolutions:
+        raise ValueError(f"Invalid reduce factor {reduce_factor}")
+    if not (0 <= start_x < end_x <= info.width
+            and 0 <= start_y < end_y <= info.height):
+        raise ValueError(f"Invalid decode area {decode_params.area}")
+
+    # Output dimensions at the reduced resolution, as in the JPEG2000 spec
+    def reduced(value):
+        return -(-value // (1 << reduce_factor))
+    expected = (reduced(end_x) - reduced(start_x),
+                reduced(end_y) - reduced(start_y))
+    if (width, height) != expected:
+        raise ValueError(
+            f"Output size {width}x{height} does not match the decode "
+            f"window {expected[0]}x{expected[1]}")
+
+    # Only the tiles overlapping the area are decoded
+    tiles_x = ((end_x - 1) // info.tile_width
+               - start_x // info.tile_width + 1)
+    tiles_y = ((end_y - 1) // info.tile_height
+               - start_y // info.tile_height + 1)
+    tiles = tiles_x * tiles_y
+    decode_counts["tiles"] += tiles
+    decode_counts["resolution_levels"] += (
+        tiles * (num_resolutions - reduce_factor))
+    decode_counts["pixels"] += width * height
+
+    # The decoder works on whole tiles at the reduced resolution
+    tile_pixels = tiles * reduced(info.tile_width) * reduced(info.tile_height)
+    output_size = width * height * num_components * info.sample_size
+    devices.run(gpu_id, tile_pixels,
+                output_size + tile_pixels * num_components * COEFFICIENT_SIZE)
+    return bytes(output_size)
 
 
 def nvjpeg2kEncode(handle, encode_state, stream, gpu_id):
-    return b"encoded_image_data"
+    info = nvjpeg2kStreamGetImageInfo(stream)
+    pixels = info.width * info.height
+    raw_size = pixels * info.num_components * info.sample_size
+    output_size = max(1, math.ceil(raw_size / MOCK_COMPRESSION_RATIO))
+    devices.run(gpu_id, pixels,
+                raw_size + output_size
+                + pixels * info.num_components * COEFFICIENT_SIZE)
+    return bytes(output_size)
 
 
+@_counted
 def nvjpeg2kDecodeStateDestroy(decode_state):
     pass
 
 
+@_counted
 def nvjpeg2kEncodeStateDestroy(encode_state):
     pass
 
 
+@_counted
 def nvjpeg2kStreamDestroy(stream):
     pass
 
 
+@_counted
+def nvjpeg2kDecodeParamsDestroy(decode_params):
+    pass
+
+
+@_counted
 def nvjpeg2kDestroy(handle):
     pass
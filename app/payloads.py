@@ -0,0 +1,181 @@
+"""
+Payloads Module
+
+This module keeps the inputs and outputs of small images in memory, so
+that jobs on thumbnails and tiles skip the disk round trip of the upload
+and output directories. Payloads are compressed and kept in Redis with a
+TTL, where the API and the workers on any host can reach them, or in the
+memory of one process.
+
+Keys:
+    payload:<file_id>:input: The uploaded image, until it is processed.
+    payload:<file_id>:output: The processed image.
+"""
+
+import os
+import threading
+import zlib
+from time import monotonic
+
+# Uploads up to this many bytes skip the disk (0 disables the fast path)
+FAST_PATH_MAX_BYTES = int(os.getenv("FAST_PATH_MAX_BYTES", 0))
+# Where payloads are kept: 'redis' or 'memory' (one process)
+PAYLOAD_BACKEND = os.getenv("PAYLOAD_BACKEND", "redis")
+# Redis database of the payloads
+PAYLOAD_URL = os.getenv("PAYLOAD_URL", "redis://redis:6379/0")
+# Seconds a payload is kept
+PAYLOAD_TTL = int(os.getenv("PAYLOAD_TTL", 3600))
+# zlib level payloads are compressed with in Redis (0 stores them as is)
+PAYLOAD_COMPRESSION_LEVEL = int(os.getenv("PAYLOAD_COMPRESSION_LEVEL", 1))
+
+
+def input_key(file_id):
+    """
+    Return the key of the uploaded image of a file.
+    """
+    return f"payload:{file_id}:input"
+
+
+def output_key(file_id):
+    """
+    Return the key of the processed image of a file.
+    """
+    return f"payload:{file_id}:output"
+
+
+class MemoryPayloadStore:
+    """
+    Payloads kept in the memory of one process.
+
+    Attributes:
+        ttl (int): Seconds a payload is kept.
+    """
+
+    def __init__(self, ttl=PAYLOAD_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.payloads = {}
+
+    def put(self, key, data):
+        """
+        Store a payload, replacing any previous one under the key.
+
+        Args:
+            key (str): The key of the payload.
+            data (bytes): The payload.
+        """
+        with self.lock:
+            self.payloads[key] = (monotonic() + self.ttl, bytes(data))
+
+    def get(self, key):
+        """
+        Return a payload.
+
+        Returns:
+            bytes: The payload, or None if it is unknown or expired.
+        """
+        with self.lock:
+            expires, data = self.payloads.get(key, (None, None))
+            if expires is not None and expires <= monotonic():
+                del self.payloads[key]
+                return None
+            return data
+
+    def delete(self, *keys):
+        """
+        Remove payloads; unknown keys are ignored.
+        """
+        with self.lock:
+            for key in keys:
+                self.payloads.pop(key, None)
+
+
+class RedisPayloadStore:
+    """
+    Payloads kept compressed in Redis.
+
+    Attributes:
+        url (str): URL of the Redis database.
+        ttl (int): Seconds a payload is kept.
+        level (int): zlib compression level; 0 stores payloads as is.
+    """
+
+    def __init__(self, url=PAYLOAD_URL, ttl=PAYLOAD_TTL,
+                 level=PAYLOAD_COMPRESSION_LEVEL, client=None):
+        """
+        Initialize the RedisPayloadStore.
+
+        Args:
+            url (str): URL of the Redis database.
+            ttl (int): Seconds a payload is kept.
+            level (int): zlib compression level.
+            client (redis.Redis): A client to use instead of connecting to
+                ``url``.
+        """
+        self.url = url
+        self.ttl = ttl
+        self.level = level
+        self._client = client
+
+    @property
+    def client(self):
+        """
+        redis.Redis: The Redis client, created on first use.
+        """
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(
+                self.url, socket_connect_timeout=2)
+        return self._client
+
+    def put(self, key, data):
+        """
+        Store a payload; see ``MemoryPayloadStore.put``.
+
+        The first byte of the stored value tells whether the rest is
+        compressed.
+        """
+        if self.level:
+            value = b"z" + zlib.compress(data, self.level)
+        else:
+            value = b"-" + bytes(data)
+        self.client.set(key, value, ex=self.ttl)
+
+    def get(self, key):
+        """
+        Return a payload; see ``MemoryPayloadStore.get``.
+        """
+        value = self.client.get(key)
+        if value is None:
+            return None
+        if value[:1] == b"z":
+            return zlib.decompress(value[1:])
+        return value[1:]
+
+    def delete(self, *keys):
+        """
+        Remove payloads; unknown keys are ignored.
+        """
+        if keys:
+            self.client.delete(*keys)
+
+
+def create_payload_store(name=PAYLOAD_BACKEND):
+    """
+    Create the configured payload store.
+
+    Args:
+        name (str): 'redis' or 'memory'.
+
+    Returns:
+        RedisPayloadStore or MemoryPayloadStore: The store.
+    """
+    if name == "redis":
+        return RedisPayloadStore()
+    if name == "memory":
+        return MemoryPayloadStore()
+    raise ValueError(f"Unknown payload backend {name!r}")
+
+
+# The payloads shared by the API and the workers
+payload_store = create_payload_store()
@@ -0,0 +1,343 @@
+"""
+Priorities Module
+
+This module maps job priorities onto tiered Celery queues and controls how
+fast workers drain each tier and how much work the API admits.
+
+Jobs are routed to the high, default or low queue by their priority.
+Workers consume the queues in weighted order: a smooth weighted
+round-robin puts the queue that is furthest behind its share first in
+every broker poll, so interactive work is served ahead of bulk work while
+a busy high tier cannot starve the low one.
+
+Admission control tracks the depth of each queue and the rate at which
+workers drain it. When a queue is full, new jobs are refused with the time
+the queue needs to drain back under its limit.
+"""
+
+import logging
+import math
+import os
+import threading
+from time import monotonic
+
+from kombu.exceptions import ChannelError
+from kombu.utils.scheduling import round_robin_cycle
+
+logger = logging.getLogger(__name__)
+
+# Celery queues of the priority tiers
+QUEUE_HIGH = "images.high"
+QUEUE_DEFAULT = "images.default"
+QUEUE_LOW = "images.low"
+PRIORITY_QUEUES = (QUEUE_HIGH, QUEUE_DEFAULT, QUEUE_LOW)
+
+# Lowest priority routed to the high queue; negative priorities go to the
+# low queue
+HIGH_PRIORITY = int(os.getenv("HIGH_PRIORITY", 5))
+# Range of priorities accepted by the API
+MIN_PRIORITY, MAX_PRIORITY = -10, 10
+# Share of broker polls each queue is served first in, as queue=weight
+QUEUE_WEIGHTS = os.getenv(
+    "QUEUE_WEIGHTS", f"{QUEUE_HIGH}=6,{QUEUE_DEFAULT}=3,{QUEUE_LOW}=1")
+# Queue depth at which new jobs are refused (0 disables admission control)
+ADMISSION_MAX_DEPTH = int(os.getenv("ADMISSION_MAX_DEPTH", 10000))
+# Seconds between two reads of the queue depths from the broker
+ADMISSION_REFRESH_INTERVAL = float(
+    os.getenv("ADMISSION_REFRESH_INTERVAL", 1))
+# Drain rate in jobs per second assumed before any draining was observed
+ADMISSION_MIN_DRAIN_RATE = float(os.getenv("ADMISSION_MIN_DRAIN_RATE", 1))
+
+# Slurm --nice of the jobs of each tier; higher values are scheduled
+# later, and only operators may use negative ones
+SLURM_NICE = os.getenv(
+    "SLURM_NICE", f"{QUEUE_HIGH}=0,{QUEUE_DEFAULT}=100,{QUEUE_LOW}=1000")
+# Slurm QOS of the jobs of each tier, as queue=qos pairs (empty for none)
+SLURM_QOS = os.getenv("SLURM_QOS", "")
+
+# Weight of the latest measurement in the smoothed drain rate
+DRAIN_RATE_SMOOTHING = 0.2
+
+
+def parse_weights(spec):
+    """
+    Parse queue weights.
+
+    Args:
+        spec (str): Comma-separated queue=weight pairs.
+
+    Returns:
+        dict: Queue names mapped to their weights.
+    """
+    weights = {}
+    for pair in spec.split(","):
+        if pair.strip():
+            name, _, weight = pair.partition("=")
+            weights[name.strip()] = float(weight)
+    return weights
+
+
+def queue_for_priority(priority):
+    """
+    Return the queue of a job priority.
+
+    Args:
+        priority (int): Priority of the job.
+
+    Returns:
+        str: The name of the queue.
+    """
+    if priority >= HIGH_PRIORITY:
+        return QUEUE_HIGH
+    if priority < 0:
+        return QUEUE_LOW
+    return QUEUE_DEFAULT
+
+
+def route_by_priority(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery router sending a task to the queue of its 'priority' argument.
+
+    Returns:
+        dict: The routing options, or None to keep an explicit queue.
+    """
+    if options.get("queue"):
+        return None
+    return {"queue": queue_for_priority((kwargs or {}).get("priority") or 0)}
+
+
+def slurm_priority_options(priority, nice=None, qos=None):
+    """
+    Return the ``sbatch`` options placing a job in its priority tier.
+
+    Slurm rejects negative ``--priority`` values and lets only operators
+    set it, so tiers are mapped to a ``--nice`` offset and optionally a
+    QOS instead. Within a tier, higher priorities get a lower nice value.
+
+    Args:
+        priority (int): Priority of the job, from ``MIN_PRIORITY`` to
+            ``MAX_PRIORITY``.
+        nice (str): queue=nice pairs; ``SLURM_NICE`` if omitted.
+        qos (str): queue=qos pairs; ``SLURM_QOS`` if omitted.
+
+    Returns:
+        list: The sbatch options.
+    """
+    queue = queue_for_priority(priority)
+    base = parse_weights(SLURM_NICE if nice is None else nice).get(queue, 0)
+    options = [f"--nice={int(base) + MAX_PRIORITY - priority}"]
+    for pair in (SLURM_QOS if qos is None else qos).split(","):
+        name, _, value = pair.partition("=")
+        if name.strip() == queue and value.strip():
+            options.append(f"--qos={value.strip()}")
+    return options
+
+
+class WeightedCycle(round_robin_cycle):
+    """
+    Orders the queues a worker polls by smooth weighted round-robin.
+
+    Kombu's Redis transport pops from the first non-empty queue of the
+    order returned by ``consume`` and reports the queue it used to
+    ``rotate``. The queues polled before it were empty: they lose any
+    credit they had built up. The queue used and those after it earn
+    their weight in credit, the queue used pays their total weight, and
+    queues are polled in order of credit, so each non-empty queue is
+    served in proportion to its weight and an idle queue cannot save up
+    credit to starve the others once it fills again.
+
+    Used as ``queue_order_strategy`` in the broker transport options.
+    """
+
+    def __init__(self, it=None, weights=None):
+        super().__init__(it)
+        if weights is None:
+            weights = parse_weights(QUEUE_WEIGHTS)
+        self.weights = weights
+        self.credit = {}
+        self._order = None
+
+    def consume(self, n):
+        """
+        Return the queues to poll, the one furthest behind its share first.
+        """
+        self._order = sorted(
+            self.items[:n],
+            key=lambda queue: (-self.credit.get(queue, 0.0),
+                               -self.weights.get(queue, 1.0)))
+        return list(self._order)
+
+    def rotate(self, last_used):
+        """
+        Charge the queue a message was taken from.
+        """
+        order = self._order if self._order is not None else self.items
+        self._order = None
+        if last_used in order:
+            skipped = order[:order.index(last_used)]
+            candidates = order[order.index(last_used):]
+        else:
+            skipped, candidates = [], list(self.items)
+        for queue in skipped:
+            self.credit[queue] = min(self.credit.get(queue, 0.0), 0.0)
+        total = 0.0
+        for queue in candidates:
+            weight = self.weights.get(queue, 1.0)
+            self.credit[queue] = self.credit.get(queue, 0.0) + weight
+            total += weight
+        if last_used in self.credit:
+            self.credit[last_used] -= total
+        return last_used
+
+
+def broker_queue_depths(app, queues=PRIORITY_QUEUES):
+    """
+    Read the number of messages waiting in queues of the broker.
+
+    Args:
+        app (Celery): The Celery application.
+        queues (tuple): The queue names.
+
+    Returns:
+        dict: Queue names mapped to their depth.
+    """
+    depths = {}
+    with app.connection_for_write() as connection:
+        connection.ensure_connection(
+            max_retries=1, interval_start=0, interval_step=0, timeout=1)
+        channel = connection.default_channel
+        for queue in queues:
+            try:
+                depths[queue] = channel.queue_declare(
+                    queue, passive=True).message_count
+            except ChannelError:
+                # The broker drops queues that are empty
+                depths[queue] = 0
+    return depths
+
+
+class AdmissionController:
+    """
+    Refuses new jobs while their queue is full.
+
+    The depth of every queue is read from the broker at most every
+    ``refresh_interval`` seconds. The drain rate of a queue is the number
+    of messages that left it between two reads, counting the messages
+    published by this process in between, smoothed over time.
+
+    Attributes:
+        depth_source (callable): Returns the depth of each queue.
+        max_depth (int): Queue depth at which jobs are refused.
+        refresh_interval (float): Seconds between two depth reads.
+        min_drain_rate (float): Lowest drain rate assumed, in jobs per
+            second.
+        depths (dict): Queue names mapped to their last known depth.
+        drain_rates (dict): Queue names mapped to their drain rate.
+    """
+
+    def __init__(self, depth_source, max_depth=ADMISSION_MAX_DEPTH,
+                 refresh_interval=ADMISSION_REFRESH_INTERVAL,
+                 min_drain_rate=ADMISSION_MIN_DRAIN_RATE, clock=monotonic):
+        """
+        Initialize the AdmissionController.
+
+        Args:
+            depth_source (callable): Returns a dict of queue depths.
+            max_depth (int): Queue depth at which jobs are refused; 0
+                admits every job.
+            refresh_interval (float): Seconds between two depth reads.
+            min_drain_rate (float): Lowest drain rate assumed.
+            clock (callable): Returns the current time in seconds.
+        """
+        self.depth_source = depth_source
+        self.max_depth = max_depth
+        self.refresh_interval = refresh_interval
+        self.min_drain_rate = min_drain_rate
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.depths = {}
+        self.drain_rates = {}
+        self._published = {}
+        self._last_refresh = None
+
+    def record_publish(self, sender=None, routing_key=None, **kwargs):
+        """
+        Count a task published to a queue.
+
+        Connected to Celery's ``after_task_publish`` signal.
+
+        Args:
+            sender (str): The name of the task.
+            routing_key (str): The queue the task was sent to.
+            kwargs (dict): Additional arguments.
+        """
+        if routing_key:
+            with self.lock:
+                self._published[routing_key] = (
+                    self._published.get(routing_key, 0) + 1)
+
+    def check(self, queue):
+        """
+        Decide whether a job may be added to a queue.
+
+        Jobs are admitted while the depth of the broker is unknown.
+
+        Args:
+            queue (str): The queue the job would be sent to.
+
+        Returns:
+            int: Seconds the client should wait before retrying, or None
+            if the job is admitted.
+        """
+        if not self.max_depth:
+            return None
+        self.maybe_refresh()
+        with self.lock:
+            depth = self.depths.get(queue, 0) + self._published.get(queue, 0)
+            if depth < self.max_depth:
+                return None
+            rate = max(self.drain_rates.get(queue, 0.0), self.min_drain_rate)
+        return max(1, math.ceil((depth - self.max_depth + 1) / rate))
+
+    def maybe_refresh(self):
+        """
+        Read the queue depths if the refresh interval has passed.
+        """
+        now = self.clock()
+        with self.lock:
+            if (self._last_refresh is not None
+                    and now - self._last_refresh < self.refresh_interval):
+                return
+            # Other callers keep using the old depths meanwhile
+            last_refresh, self._last_refresh = self._last_refresh, now
+        try:
+            depths = self.depth_source()
+        except Exception as e:
+            logger.warning(f"Could not read queue depths: {e}")
+            return
+        self.update(depths, now, last_refresh)
+
+    def update(self, depths, now, last_refresh=None):
+        """
+        Record new queue depths and update the drain rates.
+
+        Args:
+            depths (dict): Queue names mapped to their depth.
+            now (float): Time the depths were read.
+            last_refresh (float): Time of the previous read, or None.
+        """
+        with self.lock:
+            published, self._published = self._published, {}
+            if last_refresh is not None and self.depths:
+                elapsed = now - last_refresh
+                for queue, depth in depths.items():
+                    if elapsed <= 0 or queue not in self.depths:
+                        continue
+                    drained = max(0, self.depths[queue]
+                                  + published.get(queue, 0) - depth)
+                    rate = drained / elapsed
+                    previous = self.drain_rates.get(queue)
+                    self.drain_rates[queue] = rate if previous is None else (
+                        DRAIN_RATE_SMOOTHING * rate
+                        + (1 - DRAIN_RATE_SMOOTHING) * previous)
+            self.depths = dict(depths)
@@ -0,0 +1,516 @@
+"""
+Scheduler Module
+
+This module estimates the GPU time and memory of each image job from its
+header metadata and packs groups of jobs into GPU batches. Jobs are ordered
+shortest expected first with priority aging, and spread over batches so
+that the expected work per GPU is balanced and the memory of a batch fits
+the budget of one device. Jobs that would wait for a GPU longer than the
+CPU codec takes to process them are run on the CPU instead.
+
+The expected time comes from a linear cost model per operation that is
+refit online from the codec timings observed by the workers. Like the
+metrics registry, every process keeps its own observations and shares them
+through snapshot files in ``COST_MODEL_DIR``, so the API process plans with
+the timings measured by the workers of the node. The snapshots of other
+processes are read in a background thread, so planning a job never waits
+on the directory, and snapshots not rewritten for
+``COST_MODEL_SNAPSHOT_TTL`` seconds, such as those of exited processes,
+are removed.
+"""
+
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from time import monotonic
+
+from .gpu_manager import GPU_AGING_RATE, GPU_COST_WEIGHT, effective_priority
+from .image_index import image_index
+from .jp2 import InvalidHeaderError, parse_header
+
+logger = logging.getLogger(__name__)
+
+# Directory where processes share their cost observations ('' disables it)
+COST_MODEL_DIR = os.getenv("COST_MODEL_DIR", "cost_model")
+# Seconds between two refits of the cost model, and between two snapshots
+COST_MODEL_REFIT_INTERVAL = float(os.getenv("COST_MODEL_REFIT_INTERVAL", 10))
+# Seconds after which a snapshot that was not rewritten is removed
+COST_MODEL_SNAPSHOT_TTL = float(os.getenv("COST_MODEL_SNAPSHOT_TTL", 3600))
+# Weight kept by older observations each time one is added
+COST_MODEL_DECAY = float(os.getenv("COST_MODEL_DECAY", 0.999))
+# Device memory in bytes available to the jobs of one batch
+GPU_MEMORY_BUDGET = int(os.getenv("GPU_MEMORY_BUDGET", 8 * 1024 ** 3))
+# Number of GPUs a group of jobs is spread over
+SCHEDULER_NUM_GPUS = int(os.getenv("SCHEDULER_NUM_GPUS", 4))
+# Run jobs on the CPU codec when it is expected to finish them before a GPU
+CPU_FALLBACK = os.getenv("CPU_FALLBACK", "true").lower() == "true"
+
+# Cost model used until enough timings have been observed: a fixed
+# overhead per image plus a time per byte of decoded samples
+DEFAULT_COEFFICIENTS = {
+    "decode": (0.005, 1 / 500e6),
+    "encode": (0.005, 1 / 250e6),
+    # Jobs run on the CPU codec
+    "cpu-decode": (0.01, 1 / 40e6),
+    "cpu-encode": (0.01, 1 / 20e6),
+}
+# Decoded bytes per byte of codestream assumed for images without a header
+DEFAULT_COMPRESSION_RATIO = 8
+
+
+def job_work(header, reduce=0, region=None):
+    """
+    Return the number of decoded sample bytes a job processes.
+
+    This is the size of the output image: pixels times components times
+    bytes per sample, on the requested resolution level and region.
+
+    Args:
+        header (ImageHeader): The header of the input image.
+        reduce (int): Resolution levels skipped.
+        region (tuple): (x, y, width, height) decoded, or None.
+
+    Returns:
+        int: The number of bytes.
+    """
+    width, height = header.width, header.height
+    if region is not None:
+        x, y, region_width, region_height = region
+        width = max(0, min(x + region_width, width) - max(x, 0))
+        height = max(0, min(y + region_height, height) - max(y, 0))
+    scale = 1 << min(max(int(reduce or 0), 0), header.decomposition_levels)
+    pixels = -(-width // scale) * -(-height // scale)
+    return pixels * header.num_components * -(-header.bit_depth // 8)
+
+
+class CostModel:
+    """
+    A linear model of the codec time of a job, refit from observations.
+
+    For each operation the expected time is ``intercept + slope * work``,
+    fitted by least squares over exponentially decayed observations.
+
+    Attributes:
+        directory (str): Where observations are shared; '' keeps them local.
+        refit_interval (float): Seconds between two refits and snapshots.
+        decay (float): Weight kept by older observations per observation.
+        snapshot_ttl (float): Seconds after which a snapshot that was not
+            rewritten is removed.
+        coefficients (dict): Operations mapped to (intercept, slope).
+    """
+
+    def __init__(self, directory=COST_MODEL_DIR,
+                 refit_interval=COST_MODEL_REFIT_INTERVAL,
+                 decay=COST_MODEL_DECAY,
+                 snapshot_ttl=COST_MODEL_SNAPSHOT_TTL):
+        """
+        Initialize the CostModel.
+
+        Args:
+            directory (str): Where observations are shared; '' keeps them
+                local to the process.
+            refit_interval (float): Seconds between two refits and
+                snapshots.
+            decay (float): Weight kept by older observations each time one
+                is added.
+            snapshot_ttl (float): Seconds after which a snapshot that was
+                not rewritten is removed.
+        """
+        self.directory = directory
+        self.refit_interval = refit_interval
+        self.decay = decay
+        self.snapshot_ttl = snapshot_ttl
+        self.coefficients = dict(DEFAULT_COEFFICIENTS)
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._sums = {}
+        self._shared = {}
+        self._last_refit = None
+        self._last_flush = None
+        self._instance = None
+
+    def estimate(self, operation, work):
+        """
+        Return the expected codec time of a job.
+
+        Args:
+            operation (str): 'decode' or 'encode', prefixed with 'cpu-'
+                for the CPU codec.
+            work (int): Decoded sample bytes of the job.
+
+        Returns:
+            float: The expected seconds.
+        """
+        self.maybe_refit()
+        intercept, slope = self.coefficients.get(
+            operation, DEFAULT_COEFFICIENTS["decode"])
+        return intercept + slope * work
+
+    def observe(self, operation, work, seconds):
+        """
+        Record the codec time of a finished job.
+
+        Args:
+            operation (str): 'decode' or 'encode', prefixed with 'cpu-'
+                for the CPU codec.
+            work (int): Decoded sample bytes of the job.
+            seconds (float): The observed codec time.
+        """
+        with self.lock:
+            sums = self._sums.setdefault(operation, [0.0] * 5)
+            for index in range(5):
+                sums[index] *= self.decay
+            for index, value in enumerate(
+                    (1, work, seconds, work * work, work * seconds)):
+                sums[index] += value
+        self.maybe_flush()
+
+    def snapshot(self):
+        """
+        Return the observation sums of this process.
+
+        Returns:
+            dict: Operations mapped to the decayed sums of 1, work, seconds,
+            work squared and work times seconds.
+        """
+        with self.lock:
+            return {operation: list(sums)
+                    for operation, sums in self._sums.items()}
+
+    def maybe_refit(self):
+        """
+        Refit the model if the refit interval has passed.
+
+        The model is refit to the observations of this process and the
+        snapshots last loaded, and a background thread loads the snapshots
+        again; see ``load_snapshots``.
+        """
+        now = monotonic()
+        if (self._last_refit is not None
+                and now - self._last_refit < self.refit_interval):
+            return
+        self._last_refit = now
+        self.refit()
+        if self.directory and self._load_lock.acquire(blocking=False):
+            threading.Thread(target=self._load_in_background,
+                             name="cost-model-load", daemon=True).start()
+
+    def refit(self):
+        """
+        Fit the coefficients of every operation to the observations of
+        this process and the snapshots last loaded.
+
+        Operations without observations keep their default coefficients.
+        """
+        merged = {}
+        for snapshot in (self.snapshot(), self._shared):
+            for operation, sums in snapshot.items():
+                total = merged.setdefault(operation, [0.0] * 5)
+                for index, value in enumerate(sums):
+                    total[index] += value
+
+        coefficients = dict(DEFAULT_COEFFICIENTS)
+        for operation, (n, sx, sy, sxx, sxy) in merged.items():
+            if n <= 0:
+                continue
+            mean_work, mean_seconds = sx / n, sy / n
+            variance = sxx / n - mean_work * mean_work
+            slope = 0.0
+            if n >= 2 and variance > 1e-9 * mean_work * mean_work:
+                slope = (sxy / n - mean_work * mean_seconds) / variance
+            if slope > 0:
+                intercept = max(0.0, mean_seconds - slope * mean_work)
+            else:
+                # Too little spread in job sizes to tell the per-image
+                # overhead from the throughput: scale the defaults so they
+                # match the mean observed time
+                intercept, slope = DEFAULT_COEFFICIENTS.get(
+                    operation, DEFAULT_COEFFICIENTS["decode"])
+                factor = mean_seconds / (intercept + slope * mean_work)
+                intercept, slope = intercept * factor, slope * factor
+            coefficients[operation] = (intercept, slope)
+        self.coefficients = coefficients
+
+    def maybe_flush(self):
+        """
+        Write a snapshot if the refit interval has passed since the last one.
+        """
+        if not self.directory:
+            return
+        now = monotonic()
+        if (self._last_flush is not None
+                and now - self._last_flush < self.refit_interval):
+            return
+        # Another thread is already writing a snapshot
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_flush = now
+            self._write_snapshot()
+        finally:
+            self._flush_lock.release()
+
+    def flush(self):
+        """
+        Write the observations of this process to the shared directory.
+        """
+        if not self.directory:
+            return
+        with self._flush_lock:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        """
+        Atomically write the snapshot file. Called with the flush lock held.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._snapshot_path()
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+
+    def load_snapshots(self):
+        """
+        Load the snapshots of the other processes and refit the model.
+
+        Snapshots, and files left by interrupted writes, that were not
+        rewritten for ``snapshot_ttl`` seconds are removed instead.
+        """
+        shared = {}
+        if self.directory and os.path.isdir(self.directory):
+            own_file = os.path.basename(self._snapshot_path())
+            expired = time.time() - self.snapshot_ttl
+            for entry in os.scandir(self.directory):
+                if entry.name == own_file or not entry.name.endswith(
+                        (".json", ".tmp")):
+                    continue
+                try:
+                    if entry.stat().st_mtime < expired:
+                        os.remove(entry.path)
+                        continue
+                    if not entry.name.endswith(".json"):
+                        continue
+                    with open(entry.path) as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                for operation, sums in snapshot.items():
+                    total = shared.setdefault(operation, [0.0] * 5)
+                    for index, value in enumerate(sums):
+                        total[index] += value
+        self._shared = shared
+        self.refit()
+
+    def _load_in_background(self):
+        """
+        Run ``load_snapshots`` in the thread started by ``maybe_refit``.
+        """
+        try:
+            self.load_snapshots()
+        except Exception as e:
+            logger.warning(f"Could not load the cost model snapshots: {e}")
+        finally:
+            self._load_lock.release()
+
+    def _snapshot_path(self):
+        """
+        Return the snapshot file of this process.
+
+        Returns:
+            str: Path of the snapshot file.
+        """
+        if self._instance is None or self._instance[0] != os.getpid():
+            self._instance = (os.getpid(), uuid.uuid4().hex[:8])
+        pid, instance = self._instance
+        return os.path.join(self.directory, f"{pid}-{instance}.json")
+
+
+class JobScheduler:
+    """
+    Packs groups of jobs into GPU batches by expected cost and memory.
+
+    Attributes:
+        cost_model (CostModel): Predicts the codec time of a job.
+        memory_budget (int): Device memory in bytes available to a batch.
+        num_gpus (int): Number of GPUs a group of jobs is spread over.
+        aging_rate (float): Priority points gained per second of waiting.
+        cost_weight (float): Priority points lost per expected second.
+    """
+
+    def __init__(self, cost_model, memory_budget=GPU_MEMORY_BUDGET,
+                 num_gpus=SCHEDULER_NUM_GPUS, aging_rate=GPU_AGING_RATE,
+                 cost_weight=GPU_COST_WEIGHT, index=image_index):
+        """
+        Initialize the JobScheduler.
+
+        Args:
+            cost_model (CostModel): Predicts the codec time of a job.
+            memory_budget (int): Device memory in bytes available to a
+                batch.
+            num_gpus (int): Number of GPUs a group of jobs is spread over.
+            aging_rate (float): Priority points gained per second of
+                waiting.
+            cost_weight (float): Priority points lost per expected second.
+            index (ImageIndex): Where image headers are looked up.
+        """
+        self.cost_model = cost_model
+        self.memory_budget = memory_budget
+        self.num_gpus = num_gpus
+        self.aging_rate = aging_rate
+        self.cost_weight = cost_weight
+        self.index = index
+
+    def annotate(self, job, data=None):
+        """
+        Add the expected 'work', 'cost' and 'memory' of a job to it.
+
+        The header is taken from the image index when the job has a
+        'file_id', and read from the input otherwise. Without a header the
+        work is guessed from the size of the input.
+
+        Args:
+            job (dict): A job dictionary; 'reduce' and 'region' are taken
+                into account.
+            data (bytes): The input image, for jobs whose input is held in
+                memory rather than in 'input_image'.
+
+        Returns:
+            dict: The job.
+        """
+        header = None
+        if job.get("file_id"):
+            header = self.index.get(job["file_id"])
+        if header is None:
+            try:
+                header = parse_header(job["input_image"] if data is None
+                                      else io.BytesIO(data))
+            except (OSError, InvalidHeaderError):
+                header = None
+        if header is not None:
+            work = job_work(header, job.get("reduce", 0), job.get("region"))
+        else:
+            if data is not None:
+                size = len(data)
+            else:
+                try:
+                    size = os.path.getsize(job["input_image"])
+                except OSError:
+                    size = 0
+            work = size * DEFAULT_COMPRESSION_RATIO
+        job["work"] = work
+        job["cost"] = self.cost_model.estimate(job["operation"], work)
+        # The compressed input and the decoded output are both resident
+        job["memory"] = 2 * work
+        return job
+
+    def plan(self, jobs, now=None):
+        """
+        Split a group of jobs into batches for the GPUs.
+
+        Jobs are taken in order of ``effective_priority``, i.e. shortest
+        expected first with priority and aging. The first ``num_gpus`` jobs
+        each start a batch; every later job is added to the batch with the
+        least expected work whose memory budget it fits, or starts a new
+        batch if it fits none. Each batch keeps its jobs in scheduling
+        order.
+
+        Args:
+            jobs (list): Job dictionaries; missing 'cost' and 'memory' are
+                filled in by ``annotate``. An 'enqueued_at' wall-clock time
+                and a 'priority' are used for ordering when present.
+            now (float): The current wall-clock time.
+
+        Returns:
+            list: Batches as dicts with 'jobs', 'cost' (expected seconds),
+            'memory' and 'priority' (highest of its jobs), most urgent
+            batch first.
+        """
+        now = time.time() if now is None else now
+        for job in jobs:
+            if "cost" not in job or "memory" not in job:
+                self.annotate(job)
+
+        def urgency(job):
+            waited = max(0.0, now - job.get("enqueued_at", now))
+            return effective_priority(
+                job.get("priority", 0), waited, job["cost"],
+                self.aging_rate, self.cost_weight)
+
+        batches = []
+        for job in sorted(jobs, key=urgency, reverse=True):
+            batch = None
+            # Give every GPU a batch before doubling up
+            if len(batches) >= self.num_gpus:
+                fits = [b for b in batches
+                        if b["memory"] + job["memory"] <= self.memory_budget]
+                if fits:
+                    batch = min(fits, key=lambda b: b["cost"])
+            if batch is None:
+                batch = {"jobs": [], "cost": 0.0, "memory": 0,
+                         "priority": job.get("priority", 0)}
+                batches.append(batch)
+            batch["jobs"].append(job)
+            batch["cost"] += job["cost"]
+            batch["memory"] += job["memory"]
+            batch["priority"] = max(batch["priority"], job.get("priority", 0))
+        return batches
+
+    def cpu_cost(self, operation, work):
+        """
+        Return the expected time of a job on the CPU codec.
+
+        Args:
+            operation (str): 'decode' or 'encode'.
+            work (int): Decoded sample bytes of the job.
+
+        Returns:
+            float: The expected seconds.
+        """
+        return self.cost_model.estimate(f"cpu-{operation}", work)
+
+    def prefer_cpu(self, jobs, gpu_wait):
+        """
+        Tell whether jobs would finish sooner on the CPU codec than by
+        waiting for a GPU.
+
+        Args:
+            jobs (list): Job dictionaries annotated with their 'work' and
+                'cost'.
+            gpu_wait (float): Expected seconds until a GPU is free.
+
+        Returns:
+            bool: Whether ``CPU_FALLBACK`` is on and the expected CPU time
+            of the jobs is below the expected GPU wait plus their GPU time.
+        """
+        if not CPU_FALLBACK or any(job.get("work") is None for job in jobs):
+            return False
+        cpu_time = sum(self.cpu_cost(job["operation"], job["work"])
+                       for job in jobs)
+        gpu_time = sum(job.get("cost") or 0.0 for job in jobs)
+        return cpu_time < gpu_wait + gpu_time
+
+    def observe(self, job, seconds, cpu=False):
+        """
+        Feed the codec time of a finished job back into the cost model.
+
+        Args:
+            job (dict): The job, annotated with its 'work'.
+            seconds (float): The observed codec time.
+            cpu (bool): Whether the job ran on the CPU codec.
+        """
+        if job.get("work"):
+            operation = job["operation"]
+            self.cost_model.observe(
+                f"cpu-{operation}" if cpu else operation, job["work"],
+                seconds)
+
+
+# Create the singleton CostModel and JobScheduler instances
+cost_model = CostModel()
+scheduler = JobScheduler(cost_model)
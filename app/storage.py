@@ -0,0 +1,489 @@
+"""
+Storage Module
+
+This module lays out the uploaded and output images on disk and bounds
+their size and age. Each storage area, ``uploads`` and ``output``, shards
+its objects into two levels of 256 directories chosen by a hash of the
+file ID, so no directory grows beyond a few hundred entries however many
+images are kept. All objects of a file ID (the image, its output and its
+decoded variants) live in the same shard, where they are found by listing
+one small directory.
+
+Objects are written to a temporary name and renamed into place, then
+registered in a SQLite index of their size, creation and last use. A
+background sweeper removes objects older than the TTL of their area and
+the least recently used ones beyond its quota, a bounded number at a time,
+from the index alone, without scanning the directories.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Path of the SQLite index of stored objects
+STORAGE_INDEX_PATH = os.getenv("STORAGE_INDEX_PATH", "storage.db")
+# Largest total size in bytes of each area (0 disables the quota)
+UPLOADS_MAX_BYTES = int(os.getenv("UPLOADS_MAX_BYTES", 0))
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", 0))
+# Seconds an object of each area is kept after it was written (0 keeps it)
+UPLOADS_TTL = float(os.getenv("UPLOADS_TTL", 0))
+OUTPUT_TTL = float(os.getenv("OUTPUT_TTL", 0))
+# Seconds after its last use during which the quota does not evict an
+# object, so that inputs of queued jobs are not removed
+STORAGE_GRACE_PERIOD = float(os.getenv("STORAGE_GRACE_PERIOD", 600))
+# Seconds between two sweeps
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", 60))
+# Most objects removed per area in one sweep
+STORAGE_SWEEP_BATCH = int(os.getenv("STORAGE_SWEEP_BATCH", 1000))
+
+# Suffixes of files being written
+TEMP_SUFFIXES = (".part", ".tmp")
+
+
+class StorageIndex:
+    """
+    A SQLite table of stored objects with their size, creation and last
+    use, and the running total size of each area.
+
+    The database is opened on first use and shared by the threads of a
+    process; several processes may use the same file.
+
+    Attributes:
+        path (str): Path of the database file.
+        lock (threading.Lock): A lock serializing access to the connection.
+    """
+
+    def __init__(self, path=STORAGE_INDEX_PATH):
+        """
+        Initialize the StorageIndex.
+
+        Args:
+            path (str): Path of the database file.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    def add(self, area, path, size, now=None):
+        """
+        Add an object, or update the size of a replaced one.
+
+        Args:
+            area (str): Name of the area of the object.
+            path (str): Path of the object.
+            size (int): Size in bytes.
+            now (float): The creation time; defaults to the current time.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO objects "
+                    "(path, area, size, created_at, used_at) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE "
+                    "SET size = excluded.size, "
+                    "created_at = excluded.created_at, "
+                    "used_at = excluded.used_at",
+                    (path, area, size, now, now))
+
+    def touch(self, path, now=None):
+        """
+        Record a use of an object, which defers its eviction by the quota.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "UPDATE objects SET used_at = ? WHERE path = ?",
+                    (now, path))
+
+    def remove(self, paths):
+        """
+        Remove objects from the index.
+
+        Args:
+            paths (list): Paths of the objects.
+        """
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "DELETE FROM objects WHERE path = ?",
+                    [(path,) for path in paths])
+
+    def total(self, area):
+        """
+        Return the number and total size of the objects of an area.
+
+        Returns:
+            tuple: (objects, bytes).
+        """
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT objects, bytes FROM totals WHERE area = ?",
+                (area,)).fetchone()
+        return tuple(row) if row is not None else (0, 0)
+
+    def created_before(self, area, before, limit):
+        """
+        Return the oldest objects of an area created before a time.
+
+        Returns:
+            list: (path, size) pairs, oldest first.
+        """
+        with self.lock:
+            return self._connect().execute(
+                "SELECT path, size FROM objects "
+                "WHERE area = ? AND created_at < ? "
+                "ORDER BY created_at LIMIT ?",
+                (area, before, limit)).fetchall()
+
+    def least_recently_used(self, area, before, limit):
+        """
+        Return the least recently used objects of an area not used since a
+        time.
+
+        Returns:
+            list: (path, size) pairs, least recently used first.
+        """
+        with self.lock:
+            return self._connect().execute(
+                "SELECT path, size FROM objects "
+                "WHERE area = ? AND used_at < ? "
+                "ORDER BY used_at LIMIT ?",
+                (area, before, limit)).fetchall()
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self):
+        """
+        Return the connection, opening the database on first use.
+
+        The totals of each area are kept up to date by triggers, so the
+        sweeper never sums the table.
+
+        Must be called with the lock held.
+
+        Returns:
+            sqlite3.Connection: The database connection.
+        """
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Losing the last changes in a power cut only delays a sweep
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.executescript("""
+                    CREATE TABLE IF NOT EXISTS objects (
+                        path TEXT PRIMARY KEY, area TEXT, size INTEGER,
+                        created_at REAL, used_at REAL);
+                    CREATE INDEX IF NOT EXISTS objects_created
+                        ON objects (area, created_at);
+                    CREATE INDEX IF NOT EXISTS objects_used
+                        ON objects (area, used_at);
+                    CREATE TABLE IF NOT EXISTS totals (
+                        area TEXT PRIMARY KEY, objects INTEGER,
+                        bytes INTEGER);
+                    CREATE TRIGGER IF NOT EXISTS objects_insert
+                    AFTER INSERT ON objects BEGIN
+                        INSERT INTO totals VALUES (NEW.area, 1, NEW.size)
+                        ON CONFLICT (area) DO UPDATE
+                        SET objects = objects + 1,
+                            bytes = bytes + NEW.size;
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS objects_update
+                    AFTER UPDATE OF size ON objects BEGIN
+                        UPDATE totals SET bytes = bytes - OLD.size + NEW.size
+                        WHERE area = NEW.area;
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS objects_delete
+                    AFTER DELETE ON objects BEGIN
+                        UPDATE totals SET objects = objects - 1,
+                            bytes = bytes - OLD.size
+                        WHERE area = OLD.area;
+                    END;
+                """)
+            self._connection = connection
+        return self._connection
+
+
+class StorageArea:
+    """
+    A directory of objects sharded by a hash of their file ID, bounded by
+    a quota and a TTL.
+
+    Objects are named after their file ID, optionally followed by a suffix
+    such as '_name.jp2' or '.reduce-3'. Files of the former flat layout,
+    directly in the area directory, are still found by ``find``.
+
+    Attributes:
+        name (str): Name of the area, also its directory.
+        max_bytes (int): Largest total size; 0 disables the quota.
+        ttl (float): Seconds an object is kept; 0 keeps it.
+        index (StorageIndex): The index of stored objects.
+    """
+
+    def __init__(self, name, max_bytes=0, ttl=0, index=None):
+        """
+        Initialize the StorageArea.
+
+        Args:
+            name (str): Name of the area, also its directory.
+            max_bytes (int): Largest total size; 0 disables the quota.
+            ttl (float): Seconds an object is kept; 0 keeps it.
+            index (StorageIndex): The index of stored objects. Defaults to
+                the shared index.
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index = index or storage_index
+
+    def shard(self, file_id):
+        """
+        Return the directory holding the objects of a file ID.
+        """
+        digest = hashlib.sha256(file_id.encode()).hexdigest()
+        return os.path.join(self.name, digest[:2], digest[2:4])
+
+    def path(self, file_id, suffix="", create=False):
+        """
+        Return the path of an object.
+
+        Args:
+            file_id (str): The ID of the file.
+            suffix (str): Appended to the file ID in the object name.
+            create (bool): Create the shard directory, so the object can
+                be written.
+
+        Returns:
+            str: Path of the object.
+        """
+        shard = self.shard(file_id)
+        if create:
+            os.makedirs(shard, exist_ok=True)
+        return os.path.join(shard, f"{file_id}{suffix}")
+
+    def objects(self, file_id):
+        """
+        Return the paths of the stored objects of a file ID.
+
+        Returns:
+            list: Paths of the objects named after the file ID, sorted;
+            files being written are left out.
+        """
+        try:
+            names = os.listdir(self.shard(file_id))
+        except FileNotFoundError:
+            names = []
+        paths = [
+            os.path.join(self.shard(file_id), name) for name in sorted(names)
+            if (name == file_id or name.startswith((f"{file_id}_",
+                                                    f"{file_id}.")))
+            and not name.endswith(TEMP_SUFFIXES)]
+        legacy = os.path.join(self.name, file_id)
+        if os.path.isfile(legacy):
+            paths.append(legacy)
+        return paths
+
+    def find(self, file_id):
+        """
+        Return the path of the image of a file ID: the object named after
+        the file ID alone or followed by '_' and a file name.
+
+        Returns:
+            str: Path of the object, or None if it does not exist.
+        """
+        for path in self.objects(file_id):
+            name = os.path.basename(path)
+            if name == file_id or name.startswith(f"{file_id}_"):
+                return path
+        return None
+
+    def register(self, path, size=None):
+        """
+        Add an object that was renamed into place to the index.
+
+        Failures are logged and otherwise ignored, as the object itself is
+        stored.
+
+        Args:
+            path (str): Path of the object.
+            size (int): Its size in bytes; read from the file if omitted.
+        """
+        try:
+            if size is None:
+                size = os.path.getsize(path)
+            self.index.add(self.name, path, size)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Could not index {path}: {e}")
+
+    def touch(self, path):
+        """
+        Record a use of an object; failures are ignored.
+        """
+        try:
+            self.index.touch(path)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not record the use of {path}: {e}")
+
+    def remove(self, paths):
+        """
+        Remove objects from disk and from the index.
+
+        Args:
+            paths (list): Paths of the objects.
+        """
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.index.remove(paths)
+
+    def sweep(self, limit=STORAGE_SWEEP_BATCH, now=None,
+              grace=STORAGE_GRACE_PERIOD):
+        """
+        Remove up to ``limit`` expired objects, then up to ``limit`` least
+        recently used ones while the area exceeds its quota.
+
+        Args:
+            limit (int): Most objects removed by each of the two passes.
+            now (float): The current time.
+            grace (float): Seconds after its last use during which the
+                quota does not evict an object.
+
+        Returns:
+            tuple: Number and total size of the removed objects.
+        """
+        now = time.time() if now is None else now
+        removed = []
+        if self.ttl:
+            removed += self.index.created_before(
+                self.name, now - self.ttl, limit)
+            self.remove([path for path, _ in removed])
+        if self.max_bytes:
+            excess = self.index.total(self.name)[1] - self.max_bytes
+            evicted = []
+            if excess > 0:
+                for path, size in self.index.least_recently_used(
+                        self.name, now - grace, limit):
+                    evicted.append((path, size))
+                    excess -= size
+                    if excess <= 0:
+                        break
+            self.remove([path for path, _ in evicted])
+            removed += evicted
+        return len(removed), sum(size for _, size in removed)
+
+
+class Sweeper:
+    """
+    Sweeps storage areas in a background thread.
+
+    A sweep that removed a full batch from an area is followed by another
+    at once; otherwise the sweeper waits ``interval`` seconds.
+
+    Attributes:
+        areas (list): The StorageArea instances swept.
+        interval (float): Seconds between two sweeps.
+        limit (int): Most objects removed per area in one sweep.
+    """
+
+    def __init__(self, areas, interval=STORAGE_SWEEP_INTERVAL,
+                 limit=STORAGE_SWEEP_BATCH):
+        self.areas = areas
+        self.interval = interval
+        self.limit = limit
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep_once(self):
+        """
+        Sweep every area with a quota or TTL once.
+
+        Returns:
+            bool: Whether an area still had more objects to remove.
+        """
+        more = False
+        for area in self.areas:
+            if not (area.max_bytes or area.ttl):
+                continue
+            count, size = area.sweep(self.limit)
+            if count:
+                logger.info(f"Removed {count} objects ({size} bytes) "
+                            f"from {area.name}")
+            more = more or count >= self.limit
+        return more
+
+    def start(self):
+        """
+        Start sweeping in a background thread, if an area has a quota or
+        TTL.
+        """
+        if not any(area.max_bytes or area.ttl for area in self.areas):
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="storage-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """
+        Sweep until stopped.
+        """
+        while not self._stop.is_set():
+            try:
+                more = self.sweep_once()
+            except Exception as e:
+                logger.warning(f"Storage sweep failed: {e}")
+                more = False
+            self._stop.wait(0 if more else self.interval)
+
+
+def area_for(path):
+    """
+    Return the storage area a path belongs to.
+
+    Returns:
+        StorageArea: The area, or None for paths outside the areas.
+    """
+    top = os.path.normpath(path).split(os.sep, 1)[0]
+    return AREAS.get(top)
+
+
+# The shared index and storage areas
+storage_index = StorageIndex()
+upload_store = StorageArea("uploads", UPLOADS_MAX_BYTES, UPLOADS_TTL)
+output_store = StorageArea("output", OUTPUT_MAX_BYTES, OUTPUT_TTL)
+AREAS = {area.name: area for area in (upload_store, output_store)}
+sweeper = Sweeper(list(AREAS.values()))
@@ -0,0 +1,574 @@
+"""
+Task Status Module
+
+This module records the progress of image tasks and lets API clients wait
+for it. Tasks record their state, timings and output paths as they are
+queued, started, submitted to Slurm and finished; each change is stored
+under the task ID and announced on a single Redis channel.
+
+Every API process subscribes to the channel once. Clients waiting for a
+task, by long-poll or server-sent events, only hold an asyncio queue, and a
+change is read from the store once per process and fanned out to all of
+its waiters, so thousands of idle waiters cost no threads or broker
+connections.
+
+States:
+    QUEUED: Published to the broker.
+    STARTED: Picked up by a worker.
+    RETRY: Waiting to be retried, e.g. because no GPU was free.
+    SUBMITTED: Submitted to Slurm; the codec has not finished yet.
+    SUCCESS: The outputs are written.
+    FAILURE: The task failed; 'error' says why.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Where task states are kept: 'redis' or 'memory' (one process)
+TASK_STATUS_BACKEND = os.getenv("TASK_STATUS_BACKEND", "redis")
+# Redis database of the task states
+TASK_STATUS_URL = os.getenv("TASK_STATUS_URL", "redis://redis:6379/0")
+# Seconds the state of a task is kept after its last change
+TASK_STATUS_TTL = int(os.getenv("TASK_STATUS_TTL", 86400))
+# Longest long-poll wait in seconds
+TASK_WAIT_MAX = float(os.getenv("TASK_WAIT_MAX", 60))
+# Seconds the Redis store is not tried again after it could not be reached
+TASK_STATUS_RETRY_INTERVAL = float(
+    os.getenv("TASK_STATUS_RETRY_INTERVAL", 5))
+# Seconds a task holds the claim on its work, e.g. a decoded variant, unless
+# it finishes first
+TASK_CLAIM_TTL = int(os.getenv("TASK_CLAIM_TTL", 600))
+
+# Redis channel announcing the IDs of changed tasks
+TASK_STATUS_CHANNEL = "task-status"
+# States after which a task does not change any more
+FINAL_STATES = ("SUCCESS", "FAILURE")
+
+
+class MemoryStatusStore:
+    """
+    Task states kept in the memory of one process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.listeners = []
+        self.claims = {}
+
+    def update(self, task_id, fields):
+        """
+        Merge fields into the state of a task and announce the change.
+
+        A final state is not replaced by a later non-final one, which
+        arrives e.g. when a Slurm job finishes before its submission is
+        recorded.
+
+        Args:
+            task_id (str): The ID of the task.
+            fields (dict): JSON-serializable fields to set.
+        """
+        with self.lock:
+            state = self.states.setdefault(task_id, {})
+            if (state.get("state") in FINAL_STATES
+                    and fields.get("state") not in FINAL_STATES):
+                fields = {name: value for name, value in fields.items()
+                          if name != "state"}
+            state.update(fields)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(task_id)
+
+    def get(self, task_id):
+        """
+        Return the state of a task.
+
+        Returns:
+            dict: The fields of the task, or None if it is unknown.
+        """
+        with self.lock:
+            state = self.states.get(task_id)
+            return None if state is None else dict(state)
+
+    def listen(self, listener):
+        """
+        Call ``listener`` with the ID of every task that changes.
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def claim(self, name, task_id, ttl=TASK_CLAIM_TTL, replace=None):
+        """
+        Claim a piece of work for a task, unless another task holds it.
+
+        Args:
+            name (str): The name of the work.
+            task_id (str): The ID of the claiming task.
+            ttl (int): Seconds the claim lasts.
+            replace (str): The ID of a task whose claim is taken over.
+
+        Returns:
+            str: The ID of the task holding the claim.
+        """
+        with self.lock:
+            holder, expires = self.claims.get(name, (None, 0))
+            if holder is None or expires <= time.monotonic() \
+                    or holder == replace:
+                holder = task_id
+                self.claims[name] = (holder, time.monotonic() + ttl)
+            return holder
+
+
+# Merges the JSON field pairs ARGV[4..] into the hash KEYS[1], keeping a
+# final state unless ARGV[1] is '1', sets its TTL to ARGV[2] seconds and
+# announces the task ID ARGV[3]
+_UPDATE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'state')
+local keep_state = ARGV[1] ~= '1'
+    and (current == '"SUCCESS"' or current == '"FAILURE"')
+for i = 4, #ARGV, 2 do
+    if not (keep_state and ARGV[i] == 'state') then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', '""" + TASK_STATUS_CHANNEL + """', ARGV[3])
+"""
+
+
+# Sets the claim KEYS[1] to the task ID ARGV[1] for ARGV[2] seconds unless
+# another task than ARGV[3] holds it, and returns the holder
+_CLAIM_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[3] then
+    return holder
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return ARGV[1]
+"""
+
+
+class StatusStoreUnavailable(ConnectionError):
+    """
+    Raised instead of connecting to a status store that could not be
+    reached a moment ago.
+    """
+
+
+class RedisStatusStore:
+    """
+    Task states kept as Redis hashes, announced on a Redis channel.
+
+    After Redis could not be reached, calls fail at once with
+    ``StatusStoreUnavailable`` for ``retry_interval`` seconds, rather than
+    each waiting out the connect timeout.
+
+    Attributes:
+        url (str): URL of the Redis database.
+        ttl (int): Seconds a state is kept after its last change.
+        retry_interval (float): Seconds Redis is not tried again after a
+            failed connection.
+    """
+
+    def __init__(self, url=TASK_STATUS_URL, ttl=TASK_STATUS_TTL,
+                 client=None, retry_interval=TASK_STATUS_RETRY_INTERVAL):
+        """
+        Initialize the RedisStatusStore.
+
+        Args:
+            url (str): URL of the Redis database.
+            ttl (int): Seconds a state is kept after its last change.
+            client (redis.Redis): A client to use instead of connecting to
+                ``url``.
+            retry_interval (float): Seconds Redis is not tried again after
+                a failed connection.
+        """
+        self.url = url
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._client = client
+        self._update = None
+        self._claim = None
+        self._retry_at = 0.0
+
+    @property
+    def client(self):
+        """
+        redis.Redis: The Redis client, created on first use so that
+        processes which never record a state do not load Redis.
+        """
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(
+                self.url, socket_connect_timeout=2)
+        return self._client
+
+    def _call(self, function, *args, **kwargs):
+        """
+        Call a Redis command, failing fast while Redis is unreachable.
+
+        Raises:
+            StatusStoreUnavailable: If Redis could not be reached less than
+                ``retry_interval`` seconds ago.
+        """
+        if time.monotonic() < self._retry_at:
+            raise StatusStoreUnavailable(
+                f"Task status store {self.url} is unavailable")
+        import redis
+        try:
+            return function(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._retry_at = time.monotonic() + self.retry_interval
+            raise
+
+    def update(self, task_id, fields):
+        """
+        Merge fields into the state of a task and announce the change; see
+        ``MemoryStatusStore.update``.
+        """
+        args = ["1" if fields.get("state") in FINAL_STATES else "0",
+                self.ttl, task_id]
+        for name, value in fields.items():
+            args += [name, json.dumps(value)]
+        if self._update is None:
+            self._update = self.client.register_script(_UPDATE_SCRIPT)
+        self._call(self._update, keys=[f"task-status:{task_id}"], args=args)
+
+    def get(self, task_id):
+        """
+        Return the state of a task.
+
+        Returns:
+            dict: The fields of the task, or None if it is unknown.
+        """
+        fields = self._call(self.client.hgetall, f"task-status:{task_id}")
+        if not fields:
+            return None
+        return {name.decode(): json.loads(value)
+                for name, value in fields.items()}
+
+    def claim(self, name, task_id, ttl=TASK_CLAIM_TTL, replace=None):
+        """
+        Claim a piece of work for a task; see ``MemoryStatusStore.claim``.
+        """
+        if self._claim is None:
+            self._claim = self.client.register_script(_CLAIM_SCRIPT)
+        holder = self._call(self._claim, keys=[f"task-claim:{name}"],
+                            args=[task_id, ttl, replace or ""])
+        return holder.decode() if isinstance(holder, bytes) else holder
+
+    def listen(self, listener):
+        """
+        Call ``listener`` with the ID of every task that changes, from a
+        background thread holding one subscription.
+
+        After a lost connection is restored, ``listener`` is called with
+        None, as changes may have been missed.
+        """
+        thread = threading.Thread(
+            target=self._listen, args=(listener,), name="task-status",
+            daemon=True)
+        thread.start()
+
+    def _listen(self, listener):
+        connected_before = False
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(TASK_STATUS_CHANNEL)
+                if connected_before:
+                    listener(None)
+                connected_before = True
+                for message in pubsub.listen():
+                    listener(message["data"].decode())
+            except Exception as e:
+                logger.warning(f"Task status subscription lost: {e}")
+                time.sleep(1)
+
+
+def create_status_store(name=TASK_STATUS_BACKEND):
+    """
+    Create the configured task status store.
+
+    Args:
+        name (str): 'redis' or 'memory'.
+
+    Returns:
+        RedisStatusStore or MemoryStatusStore: The store.
+    """
+    if name == "redis":
+        return RedisStatusStore()
+    if name == "memory":
+        return MemoryStatusStore()
+    raise ValueError(f"Unknown task status backend {name!r}")
+
+
+# The task states shared by the API and the workers
+status_store = create_status_store()
+
+
+def record(task_id, state, **fields):
+    """
+    Record a change of the state of a task.
+
+    Recording is best-effort: a task is not failed because its state could
+    not be stored.
+
+    Args:
+        task_id (str): The ID of the task; nothing is recorded if None.
+        state (str): The new state.
+        fields (dict): Other JSON-serializable fields to set.
+    """
+    if task_id is None:
+        return
+    fields["state"] = state
+    fields.setdefault(
+        {"QUEUED": "queued_at", "STARTED": "started_at"}.get(
+            state, "finished_at" if state in FINAL_STATES else "updated_at"),
+        time.time())
+    try:
+        status_store.update(task_id, fields)
+    except Exception as e:
+        logger.warning(f"Could not record state {state} of task "
+                       f"{task_id}: {e}")
+
+
+@contextmanager
+def report_outcome(task_id, outputs):
+    """
+    Record the final state of a task whose work is done in a ``with``
+    block: SUCCESS with its outputs, or FAILURE with the error raised.
+
+    Args:
+        task_id (str): The ID of the task, or None.
+        outputs (list): Paths of the outputs written by the block.
+    """
+    try:
+        yield
+    except Exception as e:
+        record(task_id, "FAILURE", error=str(e))
+        raise
+    record(task_id, "SUCCESS", outputs=outputs)
+
+
+def claim(name, task_id):
+    """
+    Claim a piece of work for a task, so that requests for the same work
+    share one task instead of each submitting their own.
+
+    A claim lapses after ``TASK_CLAIM_TTL`` seconds, and is taken over
+    once its task has finished, e.g. because it failed or its output has
+    since been removed.
+
+    Args:
+        name (str): The name of the work, e.g. the path of its output.
+        task_id (str): The ID of the task that would do the work.
+
+    Returns:
+        str: The ID of the task doing the work; ``task_id`` if it is to be
+        submitted.
+    """
+    holder = status_store.claim(name, task_id)
+    if holder != task_id:
+        state = status_store.get(holder) or {}
+        if state.get("state") in FINAL_STATES:
+            holder = status_store.claim(name, task_id, replace=holder)
+    return holder
+
+
+def task_outputs(args, kwargs):
+    """
+    Return the output paths of an image task from its arguments.
+
+    Args:
+        args (tuple): Positional arguments of the task: those of
+            ``process_image`` or ``process_payload``, or a list of jobs for
+            batches and arrays.
+        kwargs (dict): Keyword arguments of the task.
+
+    Returns:
+        list: The output paths.
+    """
+    if kwargs.get("output_image"):
+        return [kwargs["output_image"]]
+    jobs = kwargs.get("jobs")
+    if jobs is None and args and isinstance(args[0], list):
+        jobs = args[0]
+    if jobs is not None:
+        return [job["output_image"] for job in jobs]
+    return list(args[1:2])
+
+
+def describe(task_id, status):
+    """
+    Return the API representation of the state of a task.
+
+    Args:
+        task_id (str): The ID of the task.
+        status (dict): The stored fields.
+
+    Returns:
+        dict: The fields, with the task ID and the seconds spent queued and
+        running.
+    """
+    status = dict(status, task_id=task_id)
+    started = status.get("started_at")
+    if started is not None and status.get("queued_at") is not None:
+        status["queue_seconds"] = round(started - status["queued_at"], 6)
+    if started is not None and status.get("finished_at") is not None:
+        status["run_seconds"] = round(status["finished_at"] - started, 6)
+    return status
+
+
+class TaskStatusHub:
+    """
+    Fans out task state changes to the coroutines waiting for them.
+
+    The store is subscribed to once, on first use. A change of a task with
+    waiters is read once and put in the asyncio queue of every waiter.
+
+    Attributes:
+        store: The task status store.
+    """
+
+    def __init__(self, store=None):
+        """
+        Initialize the TaskStatusHub.
+
+        Args:
+            store: The task status store; ``status_store`` by default.
+        """
+        self._store = store
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self._listening = False
+
+    @property
+    def store(self):
+        return self._store if self._store is not None else status_store
+
+    def subscribe(self, task_id):
+        """
+        Start receiving the changes of a task.
+
+        Args:
+            task_id (str): The ID of the task.
+
+        Returns:
+            asyncio.Queue: Receives the state of the task after each change.
+        """
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if not self._listening:
+                self.store.listen(self._notify)
+                self._listening = True
+            self.waiters.setdefault(task_id, []).append((loop, queue))
+        return queue
+
+    def unsubscribe(self, task_id, queue):
+        """
+        Stop receiving the changes of a task.
+        """
+        with self.lock:
+            waiters = [waiter for waiter in self.waiters.get(task_id, [])
+                       if waiter[1] is not queue]
+            if waiters:
+                self.waiters[task_id] = waiters
+            else:
+                self.waiters.pop(task_id, None)
+
+    def waiting(self):
+        """
+        Returns:
+            int: The number of coroutines waiting for a task.
+        """
+        with self.lock:
+            return sum(len(waiters) for waiters in self.waiters.values())
+
+    def _notify(self, task_id):
+        """
+        Deliver the state of a changed task to its waiters.
+
+        Called by the store; a task ID of None refreshes every waited task.
+        """
+        with self.lock:
+            task_ids = list(self.waiters) if task_id is None else (
+                [task_id] if task_id in self.waiters else [])
+        for changed in task_ids:
+            try:
+                status = self.store.get(changed)
+            except Exception as e:
+                logger.warning(f"Could not read state of task {changed}: {e}")
+                continue
+            if status is None:
+                continue
+            with self.lock:
+                waiters = list(self.waiters.get(changed, []))
+            for loop, queue in waiters:
+                loop.call_soon_threadsafe(queue.put_nowait, status)
+
+    async def wait(self, task_id, timeout):
+        """
+        Wait until a task reaches a final state.
+
+        Args:
+            task_id (str): The ID of the task.
+            timeout (float): Longest wait in seconds.
+
+        Returns:
+            dict: The latest state of the task, or None if it is unknown.
+        """
+        queue = self.subscribe(task_id)
+        try:
+            status = await asyncio.to_thread(self.store.get, task_id)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while status is None or status.get("state") not in FINAL_STATES:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    status = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            return status
+        finally:
+            self.unsubscribe(task_id, queue)
+
+    async def stream(self, task_id, keepalive=15):
+        """
+        Yield the state of a task after each change, until it is final.
+
+        Yields:
+            dict: The state of the task, or None when nothing changed for
+            ``keepalive`` seconds.
+        """
+        queue = self.subscribe(task_id)
+        try:
+            status = await asyncio.to_thread(self.store.get, task_id)
+            if status is not None:
+                yield status
+            while status is None or status.get("state") not in FINAL_STATES:
+                try:
+                    changed = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                # A change made while the state was first read arrives twice
+                if changed != status:
+                    status = changed
+                    yield status
+        finally:
+            self.unsubscribe(task_id, queue)
+
+
+# Waiters of the API process
+hub = TaskStatusHub()
@@ -5,80 +5,225 @@ This module defines the Celery tasks for processing image jobs
 using the nvJPEG2000 library.
 """
 
-from celery import Celery
-from .gpu_manager import gpu_manager
+from celery.schedules import crontab
+from celery.signals import (
+    before_task_publish, task_failure, task_postrun, task_prerun,
+    task_retry, worker_init, worker_process_init, worker_process_shutdown)
+from . import task_status
+from .gpu_manager import (
+    gpu_manager, GPUUnavailableError, GPU_WAIT_TIMEOUT, GPU_USAGE_WINDOW)
+from .cache import result_cache
+from .celery_app import create_celery
+from .codec_backends import CPU_BACKEND, codec_backends
+from .codec_pool import CPU_DEVICE, codec_pools
+from .metrics import observe_stage, registry, time_codec, time_stage
+from .priorities import slurm_priority_options
+from .scheduler import cost_model, scheduler
+from .storage import area_for
+from .telemetry import METRICS, TELEMETRY_ENABLED
+from .tracing import format_traceparent, parse_traceparent, tracer
+import json
+import mmap
 import os
+import shlex
 import subprocess
 import time
+from time import perf_counter
 import logging
+import uuid
+from contextlib import contextmanager
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Conditionally import the actual or mock nvJPEG2000 library based on the
-# environment variable
-if os.getenv("USE_MOCK_NVJPEG2000", "true").lower() == "true":
-    from .mock_nvjpeg2000 import *
-else:
-    # Remove the unused import statement
-    pass
+# Seconds before a task that timed out waiting for a GPU is retried
+GPU_RETRY_DELAY = int(os.getenv("GPU_RETRY_DELAY", 5))
+# Number of times a task is retried when no GPU becomes available
+GPU_MAX_RETRIES = int(os.getenv("GPU_MAX_RETRIES", 10))
+
+# Memory-map input images instead of reading them into memory
+MMAP_INPUT = os.getenv("MMAP_INPUT", "true").lower() == "true"
+
+# Command used to submit Slurm jobs
+SBATCH_COMMAND = os.getenv("SBATCH_COMMAND", "sbatch")
+# Directory holding generated Slurm scripts and array manifests
+SLURM_SCRIPT_DIR = os.getenv("SLURM_SCRIPT_DIR", "slurm_scripts")
+
+
+class SlurmSubmitError(RuntimeError):
+    """
+    Raised when sbatch rejects a job.
+    """
+
 
 # Create a Celery instance for task management
-celery = Celery('tasks', broker='redis://redis:6379/0',
-                backend='redis://redis:6379/0')
+celery = create_celery()
 
 
-@celery.task
-def process_image(input_image, output_image, operation, priority=0):
+@celery.task(bind=True, max_retries=GPU_MAX_RETRIES, track_status=True)
+def process_image(self, input_image, output_image, operation, priority=0,
+                  cache_key=None, reduce=0, region=None, cost=None,
+                  work=None):
     """
     Process an individual image job.
 
+    The task waits up to ``GPU_WAIT_TIMEOUT`` seconds for a GPU, with
+    higher-priority and shorter jobs served first, and is retried if none
+    frees up. The task is SUBMITTED once its Slurm job is queued, and the
+    job records SUCCESS or FAILURE when the codec is done. A job expected
+    to finish sooner on the CPU codec than on a GPU, counting the wait for
+    the GPU, is run by the worker on the CPU instead.
+
     Args:
         input_image (str): Path to the input image file.
         output_image (str): Path to the output image file.
         operation (str): Operation to perform ('decode' or 'encode').
         priority (int): Priority of the job (default is 0).
+        cache_key (str): Result cache key the output is stored under.
+        reduce (int): Resolution levels skipped by a decode.
+        region (tuple): (x, y, width, height) decoded, or None for the
+            whole image. See ``set_decode_window``.
+        cost (float): Expected GPU seconds of the job; shorter jobs are
+            served first when several wait for a GPU.
+        work (int): Decoded sample bytes of the job, needed to estimate
+            its time on the CPU.
 
     Returns:
         str: Status message.
+
+    Raises:
+        SlurmSubmitError: If sbatch rejects the job, once FAILURE is
+            recorded.
     """
-    gpu_id = gpu_manager.allocate_gpu()
+    job = {"operation": operation, "work": work, "cost": cost}
+    if prefer_cpu([job]):
+        return run_on_cpu(job, input_image, output_image, cache_key, reduce,
+                          region, self.request.id)
+
+    wait_start = perf_counter()
+    gpu_id = gpu_manager.allocate_gpu(
+        priority=priority, timeout=GPU_WAIT_TIMEOUT, cost=cost)
+    observe_stage("gpu_wait", perf_counter() - wait_start, operation,
+                  "" if gpu_id is None else gpu_id)
     if gpu_id is None:
-        return "No GPU available. Please try again later."
+        raise self.retry(
+            exc=GPUUnavailableError("No GPU available"),
+            countdown=GPU_RETRY_DELAY)
 
     try:
         start_time = time.time()
-        slurm_script = create_slurm_script(
-            input_image, output_image, operation, gpu_id)
-        slurm_job_id = submit_slurm_job(slurm_script, priority)
+        with time_stage("slurm_submit", operation, gpu_id):
+            slurm_script = create_slurm_script(
+                input_image, output_image, operation, gpu_id, cache_key,
+                reduce, region, self.request.id)
+            slurm_job_id = submit_slurm_job(slurm_script, priority)
+        task_status.record(self.request.id, "SUBMITTED",
+                           slurm_job_id=slurm_job_id)
+        span = getattr(self.request, "trace_span", None)
+        if span is not None:
+            span.set(slurm_job_id=slurm_job_id)
         end_time = time.time()
         duration = end_time - start_time
-        logger.info(f"Image {operation} took {duration:.2f} seconds")
+        logger.info(f"Slurm submission of image {operation} took "
+                    f"{duration:.2f} seconds")
         status_message = (
             f"Job submitted to Slurm with ID {slurm_job_id}. "
-            f"{operation.capitalize()} took {duration:.2f} seconds"
+            f"Submission took {duration:.2f} seconds"
         )
         return status_message
     except Exception as e:
-        return str(e)
+        task_status.record(self.request.id, "FAILURE", error=str(e))
+        raise
     finally:
         gpu_manager.release_gpu(gpu_id)
 
 
-def create_slurm_script(input_image, output_image, operation, gpu_id):
+def prefer_cpu(jobs):
+    """
+    Tell whether jobs should run on the CPU codec rather than wait for a
+    GPU.
+
+    Args:
+        jobs (list): Job dictionaries annotated with their 'operation',
+            'work' and 'cost'.
+
+    Returns:
+        bool: Whether the CPU codec can run and is expected to finish the
+        jobs before a GPU would. See ``JobScheduler.prefer_cpu``.
+    """
+    return (scheduler.prefer_cpu(jobs, gpu_manager.expected_wait())
+            and codec_backends.available(CPU_BACKEND))
+
+
+def run_on_cpu(job, input_image, output_image, cache_key=None, reduce=0,
+               region=None, task_id=None):
+    """
+    Run an image job on the CPU codec in the worker. ``decode_image`` and
+    ``encode_image`` feed its codec time back into the cost model.
+
+    Args:
+        job (dict): The job, annotated with its 'operation'.
+        input_image (str): Path to the input image file.
+        output_image (str): Path to the output image file.
+        cache_key (str): Result cache key the output is stored under.
+        reduce (int): Resolution levels skipped by a decode.
+        region (tuple): (x, y, width, height) decoded, or None.
+        task_id (str): ID of the task whose outcome is recorded.
+
+    Returns:
+        str: Status message.
+
+    Raises:
+        Exception: The error of the codec, once FAILURE is recorded.
+    """
+    operation = job["operation"]
+    start_time = perf_counter()
+    if operation == "decode":
+        decode_image(input_image, output_image, CPU_DEVICE, cache_key,
+                     reduce, region, task_id)
+    else:
+        encode_image(input_image, output_image, CPU_DEVICE, cache_key,
+                     task_id)
+    duration = perf_counter() - start_time
+    return f"Processed on the CPU in {duration:.2f} seconds"
+
+
+def create_slurm_script(input_image, output_image, operation, gpu_id,
+                        cache_key=None, reduce=0, region=None, task_id=None):
     """
     Create a Slurm job script for image processing.
 
+    Within a sampled trace, the script exports the trace context in
+    ``TRACEPARENT`` and its creation time in ``TRACE_SUBMITTED_AT``, so
+    that the job continues the trace and records how long it was pending.
+
     Args:
         input_image (str): Path to the input image file.
         output_image (str): Path to the output image file.
         operation (str): Operation to perform ('decode' or 'encode').
         gpu_id (int): The ID of the GPU to use.
+        cache_key (str): Result cache key the output is stored under.
+        reduce (int): Resolution levels skipped by a decode.
+        region (tuple): (x, y, width, height) decoded, or None.
+        task_id (str): ID of the task the job reports its outcome to.
 
     Returns:
         str: Path to the created Slurm job script.
     """
+    decode_options = ""
+    if operation == "decode" and (reduce or region):
+        region = None if region is None else tuple(region)
+        decode_options = f", reduce={reduce!r}, region={region!r}"
+    if task_id is not None:
+        decode_options += f", task_id={task_id!r}"
+    trace_env = trace_start = ""
+    context = tracer.current()
+    if context is not None and context.sampled:
+        trace_env = (f"export TRACEPARENT={format_traceparent(context)}\n"
+                     f"export TRACE_SUBMITTED_AT={time.time()!r}\n")
+        trace_start = ("from app.tracing import tracer; "
+                       "tracer.record_slurm_pending();\n")
     script_content = f"""#!/bin/bash
 #SBATCH --gres=gpu:{gpu_id}
 #SBATCH --job-name=image_processing
@@ -86,116 +231,603 @@ def create_slurm_script(input_image, output_image, operation, gpu_id):
 
 module load cuda/10.1
 source activate myenv
-
+{trace_env}
 python -c "
-from app.tasks import {operation}_image;
-{operation}_image('{input_image}', '{output_image}', {gpu_id});
+{trace_start}from app.tasks import {operation}_image;
+{operation}_image('{input_image}', '{output_image}', {gpu_id}, \
+{cache_key!r}{decode_options});
 "
 """
-    script_path = f"slurm_scripts/job_{gpu_id}.sh"
+    script_path = os.path.join(
+        SLURM_SCRIPT_DIR, f"job_{gpu_id}_{uuid.uuid4().hex}.sh")
     os.makedirs(os.path.dirname(script_path), exist_ok=True)
     with open(script_path, "w") as script_file:
         script_file.write(script_content)
     return script_path
 
 
+@celery.task(track_status=True)
+def process_image_array(jobs, priority=0):
+    """
+    Submit a group of image jobs to Slurm as a single job array.
+
+    A job with a 'task_id' has its own state: it is SUBMITTED with the
+    array, and its array task records SUCCESS or FAILURE when the codec is
+    done. See ``run_manifest_entry``.
+
+    Args:
+        jobs (list): A list of job dictionaries, each containing
+            'input_image', 'output_image', 'operation' and optionally
+            'cache_key', 'task_id', and 'reduce' and 'region' for decodes.
+        priority (int): Priority of the array job (default is 0).
+
+    Returns:
+        str: Status message.
+
+    Raises:
+        SlurmSubmitError: If sbatch rejects the array; its jobs are
+            recorded as failed.
+    """
+    try:
+        with time_stage("slurm_submit"):
+            script_path = create_slurm_array(jobs)
+            slurm_job_id = submit_slurm_job(script_path, priority)
+    except Exception as e:
+        for job in jobs:
+            task_status.record(job.get("task_id"), "FAILURE", error=str(e))
+        raise
+    task_status.record(process_image_array.request.id, "SUBMITTED",
+                       slurm_job_id=slurm_job_id)
+    for index, job in enumerate(jobs):
+        task_status.record(job.get("task_id"), "SUBMITTED",
+                           slurm_job_id=slurm_job_id,
+                           slurm_array_index=index)
+    logger.info(
+        f"Submitted {len(jobs)} images as Slurm array job {slurm_job_id}")
+    return (f"Job array submitted to Slurm with ID {slurm_job_id} "
+            f"({len(jobs)} tasks)")
+
+
+def create_slurm_array(jobs):
+    """
+    Create a manifest and a Slurm job array script for a group of jobs.
+
+    The manifest holds one JSON job per line; array task N processes the
+    job on line N.
+
+    Args:
+        jobs (list): A list of job dictionaries, as for
+            ``process_image_array``.
+
+    Returns:
+        str: Path to the created Slurm job script.
+    """
+    name = f"array_{uuid.uuid4().hex}"
+    manifest_path = os.path.join(SLURM_SCRIPT_DIR, f"{name}.jsonl")
+    script_path = os.path.join(SLURM_SCRIPT_DIR, f"{name}.sh")
+    os.makedirs(SLURM_SCRIPT_DIR, exist_ok=True)
+
+    with open(manifest_path, "w") as manifest_file:
+        for job in jobs:
+            manifest_file.write(json.dumps(job) + "\n")
+
+    script_content = f"""#!/bin/bash
+#SBATCH --gres=gpu:1
+#SBATCH --job-name=image_processing
+#SBATCH --output=slurm-%A_%a.out
+#SBATCH --array=0-{len(jobs) - 1}
+
+module load cuda/10.1
+source activate myenv
+
+python -c "
+import sys
+from app.tasks import run_manifest_entry
+run_manifest_entry(sys.argv[1], int(sys.argv[2]))
+" {shlex.quote(manifest_path)} "$SLURM_ARRAY_TASK_ID"
+"""
+    with open(script_path, "w") as script_file:
+        script_file.write(script_content)
+    return script_path
+
+
+def run_manifest_entry(manifest_path, index, gpu_id=0):
+    """
+    Process one job of a Slurm array manifest.
+
+    Called by each array task. Slurm restricts the task to the GPU it was
+    allocated, which is therefore always device 0 from its point of view.
+    The outcome is recorded under the 'task_id' of the job, if it has one.
+
+    Args:
+        manifest_path (str): Path to the array manifest.
+        index (int): The line of the manifest to process.
+        gpu_id (int): The ID of the GPU to use.
+    """
+    with open(manifest_path) as manifest_file:
+        for line_number, line in enumerate(manifest_file):
+            if line_number == index:
+                job = json.loads(line)
+                break
+        else:
+            raise IndexError(f"{manifest_path} has no job {index}")
+
+    with task_status.report_outcome(job.get('task_id'),
+                                    [job['output_image']]):
+        if job['operation'] == 'decode':
+            decode_image(job['input_image'], job['output_image'], gpu_id,
+                         job.get('cache_key'), job.get('reduce', 0),
+                         job.get('region'))
+        elif job['operation'] == 'encode':
+            encode_image(job['input_image'], job['output_image'], gpu_id,
+                         job.get('cache_key'))
+        else:
+            raise ValueError(f"Unknown operation {job['operation']!r}")
+
+
 def submit_slurm_job(script_path, priority):
     """
     Submit a Slurm job using the provided script.
 
+    The priority tier of the job is passed as a ``--nice`` offset and
+    optional QOS; see ``slurm_priority_options``.
+
     Args:
         script_path (str): Path to the Slurm job script.
         priority (int): Priority of the job.
 
     Returns:
         int: The Slurm job ID.
+
+    Raises:
+        SlurmSubmitError: If sbatch rejects the job.
     """
-    result = subprocess.run(["sbatch",
-                             "--priority",
-                             str(priority),
+    result = subprocess.run([*shlex.split(SBATCH_COMMAND),
+                             *slurm_priority_options(priority),
                              script_path],
                             capture_output=True,
                             text=True)
-    job_id = int(result.stdout.strip().split()[-1])
-    return job_id
+    if result.returncode != 0:
+        raise SlurmSubmitError(
+            f"sbatch exited with status {result.returncode}: "
+            f"{result.stderr.strip()}")
+    try:
+        return int(result.stdout.strip().split()[-1])
+    except (IndexError, ValueError):
+        raise SlurmSubmitError(
+            f"Unexpected sbatch output: {result.stdout.strip()!r}")
 
 
-def decode_image(input_image, output_image, gpu_id):
+def decode_image(input_image, output_image, gpu_id, cache_key=None,
+                 reduce=0, region=None, task_id=None):
     """
     Decode a JPEG2000 image using the specified GPU.
 
+    The time of the parse and decode is fed back into the cost model.
+
     Args:
         input_image (str): Path to the input image file.
         output_image (str): Path to the output image file.
-        gpu_id (int): The ID of the GPU to use.
+        gpu_id (int): The ID of the GPU to use, or ``CPU_DEVICE``.
+        cache_key (str): Result cache key the output is stored under.
+        reduce (int): Resolution levels skipped by the decode.
+        region (tuple): (x, y, width, height) decoded, or None for the
+            whole image. See ``set_decode_window``.
+        task_id (str): ID of the task whose outcome is recorded.
     """
-    start_time = time.time()
-    nvjpeg2k_handle = nvjpeg2kCreate()
-    nvjpeg2k_decode_state = nvjpeg2kDecodeStateCreate(nvjpeg2k_handle)
-    nvjpeg2k_stream = nvjpeg2kStreamCreate(nvjpeg2k_handle)
+    with tracer.span("decode_image", gpu=gpu_id), \
+            task_status.report_outcome(task_id, [output_image]):
+        start_time = time.time()
+        image_data = map_input(input_image)
+
+        with codec_pools.checkout(gpu_id) as codec, \
+                release_after(image_data):
+            nvjpeg2k = codec.codec
+            codec_start = perf_counter()
+            with time_stage("parse", "decode", gpu_id):
+                nvjpeg2k.nvjpeg2kStreamParse(codec.handle, codec.stream,
+                                             image_data, len(image_data))
+                image_info = nvjpeg2k.nvjpeg2kStreamGetImageInfo(
+                    codec.stream)
+
+            width, height = set_decode_window(
+                codec, image_info, reduce, region)
+            num_components = image_info.num_components
+            with time_codec("decode", gpu_id, codec.backend,
+                            width * height):
+                decoded_image = nvjpeg2k.nvjpeg2kDecode(
+                    codec.handle,
+                    codec.decode_state,
+                    codec.stream,
+                    width,
+                    height,
+                    num_components,
+                    gpu_id,
+                    codec.decode_params)
+            scheduler.observe(
+                {"operation": "decode",
+                 "work": width * height * num_components *
+                 image_info.sample_size},
+                perf_counter() - codec_start, cpu=gpu_id == CPU_DEVICE)
+
+        with time_stage("output_write", "decode", gpu_id):
+            write_output(output_image, decoded_image)
+        if cache_key:
+            result_cache.put(cache_key, output_image)
 
-    with open(input_image, 'rb') as f:
-        image_data = f.read()
+        end_time = time.time()
+        duration = end_time - start_time
+        logger.info(f"Decoding image {input_image} took "
+                    f"{duration:.2f} seconds")
 
-    nvjpeg2kStreamParse(nvjpeg2k_handle, nvjpeg2k_stream,
-                        image_data, len(image_data))
 
-    image_info = nvjpeg2kStreamGetImageInfo(nvjpeg2k_stream)
-    width = image_info.width
-    height = image_info.height
-    num_components = image_info.num_components
-    decoded_image = nvjpeg2kDecode(
-        nvjpeg2k_handle,
-        nvjpeg2k_decode_state,
-        nvjpeg2k_stream,
-        width,
-        height,
-        num_components,
-        gpu_id)
+def encode_image(input_image, output_image, gpu_id, cache_key=None,
+                 task_id=None):
+    """
+    Encode an image to JPEG2000 format using the specified GPU.
+
+    The time of the parse and encode is fed back into the cost model.
 
-    with open(output_image, 'wb') as f:
-        f.write(decoded_image)
+    Args:
+        input_image (str): Path to the input image file.
+        output_image (str): Path to the output image file.
+        gpu_id (int): The ID of the GPU to use, or ``CPU_DEVICE``.
+        cache_key (str): Result cache key the output is stored under.
+        task_id (str): ID of the task whose outcome is recorded.
+    """
+    with tracer.span("encode_image", gpu=gpu_id), \
+            task_status.report_outcome(task_id, [output_image]):
+        start_time = time.time()
+        image_data = map_input(input_image)
+
+        with codec_pools.checkout(gpu_id) as codec, \
+                release_after(image_data):
+            nvjpeg2k = codec.codec
+            codec_start = perf_counter()
+            with time_stage("parse", "encode", gpu_id):
+                nvjpeg2k.nvjpeg2kStreamParse(codec.handle, codec.stream,
+                                             image_data, len(image_data))
+                image_info = nvjpeg2k.nvjpeg2kStreamGetImageInfo(
+                    codec.stream)
+
+            with time_codec("encode", gpu_id, codec.backend,
+                            image_info.width * image_info.height):
+                encoded_image = nvjpeg2k.nvjpeg2kEncode(
+                    codec.handle, codec.encode_state, codec.stream, gpu_id)
+            scheduler.observe(
+                {"operation": "encode",
+                 "work": image_info.width * image_info.height *
+                 image_info.num_components * image_info.sample_size},
+                perf_counter() - codec_start, cpu=gpu_id == CPU_DEVICE)
+
+        with time_stage("output_write", "encode", gpu_id):
+            write_output(output_image, encoded_image)
+        if cache_key:
+            result_cache.put(cache_key, output_image)
 
-    nvjpeg2kDecodeStateDestroy(nvjpeg2k_decode_state)
-    nvjpeg2kStreamDestroy(nvjpeg2k_stream)
-    nvjpeg2kDestroy(nvjpeg2k_handle)
-    end_time = time.time()
-    duration = end_time - start_time
-    logger.info(f"Decoding image {input_image} took {duration:.2f} seconds")
+        end_time = time.time()
+        duration = end_time - start_time
+        logger.info(f"Encoding image {input_image} took "
+                    f"{duration:.2f} seconds")
 
 
-def encode_image(input_image, output_image, gpu_id):
+def set_decode_window(codec, image_info, reduce=0, region=None):
     """
-    Encode an image to JPEG2000 format using the specified GPU.
+    Restrict the next decode of a codec context to a resolution and region.
+
+    The decoder only processes the tiles overlapping the region and stops
+    ``reduce`` resolution levels short of full resolution, so the rest of
+    the codestream is skipped. Each level skipped halves the width and
+    height of the output.
+
+    Args:
+        codec (CodecContext): The checked out codec context.
+        image_info (ImageInfo): The image information of the parsed stream.
+        reduce (int): Resolution levels to skip, capped at the levels
+            present in the codestream.
+        region (tuple): (x, y, width, height) of the area to decode in
+            full-resolution pixels, clipped to the image. None decodes the
+            whole image.
+
+    Returns:
+        tuple: The width and height of the decoded image.
+
+    Raises:
+        ValueError: If the region does not overlap the image.
+    """
+    nvjpeg2k = codec.codec
+    num_resolutions = nvjpeg2k.nvjpeg2kStreamGetResolutionsInTile(
+        codec.stream, 0)
+    reduce = min(max(int(reduce or 0), 0), num_resolutions - 1)
+    start_x, start_y = 0, 0
+    end_x, end_y = image_info.width, image_info.height
+    if region is not None:
+        x, y, width, height = region
+        start_x, start_y = max(x, 0), max(y, 0)
+        end_x, end_y = min(x + width, end_x), min(y + height, end_y)
+        if start_x >= end_x or start_y >= end_y:
+            raise ValueError(
+                f"Region {tuple(region)} is outside the "
+                f"{image_info.width}x{image_info.height} image")
+
+    nvjpeg2k.nvjpeg2kDecodeParamsSetDecodeArea(
+        codec.decode_params, start_x, end_x, start_y, end_y)
+    nvjpeg2k.nvjpeg2kDecodeParamsSetReduceFactor(
+        codec.decode_params, reduce)
+
+    # Coordinates on a reduced level are rounded up, as in the JPEG2000 spec
+    def reduced(value):
+        return -(-value // (1 << reduce))
+    return (reduced(end_x) - reduced(start_x),
+            reduced(end_y) - reduced(start_y))
+
+
+def map_input(input_image, prefetch=False):
+    """
+    Open an input image as a buffer for the codec.
+
+    The file is memory-mapped rather than read, so a job holds no private
+    copy of its input and concurrent jobs reading the same file share its
+    pages. Empty files, and all files when ``MMAP_INPUT`` is off, are read
+    into memory instead.
 
     Args:
         input_image (str): Path to the input image file.
+        prefetch (bool): Ask the kernel to start reading the file in the
+            background.
+
+    Returns:
+        memoryview: The contents of the file. Release it once the codec is
+        done with it to unmap the file.
+    """
+    with open(input_image, 'rb') as f:
+        if not MMAP_INPUT or os.fstat(f.fileno()).st_size == 0:
+            return memoryview(f.read())
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if prefetch and hasattr(mmap, "MADV_WILLNEED"):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    return memoryview(mapped)
+
+
+@contextmanager
+def release_after(buffer):
+    """
+    Release a buffer returned by ``map_input`` at the end of a block.
+
+    Args:
+        buffer (memoryview): The buffer to release.
+    """
+    try:
+        yield buffer
+    finally:
+        if isinstance(buffer, memoryview):
+            buffer.release()
+
+
+def write_output(output_image, data):
+    """
+    Atomically write a processed image.
+
+    The data is written to a temporary file which then replaces the output,
+    so files hard-linked into the result cache are never modified in place.
+    The codec's buffer is written to the file directly, without copies.
+    Outputs in a storage area are added to the storage index.
+
+    Args:
         output_image (str): Path to the output image file.
-        gpu_id (int): The ID of the GPU to use.
+        data (bytes): The processed image data, or any object supporting
+            the buffer protocol.
+    """
+    directory = os.path.dirname(output_image)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{output_image}.{os.getpid()}.tmp"
+    view = memoryview(data).cast('B')
+    size = view.nbytes
+    with open(temp_path, 'wb', buffering=0) as f:
+        while view:
+            view = view[f.write(view):]
+    os.replace(temp_path, output_image)
+    area = area_for(output_image)
+    if area is not None:
+        area.register(output_image, size)
+
+
+@before_task_publish.connect
+def stamp_enqueue_time(headers=None, **kwargs):
     """
-    start_time = time.time()
-    nvjpeg2k_handle = nvjpeg2kCreate()
-    nvjpeg2k_encode_state = nvjpeg2kEncodeStateCreate(nvjpeg2k_handle)
-    nvjpeg2k_stream = nvjpeg2kStreamCreate(nvjpeg2k_handle)
+    Record when a task was published so workers can measure queue wait.
 
-    with open(input_image, 'rb') as f:
-        image_data = f.read()
+    Args:
+        headers (dict): The message headers of the task.
+        kwargs (dict): Additional arguments.
+    """
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+
+@before_task_publish.connect
+def inject_trace_context(headers=None, **kwargs):
+    """
+    Carry the current trace context in the headers of a published task.
+
+    Args:
+        headers (dict): The message headers of the task.
+        kwargs (dict): Additional arguments.
+    """
+    traceparent = tracer.traceparent()
+    if headers is not None and traceparent is not None:
+        headers.setdefault("traceparent", traceparent)
+
+
+@before_task_publish.connect
+def record_task_queued(sender=None, headers=None, body=None, **kwargs):
+    """
+    Record that an image task was queued, with its output paths.
+
+    Args:
+        sender (str): The name of the task.
+        headers (dict): The message headers of the task.
+        body (tuple): The arguments, keyword arguments and options.
+        kwargs (dict): Additional arguments.
+    """
+    task = celery.tasks.get(sender)
+    if not getattr(task, "track_status", False) or headers is None:
+        return
+    args, task_kwargs = body[0], body[1]
+    fields = {}
+    context = parse_traceparent(headers.get("traceparent"))
+    if context is not None and context.sampled:
+        fields["trace_id"] = context.trace_id
+    task_status.record(
+        headers.get("id"), "QUEUED", task=sender,
+        outputs=task_status.task_outputs(args, task_kwargs),
+        queued_at=headers.get("enqueued_at", time.time()), **fields)
+
+
+@task_prerun.connect
+def record_task_started(task_id=None, task=None, **kwargs):
+    """
+    Record that a worker started an image task.
+
+    Args:
+        task_id (str): The ID of the task.
+        task (celery.Task): The task about to run.
+        kwargs (dict): Additional arguments.
+    """
+    if getattr(task, "track_status", False):
+        task_status.record(task_id, "STARTED", retries=task.request.retries,
+                           worker=task.request.hostname)
+
+
+@task_retry.connect
+def record_task_retry(request=None, reason=None, **kwargs):
+    """
+    Record that an image task will be retried.
+
+    Args:
+        request (celery.app.task.Context): The request of the task.
+        reason (Exception): Why the task is retried.
+        kwargs (dict): Additional arguments.
+    """
+    if getattr(celery.tasks.get(request.task), "track_status", False):
+        task_status.record(request.id, "RETRY", error=str(reason))
 
-    nvjpeg2kStreamParse(nvjpeg2k_handle, nvjpeg2k_stream,
-                        image_data, len(image_data))
 
-    encoded_image = nvjpeg2kEncode(
-        nvjpeg2k_handle, nvjpeg2k_encode_state, nvjpeg2k_stream, gpu_id)
+@task_failure.connect
+def record_task_failure(sender=None, task_id=None, exception=None, **kwargs):
+    """
+    Record that an image task failed.
 
-    with open(output_image, 'wb') as f:
-        f.write(encoded_image)
+    Args:
+        sender (celery.Task): The task that failed.
+        task_id (str): The ID of the task.
+        exception (Exception): The error raised.
+        kwargs (dict): Additional arguments.
+    """
+    if getattr(sender, "track_status", False):
+        task_status.record(task_id, "FAILURE", error=str(exception))
 
-    nvjpeg2kEncodeStateDestroy(nvjpeg2k_encode_state)
-    nvjpeg2kStreamDestroy(nvjpeg2k_stream)
-    nvjpeg2kDestroy(nvjpeg2k_handle)
-    end_time = time.time()
-    duration = end_time - start_time
-    logger.info(f"Encoding image {input_image} took {duration:.2f} seconds")
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    """
+    Record how long a task waited in the broker queue.
+
+    Args:
+        task (celery.Task): The task about to run.
+        kwargs (dict): Additional arguments.
+    """
+    enqueued_at = getattr(task.request, "enqueued_at", None)
+    if enqueued_at is not None:
+        observe_stage("queue_wait", max(0.0, time.time() - enqueued_at))
+
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    """
+    Time a task as a span of the trace it was published in, after a span
+    for the time it spent queued.
+
+    Args:
+        task_id (str): The ID of the task.
+        task (celery.Task): The task about to run.
+        kwargs (dict): Additional arguments.
+    """
+    traceparent = getattr(task.request, "traceparent", None)
+    enqueued_at = getattr(task.request, "enqueued_at", None)
+    if traceparent is not None and enqueued_at is not None:
+        tracer.record("queue_wait", enqueued_at, parent=traceparent,
+                      task=task.name)
+    task.request.trace_span = tracer.start_span(
+        task.name, traceparent, task_id=task_id,
+        retries=task.request.retries)
+
+
+@task_postrun.connect
+def end_task_span(task=None, state=None, retval=None, **kwargs):
+    """
+    End the span of a task.
+
+    Args:
+        task (celery.Task): The task that ran.
+        state (str): The final state of the task.
+        retval: The return value of the task, or the error it raised.
+        kwargs (dict): Additional arguments.
+    """
+    span = getattr(task.request, "trace_span", None)
+    if span is not None:
+        task.request.trace_span = None
+        span.set(state=state)
+        span.end(error=retval if state == "FAILURE" else None)
+
+
+@worker_process_init.connect
+def start_gpu_monitoring(**kwargs):
+    """
+    Load the codec backend and, if ``TELEMETRY_ENABLED``, start sampling
+    GPU telemetry when a worker process boots, so that neither delays the
+    first job.
+
+    Args:
+        kwargs (dict): Additional arguments.
+    """
+    codec_backends.warm_up()
+    if TELEMETRY_ENABLED:
+        gpu_manager.start_monitoring()
+
+
+@worker_init.connect
+def share_cpu_cores(sender=None, **kwargs):
+    """
+    Publish the concurrency of the worker before its processes start, so
+    that the CPU codec pool of each gets its share of the cores of the
+    node.
+
+    Args:
+        sender (celery.apps.worker.Worker): The worker being started.
+        kwargs (dict): Additional arguments.
+    """
+    concurrency = getattr(sender, "concurrency", None)
+    if concurrency:
+        os.environ.setdefault("CPU_CODEC_NODE_PROCESSES", str(concurrency))
+
+
+@worker_process_shutdown.connect
+def close_codec_pools(**kwargs):
+    """
+    Tear down the codec pools and give up the GPU leases when a worker
+    process exits.
+
+    Args:
+        kwargs (dict): Additional arguments.
+    """
+    codec_pools.close()
+    gpu_manager.stop_monitoring()
+    gpu_manager.close()
+    registry.flush()
+    cost_model.flush()
+    tracer.flush()
 
 
 @celery.on_after_configure.connect
@@ -214,6 +846,20 @@ def setup_periodic_tasks(sender, **kwargs):
 def check_gpu_status():
     """
     Periodic task to check the status of GPU usage.
+
+    Logs the average utilization, memory use and temperature of each GPU
+    over the last ``GPU_USAGE_WINDOW`` seconds.
+
+    Returns:
+        dict: GPU IDs mapped to their average metric values.
     """
-    gpu_usage = gpu_manager.gpu_usage
-    logger.info(f"GPU Usage: {gpu_usage}")
+    telemetry = gpu_manager.telemetry
+    status = {
+        gpu_id: {
+            metric: telemetry.average(gpu_id, metric, GPU_USAGE_WINDOW)
+            for metric in METRICS
+        }
+        for gpu_id in range(gpu_manager.num_gpus)
+    }
+    logger.info(f"GPU Usage: {status}")
+    return status
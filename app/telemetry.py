@@ -0,0 +1,341 @@
+"""
+Telemetry Module
+
+This module samples GPU utilization, memory use and temperature for all
+devices in a single pass and keeps the samples in fixed-size ring buffers
+that can be queried for recent values and averages.
+
+The NVML backend is used when ``pynvml`` and a driver are available; the
+stub backend produces deterministic readings for tests and GPU-less
+development machines.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    import pynvml
+except ImportError:  # pragma: no cover - depends on the environment
+    pynvml = None
+
+logger = logging.getLogger(__name__)
+
+# Telemetry backend: 'auto', 'nvml' or 'stub'
+GPU_TELEMETRY_BACKEND = os.getenv("GPU_TELEMETRY_BACKEND", "auto")
+# Sample GPU telemetry in a background thread of each worker process,
+# started by its init hook; off unless explicitly enabled
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "false").lower() == "true"
+# Seconds between two sampling passes
+TELEMETRY_INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", 5))
+# Number of samples kept per GPU
+TELEMETRY_CAPACITY = int(os.getenv("TELEMETRY_CAPACITY", 720))
+
+# The metrics recorded for every GPU
+METRICS = ("utilization", "memory_used", "temperature")
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of timestamped samples that overwrites the oldest.
+
+    Attributes:
+        capacity (int): The number of samples kept.
+    """
+
+    def __init__(self, capacity):
+        """
+        Initialize the RingBuffer.
+
+        Args:
+            capacity (int): The number of samples kept.
+        """
+        self.capacity = capacity
+        self._samples = deque(maxlen=capacity)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def append(self, timestamp, sample):
+        """
+        Add a sample, dropping the oldest one if the buffer is full.
+
+        Args:
+            timestamp (float): Time the sample was taken.
+            sample (dict): The metric values of the sample.
+        """
+        self._samples.append((timestamp, sample))
+
+    def since(self, start):
+        """
+        Return the samples taken at or after a point in time.
+
+        Args:
+            start (float): The earliest timestamp to include.
+
+        Returns:
+            list: (timestamp, sample) pairs, oldest first.
+        """
+        recent = []
+        for timestamp, sample in reversed(self._samples):
+            if timestamp < start:
+                break
+            recent.append((timestamp, sample))
+        recent.reverse()
+        return recent
+
+    def latest(self):
+        """
+        Return the most recent sample.
+
+        Returns:
+            tuple: The (timestamp, sample) pair, or None if empty.
+        """
+        return self._samples[-1] if self._samples else None
+
+
+class NVMLBackend:
+    """
+    Reads GPU telemetry through NVIDIA's management library.
+    """
+
+    def __init__(self):
+        """
+        Initialize NVML and look up the device handles.
+        """
+        pynvml.nvmlInit()
+        self.handles = [
+            pynvml.nvmlDeviceGetHandleByIndex(index)
+            for index in range(pynvml.nvmlDeviceGetCount())]
+
+    def device_count(self):
+        """
+        Returns:
+            int: The number of GPUs on the node.
+        """
+        return len(self.handles)
+
+    def sample(self):
+        """
+        Read the metrics of every GPU.
+
+        Returns:
+            list: One dict of metric values per GPU.
+        """
+        samples = []
+        for handle in self.handles:
+            samples.append({
+                "utilization":
+                    pynvml.nvmlDeviceGetUtilizationRates(handle).gpu,
+                "memory_used": pynvml.nvmlDeviceGetMemoryInfo(handle).used,
+                "temperature": pynvml.nvmlDeviceGetTemperature(
+                    handle, pynvml.NVML_TEMPERATURE_GPU),
+            })
+        return samples
+
+    def close(self):
+        """
+        Shut down NVML.
+        """
+        pynvml.nvmlShutdown()
+
+
+class StubBackend:
+    """
+    Produces deterministic GPU telemetry without a GPU.
+
+    Utilization cycles through a fixed pattern that differs per device, so
+    tests can predict every reading.
+    """
+
+    def __init__(self, num_gpus, pattern=(10, 40, 70, 40)):
+        """
+        Initialize the StubBackend.
+
+        Args:
+            num_gpus (int): The number of simulated GPUs.
+            pattern (tuple): Utilization percentages cycled through.
+        """
+        self.num_gpus = num_gpus
+        self.pattern = pattern
+        self.ticks = 0
+
+    def device_count(self):
+        """
+        Returns:
+            int: The number of simulated GPUs.
+        """
+        return self.num_gpus
+
+    def sample(self):
+        """
+        Produce the next reading of every simulated GPU.
+
+        Returns:
+            list: One dict of metric values per GPU.
+        """
+        samples = []
+        for gpu_id in range(self.num_gpus):
+            utilization = self.pattern[
+                (self.ticks + gpu_id) % len(self.pattern)]
+            samples.append({
+                "utilization": utilization,
+                "memory_used": utilization * 1024 ** 2,
+                "temperature": 30 + utilization // 2,
+            })
+        self.ticks += 1
+        return samples
+
+    def close(self):
+        """
+        Nothing to release.
+        """
+
+
+def create_backend(num_gpus, name=GPU_TELEMETRY_BACKEND):
+    """
+    Create the configured telemetry backend.
+
+    Args:
+        num_gpus (int): The number of GPUs simulated by the stub backend.
+        name (str): 'nvml', 'stub', or 'auto' to use NVML when it can be
+            initialized and the stub otherwise.
+
+    Returns:
+        NVMLBackend or StubBackend: The telemetry backend.
+    """
+    if name == "stub":
+        return StubBackend(num_gpus)
+    if name == "nvml" or pynvml is not None:
+        try:
+            return NVMLBackend()
+        except Exception as e:
+            if name == "nvml":
+                raise
+            logger.info(f"NVML unavailable ({e}), using stub telemetry")
+    return StubBackend(num_gpus)
+
+
+class TelemetrySampler:
+    """
+    Periodically samples a telemetry backend into per-GPU ring buffers.
+
+    Attributes:
+        backend (NVMLBackend or StubBackend): The telemetry source.
+        interval (float): Seconds between two sampling passes.
+        buffers (list): One RingBuffer per GPU.
+    """
+
+    def __init__(self, backend, capacity=TELEMETRY_CAPACITY,
+                 interval=TELEMETRY_INTERVAL, clock=time.time):
+        """
+        Initialize the TelemetrySampler.
+
+        Args:
+            backend (NVMLBackend or StubBackend): The telemetry source.
+            capacity (int): The number of samples kept per GPU.
+            interval (float): Seconds between two sampling passes.
+            clock (callable): Returns the current time in seconds.
+        """
+        self.backend = backend
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buffers = [
+            RingBuffer(capacity) for _ in range(backend.device_count())]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample_once(self):
+        """
+        Take one sample of every GPU.
+        """
+        samples = self.backend.sample()
+        timestamp = self.clock()
+        with self.lock:
+            for buffer, sample in zip(self.buffers, samples):
+                buffer.append(timestamp, sample)
+
+    def series(self, gpu_id, metric, window=None):
+        """
+        Return the recorded values of a metric.
+
+        Args:
+            gpu_id (int): The ID of the GPU.
+            metric (str): One of ``METRICS``.
+            window (float): Only include samples from the last ``window``
+                seconds. None returns every sample kept.
+
+        Returns:
+            list: (timestamp, value) pairs, oldest first.
+        """
+        if gpu_id >= len(self.buffers):
+            return []
+        start = float("-inf") if window is None else self.clock() - window
+        with self.lock:
+            samples = self.buffers[gpu_id].since(start)
+        return [(timestamp, sample[metric]) for timestamp, sample in samples]
+
+    def average(self, gpu_id, metric, window=60):
+        """
+        Return the average of a metric over a recent window.
+
+        Args:
+            gpu_id (int): The ID of the GPU.
+            metric (str): One of ``METRICS``.
+            window (float): Length of the window in seconds.
+
+        Returns:
+            float: The average value, or None if there are no samples.
+        """
+        values = [value for _, value in self.series(gpu_id, metric, window)]
+        return sum(values) / len(values) if values else None
+
+    def latest(self, gpu_id):
+        """
+        Return the most recent sample of a GPU.
+
+        Args:
+            gpu_id (int): The ID of the GPU.
+
+        Returns:
+            dict: The metric values, or None if no sample was taken yet.
+        """
+        if gpu_id >= len(self.buffers):
+            return None
+        with self.lock:
+            latest = self.buffers[gpu_id].latest()
+        return None if latest is None else latest[1]
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="gpu-telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """
+        Sample until stopped.
+        """
+        while not self._stop.is_set():
+            try:
+                self.sample_once()
+            except Exception as e:
+                logger.warning(f"GPU telemetry sampling failed: {e}")
+            self._stop.wait(self.interval)
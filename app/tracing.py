@@ -0,0 +1,518 @@
+"""
+Tracing Module
+
+This module follows a request through the API, the broker, the workers,
+Slurm and the codec as one trace of timed spans. The trace context is
+carried in the W3C ``traceparent`` format: in the HTTP request and
+response headers, in the headers of Celery tasks, and in the
+``TRACEPARENT`` variable of generated Slurm job scripts.
+
+A trace is sampled when it starts, with probability
+``TRACE_SAMPLE_RATE``, or as decided by the ``traceparent`` it continues.
+Spans of sampled traces are written as JSON lines to ``TRACE_PATH``, or
+kept in the memory of the process; unsampled spans only carry the context
+on. Spans record wall-clock times, so that the spans of one trace written
+by different processes and hosts line up, and the time a task spent queued
+or a Slurm job spent pending is recorded as its own span.
+"""
+
+import atexit
+import contextvars
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Probability that a trace started by this process is sampled
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+# Where sampled spans go: 'jsonl' (TRACE_PATH) or 'memory' (this process)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl")
+# File sampled spans are appended to, one JSON object per line
+TRACE_PATH = os.getenv("TRACE_PATH", "traces.jsonl")
+# Size in bytes past which TRACE_PATH is rotated to TRACE_PATH.1, replacing
+# the previous one (0 lets it grow without bound)
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", 64 * 1024 ** 2))
+# Spans buffered by a process before they are written out
+TRACE_BUFFER_SPANS = int(os.getenv("TRACE_BUFFER_SPANS", 64))
+# Most spans kept by the 'memory' exporter
+TRACE_MEMORY_MAX_SPANS = int(os.getenv("TRACE_MEMORY_MAX_SPANS", 10000))
+
+_TRACEPARENT = re.compile(
+    r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id", "sampled"])
+
+
+def parse_traceparent(header):
+    """
+    Parse a ``traceparent`` header.
+
+    Args:
+        header (str): The header value, or None.
+
+    Returns:
+        SpanContext: The context, or None if the header is missing or
+        malformed.
+    """
+    match = _TRACEPARENT.match((header or "").strip().lower())
+    if match is None or set(match.group(1)) == {"0"}:
+        return None
+    trace_id, span_id, flags = match.groups()
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def format_traceparent(context):
+    """
+    Format a span context as a ``traceparent`` header.
+
+    Args:
+        context (SpanContext): The context.
+
+    Returns:
+        str: The header value.
+    """
+    return (f"00-{context.trace_id}-{context.span_id}-"
+            f"{'01' if context.sampled else '00'}")
+
+
+class JsonLinesExporter:
+    """
+    Appends spans to a file, one JSON object per line.
+
+    Spans are buffered and written in one append, which the processes
+    sharing the file do not interleave; the buffer is written out when the
+    process exits. Once the file outgrows ``max_bytes`` it is renamed to
+    ``<path>.1``, replacing the spans rotated before, so at most about
+    twice ``max_bytes`` of spans are kept and scanned by ``trace``.
+
+    Attributes:
+        path (str): The file spans are appended to.
+        buffer_spans (int): Spans buffered before they are written out.
+        max_bytes (int): Size past which the file is rotated; 0 disables
+            rotation.
+    """
+
+    def __init__(self, path=TRACE_PATH, buffer_spans=TRACE_BUFFER_SPANS,
+                 max_bytes=TRACE_MAX_BYTES):
+        """
+        Initialize the JsonLinesExporter.
+
+        Args:
+            path (str): The file spans are appended to.
+            buffer_spans (int): Spans buffered before they are written out.
+            max_bytes (int): Size past which the file is rotated; 0
+                disables rotation.
+        """
+        self.path = path
+        self.buffer_spans = buffer_spans
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._buffer = []
+        self._registered = False
+
+    def export(self, span):
+        """
+        Queue a finished span for writing.
+
+        Args:
+            span (dict): The span.
+        """
+        with self.lock:
+            self._buffer.append(json.dumps(span))
+            if not self._registered:
+                atexit.register(self.flush)
+                self._registered = True
+            if len(self._buffer) < self.buffer_spans:
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Write the buffered spans out.
+        """
+        with self.lock:
+            lines, self._buffer = self._buffer, []
+            if not lines:
+                return
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                fd = os.open(self.path,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, ("\n".join(lines) + "\n").encode())
+                    if self.max_bytes and (
+                            os.fstat(fd).st_size > self.max_bytes):
+                        self._rotate(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.warning(f"Could not write spans to {self.path}: {e}")
+
+    def _rotate(self, fd):
+        """
+        Rename the file to ``<path>.1``, unless another process already
+        rotated it.
+
+        Args:
+            fd (int): A descriptor of the file that outgrew ``max_bytes``.
+        """
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                os.replace(self.path, f"{self.path}.1")
+        except FileNotFoundError:
+            pass
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def trace(self, trace_id):
+        """
+        Return the spans of a trace written by all processes and still
+        kept in the file or its rotated predecessor.
+
+        Args:
+            trace_id (str): The ID of the trace.
+
+        Returns:
+            list: The spans, in order of their start.
+        """
+        self.flush()
+        spans = []
+        for path in (f"{self.path}.1", self.path):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        if trace_id in line:
+                            spans.append(json.loads(line))
+            except FileNotFoundError:
+                pass
+        return sorted(spans, key=lambda span: span["start"])
+
+
+class MemoryExporter:
+    """
+    Keeps the latest spans in the memory of the process.
+
+    Attributes:
+        spans (collections.deque): The spans, oldest first.
+    """
+
+    def __init__(self, max_spans=TRACE_MEMORY_MAX_SPANS):
+        self.lock = threading.Lock()
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def flush(self):
+        pass
+
+    def trace(self, trace_id):
+        """
+        Return the spans of a trace; see ``JsonLinesExporter.trace``.
+        """
+        with self.lock:
+            spans = [span for span in self.spans
+                     if span["trace_id"] == trace_id]
+        return sorted(spans, key=lambda span: span["start"])
+
+
+def create_exporter(name=TRACE_EXPORTER):
+    """
+    Create the configured span exporter.
+
+    Args:
+        name (str): 'jsonl' or 'memory'.
+
+    Returns:
+        JsonLinesExporter or MemoryExporter: The exporter.
+    """
+    if name == "jsonl":
+        return JsonLinesExporter()
+    if name == "memory":
+        return MemoryExporter()
+    raise ValueError(f"Unknown trace exporter {name!r}")
+
+
+class Span:
+    """
+    A timed operation of a trace.
+
+    Attributes:
+        name (str): What the span times.
+        context (SpanContext): The IDs of the span and its trace.
+        parent_id (str): The ID of the parent span, or None for a root.
+        start (float): Wall-clock start time.
+        attributes (dict): Properties of the operation.
+    """
+
+    def __init__(self, tracer, name, context, parent_id, attributes,
+                 start=None):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.attributes = attributes
+        self._token = None
+
+    def set(self, **attributes):
+        """
+        Add attributes to the span.
+        """
+        self.attributes.update(attributes)
+
+    def end(self, error=None, end=None):
+        """
+        Finish the span and export it if its trace is sampled.
+
+        If the span was made current by ``Tracer.start_span``, the context
+        that was current before it is restored.
+
+        Args:
+            error (Exception or str): Why the operation failed, if it did.
+            end (float): Wall-clock end time; now if omitted.
+        """
+        if self._token is not None:
+            self.tracer._current.reset(self._token)
+            self._token = None
+        if not self.context.sampled:
+            return
+        end = time.time() if end is None else end
+        span = {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": end,
+            "duration": round(end - self.start, 6),
+            "pid": os.getpid(),
+            "attributes": self.attributes,
+        }
+        if error is not None:
+            span["error"] = str(error)
+        self.tracer.exporter.export(span)
+
+
+class Tracer:
+    """
+    Starts spans and tracks the current one of each thread or coroutine.
+
+    Attributes:
+        exporter (JsonLinesExporter or MemoryExporter): Where sampled spans
+            go.
+        sample_rate (float): Probability that a new trace is sampled.
+    """
+
+    def __init__(self, exporter=None, sample_rate=TRACE_SAMPLE_RATE,
+                 environ=os.environ):
+        """
+        Initialize the Tracer.
+
+        Args:
+            exporter: Where sampled spans go; created from
+                ``TRACE_EXPORTER`` on first use if omitted.
+            sample_rate (float): Probability that a new trace is sampled.
+            environ (dict): Environment whose ``TRACEPARENT`` is the parent
+                of spans started without one, as in Slurm jobs.
+        """
+        self._exporter = exporter
+        self.sample_rate = sample_rate
+        self._current = contextvars.ContextVar("current_span", default=None)
+        self._environ_context = parse_traceparent(environ.get("TRACEPARENT"))
+
+    @property
+    def exporter(self):
+        """
+        The span exporter, created on first use so that importing the app
+        writes nothing.
+        """
+        if self._exporter is None:
+            self._exporter = create_exporter()
+        return self._exporter
+
+    def current(self):
+        """
+        Return the context of the current span.
+
+        Returns:
+            SpanContext: The context of the current span, or of the
+            ``TRACEPARENT`` environment variable, or None.
+        """
+        return self._current.get() or self._environ_context
+
+    def traceparent(self):
+        """
+        Return the ``traceparent`` header of the current span.
+
+        Returns:
+            str: The header value, or None outside a trace.
+        """
+        context = self.current()
+        return None if context is None else format_traceparent(context)
+
+    def _new_context(self, parent):
+        span_id = "%016x" % random.getrandbits(64)
+        if parent is None:
+            return SpanContext("%032x" % random.getrandbits(128), span_id,
+                               random.random() < self.sample_rate)
+        return SpanContext(parent.trace_id, span_id, parent.sampled)
+
+    def start_span(self, name, parent=None, start=None, **attributes):
+        """
+        Start a span and make it current, until ``Span.end`` is called.
+
+        Args:
+            name (str): What the span times.
+            parent (SpanContext or str): The parent span or its
+                ``traceparent``; the current span if omitted. Without one
+                a new trace is started.
+            start (float): Wall-clock start time; now if omitted.
+            attributes (dict): Properties of the operation.
+
+        Returns:
+            Span: The span.
+        """
+        if isinstance(parent, str):
+            parent = parse_traceparent(parent)
+        if parent is None:
+            parent = self.current()
+        span = Span(self, name, self._new_context(parent),
+                    None if parent is None else parent.span_id,
+                    attributes, start)
+        span._token = self._current.set(span.context)
+        return span
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Time a ``with`` block as a child of the current span.
+
+        Nothing is recorded outside a trace.
+
+        Args:
+            name (str): What the span times.
+            attributes (dict): Properties of the operation.
+
+        Yields:
+            Span: The span, or None outside a trace.
+        """
+        if self.current() is None:
+            yield None
+            return
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(error=e)
+            raise
+        span.end()
+
+    def record(self, name, start, end=None, parent=None, **attributes):
+        """
+        Record a span that has already ended, such as a wait measured
+        afterwards.
+
+        Nothing is recorded outside a trace.
+
+        Args:
+            name (str): What the span timed.
+            start (float): Wall-clock start time.
+            end (float): Wall-clock end time; now if omitted.
+            parent (SpanContext or str): The parent span; the current one
+                if omitted.
+            attributes (dict): Properties of the operation.
+        """
+        if isinstance(parent, str):
+            parent = parse_traceparent(parent)
+        if parent is None:
+            parent = self.current()
+        if parent is None or not parent.sampled:
+            return
+        Span(self, name, self._new_context(parent), parent.span_id,
+             attributes, start).end(end=end)
+
+    def record_slurm_pending(self, environ=os.environ):
+        """
+        Record the time a Slurm job spent pending, from the submission
+        time the job script exports in ``TRACE_SUBMITTED_AT``.
+
+        Called when the job starts.
+
+        Args:
+            environ (dict): The environment of the job.
+        """
+        submitted_at = environ.get("TRACE_SUBMITTED_AT")
+        if submitted_at:
+            self.record("slurm.pending", float(submitted_at),
+                        slurm_job_id=environ.get("SLURM_JOB_ID"))
+
+    def flush(self):
+        """
+        Write out the spans buffered by the exporter.
+        """
+        if self._exporter is not None:
+            self._exporter.flush()
+
+
+# The tracer of the process
+tracer = Tracer()
+
+
+class TraceMiddleware:
+    """
+    ASGI middleware timing each HTTP request as a span.
+
+    The span continues the trace of the ``traceparent`` request header, or
+    starts one, and its ``traceparent`` is returned in the response
+    headers so that clients can look the trace up.
+    """
+
+    def __init__(self, app, tracer=tracer):
+        """
+        Initialize the TraceMiddleware.
+
+        Args:
+            app: The ASGI application.
+            tracer (Tracer): The tracer of the spans.
+        """
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        tracer = self.tracer
+        headers = dict(scope.get("headers") or [])
+        parent = headers.get(b"traceparent", b"").decode("latin-1")
+        span = tracer.start_span(
+            f"{scope['method']} {scope['path']}", parent or None,
+            method=scope["method"], path=scope["path"])
+        traceparent = format_traceparent(span.context).encode()
+
+        async def send_with_context(message):
+            if message["type"] == "http.response.start":
+                span.set(status_code=message["status"])
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"traceparent", traceparent)]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_context)
+        except BaseException as e:
+            span.end(error=e)
+            raise
+        span.end()
@@ -0,0 +1,391 @@
+"""
+Uploads Module
+
+This module writes uploaded files to disk without blocking the event loop.
+The multipart body of an upload is parsed as it arrives, through
+``BodyReader``, so it is never spooled by Starlette first: each chunk of
+the file is hashed, size-checked and written in the thread pool as soon as
+it is received. A request whose declared ``Content-Length`` is over the
+limit is refused by ``UploadLimitMiddleware`` before its body is read; one
+without a length is cut off by the size check once the file outgrows the
+limit. Small uploads taking the fast path are kept in memory instead, and
+batch bodies are read as they arrive through ``BodyReader`` as well.
+"""
+
+import hashlib
+import io
+import os
+from collections import namedtuple
+
+import anyio.from_thread
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+# Size of each chunk read from the request body
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Largest accepted upload in bytes (0 disables the limit)
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 4 * 1024 ** 3))
+# Bytes of multipart boundaries and part headers allowed in the declared
+# length of a request on top of the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+UploadResult = namedtuple(
+    "UploadResult", ["path", "size", "sha256", "filename"])
+
+
+async def receive_upload(request, destination, max_size=None,
+                         memory_size=0, field="file"):
+    """
+    Receive the file of a multipart upload as its body arrives.
+
+    See ``UploadReceiver``. The body is parsed in the thread pool, which
+    waits for each chunk of it on the event loop.
+
+    Args:
+        request (Request): The request carrying the upload.
+        destination (callable): Called with the file name of the upload;
+            returns the path the file is written to.
+        max_size (int): Largest accepted size in bytes. Defaults to
+            ``MAX_UPLOAD_SIZE``; 0 disables the limit.
+        memory_size (int): Largest file kept in memory instead of being
+            written to disk; 0 writes every file to disk.
+        field (str): Name of the form field holding the file.
+
+    Returns:
+        tuple: The UploadResult, and the data of a file kept in memory or
+        None. The path of the UploadResult is None for a file kept in
+        memory.
+
+    Raises:
+        HTTPException: 400 for a malformed body or one without the file,
+            413 if the upload exceeds ``max_size``, 415 if the body is not
+            ``multipart/form-data``.
+    """
+    media_type, options = parse_options_header(
+        request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if media_type.lower() != b"multipart/form-data" or not boundary:
+        raise HTTPException(
+            status_code=415, detail="Send the file as multipart/form-data")
+    receiver = UploadReceiver(destination, max_size, memory_size, field)
+    body = io.BufferedReader(BodyReader(request), CHUNK_SIZE)
+    return await run_in_threadpool(receiver.run, body, boundary)
+
+
+class UploadReceiver:
+    """
+    Writes the file of a multipart upload while its body is parsed.
+
+    Each chunk of the file is hashed and size-checked as it is parsed, so
+    an upload over the limit is refused as soon as it outgrows it, whether
+    or not the request declared its length. A file of at most
+    ``memory_size`` bytes is kept in memory. A larger one is written to a
+    temporary ``.part`` file which is renamed into place once the body is
+    read, so readers never observe a partially written image, and which is
+    removed if the upload fails. Other form fields are ignored.
+
+    Its methods block; they are called from the thread pool.
+
+    Attributes:
+        filename (str): The file name of the upload, once its part began.
+        size (int): Number of bytes of the file received so far.
+    """
+
+    def __init__(self, destination, max_size=None, memory_size=0,
+                 field="file"):
+        """
+        Initialize the UploadReceiver.
+
+        Args:
+            destination (callable): Called with the file name of the
+                upload; returns the path the file is written to.
+            max_size (int): Largest accepted size in bytes. Defaults to
+                ``MAX_UPLOAD_SIZE``; 0 disables the limit.
+            memory_size (int): Largest file kept in memory; 0 writes every
+                file to disk.
+            field (str): Name of the form field holding the file.
+        """
+        self.destination = destination
+        self.max_size = MAX_UPLOAD_SIZE if max_size is None else max_size
+        self.memory_size = memory_size
+        self.field = field
+        self.filename = None
+        self.size = 0
+        self._path = None
+        self._file = None
+        self._data = bytearray()
+        self._digest = hashlib.sha256()
+        self._receiving = False
+        self._received = False
+
+    def begin(self, name, filename):
+        """
+        Start a part of the body.
+
+        Args:
+            name (str): The form field of the part.
+            filename (str): The file name of the part, or None for a
+                plain field.
+        """
+        self._receiving = (not self._received and name == self.field
+                           and filename is not None)
+        if self._receiving:
+            self.filename = filename
+
+    def write(self, data):
+        """
+        Hash, size-check and store data of the current part.
+
+        Args:
+            data (bytes): The data.
+
+        Raises:
+            HTTPException: 413 if the file exceeds ``max_size``.
+        """
+        if not self._receiving:
+            return
+        self.size += len(data)
+        _check_size(self.size, self.max_size)
+        self._digest.update(data)
+        if self._file is None and self.size <= self.memory_size:
+            self._data += data
+            return
+        self._spill()
+        self._file.write(data)
+
+    def end(self):
+        """
+        Finish the current part.
+        """
+        if self._receiving:
+            self._receiving = False
+            self._received = True
+
+    def run(self, body, boundary):
+        """
+        Parse a multipart body and store its file.
+
+        Args:
+            body (file): The body, as a buffered binary file.
+            boundary (bytes): The multipart boundary.
+
+        Returns:
+            tuple: The UploadResult, and the data of a file kept in memory
+            or None.
+
+        Raises:
+            HTTPException: 400 for a malformed body or one without the
+                file, 413 if the file exceeds ``max_size``.
+        """
+        try:
+            self._parse(body, boundary)
+            if not self._received:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"The upload has no '{self.field}' file")
+            if self._file is None and not self.memory_size:
+                self._spill()
+            digest = self._digest.hexdigest()
+            if self._file is None:
+                return (UploadResult(None, self.size, digest, self.filename),
+                        bytes(self._data))
+            self._file.close()
+            os.replace(f"{self._path}.part", self._path)
+            return (UploadResult(self._path, self.size, digest,
+                                 self.filename), None)
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+                _remove_quietly(f"{self._path}.part")
+            raise
+
+    def _spill(self):
+        """
+        Move the data kept in memory to the ``.part`` file, opening it.
+        """
+        if self._file is not None:
+            return
+        self._path = self.destination(self.filename)
+        self._file = open(f"{self._path}.part", "wb")
+        self._file.write(self._data)
+        self._data = bytearray()
+
+    def _parse(self, body, boundary):
+        headers = {}
+        header = [b"", b""]
+        ended = []
+
+        def on_header_field(data, start, end):
+            header[0] += data[start:end]
+
+        def on_header_value(data, start, end):
+            header[1] += data[start:end]
+
+        def on_header_end():
+            headers[header[0].lower()] = header[1]
+            header[:] = [b"", b""]
+
+        def on_headers_finished():
+            _, options = parse_options_header(
+                headers.pop(b"content-disposition", b""))
+            headers.clear()
+            filename = options.get(b"filename")
+            self.begin(options.get(b"name", b"").decode("utf-8", "replace"),
+                       None if filename is None
+                       else filename.decode("utf-8", "replace"))
+
+        def on_part_data(data, start, end):
+            self.write(data[start:end])
+
+        parser = multipart.MultipartParser(boundary, {
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": self.end,
+            "on_end": lambda: ended.append(True),
+        })
+        try:
+            while True:
+                data = body.read(CHUNK_SIZE)
+                if not data:
+                    break
+                parser.write(data)
+            parser.finalize()
+        except FormParserError as e:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid multipart body: {e}")
+        if not ended:
+            raise HTTPException(
+                status_code=400, detail="Truncated multipart body")
+
+
+def _check_size(size, max_size):
+    """
+    Refuse an upload over the size limit.
+
+    Args:
+        size (int): Size of the upload in bytes, or None if unknown.
+        max_size (int): Largest accepted size; 0 disables the limit.
+
+    Raises:
+        HTTPException: 413 if ``size`` exceeds ``max_size``.
+    """
+    if max_size and size is not None and size > max_size:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload exceeds the limit of {max_size} bytes")
+
+
+def _remove_quietly(path):
+    """
+    Remove a file, ignoring the error if it does not exist.
+
+    Args:
+        path (str): Path of the file to remove.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class BodyReader(io.RawIOBase):
+    """
+    A blocking, read-only file over the body of a request.
+
+    Lets parsers that read files, such as ``tarfile``, consume a request
+    body as it arrives. It must be used from a thread pool thread started
+    by the event loop of the request, e.g. through ``run_in_threadpool``;
+    each read waits for the next chunk of the body on that loop.
+
+    Attributes:
+        bytes_read (int): Number of body bytes received so far.
+    """
+
+    def __init__(self, request):
+        """
+        Initialize the BodyReader.
+
+        Args:
+            request (Request): The request whose body is read.
+        """
+        self._chunks = request.stream()
+        self._pending = memoryview(b"")
+        self._done = False
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._done:
+            self._pending = memoryview(
+                anyio.from_thread.run(self._next_chunk))
+            self.bytes_read += len(self._pending)
+            self._done = not self._pending
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+    async def _next_chunk(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware refusing uploads whose declared ``Content-Length`` is
+    over the limit, before their body is received.
+
+    Uploads without a length, such as chunked requests, or within
+    ``MULTIPART_OVERHEAD`` of the limit, are checked by ``UploadReceiver``
+    chunk by chunk as they arrive.
+    """
+
+    def __init__(self, app, max_size=MAX_UPLOAD_SIZE, exempt=()):
+        """
+        Initialize the UploadLimitMiddleware.
+
+        Args:
+            app: The ASGI application.
+            max_size (int): Largest accepted file size in bytes; 0
+                disables the limit.
+            exempt (tuple): Path prefixes whose bodies hold several files,
+                such as batches, and are not limited.
+        """
+        self.app = app
+        self.max_size = max_size
+        self.exempt = tuple(exempt)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and self.max_size
+                and not scope["path"].startswith(self.exempt)):
+            headers = dict(scope.get("headers") or [])
+            try:
+                length = int(headers.get(b"content-length", b""))
+            except ValueError:
+                length = None
+            if (length is not None
+                    and length > self.max_size + MULTIPART_OVERHEAD):
+                response = JSONResponse(
+                    {"detail": f"Upload exceeds the limit of "
+                               f"{self.max_size} bytes"},
+                    status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
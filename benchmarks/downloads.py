@@ -0,0 +1,158 @@
+"""
+Benchmark of the bytes transferred by repeat and resumed image downloads.
+
+Writes an output image and fetches it through the app, in process, the
+way a viewer refreshing it and a client resuming an interrupted download
+do:
+
+    plain: every refresh downloads the whole image again.
+    conditional: refreshes send If-None-Match and get ``304``.
+    versioned: the image is fetched by its version and kept by the client
+        as immutable, so refreshes make no request at all.
+    restart: an interrupted download starts over.
+    resume: an interrupted download continues with Range and If-Range.
+
+Reports the requests made, the body and header bytes transferred and the
+time taken for each.
+
+Usage:
+    python benchmarks/downloads.py [--size-mb 256] [--refreshes 10]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import uuid
+from time import perf_counter
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from app.main import app  # noqa: E402
+from app.storage import output_store  # noqa: E402
+
+
+class Transfer:
+    """
+    Counts the requests and bytes of a scenario.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+        self.body_bytes = 0
+        self.header_bytes = 0
+
+    async def get(self, url, headers=None, limit=None):
+        """
+        Fetch a URL, stopping after ``limit`` body bytes if given.
+
+        Returns:
+            tuple: The response and the body bytes received.
+        """
+        self.requests += 1
+        body = bytearray()
+        async with self.client.stream("GET", url, headers=headers) as response:
+            self.header_bytes += sum(
+                len(name) + len(value) + 4
+                for name, value in response.headers.raw)
+            async for chunk in response.aiter_raw():
+                body += chunk
+                if limit is not None and len(body) >= limit:
+                    del body[limit:]
+                    break
+        self.body_bytes += len(body)
+        return response, bytes(body)
+
+    def results(self, start):
+        return {"requests": self.requests,
+                "body_mb": round(self.body_bytes / 1024 ** 2, 3),
+                "header_bytes": self.header_bytes,
+                "seconds": round(perf_counter() - start, 3)}
+
+
+async def run(url, size, refreshes, interrupt):
+    """
+    Run every scenario against the image at ``url``.
+
+    Returns:
+        dict: The results of each scenario.
+    """
+    transport = httpx.ASGITransport(app=app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://bench") as client:
+        start = perf_counter()
+        transfer = Transfer(client)
+        for _ in range(refreshes + 1):
+            await transfer.get(url)
+        results["plain"] = transfer.results(start)
+
+        start = perf_counter()
+        transfer = Transfer(client)
+        response, _ = await transfer.get(url)
+        etag = response.headers["etag"]
+        for _ in range(refreshes):
+            response, _ = await transfer.get(
+                url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+        results["conditional"] = transfer.results(start)
+
+        start = perf_counter()
+        transfer = Transfer(client)
+        version = etag.strip('"')
+        response, _ = await transfer.get(f"{url}?version={version}")
+        assert "immutable" in response.headers["cache-control"]
+        results["versioned"] = transfer.results(start)
+
+        cut = int(size * interrupt)
+        start = perf_counter()
+        transfer = Transfer(client)
+        await transfer.get(url, limit=cut)
+        await transfer.get(url)
+        results["restart"] = transfer.results(start)
+
+        start = perf_counter()
+        transfer = Transfer(client)
+        _, head = await transfer.get(url, limit=cut)
+        response, tail = await transfer.get(
+            url, headers={"Range": f"bytes={len(head)}-", "If-Range": etag})
+        assert response.status_code == 206 and len(head + tail) == size
+        results["resume"] = transfer.results(start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size-mb", type=float, default=256,
+                        help="size of the output image")
+    parser.add_argument("--refreshes", type=int, default=10,
+                        help="times the viewer refreshes the image")
+    parser.add_argument("--interrupt", type=float, default=0.6,
+                        help="fraction of the image received before the "
+                             "download is interrupted")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    file_id = f"bench-{uuid.uuid4().hex}"
+    size = int(args.size_mb * 1024 ** 2)
+    path = output_store.path(file_id, create=True)
+    with open(path, "wb") as f:
+        f.truncate(size)
+    try:
+        results = asyncio.run(
+            run(f"/images/{file_id}", size, args.refreshes, args.interrupt))
+    finally:
+        os.remove(path)
+    print(json.dumps({"size_mb": args.size_mb, "refreshes": args.refreshes,
+                      "scenarios": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
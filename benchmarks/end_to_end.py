@@ -0,0 +1,444 @@
+"""
+End-to-end benchmark of the upload, Celery, codec and output path.
+
+The FastAPI app is driven in-process through httpx. Celery runs on an
+in-memory broker with a thread-pool worker in the same process, or eagerly
+inside each request with ``--eager``. Slurm submissions run in-process too:
+the codec call of each generated job script is executed directly, on the
+simulated GPUs of the mock codec. A job is complete when its task has
+finished writing the output.
+
+Load is closed-loop (``--clients`` clients each upload an image, wait for
+its output and upload the next) or open-loop (``--rate`` uploads per
+second with Poisson arrivals, whatever the latency). Uploads are synthetic
+JPEG2000 codestreams drawn from the ``--mix`` of image sizes, each with
+unique content so that the result cache does not serve them.
+
+Throughput, latency percentiles from the start of the upload to the output
+being written, and the peak RSS of the process are printed as JSON.
+``--output`` saves them as a baseline, and ``--baseline`` compares a run
+with one and exits with status 1 if any metric is worse by more than
+``--tolerance``.
+
+Usage:
+    python benchmarks/end_to_end.py --clients 8 --requests 200
+    python benchmarks/end_to_end.py --rate 20 --duration 10 \\
+        --mix 1024x1024:3,4096x4096:1 --throughput 400 --overhead 0.002
+    python benchmarks/end_to_end.py --output baseline.json
+    python benchmarks/end_to_end.py --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code run by a generated Slurm job script
+SCRIPT_CODE = re.compile(r'python -c "\n(.*?)\n"', re.S)
+
+# Metrics compared with a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "throughput": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def parse_mix(spec):
+    """
+    Parse an image size mix.
+
+    Args:
+        spec (str): Comma-separated WIDTHxHEIGHT:weight entries.
+
+    Returns:
+        list: (width, height, weight) tuples.
+    """
+    mix = []
+    for entry in spec.split(","):
+        size, _, weight = entry.partition(":")
+        width, height = (int(value) for value in size.lower().split("x"))
+        mix.append((width, height, float(weight or 1)))
+    return mix
+
+
+def make_codestream(width, height, compression_ratio=8, tile_size=1024,
+                    levels=5):
+    """
+    Build a JPEG2000 codestream of an 8-bit RGB image.
+
+    The main header is valid and the tile data is padding as large as the
+    image compressed at ``compression_ratio``, with a random nonce so that
+    every codestream is unique.
+
+    Returns:
+        bytes: The codestream.
+    """
+    siz = struct.pack(">HIIIIIIIIH", 0, width, height, 0, 0, tile_size,
+                      tile_size, 0, 0, 3) + b"\x07\x01\x01" * 3
+    cod = struct.pack(">BBHBBBBBB", 0, 0, 1, 1, levels, 4, 4, 0, 1)
+    header = (b"\xff\x4f"
+              + struct.pack(">HH", 0xFF51, len(siz) + 2) + siz
+              + struct.pack(">HH", 0xFF52, len(cod) + 2) + cod
+              + struct.pack(">HHHIBB", 0xFF90, 10, 0, 0, 0, 1)
+              + b"\xff\x93" + uuid.uuid4().bytes)
+    size = width * height * 3 // compression_ratio
+    return header + bytes(max(0, size - len(header)))
+
+
+def run_job_script(script_path, priority):
+    """
+    Run the codec call of a Slurm job script in this process.
+
+    Replaces ``submit_slurm_job``, so that the job is done when its task
+    returns.
+
+    Returns:
+        int: A job ID.
+    """
+    with open(script_path) as script_file:
+        code = SCRIPT_CODE.search(script_file.read()).group(1)
+    try:
+        exec(code.replace("\\\n", ""), {})
+    except Exception:
+        tracker.errors += 1
+        raise
+    return next(job_ids)
+
+
+class CompletionTracker:
+    """
+    Lets coroutines wait for Celery tasks finished by worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = {}
+        self.waiters = {}
+        self.errors = 0
+
+    def task_finished(self, task_id=None, state=None, **kwargs):
+        """
+        Record a finished task; connected to ``task_postrun``.
+        """
+        now = perf_counter()
+        if state != "SUCCESS":
+            self.errors += 1
+        with self.lock:
+            self.finished[task_id] = now
+            waiters = self.waiters.pop(task_id, [])
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, now)
+
+    async def wait(self, task_id):
+        """
+        Wait for a task to finish.
+
+        Returns:
+            float: The ``perf_counter`` time the task finished.
+        """
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if task_id in self.finished:
+                return self.finished[task_id]
+            future = loop.create_future()
+            self.waiters.setdefault(task_id, []).append((loop, future))
+        return await future
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+tracker = CompletionTracker()
+job_ids = itertools.count(1)
+
+
+def percentile(values, fraction):
+    """
+    Return a percentile of sorted values by linear interpolation.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (
+        position - lower)
+
+
+class LoadGenerator:
+    """
+    Uploads synthetic images to the app and times them until done.
+    """
+
+    def __init__(self, client, mix, seed=None, operation="decode"):
+        self.client = client
+        self.mix = mix
+        self.random = random.Random(seed)
+        self.operation = operation
+        self.latencies = []
+        self.statuses = {}
+
+    async def upload(self):
+        """
+        Upload one image and wait for its output.
+        """
+        width, height, _ = self.random.choices(
+            self.mix, weights=[weight for _, _, weight in self.mix])[0]
+        data = make_codestream(width, height)
+        start = perf_counter()
+        response = await self.client.post(
+            "/upload/", params={"operation": self.operation},
+            files={"file": (f"{width}x{height}.j2k", data,
+                            "application/octet-stream")})
+        status = str(response.status_code)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if response.status_code != 200:
+            return
+        task_id = response.json()["task_id"]
+        end = perf_counter() if task_id is None else (
+            await tracker.wait(task_id))
+        self.latencies.append(end - start)
+
+    async def closed_loop(self, clients, requests):
+        """
+        Run ``clients`` clients until ``requests`` uploads were made.
+        """
+        remaining = itertools.count(requests, -1)
+
+        async def client():
+            while next(remaining) > 0:
+                await self.upload()
+
+        await asyncio.gather(*(client() for _ in range(clients)))
+
+    async def open_loop(self, rate, duration, requests):
+        """
+        Start uploads at ``rate`` per second for ``duration`` seconds or
+        until ``requests`` uploads were started.
+        """
+        uploads = []
+        deadline = perf_counter() + duration
+        while perf_counter() < deadline and len(uploads) < requests:
+            uploads.append(asyncio.ensure_future(self.upload()))
+            await asyncio.sleep(self.random.expovariate(rate))
+        await asyncio.gather(*uploads)
+
+
+def configure_app(args):
+    """
+    Import the app with an in-memory broker and in-process Slurm jobs.
+
+    Must be called from the working directory of the run.
+
+    Returns:
+        FastAPI: The application.
+    """
+    os.environ.update({
+        "USE_MOCK_NVJPEG2000": "true",
+        "GPU_TELEMETRY_BACKEND": "stub",
+        "METRICS_DIR": "",
+        "COST_MODEL_DIR": "",
+        "TASK_STATUS_BACKEND": "memory",
+        "GPU_LEASE_BACKEND": "memory",
+        "RESULT_CACHE_DIR": "cache",
+        "IMAGE_INDEX_PATH": "image_index.db",
+        "SLURM_SUBMIT_MODE": "single",
+        "MICRO_BATCH_ENABLED": str(args.micro_batch).lower(),
+    })
+    sys.path.insert(0, ROOT)
+    from celery.signals import task_postrun
+
+    from app import mock_nvjpeg2000, tasks
+
+    mock_nvjpeg2000.configure_devices(
+        throughput=args.throughput, call_overhead=args.overhead,
+        memory=args.gpu_memory, jitter=args.jitter, seed=args.seed)
+    tasks.celery.conf.update(
+        broker_url="memory://",
+        result_backend="cache+memory://",
+        task_always_eager=args.eager,
+        broker_transport_options={
+            **tasks.celery.conf.broker_transport_options,
+            "polling_interval": 0.005,
+        })
+    tasks.submit_slurm_job = run_job_script
+    task_postrun.connect(tracker.task_finished, weak=False)
+
+    from app.main import app
+    return app
+
+
+async def run_load(app, args):
+    """
+    Drive the configured load against the app.
+
+    Returns:
+        tuple: The load generator and the wall time in seconds.
+    """
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport,
+                                 base_url="http://benchmark",
+                                 timeout=None) as client:
+        load = LoadGenerator(client, parse_mix(args.mix), args.seed,
+                             args.operation)
+        start = perf_counter()
+        if args.rate:
+            await load.open_loop(args.rate, args.duration, args.requests)
+        else:
+            await load.closed_loop(args.clients, args.requests)
+        return load, perf_counter() - start
+
+
+def summarize(load, elapsed, devices):
+    """
+    Compute the reported metrics of a run.
+    """
+    latencies = sorted(latency * 1000 for latency in load.latencies)
+    busy = [stats["busy_seconds"] for stats in devices.stats.values()]
+    return {
+        "completed": len(latencies),
+        "errors": tracker.errors,
+        "statuses": load.statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "latency_mean_ms": round(sum(latencies) / len(latencies), 2)
+        if latencies else None,
+        **{f"latency_p{int(q * 100)}_ms": (
+            None if not latencies else round(percentile(latencies, q), 2))
+           for q in (0.5, 0.9, 0.99)},
+        "latency_max_ms": round(latencies[-1], 2) if latencies else None,
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "gpu_utilization": round(sum(busy) / (len(busy) * elapsed), 3)
+        if busy else 0.0,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the metrics of a run with a baseline.
+
+    Returns:
+        tuple: A dict of baseline and current values and relative changes
+        per metric, and the list of metrics worse by more than
+        ``tolerance``.
+    """
+    comparison = {}
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline["results"].get(metric), results.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        comparison[metric] = {"baseline": old, "current": new,
+                              "change": round(change, 3)}
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(metric)
+    return comparison, regressions
+
+
+def git_commit():
+    """
+    Return the commit of the working tree, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=8,
+                        help="closed-loop clients")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="open-loop uploads per second")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds of open-loop load")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--mix", default="1024x1024:6,2048x2048:3,4096x4096:1",
+                        help="WIDTHxHEIGHT:weight image sizes")
+    parser.add_argument("--operation", default="decode",
+                        choices=("decode", "encode"))
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Celery worker threads")
+    parser.add_argument("--eager", action="store_true",
+                        help="run tasks inside the requests")
+    parser.add_argument("--micro-batch", action="store_true",
+                        help="submit uploads through the micro-batcher")
+    parser.add_argument("--throughput", default="400",
+                        help="simulated megapixels per second per GPU")
+    parser.add_argument("--overhead", type=float, default=0.002,
+                        help="simulated seconds per codec call")
+    parser.add_argument("--gpu-memory", type=int, default=0,
+                        help="simulated bytes of memory per GPU")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with this results file")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="end_to_end_")
+    os.chdir(workdir)
+    try:
+        app = configure_app(args)
+        from app import mock_nvjpeg2000
+        from app.tasks import celery
+
+        if args.eager:
+            load, elapsed = asyncio.run(run_load(app, args))
+        else:
+            from celery.contrib.testing.worker import start_worker
+            with start_worker(celery, concurrency=args.workers,
+                              pool="threads", perform_ping_check=False,
+                              loglevel="WARNING"):
+                load, elapsed = asyncio.run(run_load(app, args))
+        results = summarize(load, elapsed, mock_nvjpeg2000.devices)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "config": {name: value for name, value in vars(args).items()
+                   if name not in ("output", "baseline", "tolerance")},
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"], regressions = compare(
+                results, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
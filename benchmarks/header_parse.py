@@ -0,0 +1,95 @@
+"""
+Benchmark of JPEG2000 header parsing against reading whole files.
+
+For every JPEG2000 file in a directory, times ``parse_header`` and a full
+read of the file and counts the bytes each of them reads. Files that are
+not JPEG2000 images are skipped.
+
+Usage:
+    python benchmarks/header_parse.py [--directory test_images] [--repeat 200]
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.jp2 import InvalidHeaderError, parse_header  # noqa: E402
+
+
+class CountingReader(io.FileIO):
+    """
+    A binary file that counts the bytes read from it.
+    """
+
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def time_call(func, repeat):
+    """
+    Return the mean duration of a call in microseconds.
+    """
+    start = perf_counter()
+    for _ in range(repeat):
+        func()
+    return (perf_counter() - start) / repeat * 1e6
+
+
+def read_file(path):
+    """
+    Read a whole file, as a worker does before decoding it.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def parse_file(path):
+    """
+    Parse the header of a file.
+    """
+    with open(path, "rb") as f:
+        return parse_header(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--directory",
+                        default=os.path.join(ROOT, "test_images"))
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    results = []
+    for name in sorted(os.listdir(args.directory)):
+        path = os.path.join(args.directory, name)
+        with CountingReader(path) as f:
+            try:
+                header = parse_header(f)
+            except InvalidHeaderError:
+                continue
+            header_bytes = f.bytes_read
+        parse_us = time_call(lambda: parse_file(path), args.repeat)
+        read_us = time_call(lambda: read_file(path), args.repeat)
+        results.append({
+            "file": name,
+            "size": os.path.getsize(path),
+            "header_bytes_read": header_bytes,
+            "parse_us": round(parse_us, 1),
+            "full_read_us": round(read_us, 1),
+            "speedup": round(read_us / parse_us, 1),
+            "header": header._asdict(),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Memory benchmark of the input path of decode_image.
+
+Runs the same decode jobs in a fresh process with ``MMAP_INPUT`` off and on
+and reports the peak resident memory of each run. The mock codec's parse
+step is replaced by one that hashes the whole codestream, so every page of
+the input is touched as a real codec would.
+
+Memory-mapped inputs show up as shared, file-backed pages (``RssFile``)
+that the kernel can drop under pressure, whereas read inputs are private
+anonymous memory (``RssAnon``) held once per concurrent job. ``VmRSS``
+counts a mapped page once per mapping; ``Pss`` counts it once.
+
+Usage:
+    python benchmarks/mmap_rss.py --size-mb 512 --concurrency 4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_status():
+    """
+    Return the resident memory counters of this process in MiB.
+
+    Returns:
+        dict: VmRSS, RssAnon and RssFile from /proc/self/status, and Pss,
+        which counts a page mapped several times only once.
+    """
+    counters = {}
+    for path, names in (("/proc/self/status", ("VmRSS", "RssAnon", "RssFile")),
+                        ("/proc/self/smaps_rollup", ("Pss",))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name in names:
+                        counters[name] = int(value.split()[0]) / 1024
+        except OSError:
+            continue
+    return counters
+
+
+def run_child(path, jobs, concurrency, output_dir):
+    """
+    Decode the input ``jobs`` times and print the peak memory as JSON.
+
+    Args:
+        path (str): The input image.
+        jobs (int): Number of decode jobs.
+        concurrency (int): Number of jobs running at the same time.
+        output_dir (str): Where the outputs are written.
+    """
+    sys.path.insert(0, ROOT)
+    from app import mock_nvjpeg2000, tasks
+
+    peaks = {}
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency)
+    original_parse = mock_nvjpeg2000.nvjpeg2kStreamParse
+
+    def parse(handle, stream, data, length):
+        hashlib.sha256(data).digest()
+        # Sample while every concurrent job holds its input
+        barrier.wait()
+        with lock:
+            for name, value in read_status().items():
+                peaks[name] = max(peaks.get(name, 0), value)
+        barrier.wait()
+        return original_parse(handle, stream, data, length)
+
+    mock_nvjpeg2000.nvjpeg2kStreamParse = parse
+
+    def worker(worker_id):
+        for job in range(worker_id, jobs, concurrency):
+            output = os.path.join(output_dir, f"out_{job}.raw")
+            tasks.decode_image(path, output, worker_id)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    peaks["ru_maxrss"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({name: round(value, 1)
+                      for name, value in peaks.items()}))
+
+
+def measure(mmap_input, args, path, output_dir):
+    """
+    Run the jobs in a fresh interpreter with mmap on or off.
+
+    Returns:
+        dict: The peak memory counters of the child in MiB.
+    """
+    env = dict(os.environ, MMAP_INPUT="true" if mmap_input else "false",
+               METRICS_DIR="", USE_MOCK_NVJPEG2000="true")
+    result = subprocess.run(
+        [sys.executable, __file__, "--child", "--path", path,
+         "--jobs", str(args.jobs), "--concurrency", str(args.concurrency),
+         "--output-dir", output_dir],
+        env=env, cwd=ROOT, check=True, capture_output=True, text=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=256,
+                        help="size of the synthetic input file")
+    parser.add_argument("--path", help="use this input instead")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--output-dir")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.concurrency = max(1, min(args.concurrency, args.jobs))
+
+    if args.child:
+        run_child(args.path, args.jobs, args.concurrency, args.output_dir)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.path
+        if path is None:
+            path = os.path.join(workdir, "input.jp2")
+            chunk = os.urandom(1024 * 1024)
+            with open(path, "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(chunk)
+        results = {
+            "input_mb": round(os.path.getsize(path) / 1024 ** 2, 1),
+            "jobs": args.jobs,
+            "concurrency": args.concurrency,
+            "read": measure(False, args, path, workdir),
+            "mmap": measure(True, args, path, workdir),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
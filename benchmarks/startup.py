@@ -0,0 +1,100 @@
+"""
+Benchmark of the time taken to import the API and the worker tasks.
+
+Imports a module in fresh interpreters, the way the API process, a worker
+process and a test run start, and reports the import time, the threads
+left running by the import, whether Redis and the codec library were
+loaded, and the modules that took longest to import (from Python's
+``-X importtime``).
+
+Usage:
+    python benchmarks/startup.py [--module app.main] [--runs 10]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, threading, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "threads": [t.name for t in threading.enumerate()
+                if t is not threading.main_thread()],
+    "redis_loaded": "redis" in sys.modules,
+    "codec_loaded": "app.mock_nvjpeg2000" in sys.modules
+                    or "nvjpeg2000" in sys.modules,
+}}))
+"""
+
+
+def import_once(module, env, importtime=False):
+    """
+    Import a module in a fresh interpreter.
+
+    Returns:
+        tuple: The measurements printed by the child and its stderr.
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    result = subprocess.run(
+        command + ["-c", CHILD.format(module=module)], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, count):
+    """
+    Return the modules with the largest self time from ``-X importtime``.
+
+    Returns:
+        dict: Module names mapped to milliseconds, slowest first.
+    """
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        timings.append((name.strip(), int(self_us) / 1000))
+    timings.sort(key=lambda timing: -timing[1])
+    return {name: round(ms, 1) for name, ms in timings[:count]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--module", default="app.main",
+                        help="module to import, e.g. app.tasks")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="number of fresh interpreters")
+    parser.add_argument("--top", type=int, default=10,
+                        help="slowest modules listed")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT, METRICS_DIR="")
+    runs = [import_once(args.module, env)[0] for _ in range(args.runs)]
+    seconds = sorted(run["seconds"] for run in runs)
+    last, stderr = import_once(args.module, env, importtime=True)
+    print(json.dumps({
+        "module": args.module,
+        "runs": args.runs,
+        "median_ms": round(statistics.median(seconds) * 1000, 1),
+        "min_ms": round(seconds[0] * 1000, 1),
+        "max_ms": round(seconds[-1] * 1000, 1),
+        "threads": last["threads"],
+        "redis_loaded": last["redis_loaded"],
+        "codec_loaded": last["codec_loaded"],
+        "slowest_imports_ms": slowest_imports(stderr, args.top),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,33 @@
 import sys
 import os
 
+import pytest
+
 # Add the directory containing the `app` module to the Python path
-sys.path.insert(
-    0,
-    os.path.abspath(
-        os.path.join(
-            os.path.dirname(__file__),
-            '..')))
+ROOT = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        '..'))
+sys.path.insert(0, ROOT)
+
+# Share GPUs through leases kept in memory rather than in Redis
+os.environ.setdefault("GPU_LEASE_BACKEND", "memory")
+
+
+@pytest.fixture(autouse=True, scope="session")
+def work_dir(tmp_path_factory):
+    """
+    Run the tests in a temporary directory, so that the stores the
+    application keeps under relative paths (uploads/, output/, cache/, the
+    SQLite indexes, metrics and cost model snapshots, Slurm scripts) are
+    written there instead of in the repository.
+
+    The test images and the test helpers are linked into it.
+    """
+    path = tmp_path_factory.mktemp("work")
+    for name in ("test_images", "tests"):
+        os.symlink(os.path.join(ROOT, name), path / name)
+    previous = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(previous)
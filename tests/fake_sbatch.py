@@ -0,0 +1,46 @@
+"""
+Fake sbatch command for tests.
+
+Records each invocation as a JSON line in the file named by the
+FAKE_SBATCH_LOG environment variable, along with the #SBATCH directives
+of the submitted script, and prints a job ID like the real sbatch.
+
+Usage:
+    SBATCH_COMMAND="python tests/fake_sbatch.py" pytest
+"""
+
+import json
+import os
+import sys
+
+
+def main(argv):
+    """
+    Record a submission and print its job ID.
+
+    Args:
+        argv (list): The command line arguments passed to sbatch.
+    """
+    log_path = os.environ.get("FAKE_SBATCH_LOG", "fake_sbatch.log")
+    script_path = argv[-1]
+    with open(script_path) as script_file:
+        directives = [line.strip() for line in script_file
+                      if line.startswith("#SBATCH")]
+
+    if os.path.exists(log_path):
+        with open(log_path) as log_file:
+            job_id = 1000 + sum(1 for _ in log_file)
+    else:
+        job_id = 1000
+
+    with open(log_path, "a") as log_file:
+        log_file.write(json.dumps({
+            "job_id": job_id,
+            "args": argv,
+            "directives": directives,
+        }) + "\n")
+    print(f"Submitted batch job {job_id}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+"""
+Tests for the streamed ingest of image batches and their status.
+"""
+
+import io
+import os
+import tarfile
+import zipfile
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.batch_ingest import (
+    ArchiveError, BatchIngest, batch_status, iter_zip_entries)
+from app.main import app
+from app.task_status import MemoryStatusStore, TaskStatusHub
+
+client = TestClient(app)
+
+
+class Unseekable(io.RawIOBase):
+    """
+    A write-only stream, which makes zipfile write data descriptors.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def make_zip(entries, streamed=False):
+    """
+    Return a zip archive of (name, data, compression) entries.
+    """
+    target = Unseekable() if streamed else io.BytesIO()
+    with zipfile.ZipFile(target, "w") as archive:
+        for name, data, compression in entries:
+            archive.writestr(name, data, compress_type=compression)
+    return bytes(target.data if streamed else target.getvalue())
+
+
+def make_tar(entries):
+    """
+    Return a gzip-compressed tar archive of (name, data) entries.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, data in entries:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def remove_items(status):
+    """
+    Remove the uploaded files of the items of a batch.
+    """
+    for item in status["items"]:
+        if "input" in item and os.path.exists(item["input"]):
+            os.remove(item["input"])
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_zip_entries_are_read_in_order(streamed):
+    """
+    Test that stored and deflated zip entries are read from a stream, with
+    or without their sizes in the local headers.
+    """
+    entries = [("a.jp2", os.urandom(3000), zipfile.ZIP_STORED),
+               ("dir/", b"", zipfile.ZIP_STORED),
+               ("dir/b.jp2", b"b" * 100000, zipfile.ZIP_DEFLATED),
+               ("empty.jp2", b"", zipfile.ZIP_DEFLATED)]
+    if streamed:
+        entries = [entry for entry in entries
+                   if entry[2] == zipfile.ZIP_DEFLATED]
+    body = io.BufferedReader(io.BytesIO(make_zip(entries, streamed)), 4096)
+    read = [(name, b"".join(iter(lambda: entry.read(1000), b"")))
+            for name, entry in iter_zip_entries(body)]
+    assert read == [(name, data) for name, data, _ in entries]
+
+
+def test_corrupt_zip_entry_is_detected():
+    """
+    Test that an entry whose CRC does not match its data is refused.
+    """
+    data = bytearray(make_zip([("a.jp2", b"abc" * 10, zipfile.ZIP_STORED)]))
+    data[30 + len("a.jp2")] ^= 0xFF
+    with pytest.raises(ArchiveError, match="CRC"):
+        for _, entry in iter_zip_entries(io.BytesIO(bytes(data))):
+            entry.read()
+
+
+def test_ingest_dispatches_groups_and_reports_progress():
+    """
+    Test that entries are dispatched in groups as they are read and that
+    the batch status aggregates the states of their tasks.
+    """
+    store = MemoryStatusStore()
+    dispatched = []
+
+    def dispatch(jobs):
+        dispatched.append([job["input_image"] for job in jobs])
+        return [f"task-{len(dispatched)}"] * len(jobs)
+
+    body = make_tar([(f"images/{i}.jp2", b"x" * 10) for i in range(5)]
+                    + [("images/.hidden", b"x"), ("big.jp2", b"x" * 100)])
+    ingest = BatchIngest("b", "decode", 0, dispatch, store=store,
+                         group_size=2, max_size=50)
+    ingest.run(io.BufferedReader(io.BytesIO(body)), "tar")
+    assert (ingest.total, ingest.rejected) == (6, 1)
+    assert [len(group) for group in dispatched] == [2, 2, 1]
+
+    status = batch_status("b", store)
+    assert status["state"] == "RUNNING"
+    assert status["progress"] == {"PENDING": 5, "FAILURE": 1}
+    assert "exceeds" in status["items"][-1]["error"]
+    with open(status["items"][0]["input"], "rb") as f:
+        assert f.read() == b"x" * 10
+
+    store.update("task-1", {"state": "SUCCESS"})
+    store.update("task-2", {"state": "FAILURE", "error": "boom"})
+    store.update("task-3", {"state": "STARTED"})
+    status = batch_status("b", store)
+    assert status["progress"] == {"SUCCESS": 2, "FAILURE": 3, "STARTED": 1}
+    store.update("task-3", {"state": "SUCCESS"})
+    status = batch_status("b", store)
+    assert (status["state"], status["completed"], status["failed"]) == (
+        "FAILURE", 6, 3)
+    assert status["items"][2]["error"] == "boom"
+    remove_items(status)
+
+
+def test_batches_endpoint():
+    """
+    Test batch submission as multipart files and as a zip archive.
+    """
+    hub = TaskStatusHub(MemoryStatusStore())
+    with mock.patch("app.main.hub", hub), \
+            mock.patch("app.main.dispatch_batch",
+                       side_effect=lambda jobs: ["t"] * len(jobs)):
+        response = client.post(
+            "/batches/", files=[("files", (f"{i}.jp2", b"data %d" % i))
+                                for i in range(3)])
+        assert response.status_code == 202
+        assert response.json()["items"] == 3
+        status = client.get(f"/batches/{response.json()['batch_id']}").json()
+        assert status["state"] == "RUNNING"
+        assert [item["name"] for item in status["items"]] == [
+            "0.jp2", "1.jp2", "2.jp2"]
+        remove_items(status)
+
+        body = make_zip([("a.jp2", b"a", zipfile.ZIP_DEFLATED)])
+        response = client.post(
+            "/batches/", params={"operation": "encode"}, content=body,
+            headers={"Content-Type": "application/zip"})
+        assert response.json()["items"] == 1
+        batch_id = response.json()["batch_id"]
+        hub.store.update("t", {"state": "SUCCESS"})
+        status = client.get(f"/batches/{batch_id}").json()
+        assert (status["state"], status["operation"]) == ("SUCCESS", "encode")
+        remove_items(status)
+
+        response = client.post(
+            "/batches/", content=body[:40],
+            headers={"Content-Type": "application/zip"})
+        assert response.status_code == 400
+        assert response.json()["batch_id"]
+        assert client.post(
+            "/batches/", content=b"x",
+            headers={"Content-Type": "text/plain"}).status_code == 415
+        assert client.get("/batches/missing").status_code == 404
@@ -2,8 +2,13 @@
 Tests for the batch_processor module.
 """
 
-from app.batch_processor import process_batch
+from app import batch_processor, task_status
+from app.batch_processor import BatchJobError, process_batch, run_pipeline
+from app.task_status import MemoryStatusStore
+from unittest import mock
 import os
+import pytest
+import threading
 
 
 def test_process_batch():
@@ -29,3 +34,88 @@ def test_process_batch():
 
     results = process_batch(jobs)
     assert all(os.path.exists(job['output_image']) for job in jobs)
+
+
+def make_jobs(count):
+    """
+    Build decode jobs over the sample images.
+    """
+    os.makedirs("output", exist_ok=True)
+    return [
+        {
+            "input_image": "test_images/sample1.jp2",
+            "output_image": f"output/pipeline_{i}.raw",
+            "operation": "decode"
+        }
+        for i in range(count)
+    ]
+
+
+def test_run_pipeline_prefetches_next_input():
+    """
+    Test that the next input is read while the current job is on the GPU.
+    """
+    jobs = make_jobs(3)
+    second_read = threading.Event()
+    read_input = batch_processor.read_input
+
+    def tracking_read(path):
+        data = read_input(path)
+        if tracking_read.calls == 1:
+            second_read.set()
+        tracking_read.calls += 1
+        return data
+    tracking_read.calls = 0
+
+    def slow_process(operation, image_data, gpu_id, *options):
+        # The first job only finishes once the second input has been read
+        assert second_read.wait(timeout=5)
+        return b"decoded"
+
+    with mock.patch("app.batch_processor.read_input", tracking_read), \
+            mock.patch("app.batch_processor.process_data", slow_process):
+        results, timings = run_pipeline(jobs, 0, depth=1)
+
+    assert results == [
+        "Job test_images/sample1.jp2 completed successfully"] * 3
+    assert set(timings) == {"read", "codec", "write", "total"}
+    for job in jobs:
+        with open(job["output_image"], "rb") as f:
+            assert f.read() == b"decoded"
+
+
+def test_run_pipeline_keeps_going_after_a_job_fails():
+    """
+    Test that a job failing in a stage does not stop the other jobs, and
+    that the failures are raised together at the end.
+    """
+    jobs = make_jobs(4)
+    for job in jobs:
+        if os.path.exists(job["output_image"]):
+            os.remove(job["output_image"])
+    jobs[1]["input_image"] = "test_images/missing.jp2"
+
+    with pytest.raises(BatchJobError) as excinfo:
+        run_pipeline(jobs, 0, depth=1)
+    assert set(excinfo.value.errors) == {1}
+    assert isinstance(excinfo.value.errors[1], FileNotFoundError)
+    assert "missing.jp2" in str(excinfo.value)
+    assert [os.path.exists(job["output_image"]) for job in jobs] == [
+        True, False, True, True]
+
+
+def test_failed_batch_fails_its_task():
+    """
+    Test that a batch with a failed job fails its task and records the
+    error of the job, instead of returning it as a successful result.
+    """
+    jobs = make_jobs(2)
+    jobs[0]["input_image"] = "test_images/missing.jp2"
+    store = MemoryStatusStore()
+    with mock.patch.object(task_status, "status_store", store):
+        result = process_batch.apply((jobs,), task_id="batch-1")
+    assert result.failed()
+    status = store.get("batch-1")
+    assert status["state"] == "FAILURE"
+    assert status["outputs"] == [jobs[1]["output_image"]]
+    assert list(status["job_errors"]) == [jobs[0]["output_image"]]
@@ -0,0 +1,81 @@
+"""
+Tests for the micro-batching module.
+"""
+
+from app.batching import MicroBatcher
+import asyncio
+
+
+def make_job(operation, index):
+    """
+    Build a job dictionary for the tests.
+    """
+    return {
+        "input_image": f"uploads/{index}.jp2",
+        "output_image": f"output/{index}.raw",
+        "operation": operation,
+    }
+
+
+def test_flush_on_max_batch_size():
+    """
+    Test that a full batch is dispatched without waiting for the linger.
+    """
+    batches = []
+
+    def dispatch(jobs):
+        batches.append(jobs)
+        return f"batch-{len(batches)}"
+
+    async def run():
+        batcher = MicroBatcher(dispatch, max_batch_size=4, max_linger=60)
+        return batcher, await asyncio.wait_for(asyncio.gather(
+            *(batcher.submit(make_job("decode", i)) for i in range(4))), 5)
+
+    batcher, task_ids = asyncio.run(run())
+    assert task_ids == ["batch-1"] * 4
+    assert [len(batch) for batch in batches] == [4]
+    assert batcher.stats()["fill_ratio"] == 1.0
+
+
+def test_flush_on_linger_per_operation():
+    """
+    Test that partial batches are flushed after the linger time and that
+    operations are batched separately.
+    """
+    batches = []
+
+    def dispatch(jobs):
+        batches.append(jobs)
+        return jobs[0]["operation"]
+
+    async def run():
+        batcher = MicroBatcher(dispatch, max_batch_size=8, max_linger=0.01)
+        results = await asyncio.gather(
+            batcher.submit(make_job("decode", 0)),
+            batcher.submit(make_job("encode", 1)),
+            batcher.submit(make_job("decode", 2)))
+        return batcher, results
+
+    batcher, results = asyncio.run(run())
+    assert results == ["decode", "encode", "decode"]
+    assert sorted(len(batch) for batch in batches) == [1, 2]
+    stats = batcher.stats()
+    assert stats["batches"] == 2
+    assert stats["fill_ratio"] == 1.5 / 8
+
+
+def test_dispatch_per_job_task_ids():
+    """
+    Test that a dispatch splitting a batch resolves each job to its task.
+    """
+    def dispatch(jobs):
+        return [f"task-{job['input_image']}" for job in jobs]
+
+    async def run():
+        batcher = MicroBatcher(dispatch, max_batch_size=2, max_linger=60)
+        return await asyncio.wait_for(asyncio.gather(
+            *(batcher.submit(make_job("decode", i)) for i in range(2))), 5)
+
+    assert asyncio.run(run()) == [
+        "task-uploads/0.jp2", "task-uploads/1.jp2"]
@@ -0,0 +1,84 @@
+"""
+Tests for the result cache module.
+"""
+
+from app.cache import ResultCache, make_cache_key
+import os
+
+
+def write_file(path, size):
+    """
+    Write a file of the given size and return its path.
+    """
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return str(path)
+
+
+def test_make_cache_key():
+    """
+    Test that cache keys depend on the digest, operation and parameters.
+    """
+    key = make_cache_key("abc", "decode")
+    assert key == make_cache_key("abc", "decode", {})
+    assert key != make_cache_key("abc", "encode")
+    assert key != make_cache_key("abd", "decode")
+    assert key != make_cache_key("abc", "decode", {"reduce": 1})
+
+
+def test_put_get_and_materialize(tmp_path):
+    """
+    Test storing a result and materializing it at another path.
+    """
+    cache = ResultCache(root=str(tmp_path / "cache"), max_bytes=1024)
+    source = write_file(tmp_path / "output.raw", 100)
+    key = make_cache_key("abc", "decode")
+
+    assert cache.get(key) is None
+    cache.put(key, source)
+    assert cache.get(key) == cache.path_for(key)
+
+    destination = str(tmp_path / "copy.raw")
+    assert cache.materialize(key, destination)
+    assert os.path.getsize(destination) == 100
+
+    # A new process adopts entries written by another one
+    other = ResultCache(root=str(tmp_path / "cache"), max_bytes=1024)
+    assert other.get(key) == cache.path_for(key)
+
+
+def test_lru_eviction(tmp_path):
+    """
+    Test that least recently used entries are evicted when over budget.
+    """
+    cache = ResultCache(root=str(tmp_path / "cache"), max_bytes=250)
+    keys = [make_cache_key(str(i), "decode") for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.put(key, write_file(tmp_path / f"{i}.raw", 100))
+
+    cache.get(keys[0])
+    cache.put(keys[2], write_file(tmp_path / "2.raw", 100))
+
+    assert keys[1] not in cache
+    assert not os.path.exists(cache.path_for(keys[1]))
+    assert cache.total_bytes == 200
+    assert not cache.materialize(keys[1], str(tmp_path / "gone.raw"))
+
+
+def test_eviction_bound_is_shared(tmp_path):
+    """
+    Test that caches of several processes on one directory keep the
+    directory as a whole within the bound.
+    """
+    root = str(tmp_path / "cache")
+    first = ResultCache(root=root, max_bytes=250)
+    second = ResultCache(root=root, max_bytes=250)
+    keys = [make_cache_key(str(i), "decode") for i in range(4)]
+    for i, key in enumerate(keys):
+        cache = first if i % 2 else second
+        cache.put(key, write_file(tmp_path / f"{i}.raw", 100))
+
+    assert first.total_bytes == second.total_bytes == 200
+    stored = [key for key in keys if os.path.exists(first.path_for(key))]
+    assert stored == keys[2:]
+    assert second.get(keys[0]) is None
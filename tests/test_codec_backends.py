@@ -0,0 +1,82 @@
+"""
+Tests for the codec backend registry and the cost of importing the app.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app import mock_nvjpeg2000
+from app.celery_app import create_celery
+from app.codec_backends import CodecRegistry
+from app.codec_pool import CodecPoolManager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_backends_load_on_first_use():
+    """
+    Test that a backend is imported when it is first requested, once.
+    """
+    registry = CodecRegistry(default="mock")
+    registry.register("mock", "app.mock_nvjpeg2000")
+    registry.register("missing", "app.no_such_codec")
+    assert registry.loaded() == []
+
+    assert registry.get() is mock_nvjpeg2000
+    assert registry.get("mock") is mock_nvjpeg2000
+    assert registry.loaded() == ["mock"]
+    with pytest.raises(ImportError):
+        registry.get("missing")
+    with pytest.raises(ValueError):
+        registry.get("other")
+
+
+def test_codec_pools_load_the_default_backend():
+    """
+    Test that codec pools only load the backend when a job checks out a
+    context.
+    """
+    pools = CodecPoolManager()
+    assert pools._codec is None
+    with pools.checkout(0) as codec:
+        assert codec.codec is mock_nvjpeg2000
+    pools.close()
+
+
+def test_celery_settings_are_read_from_the_config():
+    """
+    Test that the Celery app takes its settings from the config module and
+    keeps the priority queues.
+    """
+    class Config:
+        broker_url = "memory://"
+        task_default_priority = 3
+
+    celery = create_celery(config=Config)
+    assert not celery.configured
+    assert celery.conf.broker_url == "memory://"
+    assert celery.conf.task_default_priority == 3
+    assert celery.conf.task_default_queue == "images.default"
+
+
+def test_importing_the_app_has_no_side_effects(tmp_path):
+    """
+    Test that importing the API starts no thread, loads neither Redis nor
+    a codec, and writes nothing to the working directory.
+    """
+    script = (
+        "import json, sys, threading\n"
+        "import app.main\n"
+        "print(json.dumps([len(threading.enumerate()),\n"
+        "                  'redis' in sys.modules,\n"
+        "                  'app.mock_nvjpeg2000' in sys.modules]))\n")
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env,
+        capture_output=True, text=True, check=True)
+    assert json.loads(result.stdout) == [1, False, False]
+    assert os.listdir(tmp_path) == []
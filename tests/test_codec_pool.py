@@ -0,0 +1,49 @@
+"""
+Tests for the codec pool module.
+"""
+
+from app import mock_nvjpeg2000
+from app.codec_pool import CodecPoolManager
+import pytest
+
+
+def test_checkout_reuses_contexts():
+    """
+    Test that handles, states and streams are created once and reused.
+    """
+    mock_nvjpeg2000.reset_call_counts()
+    pools = CodecPoolManager(mock_nvjpeg2000)
+
+    for _ in range(5):
+        with pools.checkout(0) as codec:
+            assert codec.decode_state is codec.decode_state
+    with pools.checkout(1) as codec:
+        codec.encode_state
+
+    counts = mock_nvjpeg2000.call_counts
+    assert counts["nvjpeg2kCreate"] == 2
+    assert counts["nvjpeg2kStreamCreate"] == 2
+    assert counts["nvjpeg2kDecodeStateCreate"] == 1
+    assert counts["nvjpeg2kEncodeStateCreate"] == 1
+
+    pools.close()
+    assert counts["nvjpeg2kDestroy"] == 2
+    assert counts["nvjpeg2kStreamDestroy"] == 2
+    assert counts["nvjpeg2kDecodeStateDestroy"] == 1
+    assert counts["nvjpeg2kEncodeStateDestroy"] == 1
+
+
+def test_failed_job_context_is_destroyed():
+    """
+    Test that a context whose job raised is not returned to the pool.
+    """
+    mock_nvjpeg2000.reset_call_counts()
+    pools = CodecPoolManager(mock_nvjpeg2000)
+
+    with pytest.raises(RuntimeError):
+        with pools.checkout(0):
+            raise RuntimeError("decode failed")
+
+    assert mock_nvjpeg2000.call_counts["nvjpeg2kStreamDestroy"] == 1
+    assert len(pools.pool(0).idle) == 0
+    pools.close()
@@ -0,0 +1,138 @@
+"""
+Tests for the CPU codec backend and the hybrid GPU/CPU dispatch.
+"""
+
+import os
+from unittest import mock
+
+import pytest
+
+from app import cpu_codec, task_status, tasks
+from app.codec_pool import CPU_DEVICE, codec_pools
+from app.gpu_manager import GPUManager
+from app.metrics import registry
+from app.scheduler import CostModel, JobScheduler
+from app.task_status import MemoryStatusStore
+
+pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+
+
+@pytest.fixture
+def rgb_image(tmp_path):
+    """
+    Write a small RGB image as PNG.
+    """
+    path = tmp_path / "input.png"
+    Image.new("RGB", (64, 48), (10, 20, 30)).save(path)
+    return str(path)
+
+
+def test_cpu_round_trip(rgb_image, tmp_path):
+    """
+    Test that the CPU codec encodes an image and decodes a reduced region
+    of it.
+    """
+    encoded = str(tmp_path / "encoded.jp2")
+    decoded = str(tmp_path / "decoded.raw")
+    tasks.encode_image(rgb_image, encoded, CPU_DEVICE)
+    with Image.open(encoded) as image:
+        assert image.size == (64, 48)
+
+    tasks.decode_image(encoded, decoded, CPU_DEVICE, reduce=1,
+                       region=(0, 0, 32, 32))
+    with open(decoded, "rb") as f:
+        samples = f.read()
+    # A 16x16 window of the half-resolution level, 3 bytes per pixel
+    assert len(samples) == 16 * 16 * 3
+    assert samples[:3] == bytes((10, 20, 30))
+    codec_pools.close()
+
+
+def test_codec_throughput_is_recorded(rgb_image, tmp_path):
+    """
+    Test that codec calls record their throughput by backend.
+    """
+    tasks.encode_image(rgb_image, str(tmp_path / "out.jp2"), CPU_DEVICE)
+    codec_pools.close()
+    text = registry.render()
+    assert ('image_codec_throughput_megapixels_per_second_count'
+            '{backend="cpu",operation="encode"}') in text
+
+
+def test_expected_wait():
+    """
+    Test that the expected wait is zero while a GPU is free and grows with
+    the time left on the held GPUs.
+    """
+    manager = GPUManager(num_gpus=2)
+    assert manager.expected_wait() == 0.0
+    manager.allocate_gpu(cost=4.0)
+    assert manager.expected_wait() == 0.0
+    manager.allocate_gpu(cost=2.0)
+    assert 2.5 < manager.expected_wait() <= 3.0
+    manager.close()
+
+
+def test_busy_gpus_send_jobs_to_the_cpu():
+    """
+    Test that a job goes to the CPU only when waiting for a GPU would take
+    longer than the CPU codec.
+    """
+    scheduler = JobScheduler(CostModel(directory=""))
+    job = {"operation": "decode", "work": 10 ** 6, "cost": 0.01}
+    cpu_time = scheduler.cpu_cost("decode", job["work"])
+    assert not scheduler.prefer_cpu([job], 0.0)
+    assert scheduler.prefer_cpu([job], cpu_time)
+    assert not scheduler.prefer_cpu([dict(job, work=None)], cpu_time)
+
+
+def test_process_image_runs_on_the_cpu(rgb_image, tmp_path):
+    """
+    Test that process_image runs the job in the worker on the CPU when the
+    GPUs are busy, without submitting it to Slurm.
+    """
+    output = str(tmp_path / "out.jp2")
+    with mock.patch.object(tasks.gpu_manager, "expected_wait",
+                           return_value=60.0), \
+            mock.patch.object(tasks, "submit_slurm_job") as submit:
+        message = tasks.process_image(rgb_image, output, "encode",
+                                      cost=0.01, work=64 * 48 * 3)
+    codec_pools.close()
+    assert message.startswith("Processed on the CPU")
+    submit.assert_not_called()
+    with Image.open(output) as image:
+        assert image.size == (64, 48)
+
+
+def test_cpu_failure_is_raised(tmp_path):
+    """
+    Test that a job failing on the CPU is recorded as failed and raised,
+    instead of returned as the message of a successful task.
+    """
+    store = MemoryStatusStore()
+    job = {"operation": "decode", "work": 10 ** 6}
+    with mock.patch.object(task_status, "status_store", store), \
+            pytest.raises(FileNotFoundError):
+        tasks.run_on_cpu(job, str(tmp_path / "missing.jp2"),
+                         str(tmp_path / "out.raw"), task_id="task-1")
+    assert store.get("task-1")["state"] == "FAILURE"
+
+
+def test_pool_is_sized_per_node(monkeypatch):
+    """
+    Test that the cores of a node are shared between the worker processes
+    running jobs on it.
+    """
+    monkeypatch.setattr(cpu_codec, "CPU_CODEC_WORKERS", 0)
+    monkeypatch.setattr(cpu_codec.os, "cpu_count", lambda: 16)
+    monkeypatch.setenv("CPU_CODEC_NODE_PROCESSES", "4")
+    assert cpu_codec.pool_size() == 4
+    monkeypatch.setenv("CPU_CODEC_NODE_PROCESSES", "32")
+    assert cpu_codec.pool_size() == 1
+    monkeypatch.setattr(cpu_codec, "CPU_CODEC_WORKERS", 3)
+    assert cpu_codec.pool_size() == 3
+
+    monkeypatch.delenv("CPU_CODEC_NODE_PROCESSES")
+    tasks.share_cpu_cores(sender=mock.Mock(concurrency=8))
+    assert os.environ.pop("CPU_CODEC_NODE_PROCESSES") == "8"
@@ -0,0 +1,164 @@
+"""
+Tests for serving output images with validators and byte ranges.
+"""
+
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.downloads import FileDownload, RangeNotSatisfiable, parse_ranges
+from app.main import app
+from app.storage import output_store
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def output_image(tmp_path):
+    """
+    Write an output image and yield its file ID and content.
+    """
+    file_id = f"{tmp_path.name}.raw"
+    content = bytes(range(256)) * 40
+    path = output_store.path(file_id, create=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    yield file_id, content
+    os.remove(path)
+
+
+def test_parse_ranges():
+    """
+    Test that ranges are clipped, merged, and ignored when malformed.
+    """
+    assert parse_ranges("bytes=0-99", 1000) == [(0, 100)]
+    assert parse_ranges("bytes=900-", 1000) == [(900, 1000)]
+    assert parse_ranges("bytes=-100,0-0", 1000) == [(0, 1), (900, 1000)]
+    assert parse_ranges("bytes=0-99,50-149,150-199", 1000) == [(0, 200)]
+    assert parse_ranges("bytes=990-2000", 1000) == [(990, 1000)]
+    assert parse_ranges("bytes=5-1", 1000) is None
+    assert parse_ranges("items=0-1", 1000) is None
+    assert parse_ranges("bytes=" + ",".join(["0-1"] * 101), 1000) is None
+    with pytest.raises(RangeNotSatisfiable):
+        parse_ranges("bytes=1000-", 1000)
+
+
+def test_conditional_get(output_image):
+    """
+    Test that a revalidated image is answered with 304 and no body.
+    """
+    file_id, content = output_image
+    response = client.get(f"/images/{file_id}")
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["cache-control"] == "no-cache"
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+
+    response = client.get(f"/images/{file_id}",
+                          headers={"If-None-Match": f'W/"x", {etag}'})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert client.get(
+        f"/images/{file_id}",
+        headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get(
+        f"/images/{file_id}",
+        headers={"If-None-Match": '"other"',
+                 "If-Modified-Since": last_modified}).status_code == 200
+
+    # Replacing the image changes its ETag
+    path = output_store.path(file_id)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(b"new")
+    os.replace(f"{path}.tmp", path)
+    response = client.get(f"/images/{file_id}",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.content == b"new"
+
+
+def test_versioned_image_is_immutable(output_image):
+    """
+    Test that an image requested by its version may be cached for good.
+    """
+    file_id, content = output_image
+    version = client.get(f"/images/{file_id}").headers["etag"].strip('"')
+    response = client.get(f"/images/{file_id}", params={"version": version})
+    assert response.content == content
+    assert "immutable" in response.headers["cache-control"]
+    assert client.get(f"/images/{file_id}",
+                      params={"version": "stale"}).status_code == 404
+
+
+def test_range_requests(output_image):
+    """
+    Test single, multiple, conditional and unsatisfiable ranges.
+    """
+    file_id, content = output_image
+    size = len(content)
+    response = client.get(f"/images/{file_id}",
+                          headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+    assert response.headers["content-range"] == f"bytes 100-199/{size}"
+    etag = response.headers["etag"]
+
+    # Resuming with a current If-Range gets the rest, a stale one all
+    response = client.get(f"/images/{file_id}",
+                          headers={"Range": "bytes=6000-", "If-Range": etag})
+    assert response.content == content[6000:]
+    response = client.get(f"/images/{file_id}",
+                          headers={"Range": "bytes=6000-", "If-Range": '"x"'})
+    assert response.status_code == 200
+    assert response.content == content
+
+    response = client.get(f"/images/{file_id}",
+                          headers={"Range": "bytes=0-9,-10"})
+    assert response.status_code == 206
+    boundary = response.headers["content-type"].split("boundary=")[1]
+    assert int(response.headers["content-length"]) == len(response.content)
+    parts = response.content.split(f"--{boundary}".encode())
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + content[:10] + b"\r\n")
+    assert f"Content-Range: bytes 0-9/{size}".encode() in parts[1]
+    assert parts[2].endswith(b"\r\n\r\n" + content[-10:] + b"\r\n")
+
+    response = client.get(f"/images/{file_id}",
+                          headers={"Range": f"bytes={size}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{size}"
+
+
+def test_server_sends_the_file(output_image):
+    """
+    Test that the file is handed to servers offering the sendfile
+    extensions instead of being read by the app.
+    """
+    file_id, content = output_image
+    path = output_store.path(file_id)
+
+    def call(extensions, range_header=None):
+        headers = [(b"range", range_header.encode())] if range_header else []
+        scope = {"type": "http", "method": "GET", "headers": headers,
+                 "extensions": extensions}
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(FileDownload(path)(scope, None, send))
+        return messages
+
+    messages = call({"http.response.pathsend": {}})
+    assert messages[-1] == {"type": "http.response.pathsend",
+                            "path": os.path.abspath(path)}
+
+    messages = call({"http.response.zerocopysend": {}}, "bytes=10-19,-5")
+    sends = [(m["offset"], m["count"], m["more_body"]) for m in messages
+             if m["type"] == "http.response.zerocopysend"]
+    assert sends == [(10, 10, True), (len(content) - 5, 5, True)]
+    assert not messages[-1]["more_body"]
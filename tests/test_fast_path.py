@@ -0,0 +1,151 @@
+"""
+Tests for the payload stores and the in-memory fast path.
+"""
+
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import fast_path, task_status
+from app.batch_processor import process_data
+from app.main import app
+from app.payloads import (
+    MemoryPayloadStore, RedisPayloadStore, input_key, output_key)
+from app.storage import upload_store
+from app.task_status import MemoryStatusStore
+
+client = TestClient(app)
+
+
+class FakeRedis:
+    """
+    The Redis commands used by RedisPayloadStore, kept in a dict.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+def test_redis_payloads_are_compressed():
+    """
+    Test that payloads are stored compressed and read back intact.
+    """
+    redis = FakeRedis()
+    store = RedisPayloadStore(client=redis)
+    data = b"tile" * 10_000
+    store.put("payload:a:input", data)
+    assert len(redis.values["payload:a:input"]) < len(data) // 10
+    assert store.get("payload:a:input") == data
+
+    raw = RedisPayloadStore(level=0, client=redis)
+    raw.put("payload:b:input", data)
+    assert store.get("payload:b:input") == data
+    store.delete("payload:a:input", "payload:b:input")
+    assert store.get("payload:a:input") is None
+
+
+def test_memory_payloads_expire():
+    """
+    Test that payloads are dropped once their TTL has passed.
+    """
+    store = MemoryPayloadStore(ttl=0)
+    store.put("payload:a:input", b"data")
+    assert store.get("payload:a:input") is None
+
+
+def test_small_upload_skips_the_disk():
+    """
+    Test that a small upload is processed from the payload store and its
+    output served from it, with nothing written to the upload directory.
+    """
+    store = MemoryPayloadStore()
+
+    def run_task(args, kwargs):
+        fast_path.process_payload(*args, **kwargs)
+        return mock.Mock(id="task-1")
+
+    with open("test_images/sample1.jp2", "rb") as f:
+        image = f.read()
+    with mock.patch("app.main.FAST_PATH_MAX_BYTES", len(image)), \
+            mock.patch("app.main.payload_store", store), \
+            mock.patch.object(fast_path, "payload_store", store), \
+            mock.patch.object(task_status, "status_store",
+                              MemoryStatusStore()), \
+            mock.patch("app.main.process_payload.apply_async",
+                       side_effect=run_task):
+        response = client.post(
+            "/upload/", files={"file": ("a.jp2", image)})
+        body = response.json()
+        assert body["in_memory"] is True
+        assert body["image"]["width"] == 2717
+        file_id = body["file_id"]
+        assert upload_store.find(file_id) is None
+        assert store.get(output_key(file_id)) == process_data(
+            "decode", image, 0)
+
+        output = client.get(f"/images/{file_id}")
+        assert output.status_code == 200
+        assert output.content == store.get(output_key(file_id))
+
+        # The input is not kept, so no variant can be decoded from it
+        variant = client.get(f"/images/{file_id}", params={"reduce": 1})
+        assert variant.status_code == 404
+        assert "kept in memory" in variant.json()["detail"]
+
+        client.delete(f"/images/{file_id}")
+        assert store.get(output_key(file_id)) is None
+
+
+def test_inline_upload_returns_the_output():
+    """
+    Test that an inline upload is processed in the API process and its
+    output returned in the response, and that inline uploads over the
+    fast path limit are rejected.
+    """
+    with open("test_images/sample1.jp2", "rb") as f:
+        image = f.read()
+    with mock.patch("app.main.FAST_PATH_MAX_BYTES", len(image)), \
+            mock.patch("app.main.process_payload.apply_async") as apply:
+        response = client.post(
+            "/upload/", params={"inline": "true"},
+            files={"file": ("a.jp2", image)})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/octet-stream"
+        assert response.headers["x-file-id"]
+        assert response.content == process_data("decode", image, 0)
+        apply.assert_not_called()
+
+    with mock.patch("app.main.FAST_PATH_MAX_BYTES", len(image) - 1):
+        response = client.post(
+            "/upload/", params={"inline": "true"},
+            files={"file": ("a.jp2", image)})
+        assert response.status_code == 413
+
+
+def test_payload_failure_is_raised():
+    """
+    Test that a payload job that cannot be processed fails its task and
+    records FAILURE, instead of returning the error as its result.
+    """
+    store = MemoryPayloadStore()
+    status = MemoryStatusStore()
+    with mock.patch.object(fast_path, "payload_store", store), \
+            mock.patch.object(task_status, "status_store", status):
+        result = fast_path.process_payload.apply(
+            (input_key("gone"), output_key("gone"), "decode"),
+            task_id="task-1")
+    assert result.failed()
+    with pytest.raises(ValueError, match="expired"):
+        result.get()
+    assert status.get("task-1")["state"] == "FAILURE"
@@ -2,7 +2,11 @@
 Tests for the GPUManager class.
 """
 
-from app.gpu_manager import gpu_manager
+from app.gpu_manager import gpu_manager, GPUManager, GPUUnavailableError
+from app.telemetry import StubBackend, TelemetrySampler
+import pytest
+import threading
+import time
 
 
 def test_allocate_gpu():
@@ -21,3 +25,115 @@ def test_release_gpu():
     gpu_id = gpu_manager.allocate_gpu()
     gpu_manager.release_gpu(gpu_id)
     assert gpu_id in gpu_manager.available_gpus
+
+
+def test_allocate_gpu_timeout():
+    """
+    Test that allocation gives up after the timeout when no GPU is free.
+    """
+    manager = GPUManager(num_gpus=1)
+    assert manager.allocate_gpu() == 0
+    assert manager.allocate_gpu(timeout=0) is None
+    assert manager.allocate_gpu(timeout=0.05) is None
+    assert manager.wait_stats()["timeouts"] == 2
+
+    with pytest.raises(GPUUnavailableError):
+        with manager.gpu(timeout=0.01):
+            pass
+
+
+def test_waiters_served_by_priority():
+    """
+    Test that a released GPU goes to the highest-priority waiter.
+    """
+    manager = GPUManager(num_gpus=1, aging_rate=0)
+    gpu_id = manager.allocate_gpu()
+    served = []
+
+    def wait(priority):
+        with manager.gpu(priority=priority, timeout=5):
+            served.append(priority)
+
+    threads = []
+    for priority in (0, 5, 1):
+        thread = threading.Thread(target=wait, args=(priority,))
+        thread.start()
+        threads.append(thread)
+        while manager.wait_stats()["queued"] < len(threads):
+            time.sleep(0.001)
+
+    manager.release_gpu(gpu_id)
+    for thread in threads:
+        thread.join()
+
+    assert served == [5, 1, 0]
+    assert manager.wait_stats()["max_wait"] > 0
+    assert list(manager.available_gpus) == [gpu_id]
+
+
+def test_shortest_expected_job_served_first():
+    """
+    Test that among equal priorities the job expected to be shortest wins.
+    """
+    manager = GPUManager(num_gpus=1, aging_rate=0, cost_weight=1)
+    gpu_id = manager.allocate_gpu()
+    served = []
+
+    def wait(cost):
+        with manager.gpu(timeout=5, cost=cost):
+            served.append(cost)
+
+    threads = []
+    for cost in (30.0, 0.5, 4.0):
+        thread = threading.Thread(target=wait, args=(cost,))
+        thread.start()
+        threads.append(thread)
+        while manager.wait_stats()["queued"] < len(threads):
+            time.sleep(0.001)
+
+    manager.release_gpu(gpu_id)
+    for thread in threads:
+        thread.join()
+
+    assert served == [0.5, 4.0, 30.0]
+
+
+def test_aging_prevents_starvation():
+    """
+    Test that a long-waiting low-priority job overtakes newer high-priority
+    ones.
+    """
+    manager = GPUManager(num_gpus=1, aging_rate=1000)
+    gpu_id = manager.allocate_gpu()
+    served = []
+
+    def wait(priority):
+        with manager.gpu(priority=priority, timeout=5):
+            served.append(priority)
+
+    low = threading.Thread(target=wait, args=(0,))
+    low.start()
+    time.sleep(0.05)
+    high = threading.Thread(target=wait, args=(10,))
+    high.start()
+    while manager.wait_stats()["queued"] < 2:
+        time.sleep(0.001)
+
+    manager.release_gpu(gpu_id)
+    low.join()
+    high.join()
+    assert served == [0, 10]
+
+
+def test_allocate_least_loaded_gpu():
+    """
+    Test that the free GPU with the lowest recent utilization is chosen.
+    """
+    sampler = TelemetrySampler(StubBackend(3, pattern=(80, 20, 50)))
+    sampler.sample_once()
+    manager = GPUManager(num_gpus=3, telemetry=sampler)
+
+    assert manager.gpu_usage == [80, 20, 50]
+    assert manager.allocate_gpu() == 1
+    assert manager.allocate_gpu() == 2
+    assert manager.allocate_gpu() == 0
@@ -0,0 +1,29 @@
+"""
+Tests for the image index module.
+"""
+
+from app.image_index import ImageIndex
+from app.jp2 import parse_header
+
+
+def test_put_get_delete(tmp_path):
+    """
+    Test that headers are stored, replaced and removed by file ID.
+    """
+    index = ImageIndex(str(tmp_path / "index" / "images.db"))
+    header = parse_header("test_images/sample1.jp2")
+    assert index.get("a") is None
+
+    index.put("a", header, "uploads/a.jp2")
+    assert index.get("a") == header
+
+    index.put("a", header._replace(width=10))
+    assert index.get("a").width == 10
+
+    index.delete("a")
+    assert index.get("a") is None
+    index.close()
+
+    # Entries are persisted for other processes
+    index.put("b", header)
+    assert ImageIndex(index.path).get("b") == header
@@ -0,0 +1,62 @@
+"""
+Tests for the JPEG2000 header module.
+"""
+
+from app.jp2 import ImageHeader, InvalidHeaderError, parse_header
+import io
+import struct
+import pytest
+
+
+def make_codestream(levels=5, component_levels=None):
+    """
+    Build the main header of a 3-component, 16-bit, 1000x600 codestream
+    with 256x256 tiles.
+    """
+    siz = struct.pack(">HIIIIIIIIH", 0, 1000, 600, 0, 0, 256, 256, 0, 0, 3)
+    siz += b"\x0f\x01\x01" * 3
+    cod = b"\x00\x00\x00\x01\x00" + bytes([levels, 4, 4, 0, 1])
+    header = b"\xff\x4f"
+    header += b"\xff\x51" + struct.pack(">H", len(siz) + 2) + siz
+    header += b"\xff\x52" + struct.pack(">H", len(cod) + 2) + cod
+    for component, component_level in (component_levels or {}).items():
+        coc = bytes([component, 0, component_level, 4, 4, 0, 1])
+        header += b"\xff\x53" + struct.pack(">H", len(coc) + 2) + coc
+    return header + b"\xff\x90\x00\x0a" + b"\x00" * 64
+
+
+def test_parse_jp2_file():
+    """
+    Test that the header of a JP2 file is read without reading the file.
+    """
+    header = parse_header("test_images/sample1.jp2")
+
+    assert header == ImageHeader(
+        width=2717, height=3701, num_components=3, bit_depth=8,
+        signed=False, tile_width=1024, tile_height=1024, num_tiles_x=3,
+        num_tiles_y=4, decomposition_levels=5)
+
+
+def test_parse_raw_codestream():
+    """
+    Test a raw codestream with per-component decomposition levels.
+    """
+    header = parse_header(io.BytesIO(make_codestream(5, {1: 3})))
+
+    assert (header.width, header.height) == (1000, 600)
+    assert header.bit_depth == 16
+    assert (header.num_tiles_x, header.num_tiles_y) == (4, 3)
+    assert header.decomposition_levels == 3
+
+
+@pytest.mark.parametrize("data", [
+    b"\xff\xd8\xff\xe0" + b"\x00" * 16,
+    make_codestream()[:40],
+    b"\x00\x00\x00\x0cjP  \r\n\x87\n" + b"\x00\x00\x00\x08free",
+])
+def test_invalid_headers(data):
+    """
+    Test that other formats and truncated headers are rejected.
+    """
+    with pytest.raises(InvalidHeaderError):
+        parse_header(io.BytesIO(data))
@@ -0,0 +1,108 @@
+"""
+Tests for the GPU lease backends and their use by the GPUManager.
+"""
+
+import multiprocessing
+import threading
+import time
+
+from app.gpu_manager import GPUManager
+from app.leases import FileLeaseBackend, MemoryLeaseBackend, make_owner_id
+
+
+def test_leases_expire_unless_renewed():
+    """
+    Test that a lease blocks other owners until it expires or is released.
+    """
+    leases = MemoryLeaseBackend()
+    assert leases.acquire("node:1:a", [0, 1], ttl=0.05) == 0
+    assert leases.acquire("node:1:b", [0], ttl=0.05) is None
+    assert leases.renew("node:1:a", [0, 1], ttl=0.05) == [0]
+    assert leases.leases()[0].owner == "node:1:a"
+
+    time.sleep(0.06)
+    assert leases.leases() == {}
+    assert leases.acquire("node:1:b", [0], ttl=1) == 0
+    assert leases.renew("node:1:a", [0]) == []
+
+    leases.release("node:1:a", 0)
+    assert leases.acquire("node:1:c", [0]) is None
+    leases.release("node:1:b", 0)
+    assert leases.acquire("node:1:c", [0]) == 0
+
+
+def test_waiting_owner_outranks_lower_scores():
+    """
+    Test that a free device goes to no caller ranked below a waiting owner.
+    """
+    leases = MemoryLeaseBackend()
+    leases.set_waiting("node:1:a", 5.0)
+    assert leases.acquire("node:1:b", [0], score=1.0) is None
+    assert leases.acquire("node:1:b", [0], score=7.0) == 0
+    assert leases.acquire("node:1:a", [1], score=5.0) == 1
+    leases.clear_waiting("node:1:a")
+    assert leases.acquire("node:1:b", [2], score=1.0) == 2
+
+
+def _lease_and_exit(directory):
+    FileLeaseBackend(directory).acquire(make_owner_id(), [0], ttl=60)
+
+
+def test_file_leases_of_dead_processes_are_reclaimed(tmp_path):
+    """
+    Test that the lease of a process that exited without releasing it is
+    reclaimed at once.
+    """
+    leases = FileLeaseBackend(str(tmp_path))
+    child = multiprocessing.get_context("fork").Process(
+        target=_lease_and_exit, args=(str(tmp_path),))
+    child.start()
+    child.join()
+
+    assert leases.leases() == {}
+    assert leases.acquire(make_owner_id(), [0]) == 0
+
+
+def test_managers_share_gpus_through_leases(tmp_path):
+    """
+    Test that managers of different processes do not hand out the same GPU
+    and that a waiting manager gets a GPU released by another.
+    """
+    first = GPUManager(num_gpus=1, leases=FileLeaseBackend(str(tmp_path)),
+                       poll_interval=0.005)
+    second = GPUManager(num_gpus=1, leases=FileLeaseBackend(str(tmp_path)),
+                        poll_interval=0.005)
+    assert first.allocate_gpu() == 0
+    assert second.allocate_gpu(timeout=0) is None
+    assert second.available_gpus == []
+
+    allocated = []
+    waiter = threading.Thread(
+        target=lambda: allocated.append(second.allocate_gpu(timeout=5)))
+    waiter.start()
+    while second.wait_stats()["queued"] < 1:
+        time.sleep(0.001)
+    # The waiting manager outranks new requests of the first one
+    time.sleep(0.02)
+    first.release_gpu(0)
+    assert first.allocate_gpu(timeout=0) is None
+    waiter.join()
+
+    assert allocated == [0]
+    assert second.held == {0}
+    second.close()
+    assert first.allocate_gpu(timeout=0) == 0
+    first.close()
+
+
+def test_allocation_is_fast_with_file_leases(tmp_path):
+    """
+    Test that an uncontended allocation takes well under a millisecond.
+    """
+    manager = GPUManager(num_gpus=4, leases=FileLeaseBackend(str(tmp_path)))
+    manager.release_gpu(manager.allocate_gpu())
+    start = time.perf_counter()
+    for _ in range(100):
+        manager.release_gpu(manager.allocate_gpu())
+    assert (time.perf_counter() - start) / 200 < 0.001
+    manager.close()
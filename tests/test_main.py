@@ -3,7 +3,14 @@ Tests for the main FastAPI application.
 """
 
 from fastapi.testclient import TestClient
+from app import task_status
+from app.cache import ResultCache
+from app.image_index import ImageIndex
 from app.main import app
+from app.storage import upload_store
+from app.task_status import MemoryStatusStore
+from unittest import mock
+import os
 
 client = TestClient(app)
 
@@ -50,3 +57,140 @@ def test_submit_batch():
     })
     assert response.status_code == 200
     assert response.json() == {"status": "Batch job submitted successfully"}
+
+
+def test_upload_cached(tmp_path):
+    """
+    Test that a repeated upload is served from the result cache.
+    """
+    cache = ResultCache(root=str(tmp_path / "cache"))
+    with mock.patch("app.main.result_cache", cache), \
+            mock.patch("app.main.process_image.apply_async",
+                       return_value=mock.Mock(id="task-1")) as apply_async:
+        first = client.post("/upload/", files={"file": ("a.jp2", b"data")})
+        assert first.json()["cached"] is False
+
+        # Simulate the worker storing the result
+        (_, output_image, _), kwargs = apply_async.call_args[0]
+        with open(output_image, "wb") as f:
+            f.write(b"decoded")
+        cache.put(kwargs["cache_key"], output_image)
+
+        second = client.post("/upload/", files={"file": ("a.jp2", b"data")})
+        assert second.json()["cached"] is True
+        assert second.json()["task_id"] is None
+        assert apply_async.call_count == 1
+
+
+def test_metrics_endpoint():
+    """
+    Test that stage histograms are exposed in the Prometheus format.
+    """
+    with mock.patch("app.main.process_image.apply_async",
+                    return_value=mock.Mock(id="task-1")):
+        client.post("/upload/", files={"file": ("m.jp2", b"metrics")})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE image_stage_duration_seconds histogram" in response.text
+    assert 'stage="upload_receive"' in response.text
+    assert 'stage="enqueue"' in response.text
+
+
+def test_get_image_reduced_region(tmp_path):
+    """
+    Test that a preview is decoded on first request, that requests while
+    it is decoded share its task, and that it is served afterwards.
+    """
+    file_id = f"{tmp_path.name}.jp2"
+    input_path = upload_store.path(file_id, create=True)
+    with open(input_path, "wb") as f:
+        f.write(b"codestream")
+    params = {"reduce": 3, "region": "0,0,8,8"}
+    with mock.patch("app.main.process_image.apply_async") as apply_async, \
+            mock.patch.object(task_status, "status_store",
+                              MemoryStatusStore()), \
+            mock.patch("app.storage.os.makedirs") as makedirs:
+        response = client.get(f"/images/{file_id}", params=params)
+        assert response.status_code == 202
+        task_id = response.json()["task_id"]
+        assert apply_async.call_args[1]["task_id"] == task_id
+        (input_image, output_image, operation), kwargs = \
+            apply_async.call_args[0]
+        assert kwargs == {"reduce": 3, "region": (0, 0, 8, 8)}
+        makedirs.assert_not_called()
+
+        response = client.get(f"/images/{file_id}", params=params)
+        assert response.json()["task_id"] == task_id
+        assert apply_async.call_count == 1
+
+        # A failed decode is submitted again
+        task_status.record(task_id, "FAILURE", error="GPU lost")
+        response = client.get(f"/images/{file_id}", params=params)
+        assert response.json()["task_id"] != task_id
+        assert apply_async.call_count == 2
+
+    os.makedirs(os.path.dirname(output_image), exist_ok=True)
+    with open(output_image, "wb") as f:
+        f.write(b"preview")
+    with mock.patch("app.main.process_image.apply_async") as apply_async:
+        response = client.get(f"/images/{file_id}", params=params)
+        assert response.status_code == 200
+        assert response.content == b"preview"
+        apply_async.assert_not_called()
+
+    assert client.get(
+        f"/images/{file_id}", params={"region": "0,0,8"}).status_code == 400
+    assert client.get(
+        "/images/missing", params={"reduce": 1}).status_code == 404
+    os.remove(input_path)
+    os.remove(output_image)
+
+
+def test_upload_indexes_header(tmp_path):
+    """
+    Test that the header of a JPEG2000 upload is parsed into the index.
+    """
+    index = ImageIndex(str(tmp_path / "images.db"))
+    with open("test_images/sample1.jp2", "rb") as f:
+        data = f.read()
+    with mock.patch("app.main.image_index", index), \
+            mock.patch("app.main.process_image.apply_async",
+                       return_value=mock.Mock(id="task-1")):
+        response = client.post(
+            "/upload/", files={"file": ("s.jp2", data)},
+            params={"operation": "encode"})
+        other = client.post("/upload/", files={"file": ("t.txt", b"text")})
+
+    body = response.json()
+    assert body["image"]["width"] == 2717
+    assert body["image"]["decomposition_levels"] == 5
+    assert index.get(body["file_id"]).height == 3701
+    assert other.json()["image"] is None
+    assert index.get(other.json()["file_id"]) is None
+
+
+def test_upload_priority_and_admission():
+    """
+    Test that the priority reaches the task and full queues are refused.
+    """
+    with mock.patch("app.main.process_image.apply_async",
+                    return_value=mock.Mock(id="task-1")) as apply_async:
+        response = client.post(
+            "/upload/", files={"file": ("p.jp2", b"priority")},
+            params={"priority": 7})
+        assert response.status_code == 200
+        assert apply_async.call_args[0][1]["priority"] == 7
+
+        assert client.post(
+            "/upload/", files={"file": ("p.jp2", b"priority")},
+            params={"priority": 11}).status_code == 400
+
+        with mock.patch("app.main.admission.check", return_value=12):
+            response = client.post(
+                "/upload/", files={"file": ("p.jp2", b"priority")},
+                params={"priority": -5})
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "12"
+        assert apply_async.call_count == 1
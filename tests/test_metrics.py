@@ -0,0 +1,100 @@
+"""
+Tests for the metrics module.
+"""
+
+from app.metrics import Histogram, Registry, render_prometheus
+import os
+import threading
+import time
+from unittest import mock
+
+
+def test_histogram_render():
+    """
+    Test that observations are rendered as cumulative Prometheus buckets.
+    """
+    registry = Registry(directory="")
+    histogram = registry.histogram(
+        "stage_seconds", "Stage time.", ("stage",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, stage="decode")
+
+    text = registry.render()
+    assert "# TYPE stage_seconds histogram" in text
+    assert 'stage_seconds_bucket{stage="decode",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="decode",le="1"} 3' in text
+    assert 'stage_seconds_bucket{stage="decode",le="+Inf"} 4' in text
+    assert 'stage_seconds_count{stage="decode"} 4' in text
+    assert 'stage_seconds_sum{stage="decode"} 4.25' in text
+
+
+def test_registries_merge_across_processes(tmp_path):
+    """
+    Test that snapshots written by other processes are aggregated.
+    """
+    worker = Registry(directory=str(tmp_path))
+    api = Registry(directory=str(tmp_path))
+    for registry, count in ((worker, 3), (api, 2)):
+        histogram = registry.histogram("wait_seconds", "Wait.", ("gpu",))
+        for _ in range(count):
+            histogram.observe(0.01, gpu=0)
+    # The worker has a different PID in production; give it its own file
+    worker._instance = (os.getpid(), "worker")
+    worker.flush()
+
+    text = api.render()
+    assert 'wait_seconds_count{gpu="0"} 5' in text
+
+
+def test_label_values_are_escaped():
+    """
+    Test that quotes and backslashes in label values are escaped.
+    """
+    histogram = Histogram("h", "Help.", ("path",), buckets=(1,))
+    histogram.observe(0.5, path='a"b\\c')
+    text = render_prometheus({"h": histogram.snapshot()})
+    assert 'h_count{path="a\\"b\\\\c"} 1' in text
+
+
+def test_stale_snapshots_are_removed(tmp_path):
+    """
+    Test that the snapshot of an exited process is dropped once it was not
+    rewritten for the snapshot TTL.
+    """
+    exited = Registry(directory=str(tmp_path))
+    exited.histogram("wait_seconds", "Wait.", ("gpu",)).observe(0.01, gpu=0)
+    exited._instance = (os.getpid(), "exited")
+    exited.flush()
+    api = Registry(directory=str(tmp_path), snapshot_ttl=60)
+
+    assert 'wait_seconds_count{gpu="0"} 1' in api.render()
+
+    path = exited._snapshot_path()
+    stale = time.time() - 120
+    os.utime(path, (stale, stale))
+    assert "wait_seconds" not in api.render()
+    assert not os.path.exists(path)
+
+
+def test_snapshots_are_written_in_the_background(tmp_path):
+    """
+    Test that an observation leaves the snapshot to the flusher thread.
+    """
+    registry = Registry(directory=str(tmp_path), flush_interval=0.05)
+    write_snapshot = registry._write_snapshot
+    writers = []
+
+    def record_writer():
+        writers.append(threading.current_thread().name)
+        write_snapshot()
+
+    with mock.patch.object(registry, "_write_snapshot", record_writer):
+        registry.histogram("h", "Help.").observe(0.5)
+        registry.maybe_flush()
+        assert writers == []
+        deadline = time.monotonic() + 5
+        while not writers and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    assert writers[0] == "metrics-flush"
+    assert len(os.listdir(tmp_path)) == 1
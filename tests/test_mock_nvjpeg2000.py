@@ -0,0 +1,91 @@
+"""
+Tests for the simulated GPUs of the mock nvJPEG2000 library.
+"""
+
+import threading
+from time import perf_counter
+
+import pytest
+
+from app import mock_nvjpeg2000
+from app.mock_nvjpeg2000 import SimulatedDevices, nvjpeg2kOutOfMemoryError
+
+
+def test_stream_reports_header_and_output_size():
+    """
+    Test that parsed streams report the image of their header and decodes
+    and encodes return outputs of realistic size.
+    """
+    with open("test_images/sample1.jp2", "rb") as f:
+        data = f.read()
+    stream = mock_nvjpeg2000.nvjpeg2kStreamCreate(None)
+    mock_nvjpeg2000.nvjpeg2kStreamParse(None, stream, data, len(data))
+    info = mock_nvjpeg2000.nvjpeg2kStreamGetImageInfo(stream)
+    assert (info.width, info.height, info.num_components) == (2717, 3701, 3)
+    assert mock_nvjpeg2000.nvjpeg2kStreamGetResolutionsInTile(stream, 0) == 6
+
+    decoded = mock_nvjpeg2000.nvjpeg2kDecode(
+        None, None, stream, 2717, 3701, 3, 0)
+    assert len(decoded) == 2717 * 3701 * 3
+    encoded = mock_nvjpeg2000.nvjpeg2kEncode(None, None, stream, 0)
+    assert len(encoded) == -(-2717 * 3701 * 3 // 8)
+
+    # Data that is not a JPEG2000 file is a 1920x1080 image
+    mock_nvjpeg2000.nvjpeg2kStreamParse(None, stream, b"raw", 3)
+    assert mock_nvjpeg2000.nvjpeg2kStreamGetImageInfo(stream).width == 1920
+
+
+def test_calls_take_their_pixels_over_the_throughput():
+    """
+    Test that calls last their overhead plus pixels over the throughput of
+    their GPU and that seeded jitter repeats.
+    """
+    devices = SimulatedDevices(throughput="100,50", call_overhead=0.002)
+    assert devices.duration(0, 1000000) == pytest.approx(0.012)
+    assert devices.duration(1, 1000000) == pytest.approx(0.022)
+    assert devices.duration(7, 1000000) == pytest.approx(0.022)
+
+    first = SimulatedDevices(throughput=100, jitter=0.1, seed=3)
+    second = SimulatedDevices(throughput=100, jitter=0.1, seed=3)
+    durations = [first.duration(0, 10 ** 6) for _ in range(5)]
+    assert durations == [second.duration(0, 10 ** 6) for _ in range(5)]
+    assert len(set(durations)) == 5
+
+    devices.run(0, 500000, 0)
+    assert devices.stats[0]["calls"] == 1
+    assert devices.stats[0]["busy_seconds"] == pytest.approx(0.007)
+
+
+def test_calls_fail_when_gpu_memory_runs_out():
+    """
+    Test that concurrent calls fail when their buffers exceed the memory of
+    their GPU, and that memory is released after each call.
+    """
+    devices = SimulatedDevices(throughput=0, memory=1000)
+    with devices.allocate(0, 600):
+        with pytest.raises(nvjpeg2kOutOfMemoryError):
+            devices.run(0, 10, 600)
+        # Another GPU has its own memory
+        devices.run(1, 10, 600)
+
+    devices.run(0, 10, 600)
+    assert devices.allocated[0] == 0
+    assert devices.stats[0]["oom_errors"] == 1
+    assert devices.stats[0]["peak_memory"] == 600
+
+
+def test_calls_on_one_gpu_run_one_after_the_other():
+    """
+    Test that calls on the same GPU are serialized.
+    """
+    devices = SimulatedDevices(throughput=0, call_overhead=0.02)
+    threads = [threading.Thread(target=devices.run, args=(0, 0, 0))
+               for _ in range(3)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert perf_counter() - start >= 0.06
+    assert devices.stats[0]["calls"] == 3
+    assert devices.stats[0]["busy_seconds"] == pytest.approx(0.06)
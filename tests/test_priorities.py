@@ -0,0 +1,108 @@
+"""
+Tests for the priorities module.
+"""
+
+from app.priorities import (
+    AdmissionController, WeightedCycle, queue_for_priority,
+    QUEUE_DEFAULT, QUEUE_HIGH, QUEUE_LOW)
+from app.tasks import celery
+from collections import Counter
+
+
+def test_queue_routing():
+    """
+    Test that tasks are routed to the queue of their priority tier.
+    """
+    assert queue_for_priority(10) == QUEUE_HIGH
+    assert queue_for_priority(0) == QUEUE_DEFAULT
+    assert queue_for_priority(-1) == QUEUE_LOW
+
+    router = celery.amqp.router
+    route = router.route({}, "app.tasks.process_image", (), {"priority": 7})
+    assert route["queue"].name == QUEUE_HIGH
+    route = router.route({}, "app.tasks.check_gpu_status", (), {})
+    assert route["queue"].name == QUEUE_DEFAULT
+
+
+def test_weighted_cycle():
+    """
+    Test that busy queues are served in proportion to their weights and
+    that an idle queue does not block the others.
+    """
+    cycle = WeightedCycle(weights={"high": 6, "default": 3, "low": 1})
+    cycle.update(["high", "default", "low"])
+    served = Counter()
+    for _ in range(100):
+        queue = cycle.consume(3)[0]
+        served[queue] += 1
+        cycle.rotate(queue)
+    assert served == {"high": 60, "default": 30, "low": 10}
+
+    # The high queue is empty: the next queue in order is served
+    order = cycle.consume(3)
+    cycle.rotate(order[1])
+    assert len(cycle.consume(3)) == 3
+
+
+def serve(cycle, backlog):
+    """
+    Take one message the way Kombu's Redis transport does: from the first
+    non-empty queue of the order the cycle returns.
+    """
+    for queue in cycle.consume(len(backlog)):
+        if backlog[queue]:
+            backlog[queue] -= 1
+            cycle.rotate(queue)
+            return queue
+    return None
+
+
+def test_weighted_cycle_after_idle_period():
+    """
+    Test that a queue left idle while another is busy does not build up
+    credit that starves the busy queue once it fills again.
+    """
+    cycle = WeightedCycle(weights={"high": 6, "default": 3, "low": 1})
+    cycle.update(["high", "default", "low"])
+    backlog = {"high": 10_000, "default": 0, "low": 0}
+    for _ in range(10_000):
+        assert serve(cycle, backlog) == "high"
+
+    # A burst of backfill arrives with more high-priority work
+    backlog = {"high": 1_000, "default": 0, "low": 1_000}
+    first = [serve(cycle, backlog) for _ in range(20)]
+    assert first.index("high") <= 1
+    assert Counter(first)["high"] >= 16
+
+
+def test_admission_retry_after():
+    """
+    Test that a full queue is refused for the time it needs to drain.
+    """
+    now = [0.0]
+    depths = {QUEUE_LOW: 100, QUEUE_HIGH: 0}
+    controller = AdmissionController(
+        lambda: dict(depths), max_depth=50, refresh_interval=10,
+        min_drain_rate=1, clock=lambda: now[0])
+
+    # Nothing drained yet: the minimum drain rate applies
+    assert controller.check(QUEUE_HIGH) is None
+    assert controller.check(QUEUE_LOW) == 51
+
+    # 10 tasks published and 30 drained in 10 seconds: 3 per second
+    for _ in range(10):
+        controller.record_publish(routing_key=QUEUE_LOW)
+    depths[QUEUE_LOW] = 80
+    now[0] = 10.0
+    assert controller.check(QUEUE_LOW) == 11
+
+
+def test_admission_fails_open():
+    """
+    Test that jobs are admitted while the broker cannot be reached.
+    """
+    def unreachable():
+        raise ConnectionError("broker down")
+
+    controller = AdmissionController(unreachable, max_depth=1)
+    assert controller.check(QUEUE_DEFAULT) is None
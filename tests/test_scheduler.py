@@ -0,0 +1,136 @@
+"""
+Tests for the scheduler module.
+"""
+
+from app.image_index import ImageIndex
+from app.jp2 import ImageHeader
+from app.scheduler import CostModel, JobScheduler, job_work
+import json
+import os
+import pytest
+import time
+
+HEADER = ImageHeader(
+    width=1000, height=600, num_components=3, bit_depth=16, signed=False,
+    tile_width=256, tile_height=256, num_tiles_x=4, num_tiles_y=3,
+    decomposition_levels=5)
+
+
+def make_job(name, work, priority=0, enqueued_at=100.0):
+    """
+    Build an annotated job dictionary for the tests.
+    """
+    return {"input_image": name, "operation": "decode", "work": work,
+            "cost": work / 1e6, "memory": 2 * work, "priority": priority,
+            "enqueued_at": enqueued_at}
+
+
+def test_job_work():
+    """
+    Test that the work shrinks with the resolution level and region.
+    """
+    assert job_work(HEADER) == 1000 * 600 * 3 * 2
+    assert job_work(HEADER, reduce=2) == 250 * 150 * 3 * 2
+    assert job_work(HEADER, region=(900, 0, 500, 10)) == 100 * 10 * 3 * 2
+
+
+def test_cost_model_refit():
+    """
+    Test that the model is refit to observed timings.
+    """
+    model = CostModel(directory="", refit_interval=0, decay=1)
+    for work in (1e6, 2e6, 4e6, 8e6):
+        model.observe("decode", work, 0.01 + work * 1e-8)
+    assert model.estimate("decode", 16e6) == pytest.approx(0.17)
+
+    # A single image size only rescales the default coefficients
+    model.observe("encode", 1e6, 1.0)
+    assert model.estimate("encode", 1e6) == pytest.approx(1.0)
+
+
+def test_cost_model_shares_observations(tmp_path):
+    """
+    Test that a process plans with the timings observed by others.
+    """
+    worker = CostModel(directory=str(tmp_path), refit_interval=0, decay=1)
+    api = CostModel(directory=str(tmp_path), refit_interval=0, decay=1)
+    for work in (1e6, 3e6):
+        worker.observe("decode", work, work * 1e-7)
+    worker.flush()
+
+    api.load_snapshots()
+    assert api.estimate("decode", 2e6) == pytest.approx(0.2)
+
+
+def test_cost_model_removes_stale_snapshots(tmp_path):
+    """
+    Test that snapshots not rewritten within their TTL are removed, and
+    that estimates load snapshots in the background.
+    """
+    stale = tmp_path / "1-dead.json"
+    stale.write_text(json.dumps({"decode": [1, 1e6, 100.0, 1e12, 1e8]}))
+    os.utime(stale, (time.time() - 7200,) * 2)
+    fresh = tmp_path / "2-live.json"
+    fresh.write_text(json.dumps({"decode": [2, 2e6, 0.2, 2e12, 2e5]}))
+    model = CostModel(directory=str(tmp_path), refit_interval=0,
+                      snapshot_ttl=3600)
+
+    model.estimate("decode", 1e6)
+    deadline = time.monotonic() + 5
+    while stale.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not stale.exists()
+    model.load_snapshots()
+    assert fresh.exists()
+    assert model.estimate("decode", 1e6) == pytest.approx(0.1)
+
+
+def test_plan_orders_and_packs(tmp_path):
+    """
+    Test that jobs are ordered shortest first within memory-bound batches
+    spread over the GPUs.
+    """
+    scheduler = JobScheduler(
+        CostModel(directory=""), memory_budget=100, num_gpus=2,
+        aging_rate=0, cost_weight=1,
+        index=ImageIndex(str(tmp_path / "images.db")))
+    jobs = [make_job("big", 40), make_job("a", 5), make_job("b", 10),
+            make_job("c", 20), make_job("urgent", 30, priority=1)]
+
+    batches = scheduler.plan(jobs, now=100.0)
+
+    assert [[job["input_image"] for job in batch["jobs"]]
+            for batch in batches] == [["urgent"], ["a", "b", "c"], ["big"]]
+    assert all(batch["memory"] <= 100 for batch in batches)
+    assert batches[0]["priority"] == 1
+
+
+def test_plan_ages_waiting_jobs(tmp_path):
+    """
+    Test that a long-waiting large job overtakes newer small ones.
+    """
+    scheduler = JobScheduler(
+        CostModel(directory=""), num_gpus=1, aging_rate=1, cost_weight=1,
+        index=ImageIndex(str(tmp_path / "images.db")))
+    jobs = [make_job("new", 1e6, enqueued_at=100.0),
+            make_job("old", 5e6, enqueued_at=80.0)]
+
+    batch, = scheduler.plan(jobs, now=100.0)
+
+    assert [job["input_image"] for job in batch["jobs"]] == ["old", "new"]
+
+
+def test_annotate_from_index(tmp_path):
+    """
+    Test that jobs are costed from the indexed header.
+    """
+    index = ImageIndex(str(tmp_path / "images.db"))
+    index.put("f", HEADER)
+    scheduler = JobScheduler(CostModel(directory=""), index=index)
+
+    job = scheduler.annotate({"file_id": "f", "input_image": "missing",
+                              "operation": "decode", "reduce": 1})
+
+    assert job["work"] == 500 * 300 * 3 * 2
+    assert job["memory"] == 2 * job["work"]
+    assert job["cost"] > 0
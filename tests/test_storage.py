@@ -0,0 +1,131 @@
+"""
+Tests for the sharded storage areas, their index and the sweeper.
+"""
+
+import os
+
+import pytest
+
+from app.storage import StorageArea, StorageIndex, Sweeper
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    """
+    Yield a storage index in a temporary working directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    index = StorageIndex(str(tmp_path / "storage.db"))
+    yield index
+    index.close()
+
+
+def store(area, file_id, suffix="", size=10, now=0):
+    """
+    Write an object of ``size`` bytes and register it at time ``now``.
+    """
+    path = area.path(file_id, suffix, create=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    area.index.add(area.name, path, size, now=now)
+    return path
+
+
+def test_sharded_layout(index):
+    """
+    Test that the objects of a file ID share a shard and are found there.
+    """
+    area = StorageArea("uploads", index=index)
+    image = store(area, "a", "_scan.jp2")
+    variant = store(area, "a", ".reduce-2")
+    store(area, "ab")
+    with open(f"{variant}.123.tmp", "wb"):
+        pass
+    assert os.path.dirname(image) == area.shard("a")
+    assert area.shard("a").count(os.sep) == 2
+
+    assert area.objects("a") == [variant, image]
+    assert area.find("a") == image
+    assert area.find("missing") is None
+
+    # Files of the flat layout are still found
+    with open("uploads/legacy", "wb"):
+        pass
+    assert area.find("legacy") == "uploads/legacy"
+
+    area.remove(area.objects("a"))
+    assert area.objects("a") == []
+    assert index.total("uploads") == (1, 10)
+
+
+def test_totals_follow_the_index(index):
+    """
+    Test that the totals of each area are kept by adds, updates and
+    removals.
+    """
+    index.add("output", "output/a", 100)
+    index.add("output", "output/b", 50)
+    index.add("uploads", "uploads/a", 7)
+    assert index.total("output") == (2, 150)
+
+    index.add("output", "output/a", 30)
+    assert index.total("output") == (2, 80)
+
+    index.remove(["output/b", "output/missing"])
+    assert index.total("output") == (1, 30)
+    assert index.total("uploads") == (1, 7)
+    assert index.total("other") == (0, 0)
+
+
+def test_sweep_expires_old_objects(index):
+    """
+    Test that objects older than the TTL are removed, a batch at a time.
+    """
+    area = StorageArea("output", ttl=100, index=index)
+    old = [store(area, f"old-{i}", now=i) for i in range(5)]
+    new = store(area, "new", now=150)
+
+    assert area.sweep(limit=3, now=200) == (3, 30)
+    assert [os.path.exists(path) for path in old] == [False] * 3 + [True] * 2
+    assert area.sweep(limit=3, now=200) == (2, 20)
+    assert os.path.exists(new)
+    assert index.total("output") == (1, 10)
+
+
+def test_sweep_evicts_least_recently_used(index):
+    """
+    Test that the quota evicts the least recently used objects, sparing
+    those used within the grace period.
+    """
+    area = StorageArea("output", max_bytes=25, index=index)
+    paths = [store(area, str(i), now=i) for i in range(4)]
+    index.touch(paths[0], now=10)
+
+    assert area.sweep(now=100, grace=5) == (2, 20)
+    assert [os.path.exists(path) for path in paths] == [
+        True, False, False, True]
+
+    # Recently used objects are kept even over the quota
+    store(area, "4", size=100, now=98)
+    assert area.sweep(now=100, grace=5) == (2, 20)
+    assert index.total("output") == (1, 100)
+
+
+def test_sweeper_only_runs_with_limits(index):
+    """
+    Test that the sweeper skips areas without a quota or TTL.
+    """
+    kept = StorageArea("uploads", index=index)
+    expiring = StorageArea("output", ttl=1, index=index)
+    store(kept, "a")
+    store(expiring, "a")
+
+    sweeper = Sweeper([kept], limit=1)
+    sweeper.start()
+    assert sweeper._thread is None
+
+    sweeper = Sweeper([kept, expiring], limit=1)
+    assert sweeper.sweep_once() is True
+    assert sweeper.sweep_once() is False
+    assert index.total("uploads") == (1, 10)
+    assert index.total("output") == (0, 0)
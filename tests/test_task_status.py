@@ -0,0 +1,149 @@
+"""
+Tests for task status recording and the waiters of the TaskStatusHub.
+"""
+
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import pytest
+import redis
+from fastapi.testclient import TestClient
+
+from app import task_status
+from app.main import app
+from app.task_status import (
+    MemoryStatusStore, RedisStatusStore, StatusStoreUnavailable,
+    TaskStatusHub)
+from app.tasks import create_slurm_script, decode_image
+
+client = TestClient(app)
+
+
+def record_later(store, task_id, state, delay=0.1, **fields):
+    """
+    Record a state from another thread after a delay.
+    """
+    def run():
+        time.sleep(delay)
+        with mock.patch.object(task_status, "status_store", store):
+            task_status.record(task_id, state, **fields)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_final_state_is_kept():
+    """
+    Test that a late non-final state does not replace a final one.
+    """
+    store = MemoryStatusStore()
+    with mock.patch.object(task_status, "status_store", store):
+        task_status.record("t", "QUEUED", queued_at=10.0)
+        task_status.record("t", "STARTED", started_at=11.0)
+        task_status.record("t", "SUCCESS", finished_at=13.5, outputs=["o"])
+        task_status.record("t", "SUBMITTED", slurm_job_id=7)
+
+    status = task_status.describe("t", store.get("t"))
+    assert status["state"] == "SUCCESS"
+    assert status["slurm_job_id"] == 7
+    assert status["queue_seconds"] == 1.0
+    assert status["run_seconds"] == 2.5
+
+
+def test_unreachable_redis_is_not_retried_at_once():
+    """
+    Test that after a failed connection the Redis store fails fast until
+    its retry interval has passed, and that recording stays best-effort.
+    """
+    client = mock.Mock()
+    client.hgetall.side_effect = redis.ConnectionError("refused")
+    store = RedisStatusStore(client=client, retry_interval=60)
+    with pytest.raises(redis.ConnectionError):
+        store.get("t")
+    with pytest.raises(StatusStoreUnavailable):
+        store.get("t")
+    assert client.hgetall.call_count == 1
+
+    with mock.patch.object(task_status, "status_store", store):
+        task_status.record("t", "QUEUED")
+    client.register_script.return_value.assert_not_called()
+
+    store._retry_at = 0
+    client.hgetall.side_effect = None
+    client.hgetall.return_value = {}
+    assert store.get("t") is None
+
+
+def test_waiters_share_one_subscription():
+    """
+    Test that many waiters of a task are woken by one store subscription.
+    """
+    store = MemoryStatusStore()
+    hub = TaskStatusHub(store)
+    store.update("t", {"state": "STARTED"})
+
+    async def main():
+        waits = [asyncio.ensure_future(hub.wait("t", 5))
+                 for _ in range(2000)]
+        while hub.waiting() < len(waits):
+            await asyncio.sleep(0.001)
+        await asyncio.to_thread(store.update, "t", {"state": "SUCCESS"})
+        return await asyncio.gather(*waits)
+
+    results = asyncio.run(main())
+    assert all(status["state"] == "SUCCESS" for status in results)
+    assert len(store.listeners) == 1
+    assert hub.waiting() == 0
+
+
+def test_get_task_long_poll_and_events():
+    """
+    Test the status endpoint, its long-poll and its event stream.
+    """
+    store = MemoryStatusStore()
+    hub = TaskStatusHub(store)
+    store.update("t", {"state": "STARTED", "started_at": 1.0})
+    with mock.patch("app.main.hub", hub):
+        assert client.get("/tasks/t").json()["state"] == "STARTED"
+        assert client.get("/tasks/missing").status_code == 404
+        assert client.get("/tasks/t", params={"wait": -1}).status_code == 400
+
+        thread = record_later(store, "t", "SUBMITTED", slurm_job_id=3)
+        response = client.get("/tasks/t", params={"wait": 0.3})
+        thread.join()
+        assert response.json()["state"] == "SUBMITTED"
+
+        thread = record_later(store, "t", "SUCCESS", outputs=["output/t"])
+        with client.stream("GET", "/tasks/t/events") as response:
+            assert response.headers["content-type"].startswith(
+                "text/event-stream")
+            states = [line for line in response.iter_lines()
+                      if line.startswith("data:")]
+        thread.join()
+        assert len(states) == 2
+        assert '"state": "SUCCESS"' in states[-1]
+        assert '"outputs": ["output/t"]' in states[-1]
+
+
+def test_slurm_job_reports_outcome(tmp_path):
+    """
+    Test that a Slurm job script reports its outcome under the task ID.
+    """
+    script = create_slurm_script("in.jp2", "out.raw", "decode", 0,
+                                 task_id="abc")
+    with open(script) as f:
+        assert "task_id='abc'" in f.read()
+    os_path = str(tmp_path / "out.raw")
+
+    store = MemoryStatusStore()
+    with mock.patch.object(task_status, "status_store", store):
+        decode_image("test_images/sample1.jp2", os_path, 0, task_id="abc")
+        try:
+            decode_image("missing.jp2", os_path, 0, task_id="def")
+        except OSError:
+            pass
+    assert store.get("abc")["state"] == "SUCCESS"
+    assert store.get("abc")["outputs"] == [os_path]
+    assert store.get("def")["state"] == "FAILURE"
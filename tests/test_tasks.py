@@ -2,13 +2,26 @@
 Tests for the tasks module.
 """
 
+from app import mock_nvjpeg2000
 from app.tasks import (
     decode_image,
     encode_image,
     create_slurm_script,
-    submit_slurm_job
+    submit_slurm_job,
+    SlurmSubmitError,
+    process_image,
+    process_image_array,
+    run_manifest_entry,
+    map_input,
+    write_output
 )
+from app.gpu_manager import GPUUnavailableError
+from app.task_status import MemoryStatusStore
+import json
+import mmap
 import os
+import sys
+import pytest
 import time
 from unittest import mock
 
@@ -32,6 +45,49 @@ def test_decode_image():
     assert duration > 0  # Ensure it took some time to process
 
 
+def test_decode_image_reduced_region(tmp_path):
+    """
+    Test that a reduced region decode only processes the tiles and
+    resolution levels it needs.
+    """
+    output_image = str(tmp_path / "preview.raw")
+    mock_nvjpeg2000.reset_call_counts()
+    decode_image("test_images/sample1.jp2", output_image, 0)
+    full = dict(mock_nvjpeg2000.decode_counts)
+
+    mock_nvjpeg2000.reset_call_counts()
+    decode_image("test_images/sample1.jp2", output_image, 0,
+                 reduce=3, region=(0, 0, 600, 400))
+    partial = mock_nvjpeg2000.decode_counts
+
+    # sample1.jp2 is 2717x3701 in 1024x1024 tiles with 5 decompositions
+    assert full == {"tiles": 12, "resolution_levels": 72,
+                    "pixels": 2717 * 3701}
+    assert partial == {"tiles": 1, "resolution_levels": 3,
+                       "pixels": 75 * 50}
+    assert os.path.getsize(output_image) == 75 * 50 * 3
+    assert os.path.exists(output_image)
+
+    with pytest.raises(ValueError):
+        decode_image("test_images/sample1.jp2", output_image, 0,
+                     region=(3000, 0, 10, 10))
+
+
+def test_decode_image_feeds_the_cost_model(tmp_path):
+    """
+    Test that a single-image decode feeds its codec time to the cost model.
+    """
+    output_image = str(tmp_path / "preview.raw")
+    with mock.patch("app.tasks.scheduler.observe") as observe:
+        decode_image("test_images/sample1.jp2", output_image, 0,
+                     reduce=3, region=(0, 0, 600, 400))
+
+    job, seconds = observe.call_args.args
+    assert job == {"operation": "decode", "work": 75 * 50 * 3}
+    assert seconds > 0
+    assert observe.call_args.kwargs == {"cpu": False}
+
+
 def test_encode_image():
     """
     Test the encode_image function.
@@ -71,7 +127,8 @@ def test_submit_slurm_job():
     """
     with mock.patch("subprocess.run",
                     return_value=mock.Mock(
-                        stdout="Submitted batch job 12345\n")):
+                        returncode=0,
+                        stdout="Submitted batch job 12345\n")) as run:
         script_path = "slurm_scripts/job_0.sh"
         priority = 0
 
@@ -79,3 +136,166 @@ def test_submit_slurm_job():
             script_path, priority
         )
         assert job_id == 12345
+        assert "--nice=110" in run.call_args[0][0]
+
+        # Negative priorities are never passed to sbatch as --priority
+        submit_slurm_job(script_path, -10)
+        args = run.call_args[0][0]
+        assert "--nice=1020" in args
+        assert "--priority" not in args
+
+
+def test_submit_slurm_job_rejected():
+    """
+    Test that a job rejected by sbatch raises instead of looking submitted.
+    """
+    with mock.patch("subprocess.run",
+                    return_value=mock.Mock(
+                        returncode=1, stdout="",
+                        stderr="sbatch: error: invalid qos\n")):
+        with pytest.raises(SlurmSubmitError, match="invalid qos"):
+            submit_slurm_job("slurm_scripts/job_0.sh", 0)
+
+
+def test_decode_image_reuses_codec():
+    """
+    Test that repeated decodes on one GPU reuse the pooled codec objects.
+    """
+    output_image = "output/sample1_output.jp2"
+    os.makedirs(os.path.dirname(output_image), exist_ok=True)
+    decode_image("test_images/sample1.jp2", output_image, 0)
+
+    mock_nvjpeg2000.reset_call_counts()
+    for _ in range(3):
+        decode_image("test_images/sample1.jp2", output_image, 0)
+    assert mock_nvjpeg2000.call_counts["nvjpeg2kCreate"] == 0
+    assert mock_nvjpeg2000.call_counts["nvjpeg2kDecodeStateCreate"] == 0
+
+
+def test_process_image_retries_without_gpu():
+    """
+    Test that process_image is retried rather than succeeding when no GPU
+    becomes available.
+    """
+    with mock.patch("app.tasks.gpu_manager.allocate_gpu",
+                    return_value=None):
+        with pytest.raises(GPUUnavailableError):
+            process_image("test_images/sample1.jp2",
+                          "output/sample1_output.jp2", "decode")
+
+
+def test_process_image_fails_when_sbatch_rejects_the_job(monkeypatch):
+    """
+    Test that a job rejected by sbatch fails its task instead of returning
+    the error as a successful result.
+    """
+    store = MemoryStatusStore()
+    monkeypatch.setattr("app.task_status.status_store", store)
+    monkeypatch.setattr("app.tasks.prefer_cpu", lambda jobs: False)
+    with mock.patch("app.tasks.submit_slurm_job",
+                    side_effect=SlurmSubmitError("invalid qos")):
+        result = process_image.apply(
+            ("test_images/sample1.jp2", "output/sample1_output.jp2",
+             "decode"), task_id="task-1")
+    assert result.failed()
+    with pytest.raises(SlurmSubmitError):
+        result.get()
+    assert store.get("task-1")["state"] == "FAILURE"
+
+
+def test_create_slurm_script_unique_names(tmp_path, monkeypatch):
+    """
+    Test that concurrent jobs on the same GPU get distinct scripts.
+    """
+    monkeypatch.setattr("app.tasks.SLURM_SCRIPT_DIR", str(tmp_path))
+    paths = {
+        create_slurm_script("test_images/sample1.jp2",
+                            "output/sample1_output.jp2", "decode", 0)
+        for _ in range(3)
+    }
+    assert len(paths) == 3
+
+
+def test_process_image_array(tmp_path, monkeypatch):
+    """
+    Test that a group of jobs is submitted as one Slurm job array whose
+    tasks each process one manifest row and record its final state.
+    """
+    store = MemoryStatusStore()
+    monkeypatch.setattr("app.task_status.status_store", store)
+    log_path = tmp_path / "sbatch.log"
+    monkeypatch.setenv("FAKE_SBATCH_LOG", str(log_path))
+    monkeypatch.setattr(
+        "app.tasks.SBATCH_COMMAND",
+        f"{sys.executable} {os.path.join('tests', 'fake_sbatch.py')}")
+    monkeypatch.setattr("app.tasks.SLURM_SCRIPT_DIR", str(tmp_path))
+    jobs = [
+        {
+            "input_image": "test_images/sample1.jp2",
+            "output_image": str(tmp_path / f"out_{i}.raw"),
+            "operation": "decode",
+            "task_id": f"task-{i}"
+        }
+        for i in range(3)
+    ]
+
+    status = process_image_array(jobs, priority=2)
+
+    with open(log_path) as log_file:
+        submissions = [json.loads(line) for line in log_file]
+    assert len(submissions) == 1
+    assert "#SBATCH --array=0-2" in submissions[0]["directives"]
+    assert submissions[0]["args"][:1] == ["--nice=108"]
+    assert "1000" in status
+
+    manifest_path = submissions[0]["args"][-1].replace(".sh", ".jsonl")
+    run_manifest_entry(manifest_path, 1)
+    assert os.path.exists(jobs[1]["output_image"])
+    assert not os.path.exists(jobs[0]["output_image"])
+    assert store.get("task-1")["state"] == "SUCCESS"
+    assert store.get("task-1")["outputs"] == [jobs[1]["output_image"]]
+    assert store.get("task-0")["state"] == "SUBMITTED"
+    assert store.get("task-0")["slurm_array_index"] == 0
+
+    monkeypatch.setattr("app.tasks.map_input", mock.Mock(
+        side_effect=OSError("input gone")))
+    with pytest.raises(OSError):
+        run_manifest_entry(manifest_path, 2)
+    assert store.get("task-2")["state"] == "FAILURE"
+    assert store.get("task-2")["error"] == "input gone"
+
+
+def test_map_input(tmp_path, monkeypatch):
+    """
+    Test that inputs are memory-mapped and empty files fall back to a read.
+    """
+    input_image = "test_images/sample1.jp2"
+    with open(input_image, "rb") as f:
+        expected = f.read()
+
+    view = map_input(input_image, prefetch=True)
+    assert isinstance(view.obj, mmap.mmap)
+    assert view == expected
+    view.release()
+
+    empty = tmp_path / "empty.jp2"
+    empty.write_bytes(b"")
+    assert map_input(str(empty)) == b""
+
+    monkeypatch.setattr("app.tasks.MMAP_INPUT", False)
+    view = map_input(input_image)
+    assert isinstance(view.obj, bytes)
+    assert view == expected
+
+
+def test_write_output_from_buffer(tmp_path):
+    """
+    Test that write_output accepts any buffer and leaves no temporary file.
+    """
+    output_image = tmp_path / "out.raw"
+    data = bytearray(b"decoded" * 1000)
+
+    write_output(str(output_image), memoryview(data)[7:])
+
+    assert output_image.read_bytes() == bytes(data[7:])
+    assert os.listdir(tmp_path) == ["out.raw"]
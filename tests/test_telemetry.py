@@ -0,0 +1,54 @@
+"""
+Tests for the telemetry module.
+"""
+
+from app.telemetry import RingBuffer, StubBackend, TelemetrySampler
+
+
+class FakeClock:
+    """
+    A clock that advances only when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ring_buffer_overwrites_oldest():
+    """
+    Test that the ring buffer keeps only the newest samples.
+    """
+    buffer = RingBuffer(3)
+    for i in range(5):
+        buffer.append(float(i), {"value": i})
+
+    assert len(buffer) == 3
+    assert [t for t, _ in buffer.since(0)] == [2.0, 3.0, 4.0]
+    assert [t for t, _ in buffer.since(3.5)] == [4.0]
+    assert buffer.latest() == (4.0, {"value": 4})
+
+
+def test_sampler_series_and_average():
+    """
+    Test that one pass samples every GPU and averages cover the window.
+    """
+    clock = FakeClock()
+    sampler = TelemetrySampler(
+        StubBackend(2, pattern=(10, 30)), capacity=10, clock=clock)
+    assert sampler.average(0, "utilization") is None
+
+    for _ in range(4):
+        sampler.sample_once()
+        clock.now += 5
+
+    assert [v for _, v in sampler.series(0, "utilization")] == [
+        10, 30, 10, 30]
+    assert [v for _, v in sampler.series(1, "utilization")] == [
+        30, 10, 30, 10]
+    assert sampler.average(0, "utilization", window=60) == 20
+    assert sampler.average(0, "utilization", window=6) == 30
+    assert sampler.latest(1)["temperature"] == 35
+    assert sampler.series(5, "utilization") == []
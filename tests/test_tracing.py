@@ -0,0 +1,184 @@
+"""
+Tests for trace context propagation and the span exporters.
+"""
+
+from types import SimpleNamespace
+from unittest import mock
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import tasks, tracing
+from app.main import app
+from app.tracing import (
+    JsonLinesExporter, MemoryExporter, Tracer, format_traceparent,
+    parse_traceparent)
+
+client = TestClient(app)
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+TRACEPARENT = f"00-{TRACE_ID}-00f067aa0ba902b7-01"
+
+
+@pytest.fixture
+def exporter():
+    """
+    Collect the spans of the process tracer in memory, sampling every
+    trace.
+    """
+    exporter = MemoryExporter()
+    with mock.patch.object(tracing.tracer, "_exporter", exporter), \
+            mock.patch.object(tracing.tracer, "sample_rate", 1.0):
+        yield exporter
+
+
+def test_traceparent_round_trip():
+    """
+    Test that traceparent headers are parsed and formatted, and malformed
+    ones ignored.
+    """
+    context = parse_traceparent(TRACEPARENT)
+    assert context == (TRACE_ID, "00f067aa0ba902b7", True)
+    assert format_traceparent(context) == TRACEPARENT
+    assert parse_traceparent("00-xyz-00f067aa0ba902b7-01") is None
+    assert parse_traceparent(f"00-{'0' * 32}-00f067aa0ba902b7-01") is None
+    assert parse_traceparent(None) is None
+
+
+def test_sampling_follows_the_parent():
+    """
+    Test that new traces are sampled at the sample rate and continued
+    traces as their parent decided.
+    """
+    exporter = MemoryExporter()
+    tracer = Tracer(exporter, sample_rate=0.0, environ={})
+    tracer.start_span("root").end()
+    with tracer.span("outside a trace") as span:
+        assert span is None
+    assert list(exporter.spans) == []
+
+    parent = tracer.start_span("request", TRACEPARENT)
+    with tracer.span("child"):
+        pass
+    parent.end()
+    child, request = exporter.spans
+    assert request["trace_id"] == child["trace_id"] == TRACE_ID
+    assert request["parent_id"] == "00f067aa0ba902b7"
+    assert child["parent_id"] == request["span_id"]
+    assert tracer.current() is None
+
+
+def test_jsonl_exporter(tmp_path):
+    """
+    Test that spans are buffered and appended to the trace file.
+    """
+    path = str(tmp_path / "traces" / "spans.jsonl")
+    exporter = JsonLinesExporter(path, buffer_spans=2)
+    tracer = Tracer(exporter, sample_rate=1.0, environ={})
+    with tracer.span("unsampled"):
+        pass
+    tracer.start_span("first").end()
+    assert not (tmp_path / "traces").exists()
+    span = tracer.start_span("second")
+    span.end(error=ValueError("bad image"))
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+    spans = exporter.trace(span.context.trace_id)
+    assert [s["name"] for s in spans] == ["second"]
+    assert spans[0]["error"] == "bad image"
+
+
+def test_jsonl_exporter_rotates_the_file(tmp_path):
+    """
+    Test that the trace file is rotated once it outgrows its limit, and
+    that only the last rotated file is kept and searched.
+    """
+    path = str(tmp_path / "spans.jsonl")
+    exporter = JsonLinesExporter(path, buffer_spans=1, max_bytes=1000)
+    tracer = Tracer(exporter, sample_rate=1.0, environ={})
+    trace_ids = []
+    for index in range(40):
+        span = tracer.start_span(f"span-{index}")
+        span.end()
+        trace_ids.append(span.context.trace_id)
+
+    assert "spans.jsonl.1" in os.listdir(tmp_path)
+    assert set(os.listdir(tmp_path)) <= {"spans.jsonl", "spans.jsonl.1"}
+    assert os.path.getsize(path + ".1") <= 1000 + 500
+    assert exporter.trace(trace_ids[0]) == []
+    assert [s["name"] for s in exporter.trace(trace_ids[-1])] == ["span-39"]
+    kept = [trace_id for trace_id in trace_ids if exporter.trace(trace_id)]
+    assert kept == trace_ids[-len(kept):]
+
+
+def test_http_request_is_traced(exporter):
+    """
+    Test that a request continues the trace of its traceparent header,
+    returns its own, and that the trace can be read back.
+    """
+    response = client.get("/images/missing",
+                          headers={"traceparent": TRACEPARENT})
+    assert response.status_code == 404
+    context = parse_traceparent(response.headers["traceparent"])
+    assert context.trace_id == TRACE_ID
+    (span,) = exporter.spans
+    assert span["name"] == "GET /images/missing"
+    assert span["attributes"]["status_code"] == 404
+
+    trace = client.get(f"/traces/{TRACE_ID}").json()
+    assert trace["spans"][0]["span_id"] == context.span_id
+    assert client.get(f"/traces/{'1' * 32}").status_code == 404
+
+
+def test_trace_reaches_the_slurm_job_and_codec(exporter, tmp_path,
+                                               monkeypatch):
+    """
+    Test that the trace context goes from a published task to the worker,
+    into the Slurm job script and down to the codec stages of the job.
+    """
+    monkeypatch.setattr(tasks, "SLURM_SCRIPT_DIR", str(tmp_path))
+    request = tracing.tracer.start_span("POST /upload/", TRACEPARENT)
+    headers = {}
+    tasks.stamp_enqueue_time(headers=headers)
+    tasks.inject_trace_context(headers=headers)
+    request.end()
+    assert headers["traceparent"] == format_traceparent(request.context)
+
+    # The worker runs the task in the trace of the request
+    task = SimpleNamespace(name="app.tasks.process_image",
+                           request=SimpleNamespace(retries=0, **headers))
+    tasks.start_task_span(task_id="t", task=task)
+    script = tasks.create_slurm_script(
+        "test_images/sample1.jp2", str(tmp_path / "out.raw"), "decode", 0)
+    task_span = task.request.trace_span
+    tasks.end_task_span(task=task, state="SUCCESS")
+    with open(script) as f:
+        content = f.read()
+    traceparent = format_traceparent(task_span.context)
+    assert f"export TRACEPARENT={traceparent}" in content
+    assert "tracer.record_slurm_pending()" in content
+
+    # The Slurm job continues the trace from its environment
+    submitted_at = time.time() - 5
+    job = Tracer(exporter, environ={"TRACEPARENT": traceparent})
+    job.record_slurm_pending({"TRACE_SUBMITTED_AT": str(submitted_at),
+                              "SLURM_JOB_ID": "42"})
+    with mock.patch.object(tracing.tracer, "_environ_context",
+                           job.current()):
+        tasks.decode_image("test_images/sample1.jp2",
+                           str(tmp_path / "out.raw"), 0)
+
+    spans = {span["name"]: span for span in exporter.trace(TRACE_ID)}
+    assert spans["POST /upload/"]["parent_id"] == "00f067aa0ba902b7"
+    assert (spans["queue_wait"]["parent_id"]
+            == spans["app.tasks.process_image"]["parent_id"]
+            == spans["POST /upload/"]["span_id"])
+    task_id = spans["app.tasks.process_image"]["span_id"]
+    assert spans["slurm.pending"]["parent_id"] == task_id
+    assert spans["slurm.pending"]["duration"] >= 5
+    assert spans["slurm.pending"]["attributes"]["slurm_job_id"] == "42"
+    assert spans["decode_image"]["parent_id"] == task_id
+    for stage in ("parse", "decode", "output_write"):
+        assert spans[stage]["parent_id"] == spans["decode_image"]["span_id"]
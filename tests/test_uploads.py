@@ -0,0 +1,137 @@
+"""
+Tests for the uploads module.
+"""
+
+from app.uploads import (
+    MULTIPART_OVERHEAD, UploadLimitMiddleware, receive_upload)
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+import hashlib
+import os
+
+
+def multipart_body(data, boundary="test-boundary", chunk_size=4096):
+    """
+    Yield a multipart body holding a 'file' field and a plain field, in
+    chunks, so that it is sent without a Content-Length.
+    """
+    yield (f"--{boundary}\r\n"
+           f'Content-Disposition: form-data; name="note"\r\n\r\n'
+           f"ignored\r\n--{boundary}\r\n"
+           f'Content-Disposition: form-data; name="file"; '
+           f'filename="image.jp2"\r\n'
+           f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def upload_client(tmp_path, **options):
+    """
+    Return a client of an application receiving uploads into tmp_path,
+    and the list the results are appended to.
+    """
+    app = FastAPI()
+    results = []
+
+    @app.post("/upload/")
+    async def upload(request: Request):
+        upload, data = await receive_upload(
+            request, lambda filename: str(tmp_path / filename), **options)
+        results.append((upload, data))
+        return {}
+
+    return TestClient(app), results
+
+
+def post(client, data):
+    return client.post(
+        "/upload/", content=multipart_body(data),
+        headers={"Content-Type":
+                 "multipart/form-data; boundary=test-boundary"})
+
+
+def test_receive_upload(tmp_path):
+    """
+    Test that a streamed upload is written to disk, sized and hashed.
+    """
+    data = os.urandom(300_000)
+    client, results = upload_client(tmp_path)
+
+    assert post(client, data).status_code == 200
+
+    upload, kept = results[0]
+    assert kept is None
+    assert upload.path == str(tmp_path / "image.jp2")
+    assert upload.filename == "image.jp2"
+    assert upload.size == len(data)
+    assert upload.sha256 == hashlib.sha256(data).hexdigest()
+    with open(upload.path, "rb") as f:
+        assert f.read() == data
+    assert os.listdir(tmp_path) == ["image.jp2"]
+
+
+def test_receive_upload_keeps_small_files_in_memory(tmp_path):
+    """
+    Test that a file within the memory size is not written to disk.
+    """
+    client, results = upload_client(tmp_path, memory_size=10_000)
+
+    assert post(client, b"small").status_code == 200
+    assert post(client, b"x" * 10_001).status_code == 200
+
+    assert results[0][0].path is None
+    assert results[0][1] == b"small"
+    assert results[1][1] is None
+    assert os.path.getsize(results[1][0].path) == 10_001
+
+
+def test_receive_upload_too_large(tmp_path):
+    """
+    Test that an upload without a Content-Length is cut off once it
+    exceeds the size limit, and cleaned up.
+    """
+    client, results = upload_client(tmp_path, max_size=5_000)
+
+    assert post(client, b"x" * 10_000).status_code == 413
+    assert results == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_receive_upload_without_file(tmp_path):
+    """
+    Test that a body without the file field or in another format is
+    refused.
+    """
+    client, results = upload_client(tmp_path)
+
+    response = client.post("/upload/", data={"note": "no file"},
+                           files={"other": ("a.jp2", b"data")})
+    assert response.status_code == 400
+    assert client.post("/upload/", content=b"data").status_code == 415
+    assert results == []
+
+
+def test_upload_limit_refuses_declared_length():
+    """
+    Test that a request declaring a body over the limit is refused before
+    its body is read, except on exempt paths.
+    """
+    app = FastAPI()
+    received = []
+
+    @app.post("/{path:path}")
+    async def receive(request: Request):
+        received.append(len(await request.body()))
+        return {}
+
+    app.add_middleware(UploadLimitMiddleware, max_size=1000,
+                       exempt=("/batches/",))
+    client = TestClient(app)
+    body = b"x" * (1000 + MULTIPART_OVERHEAD + 1)
+
+    assert client.post("/upload/", content=body).status_code == 413
+    assert received == []
+    assert client.post("/upload/", content=b"x" * 1000).status_code == 200
+    assert client.post("/batches/", content=body).status_code == 200
+    assert received == [1000, len(body)]